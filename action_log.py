@@ -0,0 +1,187 @@
+"""
+action_log.py
+Буфер аналитики действий пользователей: запись без ввода-вывода, пакетный сброс в таблицу stats
+"""
+
+import asyncio
+import logging
+from collections import deque
+from datetime import datetime
+from typing import Dict, Any, Optional, Deque, Tuple
+
+import config
+import database
+from async_db import adb
+
+logger = logging.getLogger(__name__)
+
+# Доля заполнения буфера, после которой сброс запускается досрочно и фиксируется перегрузка
+BACKPRESSURE_RATIO = 0.8
+
+ActionEvent = Tuple[int, str, Optional[str], str]
+
+
+class ActionLog:
+    """
+    Кольцевой буфер событий аналитики.
+
+    log() только кладет событие в память, фоновая задача раз в
+    ACTION_LOG_FLUSH_INTERVAL секунд (или сразу после ACTION_LOG_BATCH_SIZE
+    событий) пишет накопленное одним bulk_log_actions через поток записи БД.
+    Время события фиксируется в момент log(). Если запись не успевает и
+    буфер переполнен, вытесняются самые старые события (счетчик dropped).
+    Без запущенной фоновой задачи (скрипты, тесты) события пишутся сразу.
+    """
+
+    def __init__(self, capacity: int = config.ACTION_LOG_BUFFER_SIZE,
+                 batch_size: int = config.ACTION_LOG_BATCH_SIZE,
+                 flush_interval: float = config.ACTION_LOG_FLUSH_INTERVAL):
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._events: Deque[ActionEvent] = deque(maxlen=capacity)
+        self._flush_event: Optional[asyncio.Event] = None
+        self._flush_task: Optional[asyncio.Task] = None
+        # Пакет, который сейчас пишет фоновая задача
+        self._writing: Optional[asyncio.Future] = None
+        self._stopping = False
+        self._backpressure_reported = False
+        self.stats = {
+            'logged': 0,        # всего событий
+            'written': 0,       # записано в БД
+            'dropped': 0,       # вытеснено из переполненного буфера
+            'failed': 0,        # потеряно из-за ошибки записи
+            'backpressure': 0,  # сколько раз буфер заполнялся выше BACKPRESSURE_RATIO
+            'flushes': 0,       # пакетных записей
+            'max_buffered': 0   # максимальная глубина буфера
+        }
+
+    def log(self, user_id: int, action: str, details: Optional[str] = None):
+        """Записать действие пользователя"""
+        self.stats['logged'] += 1
+
+        if self._flush_task is None or self._flush_task.done():
+            self.stats['written'] += 1
+            database.fast_log_action(user_id, action, details)
+            return
+
+        if len(self._events) == self.capacity:
+            self.stats['dropped'] += 1
+        self._events.append((user_id, action, details, datetime.now().isoformat()))
+
+        depth = len(self._events)
+        if depth > self.stats['max_buffered']:
+            self.stats['max_buffered'] = depth
+        if depth >= self.capacity * BACKPRESSURE_RATIO:
+            if not self._backpressure_reported:
+                self._backpressure_reported = True
+                self.stats['backpressure'] += 1
+                logger.warning(f"⚠️ Буфер аналитики заполнен на {depth}/{self.capacity}, запись в БД не успевает")
+            self._flush_event.set()
+        elif depth >= self.batch_size:
+            self._flush_event.set()
+
+    def _take_batch(self) -> list:
+        batch = list(self._events)
+        self._events.clear()
+        self._backpressure_reported = False
+        return batch
+
+    def _account(self, batch: list, ok: bool):
+        if ok:
+            self.stats['written'] += len(batch)
+            self.stats['flushes'] += 1
+        else:
+            self.stats['failed'] += len(batch)
+
+    def flush(self) -> int:
+        """
+        Синхронная запись всех накопленных событий
+
+        Returns:
+            Количество записанных событий
+        """
+        if not self._events:
+            return 0
+        batch = self._take_batch()
+        ok = database.bulk_log_actions(batch)
+        self._account(batch, ok)
+        return len(batch) if ok else 0
+
+    async def _flush_loop(self):
+        """Фоновая задача записи событий"""
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._flush_event.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_event.clear()
+
+            if not self._events:
+                continue
+            batch = self._take_batch()
+            self._writing = asyncio.ensure_future(adb.write(database.bulk_log_actions, batch))
+            try:
+                ok = await self._writing
+            except Exception as e:
+                logger.error(f"❌ Ошибка записи событий аналитики: {e}")
+                ok = False
+            finally:
+                self._writing = None
+            self._account(batch, ok)
+
+    def start(self):
+        """Включение буферизации (вызывать из работающего event loop)"""
+        if self._flush_task is not None and not self._flush_task.done():
+            return
+
+        self._stopping = False
+        self._flush_event = asyncio.Event()
+        self._flush_task = asyncio.create_task(self._flush_loop())
+        logger.info(f"✅ Буфер аналитики включен ({self.flush_interval} с / {self.batch_size} событий, "
+                    f"емкость {self.capacity})")
+
+    async def stop(self):
+        """Остановка фоновой задачи и запись оставшихся событий"""
+        if self._flush_task is not None:
+            # Задача завершается сама после текущей записи (без cancel - запись не обрывается)
+            self._stopping = True
+            self._flush_event.set()
+            await self._flush_task
+            self._flush_task = None
+
+        written = self.flush()
+        stats = self.stats
+        logger.info(f"✅ События аналитики сохранены при остановке ({written}), "
+                    f"всего: {stats['logged']}, потеряно: {stats['dropped'] + stats['failed']}")
+
+    def get_buffer_stats(self) -> Dict[str, int]:
+        """Счетчики буфера (в т.ч. перегрузка и потерянные события)"""
+        return {**self.stats, 'buffered': len(self._events)}
+
+    async def get_stats(self) -> Dict[str, Any]:
+        """database.get_stats() с учетом еще не записанных событий и счетчиками буфера"""
+        # Пакет, который уже пишет фоновая задача, дожидаемся - иначе он не попадет в счетчики
+        writing = self._writing
+        if writing is not None:
+            try:
+                await asyncio.shield(writing)
+            except Exception:
+                pass  # ошибку учитывает _flush_loop
+
+        if self._events:
+            batch = self._take_batch()
+            try:
+                ok = await adb.write(database.bulk_log_actions, batch)
+            except Exception as e:
+                logger.error(f"❌ Ошибка записи событий аналитики: {e}")
+                ok = False
+            self._account(batch, ok)
+
+        stats = await adb.read(database.get_stats)
+        stats['action_log'] = self.get_buffer_stats()
+        return stats
+
+
+# Глобальный буфер аналитики
+action_log = ActionLog()
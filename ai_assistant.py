@@ -2,16 +2,17 @@
 ai_assistant.py - AI помощник для общения с пользователями
 """
 
-import asyncio
 import json
 import subprocess
 import os
 import re
 import random
-from typing import Optional, Dict, List, Any
+from typing import Optional, Dict, List, Any, Callable, Awaitable
 import logging
 import database
 import cache_manager
+from menu_compiler import menu_compiler
+from llm_client import llm_client
 
 # Импорт requests
 import requests
@@ -21,6 +22,18 @@ logger = logging.getLogger(__name__)
 # История сообщений пользователей
 user_history: Dict[int, List[Dict]] = {}
 
+# Служебные маркеры в ответе модели - разбираются после получения ответа целиком
+_SERVICE_MARKER_RE = re.compile(r'CHECK_DELIVERY|PARSE_|SHOW_|SHOWDELIVERY|GEN_IMAGE|DISH_PHOTO|CONFIRM_AGE')
+# Недописанный маркер в конце потока
+_MARKER_TAIL_RE = re.compile(r'[A-Z_]+$')
+
+def visible_partial_text(text: str) -> str:
+    """Часть потокового ответа, которую можно показывать пользователю (без служебных маркеров)"""
+    match = _SERVICE_MARKER_RE.search(text)
+    if match:
+        text = text[:match.start()]
+    return _MARKER_TAIL_RE.sub('', text).rstrip()
+
 def load_token() -> str:
     """Загрузка токена GigaChat"""
     try:
@@ -44,27 +57,8 @@ def refresh_token() -> str:
         return ""
 
 def load_menu_cache() -> Dict:
-    """Загрузка кэша всех меню для AI"""
-    try:
-        # Сначала пробуем загрузить all_menus_cache.json
-        cache_file = 'files/all_menus_cache.json'
-        if os.path.exists(cache_file):
-            with open(cache_file, 'r', encoding='utf-8') as f:
-                cache_data = json.load(f)
-                # Возвращаем только all_menus часть
-                return cache_data.get('all_menus', {})
-
-        # Fallback на старый файл menu_cache.json
-        old_cache_file = 'files/menu_cache.json'
-        if os.path.exists(old_cache_file):
-            with open(old_cache_file, 'r', encoding='utf-8') as f:
-                cache_data = json.load(f)
-                return cache_data.get('all_menus', {})
-
-        return {}
-    except Exception as e:
-        logger.error(f"Ошибка загрузки кэша меню для AI: {e}")
-        return {}
+    """Все меню для AI (из памяти компилятора, файл читается только при обновлении)"""
+    return menu_compiler.get_menu_data()
 
 def get_ai_notes() -> str:
     """Получение дополнительных примечаний для ИИ из БД"""
@@ -520,10 +514,14 @@ async def check_and_reset_ai_limit(user_id: int) -> None:
     except Exception as e:
         logger.error(f"Ошибка проверки баланса бонусов для пользователя {user_id}: {e}")
 
-async def get_ai_response(message: str, user_id: int) -> Dict:
+async def get_ai_response(message: str, user_id: int,
+                          on_partial: Optional[Callable[[str], Awaitable[None]]] = None) -> Dict:
     """
     Получение ответа от AI
 
+    Args:
+        on_partial: вызывается с уже сгенерированной частью ответа (без служебных маркеров)
+
     Returns:
         Dict с ключами:
         - type: 'text' | 'photo' | 'photo_with_text'
@@ -545,48 +543,11 @@ async def get_ai_response(message: str, user_id: int) -> Dict:
             return {'type': 'text', 'text': faq_answer}
         
         # 2. Загружаем меню и примечания
-        menu_data = load_menu_cache()
+        # 3. ПОЛНЫЙ контекст меню собирается один раз на обновление меню
+        compiled_menu = menu_compiler.get()
+        menu_context = compiled_menu['text']
+        dish_index = compiled_menu['dish_index']
         ai_notes = get_ai_notes()
-        
-        # 3. Формируем ПОЛНЫЙ контекст меню для перечисления категорий
-        menu_context = "ПОЛНОЕ МЕНЮ РЕСТОРАНА (все позиции для перечисления):\n\n"
-
-        # Разделяем меню на доставку и бар
-        delivery_menu_ids = {90, 92, 141}
-        bar_menu_ids = {29, 91, 86, 32}
-
-        # Добавляем меню доставки с ПОЛНЫМИ категориями
-        for menu_id in delivery_menu_ids:
-            if menu_id in menu_data:
-                menu = menu_data[menu_id]
-                menu_name = menu.get('name', '').replace('🍳', '').replace('📋', '').strip()
-                menu_context += f"=== {menu_name} (ДОСТАВКА) ===\n"
-
-                for category_id, category in menu.get('categories', {}).items():
-                    category_name = category.get('name', '').replace('🍕', '').replace('🥗', '').strip()
-                    menu_context += f"\n{category_name}:\n"
-
-                    items = category.get('items', [])
-                    for item in items:
-                        menu_context += f"• {item['name']} - {item['price']}₽\n"
-                    menu_context += "\n"
-
-        # Добавляем меню бара с ПОЛНЫМИ категориями
-        for menu_id in bar_menu_ids:
-            if menu_id in menu_data:
-                menu = menu_data[menu_id]
-                menu_name = menu.get('name', '').replace('🍳', '').replace('📋', '').strip()
-                alcohol_note = " (АЛКОГОЛЬ)" if menu_id == 32 else ""
-                menu_context += f"=== {menu_name}{alcohol_note} (БАР) ===\n"
-
-                for category_id, category in menu.get('categories', {}).items():
-                    category_name = category.get('name', '').replace('🍕', '').replace('🥗', '').strip()
-                    menu_context += f"\n{category_name}:\n"
-
-                    items = category.get('items', [])
-                    for item in items:
-                        menu_context += f"• {item['name']} - {item['price']}₽\n"
-                    menu_context += "\n"
 
         # 4. Получаем историю
         if user_id not in user_history:
@@ -910,15 +871,7 @@ async def get_ai_response(message: str, user_id: int) -> Dict:
 
         logger.info("Отправляем запрос в Polza AI API")
 
-        # Отправляем запрос в Gemini API с правильным форматом
-
         # 8. Формируем запрос к Polza AI API
-        url = "https://api.polza.ai/api/v1/chat/completions"
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {token}"
-        }
-
         # Конвертируем сообщения в формат Polza AI (OpenAI совместимый)
         polza_messages = []
         for msg in [{"role": "system", "content": system_prompt}] + user_history[user_id]:
@@ -938,7 +891,7 @@ async def get_ai_response(message: str, user_id: int) -> Dict:
         data = {
             "model": "mistralai/mistral-small-3.2-24b-instruct",
             "messages": polza_messages,
-            "stream": False,  # Отключаем streaming для простоты
+            "stream": True,  # Ответ приходит по частям и показывается по мере генерации
             "max_tokens": 2000,  # Ограничиваем длину ответа
             "temperature": 0.3,  # Снижаем креативность для точности
             "top_p": 0.7,  # Уменьшаем разнообразие для точности
@@ -946,48 +899,19 @@ async def get_ai_response(message: str, user_id: int) -> Dict:
             "presence_penalty": 0.3  # Поощряем использование данных из контекста
         }
 
-        # Логируем полный запрос для отладки
-        logger.info(f"Polza AI Request URL: {url}")
-        logger.info(f"Polza AI Request Headers: {headers}")
-        logger.info(f"Polza AI Request Data: {json.dumps(data, indent=2, ensure_ascii=False)}")
-
-        # Выполняем запрос асинхронно
-        loop = asyncio.get_event_loop()
-        response = await loop.run_in_executor(
-            None,
-            lambda: requests.post(url, headers=headers, json=data, timeout=30)
-        )
-
-        logger.info(f"Polza AI response status: {response.status_code}")
-
-        if response.status_code not in [200, 201]:
-            logger.error(f"Polza AI API error: {response.status_code} - {response.text}")
-            # При ошибке используем fallback
-            return get_fallback_response(message, user_id)
-
-        response_data = response.json()
-        logger.info(f"Polza AI full response: {json.dumps(response_data, indent=2, ensure_ascii=False)}")
-
-        # Проверяем структуру ответа (OpenAI совместимый формат)
-        if 'choices' not in response_data:
-            logger.error(f"Polza AI API не вернул 'choices'. Доступные ключи: {list(response_data.keys())}")
-            return get_fallback_response(message, user_id)
-
-        if not response_data['choices']:
-            logger.error("Polza AI API вернул пустой массив choices")
-            return get_fallback_response(message, user_id)
+        logger.debug(f"Polza AI Request Data: {json.dumps(data, ensure_ascii=False)}")
 
-        choice = response_data['choices'][0]
-        if 'message' not in choice:
-            logger.error(f"Choice не содержит 'message'. Доступные ключи: {list(choice.keys())}")
-            return get_fallback_response(message, user_id)
+        async def forward_partial(text: str):
+            visible = visible_partial_text(text)
+            if visible:
+                await on_partial(visible)
 
-        ai_text = choice['message'].get('content', '')
+        ai_text = await llm_client.chat(token, data, on_text=forward_partial if on_partial else None)
         if not ai_text:
-            logger.warning("Polza AI вернул пустой content")
+            logger.warning("Polza AI не вернул ответ, используем fallback")
             return get_fallback_response(message, user_id)
 
-        logger.info(f"Polza AI response: {ai_text}")
+        logger.debug(f"Polza AI response: {ai_text}")
 
         # Не кешируем ответы для более живого общения
         user_history[user_id].append({"role": "assistant", "content": ai_text})
@@ -1077,36 +1001,36 @@ async def get_ai_response(message: str, user_id: int) -> Dict:
                     found_items = []
                     found_category_names = []
 
-                    for menu_id, menu in menu_data.items():
-                        for cat_id, category in menu.get('categories', {}).items():
-                            cat_name = category.get('name', '').lower().strip()
-                            cat_display = category.get('display_name', '').lower().strip()
-
-                            # Ищем ТОЛЬКО категории супов по точному совпадению
-                            is_soup_category = (
-                                cat_name == 'супы' or 
-                                cat_display == '🍲 супы' or
-                                cat_id in ['4819', '4722'] or  # Известные ID категорий супов
-                                (cat_name == 'суп' and 'чай' not in cat_display and 'напитки' not in cat_display)
-                            )
+                    for entry in dish_index.categories:
+                        cat_id, category = entry['cat_id'], entry['category']
+                        cat_name = entry['name']
+                        cat_display = entry['display'] or ''
+
+                        # Ищем ТОЛЬКО категории супов по точному совпадению
+                        is_soup_category = (
+                            cat_name == 'супы' or 
+                            cat_display == '🍲 супы' or
+                            str(cat_id) in ['4819', '4722'] or  # Известные ID категорий супов
+                            (cat_name == 'суп' and 'чай' not in cat_display and 'напитки' not in cat_display)
+                        )
                             
-                            if is_soup_category:
-                                items = category.get('items', [])
-                                if items:
-                                    # Дополнительная фильтрация: исключаем чай и напитки по названию блюда
-                                    soup_items = []
-                                    for item in items:
-                                        item_name_lower = item.get('name', '').lower()
-                                        # Исключаем чай, глинтвейн и другие напитки
-                                        if not any(drink_word in item_name_lower for drink_word in [
-                                            'чайник', 'чай', 'глинтвейн', 'напиток', 'коктейль', 'сок', 'вода'
-                                        ]):
-                                            soup_items.append(item)
+                        if is_soup_category:
+                            items = category.get('items', [])
+                            if items:
+                                # Дополнительная фильтрация: исключаем чай и напитки по названию блюда
+                                soup_items = []
+                                for item in items:
+                                    item_name_lower = item.get('name', '').lower()
+                                    # Исключаем чай, глинтвейн и другие напитки
+                                    if not any(drink_word in item_name_lower for drink_word in [
+                                        'чайник', 'чай', 'глинтвейн', 'напиток', 'коктейль', 'сок', 'вода'
+                                    ]):
+                                        soup_items.append(item)
                                     
-                                    found_items.extend(soup_items)
-                                    cat_display_name = category.get('display_name') or category.get('name', cat_name)
-                                    if cat_display_name not in found_category_names:
-                                        found_category_names.append(cat_display_name)
+                                found_items.extend(soup_items)
+                                cat_display_name = category.get('display_name') or category.get('name', cat_name)
+                                if cat_display_name not in found_category_names:
+                                    found_category_names.append(cat_display_name)
 
                     # Формируем специальный ответ для супов
                     if found_items:
@@ -1133,25 +1057,25 @@ async def get_ai_response(message: str, user_id: int) -> Dict:
                     found_items = []
                     found_category_names = []
 
-                    for menu_id, menu in menu_data.items():
-                        for cat_id, category in menu.get('categories', {}).items():
-                            cat_name = category.get('name', '').lower().strip()
-                            cat_display = category.get('display_name', '').lower().strip()
-
-                            # Проверяем, является ли категория пиццей
-                            is_pizza_category = (
-                                'пицц' in cat_name or 
-                                'пицц' in cat_display or
-                                cat_name == 'пицца'
-                            )
+                    for entry in dish_index.categories:
+                        cat_id, category = entry['cat_id'], entry['category']
+                        cat_name = entry['name']
+                        cat_display = entry['display'] or ''
+
+                        # Проверяем, является ли категория пиццей
+                        is_pizza_category = (
+                            'пицц' in cat_name or 
+                            'пицц' in cat_display or
+                            cat_name == 'пицца'
+                        )
                             
-                            if is_pizza_category:
-                                items = category.get('items', [])
-                                if items:
-                                    found_items.extend(items)
-                                    cat_display = category.get('display_name') or category.get('name', cat_name)
-                                    if cat_display not in found_category_names:
-                                        found_category_names.append(cat_display)
+                        if is_pizza_category:
+                            items = category.get('items', [])
+                            if items:
+                                found_items.extend(items)
+                                cat_display = category.get('display_name') or category.get('name', cat_name)
+                                if cat_display not in found_category_names:
+                                    found_category_names.append(cat_display)
 
                     # Формируем специальный ответ для пицц
                     if found_items:
@@ -1178,25 +1102,25 @@ async def get_ai_response(message: str, user_id: int) -> Dict:
                     found_items = []
                     found_category_names = []
 
-                    for menu_id, menu in menu_data.items():
-                        for cat_id, category in menu.get('categories', {}).items():
-                            cat_name = category.get('name', '').lower().strip()
-                            cat_display = category.get('display_name', '').lower().strip()
-
-                            # Проверяем, является ли категория пивной
-                            is_beer_category = (
-                                'пив' in cat_name or 
-                                'пив' in cat_display or
-                                'beer' in cat_name.lower()
-                            )
+                    for entry in dish_index.categories:
+                        cat_id, category = entry['cat_id'], entry['category']
+                        cat_name = entry['name']
+                        cat_display = entry['display'] or ''
+
+                        # Проверяем, является ли категория пивной
+                        is_beer_category = (
+                            'пив' in cat_name or 
+                            'пив' in cat_display or
+                            'beer' in cat_name.lower()
+                        )
                             
-                            if is_beer_category:
-                                items = category.get('items', [])
-                                if items:
-                                    found_items.extend(items)
-                                    cat_display = category.get('display_name') or category.get('name', cat_name)
-                                    if cat_display not in found_category_names:
-                                        found_category_names.append(cat_display)
+                        if is_beer_category:
+                            items = category.get('items', [])
+                            if items:
+                                found_items.extend(items)
+                                cat_display = category.get('display_name') or category.get('name', cat_name)
+                                if cat_display not in found_category_names:
+                                    found_category_names.append(cat_display)
 
                     # Формируем специальный ответ для пива
                     if found_items:
@@ -1247,33 +1171,33 @@ async def get_ai_response(message: str, user_id: int) -> Dict:
                     found_items = []
                     found_category_names = []
 
-                    for menu_id, menu in menu_data.items():
-                        for cat_id, category in menu.get('categories', {}).items():
-                            cat_name = category.get('name', '').lower().strip()
-                            cat_display = category.get('display_name', '').lower().strip()
-
-                            # Проверяем, является ли категория винной
-                            is_wine_category = (
-                                any(wine_type in cat_name for wine_type in wine_categories) or
-                                any(wine_type in cat_display for wine_type in wine_categories) or
-                                'вин' in cat_name
-                            )
+                    for entry in dish_index.categories:
+                        cat_id, category = entry['cat_id'], entry['category']
+                        cat_name = entry['name']
+                        cat_display = entry['display'] or ''
+
+                        # Проверяем, является ли категория винной
+                        is_wine_category = (
+                            any(wine_type in cat_name for wine_type in wine_categories) or
+                            any(wine_type in cat_display for wine_type in wine_categories) or
+                            'вин' in cat_name
+                        )
                             
-                            if is_wine_category:
-                                items = category.get('items', [])
-                                if items:
-                                    # Дополнительная фильтрация: только вина
-                                    wine_items = []
-                                    for item in items:
-                                        item_name_lower = item.get('name', '').lower()
-                                        # Включаем только вина
-                                        if 'вино' in item_name_lower or 'игристое' in item_name_lower:
-                                            wine_items.append(item)
+                        if is_wine_category:
+                            items = category.get('items', [])
+                            if items:
+                                # Дополнительная фильтрация: только вина
+                                wine_items = []
+                                for item in items:
+                                    item_name_lower = item.get('name', '').lower()
+                                    # Включаем только вина
+                                    if 'вино' in item_name_lower or 'игристое' in item_name_lower:
+                                        wine_items.append(item)
                                     
-                                    found_items.extend(wine_items)
-                                    cat_display = category.get('display_name') or category.get('name', cat_name)
-                                    if cat_display not in found_category_names:
-                                        found_category_names.append(cat_display)
+                                found_items.extend(wine_items)
+                                cat_display = category.get('display_name') or category.get('name', cat_name)
+                                if cat_display not in found_category_names:
+                                    found_category_names.append(cat_display)
 
                     # Формируем специальный ответ для вин
                     if found_items:
@@ -1323,58 +1247,58 @@ async def get_ai_response(message: str, user_id: int) -> Dict:
                 found_items = []
                 category_display_name = ""
 
-                for menu_id, menu in menu_data.items():
-                    for cat_id, category in menu.get('categories', {}).items():
-                        cat_name = category.get('name', '').lower().strip()
-                        cat_display_name = category.get('display_name', cat_name).lower().strip()
+                for entry in dish_index.categories:
+                    cat_id, category = entry['cat_id'], entry['category']
+                    cat_name = entry['name']
+                    cat_display_name = entry['display'] if entry['display'] is not None else cat_name
 
-                        # Более точное совпадение категории
-                        exact_match = (category_name == cat_name or 
-                                     category_name == cat_display_name.replace('🍕', '').replace('🍲', '').replace('🥗', '').replace('🍰', '').replace('🍸', '').replace('🍺', '').replace('🍷', '').replace('🍵', '').strip())
+                    # Более точное совпадение категории
+                    exact_match = (category_name == cat_name or 
+                                 category_name == cat_display_name.replace('🍕', '').replace('🍲', '').replace('🥗', '').replace('🍰', '').replace('🍸', '').replace('🍺', '').replace('🍷', '').replace('🍵', '').strip())
                         
-                        partial_match = (category_name in cat_name and len(category_name) > 2) or (category_name in cat_display_name and len(category_name) > 2)
+                    partial_match = (category_name in cat_name and len(category_name) > 2) or (category_name in cat_display_name and len(category_name) > 2)
 
-                        # Дополнительная проверка для исключения неподходящих категорий
-                        is_relevant_category = True
+                    # Дополнительная проверка для исключения неподходящих категорий
+                    is_relevant_category = True
                         
-                        # Исключаем чай и напитки если ищем еду
-                        if category_name in ['пиво', 'водка', 'вино', 'коктейль', 'напитки']:
-                            # Для алкоголя и напитков - разрешаем
-                            pass
-                        elif 'чай' in cat_name or 'напитки' in cat_name:
-                            # Если ищем не напитки, а категория содержит чай/напитки - исключаем
-                            if category_name not in ['чай', 'напитки', 'напиток']:
-                                is_relevant_category = False
-
-                        if (exact_match or partial_match) and is_relevant_category:
-                            items = category.get('items', [])
-                            if items:
-                                # Дополнительная фильтрация по названию блюда
-                                filtered_items = []
-                                for item in items:
-                                    item_name_lower = item.get('name', '').lower()
+                    # Исключаем чай и напитки если ищем еду
+                    if category_name in ['пиво', 'водка', 'вино', 'коктейль', 'напитки']:
+                        # Для алкоголя и напитков - разрешаем
+                        pass
+                    elif 'чай' in cat_name or 'напитки' in cat_name:
+                        # Если ищем не напитки, а категория содержит чай/напитки - исключаем
+                        if category_name not in ['чай', 'напитки', 'напиток']:
+                            is_relevant_category = False
+
+                    if (exact_match or partial_match) and is_relevant_category:
+                        items = category.get('items', [])
+                        if items:
+                            # Дополнительная фильтрация по названию блюда
+                            filtered_items = []
+                            for item in items:
+                                item_name_lower = item.get('name', '').lower()
                                     
-                                    # Исключаем неподходящие блюда
-                                    exclude_item = False
+                                # Исключаем неподходящие блюда
+                                exclude_item = False
                                     
-                                    # Если ищем супы - исключаем чай и напитки
-                                    if category_name in ['суп', 'супы']:
-                                        if any(drink_word in item_name_lower for drink_word in [
-                                            'чайник', 'чай', 'глинтвейн', 'коктейль', 'сок', 'вода', 'напиток'
-                                        ]):
-                                            exclude_item = True
+                                # Если ищем супы - исключаем чай и напитки
+                                if category_name in ['суп', 'супы']:
+                                    if any(drink_word in item_name_lower for drink_word in [
+                                        'чайник', 'чай', 'глинтвейн', 'коктейль', 'сок', 'вода', 'напиток'
+                                    ]):
+                                        exclude_item = True
                                     
-                                    # Если ищем пиццу - исключаем не-пиццы
-                                    elif category_name in ['пицца', 'пиццы']:
-                                        if 'пицца' not in item_name_lower:
-                                            exclude_item = True
+                                # Если ищем пиццу - исключаем не-пиццы
+                                elif category_name in ['пицца', 'пиццы']:
+                                    if 'пицца' not in item_name_lower:
+                                        exclude_item = True
                                     
-                                    if not exclude_item:
-                                        filtered_items.append(item)
+                                if not exclude_item:
+                                    filtered_items.append(item)
                                 
-                                found_items.extend(filtered_items)
-                                if not category_display_name:
-                                    category_display_name = category.get('display_name') or category.get('name', category_name)
+                            found_items.extend(filtered_items)
+                            if not category_display_name:
+                                category_display_name = category.get('display_name') or category.get('name', category_name)
 
                 # Формируем ответ со списком блюд
                 if found_items:
@@ -1426,30 +1350,11 @@ async def get_ai_response(message: str, user_id: int) -> Dict:
                 dish_name = dish_name.replace('_', ' ').strip()
                 logger.info(f"Ищу фото блюда: '{dish_name}'")
                 
-                # Ищем блюдо в меню (улучшенный поиск с приоритетом)
+                # Ищем блюдо по индексу названий (улучшенный поиск с приоритетом)
                 found = False
-                best_match = None
-                best_score = 0
-
-                for menu_id, menu in menu_data.items():
-                    for category_id, category in menu.get('categories', {}).items():
-                        for item in category.get('items', []):
-                            item_name = item['name'].lower().strip()
-                            search_name = dish_name.lower().strip()
-
-                            # Вычисляем степень совпадения
-                            score = 0
-                            if item_name == search_name:
-                                score = 100  # Точное совпадение
-                            elif item_name.startswith(search_name):
-                                score = 90  # Начинается с поискового запроса
-                            elif search_name in item_name:
-                                score = len(search_name) / len(item_name) * 50  # Процент вхождения
-
-                            # Обновляем лучший результат
-                            if score > best_score and item.get('image_url'):
-                                best_score = score
-                                best_match = item
+                best_match, best_score = dish_index.best_match(
+                    dish_name, predicate=lambda item: item.get('image_url')
+                )
 
                 # Возвращаем лучший результат
                 if best_match:
@@ -0,0 +1,114 @@
+"""
+async_db.py
+Асинхронный доступ к database.py: один поток записи с очередью и пул потоков чтения
+"""
+
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict
+
+import config
+import database
+
+logger = logging.getLogger(__name__)
+
+# Функции database.py, которые только читают - выполняются в пуле чтения
+READ_HELPERS = (
+    'get_user_data',
+    'get_user_complete_data',
+    'get_user_addresses',
+    'get_user_orders',
+    'validate_promocode_for_user',
+    'get_all_chats_for_admin',
+    'get_chat_by_id',
+    'get_chat_messages',
+    'get_faq',
+    'get_all_reviews',
+    'get_stats_range',
+    'get_menu_diffs',
+)
+
+# Функции database.py, которые пишут - выполняются по очереди в потоке записи
+WRITE_HELPERS = (
+    'save_order',
+    'get_or_create_chat',
+    'save_chat_message',
+    'save_user_address',
+    'update_address_last_used',
+    'save_user_promocode',
+    'mark_promocode_used',
+    'add_or_update_user',
+    'update_user_phone',
+    'update_user_name',
+    'update_chat_status',
+)
+
+
+def _init_reader():
+    """Соединение потока чтения открывается сразу и только для чтения"""
+    database.get_connection().execute('PRAGMA query_only = ON')
+
+
+class AsyncDatabase:
+    """
+    Awaitable-обертки над функциями database.py.
+
+    Запросы выполняются вне цикла событий, поэтому блокировка SQLite
+    (запись другого процесса, checkpoint WAL) задерживает только сам
+    запрос, а не все обработчики бота. Все изменения идут через один поток
+    записи в порядке вызова - писатели не соревнуются за блокировку БД
+    между собой. Чтение идет параллельно в DB_READ_WORKERS потоках, у
+    каждого свое соединение (пул database.get_connection() - по потокам).
+
+    Использование: await adb.get_user_data(user_id) для функций из
+    READ_HELPERS/WRITE_HELPERS, await adb.read(func, ...) /
+    await adb.write(func, ...) для остальных.
+    """
+
+    def __init__(self, read_workers: int = config.DB_READ_WORKERS):
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+        self._readers = ThreadPoolExecutor(max_workers=read_workers, thread_name_prefix='db-reader',
+                                           initializer=_init_reader)
+        self._helpers: Dict[str, Callable] = {}
+
+    async def read(self, func: Callable, *args, **kwargs) -> Any:
+        """Выполнить читающую функцию в пуле чтения"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._readers, functools.partial(func, *args, **kwargs))
+
+    async def write(self, func: Callable, *args, **kwargs) -> Any:
+        """Выполнить изменяющую функцию в потоке записи (после всех ранее поставленных)"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._writer, functools.partial(func, *args, **kwargs))
+
+    def __getattr__(self, name: str) -> Callable:
+        helper = self._helpers.get(name)
+        if helper is not None:
+            return helper
+
+        if name in READ_HELPERS:
+            run = self.read
+        elif name in WRITE_HELPERS:
+            run = self.write
+        else:
+            raise AttributeError(f"{name} нет в READ_HELPERS/WRITE_HELPERS - используйте adb.read() или adb.write()")
+
+        func = getattr(database, name)
+
+        @functools.wraps(func)
+        async def helper(*args, **kwargs):
+            return await run(func, *args, **kwargs)
+
+        self._helpers[name] = helper
+        return helper
+
+    def close(self):
+        """Дождаться поставленных запросов и остановить потоки"""
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+
+
+# Глобальный асинхронный доступ к БД
+adb = AsyncDatabase()
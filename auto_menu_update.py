@@ -18,10 +18,14 @@ async def auto_update_menu():
     try:
         # Импортируем необходимые модули
         from menu_cache import menu_cache
+        from presto_api import presto_api
         import database
 
         # Обновляем меню с принудительной перезагрузкой
         menus = await menu_cache.load_all_menus(force_update=True)
+        # Фото блюд докачиваются в фоне - скрипт должен дождаться их до выхода
+        await presto_api.wait_for_images()
+        sync_stats = presto_api.last_sync_stats
 
         if menus:
             total_items = 0
@@ -32,7 +36,10 @@ async def auto_update_menu():
             success_message = (
                 f"✅ Меню успешно обновлено автоматически!\n\n"
                 f"📊 Загружено {len(menus)} меню\n"
-                f"🍽️ Всего позиций: {total_items}\n\n"
+                f"🍽️ Всего позиций: {total_items}\n"
+                f"🔍 Изменения: {menu_cache.last_diff.summary() if menu_cache.last_diff else 'первая загрузка'}\n"
+                f"⏱️ Меню: {sync_stats.get('menus_time', 0):.1f} сек, "
+                f"фото ({sync_stats.get('images_downloaded', 0)} новых): {sync_stats.get('images_time', 0):.1f} сек\n\n"
                 f"🕐 Обновлено: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
             )
 
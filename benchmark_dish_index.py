@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк: полный перебор меню против индекса названий блюд (DISH_PHOTO)
+"""
+
+import random
+import sys
+import os
+import time
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from dish_index import DishIndex
+
+ITEMS_COUNT = 5000
+QUERIES_COUNT = 500
+
+WORDS = [
+    'пицца', 'суп', 'салат', 'паста', 'стейк', 'бургер', 'вино', 'пиво', 'чай', 'десерт',
+    'борщ', 'цезарь', 'карбонара', 'пепперони', 'маргарита', 'том', 'ям', 'лосось', 'курица',
+    'индейка', 'грибы', 'сливочный', 'томатный', 'острый', 'домашний', 'белое', 'красное',
+    'сухое', 'игристое', 'шоколадный', 'ягодный', 'овощной', 'рыбный', 'мясной', 'сырный'
+]
+
+
+def build_menu(items_count: int) -> dict:
+    """Синтетическое меню: 5 меню по 20 категорий"""
+    rnd = random.Random(42)
+    menus = {}
+    item_id = 1
+    for menu_id in range(1, 6):
+        categories = {}
+        for cat_id in range(menu_id * 100, menu_id * 100 + 20):
+            items = []
+            for _ in range(items_count // 100):
+                name = ' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(2, 4))).capitalize()
+                items.append({
+                    'id': item_id,
+                    'name': f"{name} №{item_id}",
+                    'price': rnd.randint(100, 2000),
+                    'image_url': f"https://example.com/{item_id}.jpg" if rnd.random() > 0.1 else ''
+                })
+                item_id += 1
+            categories[cat_id] = {'name': f"Категория {cat_id}", 'items': items}
+        menus[menu_id] = {'name': f"Меню {menu_id}", 'categories': categories}
+    return menus
+
+
+def scan_best_match(menu_data: dict, dish_name: str):
+    """Прежний алгоритм get_ai_response: тройной цикл по всему меню"""
+    best_match = None
+    best_score = 0
+
+    for menu_id, menu in menu_data.items():
+        for category_id, category in menu.get('categories', {}).items():
+            for item in category.get('items', []):
+                item_name = item['name'].lower().strip()
+                search_name = dish_name.lower().strip()
+
+                score = 0
+                if item_name == search_name:
+                    score = 100
+                elif item_name.startswith(search_name):
+                    score = 90
+                elif search_name in item_name:
+                    score = len(search_name) / len(item_name) * 50
+
+                if score > best_score and item.get('image_url'):
+                    best_score = score
+                    best_match = item
+
+    return best_match, best_score
+
+
+def main():
+    print("🧪 БЕНЧМАРК ПОИСКА БЛЮД")
+    print("=" * 60)
+
+    menus = build_menu(ITEMS_COUNT)
+    all_items = [item for menu in menus.values() for cat in menu['categories'].values() for item in cat['items']]
+    print(f"📦 Позиций в меню: {len(all_items)}")
+
+    rnd = random.Random(7)
+    queries = []
+    for _ in range(QUERIES_COUNT):
+        name = rnd.choice(all_items)['name']
+        kind = rnd.random()
+        if kind < 0.4:
+            queries.append(name)                      # точное название
+        elif kind < 0.7:
+            queries.append(name[:rnd.randint(5, 12)])  # начало названия
+        else:
+            words = name.split()
+            queries.append(rnd.choice(words))          # отдельное слово
+
+    start = time.perf_counter()
+    index = DishIndex(menus)
+    build_ms = (time.perf_counter() - start) * 1000
+    print(f"🏗️ Построение индекса: {build_ms:.1f} мс")
+
+    start = time.perf_counter()
+    scan_results = [scan_best_match(menus, q) for q in queries]
+    scan_ms = (time.perf_counter() - start) * 1000 / len(queries)
+
+    predicate = lambda item: item.get('image_url')
+    start = time.perf_counter()
+    index_results = [index.best_match(q, predicate=predicate) for q in queries]
+    index_ms = (time.perf_counter() - start) * 1000 / len(queries)
+
+    # Там, где перебор что-то нашел, индекс обязан вернуть то же блюдо
+    mismatches = sum(
+        1 for (scan_item, scan_score), (index_item, index_score) in zip(scan_results, index_results)
+        if scan_item is not None and (scan_item is not index_item or abs(scan_score - index_score) > 1e-9)
+    )
+    fuzzy_extra = sum(
+        1 for (scan_item, _), (index_item, _) in zip(scan_results, index_results)
+        if scan_item is None and index_item is not None
+    )
+
+    print(f"🐢 Полный перебор: {scan_ms:.3f} мс/запрос")
+    print(f"⚡ Индекс:         {index_ms:.3f} мс/запрос")
+    print(f"🚀 Ускорение:      x{scan_ms / index_ms:.1f}")
+    print(f"{'✅' if mismatches == 0 else '⚠️'} Расхождений с перебором: {mismatches} из {len(queries)}")
+    print(f"🔎 Найдено только нечетким поиском: {fuzzy_extra}")
+
+
+if __name__ == "__main__":
+    main()
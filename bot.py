@@ -26,7 +26,6 @@ if sys.platform == 'win32':
 
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.client.session.aiohttp import AiohttpSession
 from config import BOT_TOKEN, REQUEST_TIMEOUT
 
@@ -43,8 +42,16 @@ from handlers.utils import TimeoutMiddleware
 import database
 from menu_cache import menu_cache
 from presto_api import presto_api
+import presto_api_booking
+from hall_schema import hall_schema_cache
 from cart_manager import cart_manager
-import handlers.utils
+from payment_watcher import payment_watcher
+from miniapp_bridge import miniapp_bridge
+from fsm_storage import SQLiteStorage
+from llm_client import llm_client
+from async_db import adb
+from action_log import action_log
+from retention import retention_manager
 
 # Настройка логирования
 logging.basicConfig(
@@ -54,37 +61,6 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-async def process_message_queue(bot):
-    """Обработка очереди сообщений от миниаппа"""
-    while True:
-        try:
-            # Получаем неотправленные сообщения от админа
-            unsent_messages = database.get_unsent_admin_messages()
-
-            for message in unsent_messages:
-                chat_id = message['chat_id']
-                message_text = message['message_text']
-                message_id = message['id']
-
-                logger.info(f"Отправка сообщения из очереди: chat {chat_id}, message_id {message_id}")
-
-                # Отправляем сообщение пользователю
-                result = await handlers.utils.safe_send_message(bot, message['user_id'], message_text)
-
-                if result:
-                    # Отмечаем сообщение как отправленное
-                    database.mark_message_sent(message_id)
-                    logger.info(f"Сообщение {message_id} успешно отправлено пользователю {message['user_id']}")
-                else:
-                    logger.error(f"Не удалось отправить сообщение {message_id} пользователю {message['user_id']}")
-
-            # Ждем 5 секунд перед следующей проверкой
-            await asyncio.sleep(5)
-
-        except Exception as e:
-            logger.error(f"Ошибка в process_message_queue: {e}")
-            await asyncio.sleep(10)  # В случае ошибки ждем дольше
-
 async def load_presto_menus():
     """Загрузка всех меню и изображений из Presto API"""
     print("🔄 Загружаем меню и изображения из Presto API...")
@@ -111,8 +87,8 @@ async def load_presto_menus():
                         if dish.get('image_filename'):
                             total_images += 1
             
-            print(f"\n🖼️ Всего изображений товаров: {total_images}")
-            print("✅ Все меню и изображения загружены и готовы к работе!")
+            print(f"\n🖼️ Всего изображений товаров: {total_images} (новые загружаются в фоне)")
+            print("✅ Все меню загружены и готовы к работе!")
         else:
             print("⚠️ Не удалось загрузить меню")
             print("ℹ️  Меню будет недоступно")
@@ -127,13 +103,48 @@ async def shutdown(bot=None):
     """Корректное завершение работы"""
     print("\n🛑 Завершение работы...")
     
+    # Останавливаем ночное обслуживание БД
+    try:
+        await retention_manager.stop()
+    except Exception as e:
+        print(f"⚠️ Ошибка остановки обслуживания БД: {e}")
+    
+    # Останавливаем проверку оплат (ожидающие заказы остаются в БД)
+    try:
+        await payment_watcher.stop()
+    except Exception as e:
+        print(f"⚠️ Ошибка остановки планировщика оплат: {e}")
+    
+    # Останавливаем доставку сообщений миниаппа (неотправленные остаются в БД)
+    try:
+        await miniapp_bridge.stop()
+    except Exception as e:
+        print(f"⚠️ Ошибка остановки доставки сообщений миниаппа: {e}")
+    
+    # Сбрасываем отложенные изменения корзин
+    try:
+        await cart_manager.stop_write_behind()
+        print("✅ Корзины сохранены")
+    except Exception as e:
+        print(f"⚠️ Ошибка сохранения корзин: {e}")
+    
+    # Записываем накопленные события аналитики
+    try:
+        await action_log.stop()
+    except Exception as e:
+        print(f"⚠️ Ошибка записи событий аналитики: {e}")
+    
     # Закрываем сессию API
     try:
         await presto_api.close_session()
+        await presto_api_booking.close_session()
+        await llm_client.close_session()
         print("✅ Сессия API закрыта")
     except Exception as e:
         print(f"⚠️ Ошибка закрытия сессии API: {e}")
     
+    hall_schema_cache.shutdown()
+    
     # Закрываем сессию бота если передана
     if bot:
         try:
@@ -142,8 +153,9 @@ async def shutdown(bot=None):
         except Exception as e:
             print(f"⚠️ Ошибка закрытия сессии бота: {e}")
     
-    # Закрываем соединения с БД
+    # Закрываем соединения с БД (после записи всего, что стоит в очереди)
     try:
+        adb.close()
         database.close_all_connections()
         print("✅ Соединения с БД закрыты")
     except Exception as e:
@@ -166,8 +178,8 @@ async def main():
     
     bot = Bot(token=BOT_TOKEN, default=default, session=session)
     
-    # Настройка диспетчера
-    dp = Dispatcher(storage=MemoryStorage())
+    # Настройка диспетчера (состояния FSM хранятся в БД и переживают перезапуск)
+    dp = Dispatcher(storage=SQLiteStorage())
     # Регистрируем middleware таймаута глобально (если поддерживается)
     try:
         if TimeoutMiddleware is not None:
@@ -186,6 +198,15 @@ async def main():
         logger.error(f"Ошибка при инициализации БД: {e}")
         print(f"❌ Ошибка при инициализации БД: {e}")
     
+    # Отложенная запись корзин
+    cart_manager.start_write_behind()
+    
+    # Пакетная запись аналитики действий
+    action_log.start()
+    
+    # Архивация старых данных и сжатие БД в окне обслуживания
+    retention_manager.start()
+    
     # Загрузка меню из Presto API
     await load_presto_menus()
     
@@ -201,9 +222,13 @@ async def main():
     # Регистрируем обработчик ошибок
     dp.errors.register(error_handler)
 
-    # Запускаем фоновую задачу для обработки сообщений из миниаппа
-    message_queue_task = asyncio.create_task(process_message_queue(bot))
-    print("📨 Фоновая задача обработки сообщений миниаппа запущена")
+    # Доставка сообщений из миниаппа (по уведомлению миниапп-сервера, БД - резерв)
+    await miniapp_bridge.start(bot)
+    print("📨 Доставка сообщений миниаппа запущена")
+
+    # Ожидание оплаты заказов (после перезапуска продолжается по данным из БД)
+    payment_watcher.start(bot, dp.storage)
+    print("💳 Планировщик проверки оплат запущен")
 
     print("\n" + "=" * 50)
     print("✅ Все обработчики зарегистрированы")
@@ -4,6 +4,7 @@ cart_manager.py - Менеджер корзины покупок
 Обновленная версия с поддержкой исходной суммы для расчета доставки
 """
 
+import asyncio
 import json
 import os
 import logging
@@ -12,6 +13,7 @@ from datetime import datetime
 import hashlib
 
 import config
+import database
 
 logger = logging.getLogger(__name__)
 
@@ -21,33 +23,142 @@ class CartManager:
     def __init__(self):
         self.cache_file = config.CART_CACHE_FILE
         self.carts = {}  # {user_id: {'items': [], 'updated_at': timestamp, 'applied_discount': 0, 'original_total': 0}}
+        self._loaded = set()  # пользователи, чья корзина уже прочитана из БД (в т.ч. пустая)
         
-        # Создаем директорию если нужно
-        os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+        # Отложенная запись: изменённые корзины копятся и сбрасываются фоновой задачей
+        self._dirty = set()
+        self._pending_mutations = 0
+        self._flush_event: Optional[asyncio.Event] = None
+        self._flush_task: Optional[asyncio.Task] = None
+        self.write_stats = {
+            'mutations': 0,   # всего изменений корзин
+            'writes': 0,      # реально записанных корзин
+            'coalesced': 0,   # изменений, схлопнутых с уже ожидающей записью
+            'flushes': 0      # пакетных сбросов в БД
+        }
         
-        # Загружаем кэш
-        self._load_cache()
+        # Переносим старый JSON-кэш в БД (однократно)
+        self._migrate_legacy_cache()
     
-    def _load_cache(self):
-        """Загрузка кэша корзин из файла"""
+    def _migrate_legacy_cache(self):
+        """Однократный перенос корзин из JSON-файла в таблицы carts/cart_items"""
+        if not os.path.exists(self.cache_file):
+            return
+        
         try:
-            if os.path.exists(self.cache_file):
-                with open(self.cache_file, 'r', encoding='utf-8') as f:
-                    self.carts = json.load(f)
-                logger.info(f"✅ Корзины загружены из кэша ({len(self.carts)} пользователей)")
+            with open(self.cache_file, 'r', encoding='utf-8') as f:
+                legacy_carts = json.load(f)
+            
+            imported = database.import_carts(legacy_carts) if legacy_carts else 0
+            if imported != len(legacy_carts):
+                logger.error("❌ Корзины из JSON-кэша перенесены не полностью, файл оставлен")
+                return
+            
+            os.replace(self.cache_file, self.cache_file + '.migrated')
+            logger.info(f"✅ Корзины перенесены из JSON-кэша в БД ({imported} пользователей)")
         except Exception as e:
-            logger.error(f"❌ Ошибка загрузки кэша корзин: {e}")
-            self.carts = {}
+            logger.error(f"❌ Ошибка переноса кэша корзин: {e}")
     
-    def _save_cache(self):
-        """Сохранение кэша корзин в файл"""
-        try:
-            with open(self.cache_file, 'w', encoding='utf-8') as f:
-                json.dump(self.carts, f, ensure_ascii=False, indent=2)
+    def _get_cart(self, user_id_str: str) -> Optional[Dict[str, Any]]:
+        """
+        Корзина пользователя из памяти, при первом обращении - из БД
+
+        Ошибка чтения БД пробрасывается, а пользователь не считается загруженным:
+        изменение корзины не выполнится и не затрет сохраненные позиции.
+        """
+        if user_id_str not in self._loaded:
+            cart = database.get_cart(int(user_id_str))
+            if cart:
+                self.carts[user_id_str] = cart
+            self._loaded.add(user_id_str)
+        return self.carts.get(user_id_str)
+    
+    def _save_cart(self, user_id_str: str) -> bool:
+        """Сохранение корзины одного пользователя в БД (или постановка в очередь записи)"""
+        self.write_stats['mutations'] += 1
+        
+        if self._flush_task is not None and not self._flush_task.done():
+            if user_id_str in self._dirty:
+                self.write_stats['coalesced'] += 1
+            self._dirty.add(user_id_str)
+            self._pending_mutations += 1
+            if self._pending_mutations >= config.CART_FLUSH_MAX_MUTATIONS:
+                self._flush_event.set()
             return True
-        except Exception as e:
-            logger.error(f"❌ Ошибка сохранения кэша корзин: {e}")
-            return False
+        
+        self.write_stats['writes'] += 1
+        cart = self.carts.get(user_id_str)
+        if cart is None:
+            return database.delete_cart(int(user_id_str))
+        return database.save_cart(int(user_id_str), cart)
+    
+    def flush(self) -> int:
+        """
+        Сброс всех изменённых корзин в БД одной транзакцией
+        
+        Returns:
+            Количество записанных корзин
+        """
+        if not self._dirty:
+            return 0
+        
+        dirty, self._dirty = self._dirty, set()
+        self._pending_mutations = 0
+        
+        batch = {int(user_id_str): self.carts.get(user_id_str) for user_id_str in dirty}
+        if not database.save_carts(batch):
+            # Возвращаем корзины в очередь, чтобы не потерять изменения
+            self._dirty |= dirty
+            return 0
+        
+        self.write_stats['writes'] += len(batch)
+        self.write_stats['flushes'] += 1
+        return len(batch)
+    
+    async def _flush_loop(self):
+        """Фоновая задача отложенной записи корзин"""
+        interval = config.CART_FLUSH_INTERVAL_MS / 1000
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_event.wait(), timeout=interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_event.clear()
+            
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"❌ Ошибка отложенной записи корзин: {e}")
+    
+    def start_write_behind(self):
+        """Включение режима отложенной записи (вызывать из работающего event loop)"""
+        if self._flush_task is not None and not self._flush_task.done():
+            return
+        
+        self._flush_event = asyncio.Event()
+        self._flush_task = asyncio.create_task(self._flush_loop())
+        logger.info(f"✅ Отложенная запись корзин включена "
+                    f"({config.CART_FLUSH_INTERVAL_MS} мс / {config.CART_FLUSH_MAX_MUTATIONS} изменений)")
+    
+    async def stop_write_behind(self):
+        """Остановка фоновой задачи и финальный сброс корзин"""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        
+        written = self.flush()
+        stats = self.write_stats
+        logger.info(f"✅ Корзины сохранены при остановке ({written}), "
+                    f"изменений: {stats['mutations']}, записей: {stats['writes']}, "
+                    f"схлопнуто: {stats['coalesced']}")
+    
+    def get_write_stats(self) -> Dict[str, int]:
+        """Счётчики записи корзин (сколько изменений схлопнуто отложенной записью)"""
+        return {**self.write_stats, 'pending': len(self._dirty)}
     
     def get_cart_summary(self, user_id: int) -> Dict[str, Any]:
         """
@@ -72,7 +183,11 @@ class CartManager:
             }
         """
         user_id_str = str(user_id)
-        user_cart = self.carts.get(user_id_str, {})
+        try:
+            user_cart = self._get_cart(user_id_str) or {}
+        except Exception as e:
+            logger.error(f"❌ Корзина {user_id} не загружена: {e}")
+            user_cart = {}
         items = user_cart.get('items', [])
         
         # Рассчитываем исходную сумму (без учета скидок)
@@ -127,7 +242,7 @@ class CartManager:
             user_id_str = str(user_id)
             
             # Получаем или создаем корзину пользователя
-            if user_id_str not in self.carts:
+            if self._get_cart(user_id_str) is None:
                 self.carts[user_id_str] = {
                     'items': [],
                     'applied_discount': 0,
@@ -192,7 +307,7 @@ class CartManager:
             self.carts[user_id_str]['updated_at'] = datetime.now().isoformat()
             
             # Сохраняем кэш
-            self._save_cache()
+            self._save_cart(user_id_str)
             
             logger.info(f"✅ Товар добавлен в корзину: user={user_id}, dish={dish_id}, qty={quantity}")
             logger.debug(f"   Исходная сумма: {self.carts[user_id_str].get('original_total')}₽, Скидка: {applied_discount}₽, Итог: {current_total}₽")
@@ -217,7 +332,7 @@ class CartManager:
         try:
             user_id_str = str(user_id)
             
-            if user_id_str not in self.carts:
+            if self._get_cart(user_id_str) is None:
                 return False
             
             items = self.carts[user_id_str]['items']
@@ -251,7 +366,7 @@ class CartManager:
                         del self.carts[user_id_str]
                     
                     # Сохраняем кэш
-                    self._save_cache()
+                    self._save_cart(user_id_str)
                     
                     logger.info(f"✅ Товар удален из корзины: user={user_id}, dish={dish_id}, removed_qty={removed_quantity}")
                     return True
@@ -277,7 +392,7 @@ class CartManager:
         try:
             user_id_str = str(user_id)
             
-            if user_id_str not in self.carts:
+            if self._get_cart(user_id_str) is None:
                 return False
             
             items = self.carts[user_id_str]['items']
@@ -304,7 +419,7 @@ class CartManager:
                     self.carts[user_id_str]['updated_at'] = datetime.now().isoformat()
                     
                     # Сохраняем кэш
-                    self._save_cache()
+                    self._save_cart(user_id_str)
                     
                     logger.info(f"✅ Количество обновлено: user={user_id}, dish={dish_id}, old_qty={old_quantity}, new_qty={new_quantity}")
                     return True
@@ -328,9 +443,9 @@ class CartManager:
         try:
             user_id_str = str(user_id)
             
-            if user_id_str in self.carts:
+            if self._get_cart(user_id_str) is not None:
                 del self.carts[user_id_str]
-                self._save_cache()
+                self._save_cart(user_id_str)
                 logger.info(f"✅ Корзина очищена: user={user_id}")
                 return True
             
@@ -356,7 +471,7 @@ class CartManager:
         try:
             user_id_str = str(user_id)
             
-            if user_id_str not in self.carts:
+            if self._get_cart(user_id_str) is None:
                 return False
             
             # Получаем текущую исходную сумму
@@ -382,7 +497,7 @@ class CartManager:
             self.carts[user_id_str]['updated_at'] = datetime.now().isoformat()
             
             # Сохраняем кэш
-            self._save_cache()
+            self._save_cart(user_id_str)
             
             logger.info(f"✅ Промокод применен к корзине: user={user_id}, "
                        f"discount={final_discount}₽, original_total={original_total}₽")
@@ -405,7 +520,7 @@ class CartManager:
         try:
             user_id_str = str(user_id)
             
-            if user_id_str in self.carts:
+            if self._get_cart(user_id_str) is not None:
                 # Очищаем данные о скидке
                 self.carts[user_id_str].pop('applied_discount', None)
                 self.carts[user_id_str].pop('discount_type', None)
@@ -415,7 +530,7 @@ class CartManager:
                 self.carts[user_id_str]['updated_at'] = datetime.now().isoformat()
                 
                 # Сохраняем кэш
-                self._save_cache()
+                self._save_cart(user_id_str)
                 
                 logger.info(f"✅ Промокод удален из корзины: user={user_id}")
                 return True
@@ -527,7 +642,7 @@ class CartManager:
         try:
             user_id_str = str(user_id)
             
-            if user_id_str not in self.carts:
+            if self._get_cart(user_id_str) is None:
                 return False
             
             items = self.carts[user_id_str]['items']
@@ -545,7 +660,7 @@ class CartManager:
             self.carts[user_id_str]['updated_at'] = datetime.now().isoformat()
             
             # Сохраняем кэш
-            self._save_cache()
+            self._save_cart(user_id_str)
             
             logger.info(f"✅ Суммы корзины пересчитаны: user={user_id}, "
                        f"original_total={original_total}₽, discount={applied_discount}₽")
@@ -562,6 +677,11 @@ class CartManager:
         Returns:
             Словарь всех корзин
         """
+        for user_id in database.get_cart_user_ids():
+            try:
+                self._get_cart(str(user_id))
+            except Exception:
+                continue  # ошибка уже в логе, корзина попробует загрузиться в следующий раз
         return self.carts.copy()
 
 # Глобальный экземпляр менеджера корзины
@@ -56,6 +56,8 @@ PRESTO_SECRET_KEY = os.getenv("PRESTO_SECRET_KEY", "IR9K96TJIRNJSRIL3EW0JVE0")
 MENU_IMAGES_DIR = "files/imagesMenu"
 MENU_CACHE_FILE = "files/menu_cache.json"
 CART_CACHE_FILE = "files/cart_cache.json"
+MENU_SYNC_CONCURRENCY = 4     # Прайс-листов, загружаемых из Presto одновременно
+MENU_IMAGE_CONCURRENCY = 8    # Одновременных загрузок фото блюд (идут в фоне после загрузки меню)
 
 # ===== НАСТРОЙКИ ПРОИЗВОДИТЕЛЬНОСТИ =====
 # Таймауты (в секундах)
@@ -76,10 +78,62 @@ NEWSLETTER_BATCH_SIZE = 30    # Размер батча для рассылок
 NEWSLETTER_DELAY = 0.5        # Задержка между батчами (сек)
 MAX_NEWSLETTER_RETRIES = 3    # Максимальное количество повторных попыток
 NEWSLETTER_TIMEOUT = 30       # Таймаут для отправки одной пачки
+NEWSLETTER_RATE_LIMIT = 25    # Сообщений в секунду (глобальный лимит Telegram ~30)
+NEWSLETTER_WORKERS = 8        # Одновременных отправок
+NEWSLETTER_PAGE_SIZE = 500    # Получателей за один запрос к БД
+NEWSLETTER_PROGRESS_INTERVAL = 5  # Как часто обновлять прогресс у админа (сек)
+
+# Общий лимит отправки в Telegram (на всего бота и на один чат)
+TELEGRAM_RATE_LIMIT = 30      # Запросов в секунду на бота
+TELEGRAM_CHAT_RATE_LIMIT = 4  # Запросов в секунду в один чат после исчерпания запаса
+TELEGRAM_CHAT_BURST = 20      # Запас запросов в один чат
+
+# Показ категорий меню
+CATEGORY_SEND_CONCURRENCY = 4   # Одновременных подготовок карточек блюд (отправка - по порядку)
+CATEGORY_ALBUM_THRESHOLD = 12   # Больше блюд - показываем альбомами (0 - всегда карточками)
+CATEGORY_ALBUM_PAGE_SIZE = 10   # Блюд на странице альбома (лимит Telegram - 10)
+
+# AI-ассистент (Polza AI)
+AI_API_URL = "https://api.polza.ai/api/v1/chat/completions"
+AI_MAX_CONCURRENCY = 8        # Одновременных запросов к модели
+AI_REQUEST_TIMEOUT = 60       # Общий таймаут ответа (сек)
+AI_STREAM_READ_TIMEOUT = 30   # Максимальная пауза между фрагментами потока (сек)
+AI_STREAM_EDIT_INTERVAL = 1.0 # Как часто обновлять сообщение с ответом во время генерации (сек)
+
+# Ожидание онлайн-оплаты заказов
+PAYMENT_TIMEOUT = 420                          # Время на оплату (сек), потом заказ отменяется
+PAYMENT_POLL_SCHEDULE = [5, 5, 10, 10, 15, 20, 30]  # Паузы между проверками статуса (сек), дальше - последняя
+PAYMENT_STATUS_CONCURRENCY = 5                 # Одновременных запросов статуса в Presto
+
+# Доставка сообщений из миниаппа (миниапп-сервер будит бота через локальный TCP-порт)
+MINIAPP_BRIDGE_HOST = os.getenv("MINIAPP_BRIDGE_HOST", "127.0.0.1")
+MINIAPP_BRIDGE_PORT = int(os.getenv("MINIAPP_BRIDGE_PORT", "8765"))
+MINIAPP_SWEEP_INTERVAL = 60   # Проверка БД без уведомлений (сек) - для сообщений, сохраненных без работающего бота
+
+# Хранилище состояний FSM
+FSM_STATE_TTL = 2 * 24 * 3600  # Сессия без изменений удаляется через (сек)
+FSM_CACHE_SIZE = 5000          # Пользователей в кэше памяти
+
+# Корзины (отложенная запись)
+CART_FLUSH_INTERVAL_MS = 500  # Интервал сброса изменённых корзин в БД (мс)
+CART_FLUSH_MAX_MUTATIONS = 50 # Досрочный сброс после стольких изменений
+
+# Аналитика действий пользователей (буфер в памяти, пакетная запись)
+ACTION_LOG_BUFFER_SIZE = 10000   # Емкость буфера (при переполнении вытесняются старые события)
+ACTION_LOG_BATCH_SIZE = 200      # Досрочная запись после стольких событий
+ACTION_LOG_FLUSH_INTERVAL = 1.0  # Интервал записи (сек)
 
 # База данных
 DB_CACHE_TTL = 300            # Время жизни кэша (сек)
 DB_POOL_SIZE = 10             # Размер пула соединений
+DB_READ_WORKERS = 4           # Потоков чтения для асинхронного доступа к БД (запись - всегда один поток)
+
+# Хранение истории: старые строки переносятся в архивную БД (сводная статистика остается)
+ARCHIVE_DB_PATH = "restaurant_archive.db"
+RETENTION_STATS_DAYS = 90     # События аналитики (stats) старше - в архив
+RETENTION_CHAT_DAYS = 180     # Сообщения чатов с операторами старше - в архив
+RETENTION_BATCH_SIZE = 5000   # Строк за одну транзакцию переноса
+RETENTION_WINDOW = (3, 6)     # Часы обслуживания (с, до) - переносим и сжимаем БД ночью
 
 # ===== НАСТРОЙКИ БАНКЕТА =====
 BANQUET_PREPAYMENT = 50  # процент предоплаты
@@ -10,9 +10,12 @@ import atexit
 from typing import Dict, List, Optional, Any, Tuple
 import contextlib
 import logging
+import os
 
 logger = logging.getLogger(__name__)
 
+DB_PATH = 'restaurant.db'
+
 # Глобальные переменные для кэша с использованием LRU
 _settings_cache: Dict[str, str] = {}
 _settings_cache_time: float = 0
@@ -73,12 +76,13 @@ def get_connection() -> sqlite3.Connection:
         if thread_id not in _connection_pool:
             # Создаем новое соединение с оптимизациями
             conn = sqlite3.connect(
-                'restaurant.db',
+                DB_PATH,
                 check_same_thread=False,
                 timeout=5,
                 isolation_level=None  # Автокоммит
             )
             # Включаем оптимизации SQLite
+            conn.execute('PRAGMA auto_vacuum=INCREMENTAL')  # Для новой БД; существующая переводится в compact_database()
             conn.execute('PRAGMA journal_mode=WAL')  # Write-Ahead Logging
             conn.execute('PRAGMA synchronous=NORMAL')  # Баланс скорости и надежности
             conn.execute('PRAGMA cache_size=-2000')  # Кэш 2MB
@@ -126,21 +130,21 @@ def cleanup_cache():
     if current_time - _last_cache_cleanup > _cache_cleanup_interval:
         # Очищаем старые записи в кэше админов
         expired_keys = []
-        for user_id, (_, timestamp) in _admin_cache.items():
+        for user_id, (_, timestamp) in list(_admin_cache.items()):
             if current_time - timestamp > _cache_ttl:
                 expired_keys.append(user_id)
 
         for key in expired_keys:
-            del _admin_cache[key]
+            _admin_cache.pop(key, None)
 
         # Очищаем старые записи в кэше регистрации
         expired_keys = []
-        for user_id, (_, timestamp) in _user_reg_cache.items():
+        for user_id, (_, timestamp) in list(_user_reg_cache.items()):
             if current_time - timestamp > _cache_ttl:
                 expired_keys.append(user_id)
 
         for key in expired_keys:
-            del _user_reg_cache[key]
+            _user_reg_cache.pop(key, None)
 
     # Очищаем старые записи в кэше адресов
     expired_keys = []
@@ -149,10 +153,8 @@ def cleanup_cache():
             expired_keys.append(user_id)
 
     for user_id in expired_keys:
-        if user_id in _user_addresses_cache:
-            del _user_addresses_cache[user_id]
-        if user_id in _user_addresses_cache_time:
-            del _user_addresses_cache_time[user_id]
+        _user_addresses_cache.pop(user_id, None)
+        _user_addresses_cache_time.pop(user_id, None)
 
     # Очищаем старые записи в кэше FAQ
     if _faq_cache and (current_time - _faq_cache_time) > FAQ_CACHE_TTL:
@@ -318,6 +320,21 @@ def init_database():
         )
         ''')
         
+        # Статус доставки рассылки каждому получателю (для продолжения после сбоя)
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS newsletter_deliveries (
+            newsletter_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            attempts INTEGER DEFAULT 1,
+            error TEXT,
+            updated_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (newsletter_id, user_id),
+            FOREIGN KEY (newsletter_id) REFERENCES newsletters (id) ON DELETE CASCADE
+        )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_newsletter_deliveries_status ON newsletter_deliveries(newsletter_id, status)')
+        
         # Статистика с компрессией данных
         cursor.execute('''
         CREATE TABLE IF NOT EXISTS stats (
@@ -441,6 +458,98 @@ def init_database():
             # Поле уже существует
             pass
 
+        # Корзины пользователей (шапка корзины, одна строка на пользователя)
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS carts (
+            user_id INTEGER PRIMARY KEY,
+            applied_discount REAL DEFAULT 0,
+            original_total REAL DEFAULT 0,
+            discount_type TEXT,
+            discount_value REAL,
+            updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
+
+        # Позиции корзин (одна строка на блюдо)
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS cart_items (
+            user_id INTEGER NOT NULL,
+            dish_id INTEGER NOT NULL,
+            name TEXT,
+            price REAL DEFAULT 0,
+            quantity INTEGER DEFAULT 1,
+            total_price REAL DEFAULT 0,
+            image_url TEXT,
+            added_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, dish_id)
+        )
+        ''')
+
+        # Реестр file_id Telegram для локальных файлов (фото блюд, PDF меню и т.п.)
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS media_files (
+            path TEXT PRIMARY KEY,
+            content_hash TEXT NOT NULL,
+            file_id TEXT NOT NULL,
+            file_type TEXT,
+            size INTEGER,
+            mtime REAL,
+            updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
+
+        # Заказы, ожидающие онлайн-оплаты (переживают перезапуск бота)
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS pending_payments (
+            sale_key TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            order_number TEXT,
+            status TEXT DEFAULT 'pending',
+            attempts INTEGER DEFAULT 0,
+            next_check_at REAL NOT NULL,
+            expires_at REAL NOT NULL,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
+
+        # Кэш геокодирования и подсказок адресов (result NULL - адрес не найден)
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS geocode_cache (
+            kind TEXT NOT NULL,
+            query_key TEXT NOT NULL,
+            result TEXT,
+            expires_at REAL NOT NULL,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (kind, query_key)
+        )
+        ''')
+
+        # Состояния и данные FSM пользователей (data - сжатый JSON)
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS fsm_storage (
+            storage_key TEXT PRIMARY KEY,
+            state TEXT,
+            data BLOB,
+            expires_at REAL NOT NULL
+        )
+        ''')
+
+        # История изменений меню при обновлении из Presto
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS menu_diffs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            added INTEGER DEFAULT 0,
+            removed INTEGER DEFAULT 0,
+            price_changed INTEGER DEFAULT 0,
+            stock_changed INTEGER DEFAULT 0,
+            changed INTEGER DEFAULT 0,
+            summary TEXT,
+            details TEXT
+        )
+        ''')
+
         # Настройки бота
         cursor.execute('''
         CREATE TABLE IF NOT EXISTS settings (
@@ -465,10 +574,14 @@ def init_database():
             ('idx_promocodes_active', 'promocodes(is_active)'),
             ('idx_stats_user_action', 'stats(user_id, action)'),
             ('idx_stats_time', 'stats(timestamp)'),
+            ('idx_chat_messages_time', 'chat_messages(message_time)'),
             ('idx_reviews_date', 'reviews(date DESC, created_at DESC)'),
             ('idx_reviews_author', 'reviews(author)'),
             ('idx_faq_category', 'faq(category)'),
-            ('idx_newsletters_status', 'newsletters(status)')
+            ('idx_newsletters_status', 'newsletters(status)'),
+            ('idx_geocode_cache_expires', 'geocode_cache(expires_at)'),
+            ('idx_pending_payments_status', 'pending_payments(status)'),
+            ('idx_fsm_storage_expires', 'fsm_storage(expires_at)')
         ]
         
         for idx_name, idx_sql in indexes:
@@ -512,6 +625,134 @@ def init_database():
                     cursor.execute('INSERT INTO faq (question, answer) VALUES (?, ?)', (question, answer))
                 except sqlite3.IntegrityError:
                     pass
+        
+        # Сводная статистика по дням и часам (счетчики ведут триггеры)
+        _init_stats_rollups(cursor)
+
+# ===== СВОДНАЯ СТАТИСТИКА =====
+
+# Источники счетчиков: метрика -> (таблица, время события, ключ)
+_ROLLUP_SOURCES = {
+    'users': ('users', 'registered_at', "''"),
+    'orders': ('orders', 'created_at', "''"),
+    'bookings': ('bookings', 'created_at', "''"),
+    'action': ('stats', 'timestamp', 'action'),
+}
+
+def _day_expr(column: str) -> str:
+    return f"substr({column}, 1, 10)"
+
+def _hour_expr(column: str) -> str:
+    # Подходит и для CURRENT_TIMESTAMP ('2024-01-01 12:00:00'), и для isoformat ('2024-01-01T12:00:00')
+    return f"substr({column}, 1, 10) || ' ' || substr({column}, 12, 2)"
+
+def _rollup_increment_sql(metric: str, column: str, key: str, hourly: bool = True) -> str:
+    """Увеличение счетчиков метрики за день (и час) события - тело триггера"""
+    sql = f'''
+        INSERT INTO stats_daily (day, metric, key, count) VALUES ({_day_expr(column)}, '{metric}', {key}, 1)
+        ON CONFLICT (day, metric, key) DO UPDATE SET count = count + 1;'''
+    if hourly:
+        sql += f'''
+        INSERT INTO stats_hourly (hour, metric, key, count) VALUES ({_hour_expr(column)}, '{metric}', {key}, 1)
+        ON CONFLICT (hour, metric, key) DO UPDATE SET count = count + 1;'''
+    return sql
+
+def _init_stats_rollups(cursor):
+    """Таблицы и триггеры сводной статистики; при первом создании - заполнение по истории"""
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS stats_daily (
+        day TEXT NOT NULL,
+        metric TEXT NOT NULL,
+        key TEXT NOT NULL DEFAULT '',
+        count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, metric, key)
+    ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS stats_hourly (
+        hour TEXT NOT NULL,
+        metric TEXT NOT NULL,
+        key TEXT NOT NULL DEFAULT '',
+        count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (hour, metric, key)
+    ) WITHOUT ROWID
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS stats_totals (
+        metric TEXT PRIMARY KEY,
+        count INTEGER NOT NULL DEFAULT 0
+    )
+    ''')
+    
+    cursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'trigger' AND name LIKE 'trg_rollup_%'")
+    triggers_exist = cursor.fetchone()[0] > 0
+    
+    for metric, (table, column, key) in _ROLLUP_SOURCES.items():
+        body = _rollup_increment_sql(metric, f'NEW.{column}', key if key == "''" else f'NEW.{key}')
+        if metric == 'users':
+            # Новый пользователь - активен в день регистрации, плюс общий счетчик
+            body += _rollup_increment_sql('active_users', 'NEW.last_active', "''", hourly=False)
+            body += '''
+        INSERT INTO stats_totals (metric, count) VALUES ('users', 1)
+        ON CONFLICT (metric) DO UPDATE SET count = count + 1;'''
+        cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_rollup_{metric} AFTER INSERT ON {table}
+        WHEN NEW.{column} IS NOT NULL
+        BEGIN{body}
+        END
+        ''')
+    
+    # Активные пользователи: первое действие за день
+    cursor.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS trg_rollup_active_users AFTER UPDATE OF last_active ON users
+    WHEN NEW.last_active IS NOT NULL AND {_day_expr('NEW.last_active')} IS NOT {_day_expr('OLD.last_active')}
+    BEGIN{_rollup_increment_sql('active_users', 'NEW.last_active', "''", hourly=False)}
+    END
+    ''')
+    
+    if not triggers_exist:
+        _fill_stats_rollups(cursor)
+        logger.info("✅ Сводная статистика заполнена по истории")
+
+def _fill_stats_rollups(cursor):
+    """Пересчет сводных таблиц по исходным данным"""
+    cursor.execute('DELETE FROM stats_daily')
+    cursor.execute('DELETE FROM stats_hourly')
+    cursor.execute('DELETE FROM stats_totals')
+    
+    for metric, (table, column, key) in _ROLLUP_SOURCES.items():
+        cursor.execute(f'''
+        INSERT INTO stats_daily (day, metric, key, count)
+        SELECT {_day_expr(column)}, '{metric}', {key}, COUNT(*) FROM {table}
+        WHERE {column} IS NOT NULL
+        GROUP BY 1, 3
+        ''')
+        cursor.execute(f'''
+        INSERT INTO stats_hourly (hour, metric, key, count)
+        SELECT {_hour_expr(column)}, '{metric}', {key}, COUNT(*) FROM {table}
+        WHERE {column} IS NOT NULL
+        GROUP BY 1, 3
+        ''')
+    
+    # По истории известен только последний день активности каждого пользователя
+    cursor.execute(f'''
+    INSERT INTO stats_daily (day, metric, key, count)
+    SELECT {_day_expr('last_active')}, 'active_users', '', COUNT(*) FROM users
+    WHERE last_active IS NOT NULL
+    GROUP BY 1
+    ''')
+    cursor.execute("INSERT INTO stats_totals (metric, count) SELECT 'users', COUNT(*) FROM users")
+
+def rebuild_stats_rollups() -> bool:
+    """Полный пересчет сводной статистики (например, после ручной правки таблиц)"""
+    try:
+        with get_cursor() as cursor:
+            cursor.execute('BEGIN')
+            _fill_stats_rollups(cursor)
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка пересчета сводной статистики: {e}")
+        return False
 # ===== ФУНКЦИИ ДЛЯ РАБОТЫ С АДРЕСАМИ =====
 
 def save_user_address(user_id: int, address: str, 
@@ -1109,19 +1350,22 @@ def fast_log_action(user_id: int, action: str, details: Optional[str] = None):
     except Exception as e:
         logger.error(f"Ошибка логирования: {e}")
 
-def bulk_log_actions(actions: List[Tuple[int, str, Optional[str]]]):
-    """Массовое логирование действий"""
+def bulk_log_actions(actions: List[Tuple]) -> bool:
+    """Массовое логирование действий: (user_id, action, details) или (user_id, action, details, timestamp)"""
     if not actions:
-        return
+        return True
     
     try:
+        now = datetime.now().isoformat()
         with get_cursor() as cursor:
             cursor.executemany('''
             INSERT INTO stats (user_id, action, details, timestamp)
             VALUES (?, ?, ?, ?)
-            ''', [(user_id, action, details, datetime.now().isoformat()) for user_id, action, details in actions])
+            ''', [(action[0], action[1], action[2], action[3] if len(action) > 3 else now) for action in actions])
+        return True
     except Exception as e:
         logger.error(f"Ошибка массового логирования: {e}")
+        return False
 
 def add_or_update_user(user_id: int, username: Optional[str] = None, full_name: Optional[str] = None) -> bool:
     """Добавление/обновление пользователя одной операцией"""
@@ -1273,24 +1517,25 @@ def get_stats() -> Dict[str, Any]:
     
     try:
         with get_cursor() as cursor:
-            # Все запросы выполняем в одной транзакции
-            cursor.execute('SELECT COUNT(*) FROM users')
-            stats['total_users'] = cursor.fetchone()[0] or 0
-            
-            cursor.execute('SELECT COUNT(*) FROM users WHERE date(last_active) = date("now")')
-            stats['active_today'] = cursor.fetchone()[0] or 0
+            # Счетчики берем из сводных таблиц, а не считаем по исходным
+            cursor.execute("SELECT count FROM stats_totals WHERE metric = 'users'")
+            row = cursor.fetchone()
+            stats['total_users'] = row[0] if row else 0
             
-            cursor.execute('SELECT COUNT(*) FROM bookings WHERE date(created_at) = date("now")')
-            stats['bookings_today'] = cursor.fetchone()[0] or 0
-            
-            cursor.execute('SELECT COUNT(*) FROM orders WHERE date(created_at) = date("now")')
-            stats['orders_today'] = cursor.fetchone()[0] or 0
+            cursor.execute('''
+            SELECT metric, count FROM stats_daily
+            WHERE day = date('now') AND key = '' AND metric IN ('active_users', 'bookings', 'orders')
+            ''')
+            today = {row['metric']: row['count'] for row in cursor.fetchall()}
+            stats['active_today'] = today.get('active_users', 0)
+            stats['bookings_today'] = today.get('bookings', 0)
+            stats['orders_today'] = today.get('orders', 0)
             
             cursor.execute('''
-            SELECT action, COUNT(*) as count 
-            FROM stats 
-            WHERE timestamp > datetime('now', '-1 day')
-            GROUP BY action 
+            SELECT key as action, SUM(count) as count 
+            FROM stats_hourly 
+            WHERE metric = 'action' AND hour >= strftime('%Y-%m-%d %H', 'now', '-1 day')
+            GROUP BY key 
             ORDER BY count DESC 
             LIMIT 5
             ''')
@@ -1305,6 +1550,50 @@ def get_stats() -> Dict[str, Any]:
     
     return stats
 
+def get_stats_range(days: int) -> Dict[str, Any]:
+    """Статистика за последние days дней: суммы, ряд по дням и популярные действия"""
+    stats = {
+        'days': days,
+        'new_users': 0,
+        'active_users': 0,
+        'orders': 0,
+        'bookings': 0,
+        'daily': [],
+        'popular_actions': [],
+    }
+    
+    try:
+        since = f'-{max(days - 1, 0)} days'
+        with get_cursor() as cursor:
+            cursor.execute('''
+            SELECT day,
+                   SUM(CASE WHEN metric = 'users' THEN count ELSE 0 END) as new_users,
+                   SUM(CASE WHEN metric = 'active_users' THEN count ELSE 0 END) as active_users,
+                   SUM(CASE WHEN metric = 'orders' THEN count ELSE 0 END) as orders,
+                   SUM(CASE WHEN metric = 'bookings' THEN count ELSE 0 END) as bookings
+            FROM stats_daily
+            WHERE day >= date('now', ?) AND key = ''
+            GROUP BY day
+            ORDER BY day
+            ''', (since,))
+            stats['daily'] = [dict(row) for row in cursor.fetchall()]
+            for field in ('new_users', 'active_users', 'orders', 'bookings'):
+                stats[field] = sum(row[field] for row in stats['daily'])
+            
+            cursor.execute('''
+            SELECT key as action, SUM(count) as count
+            FROM stats_daily
+            WHERE metric = 'action' AND day >= date('now', ?)
+            GROUP BY key
+            ORDER BY count DESC
+            LIMIT 5
+            ''', (since,))
+            stats['popular_actions'] = cursor.fetchall() or []
+    except Exception as e:
+        logger.error(f"Ошибка получения статистики за {days} дн.: {e}")
+    
+    return stats
+
 def save_order(user_id: int, items: str, total_amount: float, phone: str, 
                delivery_address: Optional[str] = None, notes: Optional[str] = None,
                promocode: Optional[str] = None, discount_amount: float = 0) -> Optional[int]:
@@ -1770,6 +2059,120 @@ def get_newsletter_by_id(newsletter_id: int) -> Optional[Dict[str, Any]]:
         logger.error(f"Ошибка получения рассылки: {e}")
         return None
 
+# Статусы доставки, после которых получателю повторно не отправляем
+NEWSLETTER_FINAL_STATUSES = ('sent', 'blocked')
+# 'sending' - отправка прервана сбоем: дошло ли сообщение, неизвестно, повторно не шлем
+NEWSLETTER_SKIP_STATUSES = NEWSLETTER_FINAL_STATUSES + ('sending',)
+
+def count_newsletter_recipients(newsletter_id: int) -> Dict[str, int]:
+    """Сколько активных получателей всего и скольким рассылка уже доставлена"""
+    try:
+        with get_cursor() as cursor:
+            cursor.execute('''
+            SELECT COUNT(*), COUNT(d.user_id)
+            FROM users u
+            LEFT JOIN newsletter_deliveries d
+                   ON d.newsletter_id = ? AND d.user_id = u.user_id AND d.status IN (?, ?)
+            WHERE u.last_active > datetime('now', '-30 days')
+            ''', (newsletter_id, *NEWSLETTER_FINAL_STATUSES))
+            total, done = cursor.fetchone()
+            return {'total': total, 'done': done}
+    except Exception as e:
+        logger.error(f"Ошибка подсчета получателей рассылки: {e}")
+        return {'total': 0, 'done': 0}
+
+def get_newsletter_recipients_page(newsletter_id: int, after_user_id: int = 0, limit: int = 500) -> List:
+    """
+    Очередная страница получателей рассылки (keyset-пагинация по user_id)
+
+    Пропускает тех, кому рассылка уже доставлена или кто заблокировал бота.
+    """
+    try:
+        with get_cursor() as cursor:
+            cursor.execute('''
+            SELECT u.user_id, u.full_name
+            FROM users u
+            LEFT JOIN newsletter_deliveries d
+                   ON d.newsletter_id = ? AND d.user_id = u.user_id
+            WHERE u.user_id > ?
+              AND u.last_active > datetime('now', '-30 days')
+              AND (d.status IS NULL OR d.status NOT IN (?, ?, ?))
+            ORDER BY u.user_id
+            LIMIT ?
+            ''', (newsletter_id, after_user_id, *NEWSLETTER_SKIP_STATUSES, limit))
+            return cursor.fetchall() or []
+    except Exception as e:
+        logger.error(f"Ошибка получения получателей рассылки: {e}")
+        return []
+
+def claim_newsletter_recipient(newsletter_id: int, user_id: int) -> bool:
+    """Пометка получателя как 'sending' перед отправкой; False - ему уже отправляли"""
+    try:
+        with get_cursor() as cursor:
+            cursor.execute('''
+            INSERT INTO newsletter_deliveries (newsletter_id, user_id, status, attempts, updated_at)
+            VALUES (?, ?, 'sending', 0, CURRENT_TIMESTAMP)
+            ON CONFLICT(newsletter_id, user_id) DO UPDATE SET
+                status = 'sending',
+                updated_at = excluded.updated_at
+            WHERE newsletter_deliveries.status NOT IN (?, ?, ?)
+            ''', (newsletter_id, user_id, *NEWSLETTER_SKIP_STATUSES))
+            return cursor.rowcount > 0
+    except Exception as e:
+        logger.error(f"Ошибка пометки получателя рассылки {user_id}: {e}")
+        return False
+
+def release_newsletter_recipient(newsletter_id: int, user_id: int) -> bool:
+    """Снятие пометки 'sending', если отправка прервана до запроса в Telegram (получатель будет в дорассылке)"""
+    try:
+        with get_cursor() as cursor:
+            cursor.execute('''
+            UPDATE newsletter_deliveries
+            SET status = 'failed', error = 'прервано до отправки', updated_at = CURRENT_TIMESTAMP
+            WHERE newsletter_id = ? AND user_id = ? AND status = 'sending'
+            ''', (newsletter_id, user_id))
+            return cursor.rowcount > 0
+    except Exception as e:
+        logger.error(f"Ошибка снятия пометки получателя рассылки {user_id}: {e}")
+        return False
+
+def save_newsletter_deliveries(newsletter_id: int, deliveries: List[tuple]) -> bool:
+    """Пакетное сохранение статусов доставки: [(user_id, status, attempts, error), ...]"""
+    if not deliveries:
+        return True
+
+    try:
+        with get_cursor() as cursor:
+            cursor.execute('BEGIN')
+            cursor.executemany('''
+            INSERT INTO newsletter_deliveries (newsletter_id, user_id, status, attempts, error, updated_at)
+            VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(newsletter_id, user_id) DO UPDATE SET
+                status = excluded.status,
+                attempts = newsletter_deliveries.attempts + excluded.attempts,
+                error = excluded.error,
+                updated_at = excluded.updated_at
+            ''', [(newsletter_id, user_id, status, attempts, error)
+                  for user_id, status, attempts, error in deliveries])
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка сохранения статусов доставки рассылки: {e}")
+        return False
+
+def get_newsletter_delivery_stats(newsletter_id: int) -> Dict[str, int]:
+    """Количество получателей рассылки по статусам доставки"""
+    try:
+        with get_cursor() as cursor:
+            cursor.execute('''
+            SELECT status, COUNT(*) FROM newsletter_deliveries
+            WHERE newsletter_id = ?
+            GROUP BY status
+            ''', (newsletter_id,))
+            return {status: count for status, count in cursor.fetchall()}
+    except Exception as e:
+        logger.error(f"Ошибка получения статистики рассылки: {e}")
+        return {}
+
 def get_promocode_stats(code: str) -> Dict[str, Any]:
     """Получение статистики по промокоду"""
     try:
@@ -2305,8 +2708,8 @@ def update_chat_status(chat_id: int, status: str) -> bool:
         logger.error(f"Ошибка обновления статуса чата {chat_id}: {e}")
         return False
 
-def get_unsent_admin_messages() -> List[Dict[str, Any]]:
-    """Получение неотправленных сообщений от админа"""
+def get_unsent_admin_messages(after_id: int = 0, limit: int = 10) -> List[Dict[str, Any]]:
+    """Получение неотправленных сообщений от админа (по порядку id, начиная после after_id)"""
     try:
         with get_cursor() as cursor:
             cursor.execute('''
@@ -2314,10 +2717,10 @@ def get_unsent_admin_messages() -> List[Dict[str, Any]]:
                    c.user_id, c.user_name
             FROM chat_messages cm
             JOIN chats c ON cm.chat_id = c.id
-            WHERE cm.sender = 'admin' AND (cm.sent IS NULL OR cm.sent = 0)
-            ORDER BY cm.message_time ASC
-            LIMIT 10
-            ''')
+            WHERE cm.sender = 'admin' AND (cm.sent IS NULL OR cm.sent = 0) AND cm.id > ?
+            ORDER BY cm.id ASC
+            LIMIT ?
+            ''', (after_id, limit))
 
             results = cursor.fetchall() or []
             return [
@@ -2460,6 +2863,518 @@ def save_character_generation(user_id: int, character_name: str, dish_name: str
         logger.error(f"Ошибка сохранения генерации персонажа: {e}")
         return False
 
+# ===== ФУНКЦИИ ДЛЯ РАБОТЫ С КОРЗИНАМИ =====
+
+def get_cart(user_id: int) -> Optional[Dict[str, Any]]:
+    """
+    Загрузка корзины одного пользователя (шапка + позиции)
+
+    None - корзины нет. Ошибка БД пробрасывается: иначе ее не отличить
+    от пустой корзины, и следующая запись затрет сохраненные позиции.
+    """
+    try:
+        with get_cursor() as cursor:
+            cursor.execute('''
+            SELECT applied_discount, original_total, discount_type, discount_value, updated_at
+            FROM carts WHERE user_id = ?
+            ''', (user_id,))
+            header = cursor.fetchone()
+            if not header:
+                return None
+
+            cursor.execute('''
+            SELECT dish_id, name, price, quantity, total_price, image_url, added_at
+            FROM cart_items WHERE user_id = ?
+            ORDER BY rowid
+            ''', (user_id,))
+            items = [
+                {
+                    'dish_id': row[0],
+                    'name': row[1],
+                    'price': row[2],
+                    'quantity': row[3],
+                    'total_price': row[4],
+                    'image_url': row[5],
+                    'added_at': row[6]
+                }
+                for row in cursor.fetchall()
+            ]
+
+            cart = {
+                'items': items,
+                'applied_discount': header[0] or 0,
+                'original_total': header[1] or 0,
+                'updated_at': header[4] or ''
+            }
+            if header[2] is not None:
+                cart['discount_type'] = header[2]
+            if header[3] is not None:
+                cart['discount_value'] = header[3]
+            return cart
+    except Exception as e:
+        logger.error(f"Ошибка загрузки корзины {user_id}: {e}")
+        raise
+
+def _write_cart(cursor, user_id: int, cart: Dict[str, Any]):
+    """Запись корзины одного пользователя в открытой транзакции"""
+    cursor.execute('''
+    INSERT INTO carts (user_id, applied_discount, original_total, discount_type, discount_value, updated_at)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET
+        applied_discount = excluded.applied_discount,
+        original_total = excluded.original_total,
+        discount_type = excluded.discount_type,
+        discount_value = excluded.discount_value,
+        updated_at = excluded.updated_at
+    ''', (user_id, cart.get('applied_discount', 0), cart.get('original_total', 0),
+          cart.get('discount_type'), cart.get('discount_value'), cart.get('updated_at')))
+
+    items = cart.get('items', [])
+    dish_ids = [item['dish_id'] for item in items]
+    if dish_ids:
+        placeholders = ','.join('?' * len(dish_ids))
+        cursor.execute(f'''
+        DELETE FROM cart_items WHERE user_id = ? AND dish_id NOT IN ({placeholders})
+        ''', (user_id, *dish_ids))
+    else:
+        cursor.execute('DELETE FROM cart_items WHERE user_id = ?', (user_id,))
+
+    cursor.executemany('''
+    INSERT INTO cart_items (user_id, dish_id, name, price, quantity, total_price, image_url, added_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(user_id, dish_id) DO UPDATE SET
+        name = excluded.name,
+        price = excluded.price,
+        quantity = excluded.quantity,
+        total_price = excluded.total_price,
+        image_url = excluded.image_url
+    ''', [(user_id, item['dish_id'], item.get('name'), item.get('price', 0), item.get('quantity', 0),
+           item.get('total_price', 0), item.get('image_url'), item.get('added_at'))
+          for item in items])
+
+def save_cart(user_id: int, cart: Dict[str, Any]) -> bool:
+    """Сохранение корзины пользователя (затрагивает только строки этого пользователя)"""
+    try:
+        with get_cursor() as cursor:
+            cursor.execute('BEGIN')
+            _write_cart(cursor, user_id, cart)
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка сохранения корзины {user_id}: {e}")
+        return False
+
+def delete_cart(user_id: int) -> bool:
+    """Удаление корзины пользователя"""
+    try:
+        with get_cursor() as cursor:
+            cursor.execute('BEGIN')
+            cursor.execute('DELETE FROM cart_items WHERE user_id = ?', (user_id,))
+            cursor.execute('DELETE FROM carts WHERE user_id = ?', (user_id,))
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка удаления корзины {user_id}: {e}")
+        return False
+
+def save_carts(carts: Dict[int, Optional[Dict[str, Any]]]) -> bool:
+    """Пакетное сохранение нескольких корзин одной транзакцией (None - удалить корзину)"""
+    if not carts:
+        return True
+
+    try:
+        with get_cursor() as cursor:
+            cursor.execute('BEGIN')
+            for user_id, cart in carts.items():
+                if cart is None:
+                    cursor.execute('DELETE FROM cart_items WHERE user_id = ?', (user_id,))
+                    cursor.execute('DELETE FROM carts WHERE user_id = ?', (user_id,))
+                else:
+                    _write_cart(cursor, user_id, cart)
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка пакетного сохранения корзин: {e}")
+        return False
+
+def get_cart_user_ids() -> List[int]:
+    """Список пользователей с непустой корзиной"""
+    try:
+        with get_cursor() as cursor:
+            cursor.execute('SELECT user_id FROM carts')
+            return [row[0] for row in cursor.fetchall()]
+    except Exception as e:
+        logger.error(f"Ошибка получения списка корзин: {e}")
+        return []
+
+def import_carts(carts: Dict[str, Dict[str, Any]]) -> int:
+    """Массовый импорт корзин (миграция со старого JSON-кэша)"""
+    imported = 0
+    try:
+        with get_cursor() as cursor:
+            cursor.execute('BEGIN')
+            for user_id, cart in carts.items():
+                _write_cart(cursor, int(user_id), cart)
+                imported += 1
+        return imported
+    except Exception as e:
+        logger.error(f"Ошибка импорта корзин: {e}")
+        return 0
+
+# ===== РЕЕСТР FILE_ID ДЛЯ МЕДИА =====
+
+def get_media_file(path: str) -> Optional[Dict[str, Any]]:
+    """Запись реестра медиа для локального файла"""
+    try:
+        with get_cursor() as cursor:
+            cursor.execute('''
+            SELECT path, content_hash, file_id, file_type, size, mtime
+            FROM media_files WHERE path = ?
+            ''', (path,))
+            row = cursor.fetchone()
+            return dict(row) if row else None
+    except Exception as e:
+        logger.error(f"Ошибка получения file_id для {path}: {e}")
+        return None
+
+def save_media_file(path: str, content_hash: str, file_id: str, file_type: str,
+                    size: int, mtime: float) -> bool:
+    """Сохранение file_id для текущего содержимого файла"""
+    try:
+        with get_cursor() as cursor:
+            cursor.execute('''
+            INSERT OR REPLACE INTO media_files (path, content_hash, file_id, file_type, size, mtime, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ''', (path, content_hash, file_id, file_type, size, mtime))
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка сохранения file_id для {path}: {e}")
+        return False
+
+def delete_media_file(path: str) -> bool:
+    """Удаление записи реестра медиа (файл заменен)"""
+    try:
+        with get_cursor() as cursor:
+            cursor.execute('DELETE FROM media_files WHERE path = ?', (path,))
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка удаления file_id для {path}: {e}")
+        return False
+
+# ===== ОЖИДАНИЕ ОПЛАТЫ ЗАКАЗОВ =====
+
+def add_pending_payment(sale_key: str, user_id: int, order_number: Optional[str],
+                        next_check_at: float, expires_at: float) -> bool:
+    """Постановка заказа на отслеживание оплаты"""
+    try:
+        with get_cursor() as cursor:
+            cursor.execute('''
+            INSERT OR REPLACE INTO pending_payments
+            (sale_key, user_id, order_number, status, attempts, next_check_at, expires_at, created_at, updated_at)
+            VALUES (?, ?, ?, 'pending', 0, ?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+            ''', (sale_key, user_id, order_number, next_check_at, expires_at))
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка сохранения ожидающей оплаты {sale_key}: {e}")
+        return False
+
+def get_pending_payments() -> List[Dict[str, Any]]:
+    """Все заказы, оплата которых еще ожидается"""
+    try:
+        with get_cursor() as cursor:
+            cursor.execute('''
+            SELECT sale_key, user_id, order_number, attempts, next_check_at, expires_at
+            FROM pending_payments WHERE status = 'pending'
+            ''')
+            return [dict(row) for row in cursor.fetchall()]
+    except Exception as e:
+        logger.error(f"Ошибка получения ожидающих оплат: {e}")
+        return []
+
+def update_pending_payment(sale_key: str, attempts: int, next_check_at: float) -> bool:
+    """Запись очередной проверки статуса оплаты"""
+    try:
+        with get_cursor() as cursor:
+            cursor.execute('''
+            UPDATE pending_payments
+            SET attempts = ?, next_check_at = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE sale_key = ?
+            ''', (attempts, next_check_at, sale_key))
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка обновления ожидающей оплаты {sale_key}: {e}")
+        return False
+
+def finish_pending_payment(sale_key: str, status: str) -> Optional[bool]:
+    """
+    Завершение отслеживания: paid, expired или cancelled
+    
+    True - завершено этим вызовом, False - уже было завершено раньше, None - ошибка БД
+    """
+    try:
+        with get_cursor() as cursor:
+            cursor.execute('''
+            UPDATE pending_payments
+            SET status = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE sale_key = ? AND status = 'pending'
+            ''', (status, sale_key))
+            return cursor.rowcount > 0
+    except Exception as e:
+        logger.error(f"Ошибка завершения ожидающей оплаты {sale_key}: {e}")
+        return None
+
+# ===== КЭШ ГЕОКОДИРОВАНИЯ =====
+
+def get_geocode_cache(kind: str, query_key: str) -> Optional[Dict[str, Any]]:
+    """Непросроченная запись кэша геокодирования: {'result': JSON или None, 'expires_at'}"""
+    try:
+        with get_cursor() as cursor:
+            cursor.execute('''
+            SELECT result, expires_at FROM geocode_cache
+            WHERE kind = ? AND query_key = ? AND expires_at > ?
+            ''', (kind, query_key, time.time()))
+            row = cursor.fetchone()
+            return dict(row) if row else None
+    except Exception as e:
+        logger.error(f"Ошибка чтения кэша геокодирования: {e}")
+        return None
+
+def save_geocode_cache(kind: str, query_key: str, result: Optional[str], ttl: float) -> bool:
+    """Сохранение результата геокодирования (result None - отрицательный результат)"""
+    try:
+        with get_cursor() as cursor:
+            cursor.execute('''
+            INSERT OR REPLACE INTO geocode_cache (kind, query_key, result, expires_at, created_at)
+            VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ''', (kind, query_key, result, time.time() + ttl))
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка сохранения кэша геокодирования: {e}")
+        return False
+
+def cleanup_geocode_cache() -> int:
+    """Удаление просроченных записей кэша геокодирования"""
+    try:
+        with get_cursor() as cursor:
+            cursor.execute('DELETE FROM geocode_cache WHERE expires_at <= ?', (time.time(),))
+            return cursor.rowcount
+    except Exception as e:
+        logger.error(f"Ошибка очистки кэша геокодирования: {e}")
+        return 0
+
+def get_geocode_cache_counts() -> Dict[str, int]:
+    """Количество действующих записей кэша геокодирования по типам"""
+    try:
+        with get_cursor() as cursor:
+            cursor.execute('''
+            SELECT kind, COUNT(*) FROM geocode_cache
+            WHERE expires_at > ?
+            GROUP BY kind
+            ''', (time.time(),))
+            return {row[0]: row[1] for row in cursor.fetchall()}
+    except Exception as e:
+        logger.error(f"Ошибка подсчета кэша геокодирования: {e}")
+        return {}
+
+def get_saved_address_coordinates() -> List[Tuple[str, float, float]]:
+    """Адреса из user_addresses с координатами (последние использованные - первыми)"""
+    try:
+        with get_cursor() as cursor:
+            cursor.execute('''
+            SELECT address, latitude, longitude FROM user_addresses
+            WHERE latitude IS NOT NULL AND longitude IS NOT NULL
+            ORDER BY last_used DESC
+            ''')
+            return [(row[0], row[1], row[2]) for row in cursor.fetchall()]
+    except Exception as e:
+        logger.error(f"Ошибка получения сохраненных адресов: {e}")
+        return []
+
+def get_fsm_record(storage_key: str) -> Optional[Dict[str, Any]]:
+    """
+    Непросроченная запись FSM: {'state', 'data', 'expires_at'}
+
+    None - записи нет. Ошибка БД пробрасывается: пустая сессия вместо нее
+    затерла бы незаконченный заказ при следующей записи.
+    """
+    try:
+        with get_cursor() as cursor:
+            cursor.execute('''
+            SELECT state, data, expires_at FROM fsm_storage
+            WHERE storage_key = ? AND expires_at > ?
+            ''', (storage_key, time.time()))
+            row = cursor.fetchone()
+            return dict(row) if row else None
+    except Exception as e:
+        logger.error(f"Ошибка чтения FSM {storage_key}: {e}")
+        raise
+
+def save_fsm_record(storage_key: str, state: Optional[str], data: Optional[bytes], expires_at: float) -> bool:
+    """Сохранение состояния и данных FSM"""
+    try:
+        with get_cursor() as cursor:
+            cursor.execute('''
+            INSERT OR REPLACE INTO fsm_storage (storage_key, state, data, expires_at)
+            VALUES (?, ?, ?, ?)
+            ''', (storage_key, state, data, expires_at))
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка сохранения FSM {storage_key}: {e}")
+        return False
+
+def delete_fsm_record(storage_key: str) -> bool:
+    """Удаление записи FSM (состояние сброшено, данных нет)"""
+    try:
+        with get_cursor() as cursor:
+            cursor.execute('DELETE FROM fsm_storage WHERE storage_key = ?', (storage_key,))
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка удаления FSM {storage_key}: {e}")
+        return False
+
+def cleanup_fsm_records() -> int:
+    """Удаление брошенных сессий FSM с истекшим сроком"""
+    try:
+        with get_cursor() as cursor:
+            cursor.execute('DELETE FROM fsm_storage WHERE expires_at <= ?', (time.time(),))
+            return cursor.rowcount
+    except Exception as e:
+        logger.error(f"Ошибка очистки FSM: {e}")
+        return 0
+
+# ===== ИСТОРИЯ ИЗМЕНЕНИЙ МЕНЮ =====
+
+def save_menu_diff(counts: Dict[str, int], summary: str, details: str) -> Optional[int]:
+    """Сохранение изменений меню (details - JSON со списками изменений)"""
+    try:
+        with get_cursor() as cursor:
+            cursor.execute('''
+            INSERT INTO menu_diffs (created_at, added, removed, price_changed, stock_changed, changed, summary, details)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (datetime.now().isoformat(), counts.get('added', 0), counts.get('removed', 0),
+                  counts.get('price_changed', 0), counts.get('stock_changed', 0), counts.get('changed', 0),
+                  summary, details))
+            return cursor.lastrowid
+    except Exception as e:
+        logger.error(f"Ошибка сохранения изменений меню: {e}")
+        return None
+
+def get_menu_diffs(limit: int = 10) -> List[Dict]:
+    """Последние изменения меню (новые первыми)"""
+    try:
+        with get_cursor() as cursor:
+            cursor.execute('''
+            SELECT id, created_at, added, removed, price_changed, stock_changed, changed, summary, details
+            FROM menu_diffs
+            ORDER BY id DESC
+            LIMIT ?
+            ''', (limit,))
+            return [dict(row) for row in cursor.fetchall()]
+    except Exception as e:
+        logger.error(f"Ошибка получения истории изменений меню: {e}")
+        return []
+
+# ===== АРХИВ СТАРЫХ ДАННЫХ =====
+
+# Таблицы с архивом: таблица -> (колонка времени, колонки, схема в архиве, доп. условие)
+ARCHIVE_TABLES = {
+    'stats': (
+        'timestamp',
+        'id, user_id, action, timestamp, details',
+        'id INTEGER PRIMARY KEY, user_id INTEGER, action TEXT NOT NULL, timestamp TEXT, details TEXT',
+        '',
+    ),
+    'chat_messages': (
+        'message_time',
+        'id, chat_id, sender, message_text, message_time, sent',
+        'id INTEGER PRIMARY KEY, chat_id INTEGER NOT NULL, sender TEXT NOT NULL, '
+        'message_text TEXT NOT NULL, message_time TEXT, sent INTEGER',
+        # Недоставленные ответы операторов остаются в основной БД
+        "AND NOT (sender = 'admin' AND sent = 0)",
+    ),
+}
+
+def _attach_archive(cursor, archive_path: str):
+    """Подключение архивной БД к соединению (один раз) и создание таблиц архива"""
+    cursor.execute('PRAGMA database_list')
+    if any(row['name'] == 'archive' for row in cursor.fetchall()):
+        return
+    cursor.execute('ATTACH DATABASE ? AS archive', (archive_path,))
+    for table, (time_column, _, schema, _) in ARCHIVE_TABLES.items():
+        cursor.execute(f'CREATE TABLE IF NOT EXISTS archive.{table} ({schema})')
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS archive.idx_{table}_time ON {table}({time_column})')
+
+def archive_old_rows(table: str, cutoff: str, archive_path: str, batch_size: int = 5000) -> int:
+    """
+    Перенос пачки строк старше cutoff в архивную БД
+    
+    Строки копируются в архив и удаляются из основной БД в одной транзакции;
+    повторный перенос после сбоя не создает дублей (INSERT OR IGNORE по id).
+    Возвращает число перенесенных строк (меньше batch_size - старых строк больше нет).
+    """
+    time_column, columns, _, condition = ARCHIVE_TABLES[table]
+    batch_sql = f'''
+        SELECT id FROM main.{table}
+        WHERE {time_column} < ? {condition}
+        ORDER BY id LIMIT ?
+    '''
+    
+    try:
+        with get_cursor() as cursor:
+            _attach_archive(cursor, archive_path)
+            cursor.execute('BEGIN')
+            cursor.execute(f'''
+            INSERT OR IGNORE INTO archive.{table} ({columns})
+            SELECT {columns} FROM main.{table} WHERE id IN ({batch_sql})
+            ''', (cutoff, batch_size))
+            cursor.execute(f'DELETE FROM main.{table} WHERE id IN ({batch_sql})', (cutoff, batch_size))
+            return cursor.rowcount
+    except Exception as e:
+        logger.error(f"Ошибка переноса {table} в архив: {e}")
+        return 0
+
+def get_db_space_info() -> Dict[str, int]:
+    """Размер основной БД, свободное место в ней и размер WAL (байт)"""
+    info = {'db_bytes': 0, 'free_bytes': 0, 'wal_bytes': 0, 'auto_vacuum': 0}
+    try:
+        with get_cursor() as cursor:
+            cursor.execute('PRAGMA main.page_size')
+            page_size = cursor.fetchone()[0]
+            cursor.execute('PRAGMA main.page_count')
+            info['db_bytes'] = cursor.fetchone()[0] * page_size
+            cursor.execute('PRAGMA main.freelist_count')
+            info['free_bytes'] = cursor.fetchone()[0] * page_size
+            cursor.execute('PRAGMA main.auto_vacuum')
+            info['auto_vacuum'] = cursor.fetchone()[0]
+        wal_path = f'{DB_PATH}-wal'
+        if os.path.exists(wal_path):
+            info['wal_bytes'] = os.path.getsize(wal_path)
+    except Exception as e:
+        logger.error(f"Ошибка получения размера БД: {e}")
+    return info
+
+def compact_database(max_pages: Optional[int] = None) -> bool:
+    """
+    Возврат свободных страниц файловой системе и усечение WAL
+    
+    БД, созданная без auto_vacuum=INCREMENTAL, переводится в этот режим
+    одним полным VACUUM, дальше хватает incremental_vacuum.
+    """
+    try:
+        with get_cursor() as cursor:
+            cursor.execute('PRAGMA main.auto_vacuum')
+            if cursor.fetchone()[0] != 2:
+                logger.info("🗜️ Переводим БД в режим auto_vacuum=INCREMENTAL (полный VACUUM)")
+                cursor.execute('PRAGMA main.auto_vacuum = INCREMENTAL')
+                cursor.execute('VACUUM main')
+            else:
+                # Каждый шаг прагмы освобождает одну страницу - читаем результат до конца
+                cursor.execute(f'PRAGMA main.incremental_vacuum({int(max_pages or 0)})')
+                cursor.fetchall()
+            cursor.execute('PRAGMA main.wal_checkpoint(TRUNCATE)')
+            cursor.fetchall()
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка сжатия БД: {e}")
+        return False
+
 # Синонимы для обратной совместимости
 log_action = fast_log_action
 add_user = add_or_update_user
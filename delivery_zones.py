@@ -0,0 +1,216 @@
+"""
+delivery_zones.py
+Зоны доставки: районы из Presto с кэшем, нормализованные полигоны и сеточный индекс
+"""
+
+import asyncio
+import logging
+import math
+import time
+from typing import Dict, List, Optional, Tuple, Iterable
+
+from presto_api import presto_api
+
+logger = logging.getLogger(__name__)
+
+# Районы перечитываются из Presto не чаще раза в DISTRICTS_CACHE_TTL секунд
+DISTRICTS_CACHE_TTL = 600
+# После неудачной загрузки следующая попытка - через DISTRICTS_RETRY_INTERVAL секунд
+DISTRICTS_RETRY_INTERVAL = 60
+
+# Размер ячейки сетки в градусах (~2 км по широте Москвы)
+GRID_CELL_DEG = 0.02
+
+# 1 градус ≈ 111 км
+KM_PER_DEGREE = 111
+
+
+def normalize_point(point) -> Optional[Tuple[float, float]]:
+    """
+    Точка полигона в порядке (lat, lon)
+
+    Presto отдает координаты то как [lon, lat], то как [lat, lon] - порядок
+    определяется по диапазонам Москвы (lat ≈ 55-56, lon ≈ 37-38).
+    """
+    if not isinstance(point, (list, tuple)) or len(point) < 2:
+        return None
+    try:
+        val1 = float(point[0])
+        val2 = float(point[1])
+    except (ValueError, TypeError):
+        return None
+
+    if 30 <= val1 <= 40 and 50 <= val2 <= 60:
+        return val2, val1
+    if 50 <= val1 <= 60 and 30 <= val2 <= 40:
+        return val1, val2
+    return None
+
+
+def normalize_rings(coordinates) -> List[List[Tuple[float, float]]]:
+    """Контуры района (каждая группа координат - отдельный контур) в порядке (lat, lon)"""
+    rings = []
+    if not isinstance(coordinates, list):
+        return rings
+
+    for coord_group in coordinates:
+        if not isinstance(coord_group, list):
+            continue
+        ring = [p for p in (normalize_point(point) for point in coord_group) if p is not None]
+        if len(ring) >= 3:
+            rings.append(ring)
+    return rings
+
+
+def point_in_ring(lat: float, lon: float, ring: List[Tuple[float, float]]) -> bool:
+    """Ray casting: пересекает ли луч от точки контур нечетное число раз"""
+    inside = False
+    p1x, p1y = ring[-1]
+    for p2x, p2y in ring:
+        if (p1y > lon) != (p2y > lon):
+            xinters = (lon - p1y) * (p2x - p1x) / (p2y - p1y) + p1x
+            if lat < xinters:
+                inside = not inside
+        p1x, p1y = p2x, p2y
+    return inside
+
+
+class DeliveryZone:
+    """Район доставки с нормализованными контурами, рамкой и центром"""
+
+    def __init__(self, district: Dict, rings: List[List[Tuple[float, float]]]):
+        self.district = district
+        self.name = district.get('name', '')
+        self.rings = rings
+
+        points = [point for ring in rings for point in ring]
+        lats = [p[0] for p in points]
+        lons = [p[1] for p in points]
+        self.bbox = (min(lats), min(lons), max(lats), max(lons))
+        # Центр - среднее арифметическое вершин
+        self.centroid = (sum(lats) / len(points), sum(lons) / len(points))
+
+    def contains(self, lat: float, lon: float) -> bool:
+        """Точка внутри района (контуры-дыры учитываются по правилу четности)"""
+        min_lat, min_lon, max_lat, max_lon = self.bbox
+        if not (min_lat <= lat <= max_lat and min_lon <= lon <= max_lon):
+            return False
+
+        inside = False
+        for ring in self.rings:
+            if point_in_ring(lat, lon, ring):
+                inside = not inside
+        return inside
+
+    def distance_to_centroid(self, lat: float, lon: float) -> float:
+        """Расстояние до центра в градусах (упрощенно)"""
+        return math.hypot(lat - self.centroid[0], lon - self.centroid[1])
+
+
+class DeliveryZoneIndex:
+    """
+    Индекс зон доставки.
+
+    Районы загружаются из Presto один раз на DISTRICTS_CACHE_TTL (параллельные
+    запросы ждут одну загрузку), полигоны разбираются сразу, а рамки районов
+    раскладываются по ячейкам сетки - проверка адреса смотрит только районы
+    своей ячейки и почти всегда отсекает лишние по рамке.
+    """
+
+    def __init__(self, ttl: float = DISTRICTS_CACHE_TTL, cell_size: float = GRID_CELL_DEG):
+        self.ttl = ttl
+        self.cell_size = cell_size
+        self.districts: List[Dict] = []
+        self.zones: List[DeliveryZone] = []
+        self._grid: Dict[Tuple[int, int], List[int]] = {}
+        self._expires_at = 0.0
+        self._lock = asyncio.Lock()
+        self.stats = {'loads': 0, 'lookups': 0}
+
+    def _cell(self, lat: float, lon: float) -> Tuple[int, int]:
+        return math.floor(lat / self.cell_size), math.floor(lon / self.cell_size)
+
+    def build(self, districts: List[Dict]):
+        """Разбор районов и построение сетки"""
+        zones = []
+        for district in districts:
+            rings = normalize_rings(district.get('coordinates', []))
+            if not rings:
+                logger.warning(f"⚠️ Нет валидных координат у района '{district.get('name', '')}'")
+                continue
+            zones.append(DeliveryZone(district, rings))
+
+        grid: Dict[Tuple[int, int], List[int]] = {}
+        for zone_index, zone in enumerate(zones):
+            min_lat, min_lon, max_lat, max_lon = zone.bbox
+            min_cell = self._cell(min_lat, min_lon)
+            max_cell = self._cell(max_lat, max_lon)
+            for cell_lat in range(min_cell[0], max_cell[0] + 1):
+                for cell_lon in range(min_cell[1], max_cell[1] + 1):
+                    grid.setdefault((cell_lat, cell_lon), []).append(zone_index)
+
+        self.districts = districts
+        self.zones = zones
+        self._grid = grid
+        logger.info(f"✅ Зоны доставки: {len(zones)} из {len(districts)} районов, {len(grid)} ячеек сетки")
+
+    async def load(self, force: bool = False) -> bool:
+        """Загрузить районы, если кэш устарел. False - районов нет"""
+        if not force and time.monotonic() < self._expires_at:
+            return bool(self.districts)
+
+        async with self._lock:
+            if not force and time.monotonic() < self._expires_at:
+                return bool(self.districts)
+
+            districts = await presto_api.get_delivery_districts(with_coordinates=True)
+            if districts:
+                self.build(districts)
+                self.stats['loads'] += 1
+                self._expires_at = time.monotonic() + self.ttl
+            else:
+                # Оставляем прежние районы (если были) и пробуем снова позже
+                logger.warning("⚠️ Не удалось загрузить районы доставки")
+                self._expires_at = time.monotonic() + DISTRICTS_RETRY_INTERVAL
+            return bool(self.districts)
+
+    def invalidate(self):
+        """Перечитать районы при следующем обращении"""
+        self._expires_at = 0.0
+
+    def locate(self, lat: float, lon: float) -> Optional[DeliveryZone]:
+        """Район, в который попадает точка (первый по порядку Presto)"""
+        self.stats['lookups'] += 1
+        for zone_index in self._grid.get(self._cell(lat, lon), ()):
+            zone = self.zones[zone_index]
+            if zone.contains(lat, lon):
+                return zone
+        return None
+
+    def nearest(self, lat: float, lon: float) -> Tuple[Optional[DeliveryZone], float]:
+        """Ближайший по центру район и расстояние до него в градусах"""
+        closest = None
+        min_distance = float('inf')
+        for zone in self.zones:
+            distance = zone.distance_to_centroid(lat, lon)
+            if distance < min_distance:
+                closest = zone
+                min_distance = distance
+        return closest, min_distance
+
+    def classify(self, points: Iterable[Tuple[float, float]]) -> List[Optional[Dict]]:
+        """Районы для множества точек (lat, lon); None - точка вне зоны доставки"""
+        result = []
+        for lat, lon in points:
+            zone = self.locate(lat, lon)
+            result.append(zone.district if zone else None)
+        return result
+
+    async def classify_points(self, points: Iterable[Tuple[float, float]]) -> List[Optional[Dict]]:
+        """classify() с предварительной загрузкой районов"""
+        await self.load()
+        return self.classify(points)
+
+
+# Глобальный индекс зон доставки
+delivery_zones = DeliveryZoneIndex()
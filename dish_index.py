@@ -0,0 +1,172 @@
+"""
+dish_index.py
+Индекс названий блюд для быстрого поиска по меню (AI помощник)
+"""
+
+import logging
+from typing import Dict, List, Optional, Any, Callable, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Порог похожести по триграммам для нечеткого поиска (опечатки)
+FUZZY_MIN_SIMILARITY = 0.45
+
+
+def normalize_name(text: str) -> str:
+    """Нормализация названия: регистр, ё→е, лишние пробелы"""
+    return ' '.join(text.lower().replace('ё', 'е').split())
+
+
+def trigrams(text: str) -> set:
+    """Символьные триграммы строки (с границами слова)"""
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class DishIndex:
+    """
+    Индекс блюд одного снимка меню.
+
+    Хранит нормализованное название → позиции, префиксное дерево
+    и инвертированный индекс триграмм. Порядок позиций совпадает
+    с порядком обхода меню, поэтому при равной оценке побеждает
+    то же блюдо, что и при полном переборе.
+    """
+
+    def __init__(self, menus: Dict):
+        self.entries: List[Dict[str, Any]] = []      # позиции в порядке обхода меню
+        self.categories: List[Dict[str, Any]] = []   # категории с нормализованными названиями
+        self.by_name: Dict[str, List[int]] = {}
+        self._trie: Dict[Any, Any] = {}              # узел: символ → узел, None → все позиции с этим префиксом
+        self._trigrams: Dict[str, List[int]] = {}
+        self._gram_counts: List[int] = []
+
+        for menu_id, menu in menus.items():
+            for cat_id, category in menu.get('categories', {}).items():
+                display_name = category.get('display_name')
+                self.categories.append({
+                    'menu_id': menu_id,
+                    'cat_id': cat_id,
+                    'category': category,
+                    'name': category.get('name', '').lower().strip(),
+                    'display': display_name.lower().strip() if display_name is not None else None
+                })
+
+                for item in category.get('items', []):
+                    self._add(item, menu_id, cat_id)
+
+        logger.debug(f"Индекс блюд: {len(self.entries)} позиций, "
+                     f"{len(self.categories)} категорий, {len(self._trigrams)} триграмм")
+
+    def _add(self, item: Dict, menu_id: Any, cat_id: Any):
+        """Добавление позиции во все структуры индекса"""
+        entry_id = len(self.entries)
+        name = normalize_name(item.get('name', ''))
+        self.entries.append({'item': item, 'menu_id': menu_id, 'cat_id': cat_id, 'name': name})
+
+        self.by_name.setdefault(name, []).append(entry_id)
+
+        # Позиции добавляются по порядку, поэтому списки в узлах уже отсортированы
+        node = self._trie
+        for char in name:
+            node = node.setdefault(char, {})
+            node.setdefault(None, []).append(entry_id)
+
+        grams = trigrams(name)
+        self._gram_counts.append(len(grams))
+        for gram in grams:
+            self._trigrams.setdefault(gram, []).append(entry_id)
+
+    def _prefix_ids(self, prefix: str) -> List[int]:
+        """Все позиции, название которых начинается с prefix (по возрастанию)"""
+        node = self._trie
+        for char in prefix:
+            node = node.get(char)
+            if node is None:
+                return []
+        return node.get(None, [])
+
+    def _substring_ids(self, query: str) -> List[int]:
+        """Позиции, содержащие query как подстроку (кандидаты - по самой редкой триграмме)"""
+        # Триграммы с краевыми пробелами привязаны к началу/концу слова - для подстроки не годятся
+        grams = [g for g in trigrams(query) if g[0] != ' ' and g[-1] != ' ']
+        if not grams:
+            return [i for i, entry in enumerate(self.entries) if query in entry['name']]
+
+        candidates = min((self._trigrams.get(g, []) for g in grams), key=len)
+        return [i for i in candidates if query in self.entries[i]['name']]
+
+    def _fuzzy_ids(self, query: str) -> List[Tuple[float, int]]:
+        """Нечеткие кандидаты: похожесть Жаккара по триграммам"""
+        query_grams = trigrams(query)
+        overlap: Dict[int, int] = {}
+        for gram in query_grams:
+            for entry_id in self._trigrams.get(gram, ()):
+                overlap[entry_id] = overlap.get(entry_id, 0) + 1
+
+        results = []
+        for entry_id, common in overlap.items():
+            similarity = common / (len(query_grams) + self._gram_counts[entry_id] - common)
+            if similarity >= FUZZY_MIN_SIMILARITY:
+                results.append((similarity, entry_id))
+        return results
+
+    def search(self, query: str, limit: int = 5,
+               predicate: Optional[Callable[[Dict], Any]] = None) -> List[Tuple[float, Dict]]:
+        """
+        Ранжированный поиск блюда по названию
+
+        Оценки совпадают с прежним перебором: 100 - точное совпадение,
+        90 - начало названия, до 50 - вхождение подстроки. Если ничего
+        не нашлось, возвращаются нечеткие совпадения (до 40 баллов).
+
+        Args:
+            query: название блюда
+            limit: максимум результатов
+            predicate: фильтр позиций (например, только с фото)
+
+        Returns:
+            Список (оценка, блюдо) по убыванию оценки
+        """
+        search_name = normalize_name(query)
+        if not search_name:
+            return []
+
+        ranked: List[Tuple[float, int]] = []
+        seen = set()
+
+        def collect(entry_ids, score_of, stop_at_limit: bool):
+            for entry_id in entry_ids:
+                if entry_id in seen:
+                    continue
+                seen.add(entry_id)
+                if predicate and not predicate(self.entries[entry_id]['item']):
+                    continue
+                ranked.append((score_of(entry_id), entry_id))
+                # Внутри уровня с одинаковой оценкой дальше искать незачем
+                if stop_at_limit and len(ranked) >= limit:
+                    return
+
+        # Уровни идут по убыванию оценки: следующий нужен, только если не набрали limit
+        collect(self.by_name.get(search_name, ()), lambda i: 100, True)
+        if len(ranked) < limit:
+            collect(self._prefix_ids(search_name), lambda i: 90, True)
+        if len(ranked) < limit:
+            collect(self._substring_ids(search_name),
+                    lambda i: len(search_name) / len(self.entries[i]['name']) * 50, False)
+
+        if not ranked:
+            similarities = dict((entry_id, similarity) for similarity, entry_id in self._fuzzy_ids(search_name))
+            collect(sorted(similarities), lambda i: similarities[i] * 40, False)
+
+        ranked.sort(key=lambda pair: (-pair[0], pair[1]))
+        return [(score, self.entries[entry_id]['item']) for score, entry_id in ranked[:limit]]
+
+    def best_match(self, query: str,
+                   predicate: Optional[Callable[[Dict], Any]] = None) -> Tuple[Optional[Dict], float]:
+        """Лучшее совпадение и его оценка (None, 0 - если не найдено)"""
+        results = self.search(query, limit=1, predicate=predicate)
+        if not results:
+            return None, 0
+        score, item = results[0]
+        return item, score
@@ -0,0 +1,183 @@
+"""
+fsm_storage.py
+Хранилище FSM aiogram в SQLite: компактные данные, срок жизни сессий и LRU-кэш в памяти
+"""
+
+import json
+import logging
+import time
+import zlib
+from collections import OrderedDict
+from datetime import date, datetime
+from typing import Dict, Any, Optional, List
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType
+
+import config
+import database
+
+logger = logging.getLogger(__name__)
+
+# Данные больше COMPRESS_MIN_SIZE байт сжимаются zlib
+COMPRESS_MIN_SIZE = 512
+
+# Брошенные сессии удаляются из БД после стольких записей
+CLEANUP_EVERY_WRITES = 1000
+
+_PLAIN = b'j'
+_COMPRESSED = b'z'
+
+
+def _encode_value(value):
+    """
+    Типы, которых нет в JSON
+
+    datetime и date восстанавливаются при чтении, а tuple, set и frozenset
+    сохраняются списком и после перезапуска читаются как list.
+    """
+    if isinstance(value, datetime):
+        return {'__datetime__': value.isoformat()}
+    if isinstance(value, date):
+        return {'__date__': value.isoformat()}
+    if isinstance(value, (set, frozenset, tuple)):
+        return list(value)
+    raise TypeError(f"{type(value).__name__} нельзя сохранить в FSM")
+
+
+def _decode_value(value: Dict[str, Any]):
+    if '__datetime__' in value:
+        return datetime.fromisoformat(value['__datetime__'])
+    if '__date__' in value:
+        return date.fromisoformat(value['__date__'])
+    return value
+
+
+def dump_data(data: Dict[str, Any]) -> Optional[bytes]:
+    """Данные FSM → компактный JSON (сжатый, если большой); пустые данные → None"""
+    if not data:
+        return None
+    raw = json.dumps(data, ensure_ascii=False, separators=(',', ':'), default=_encode_value).encode('utf-8')
+    if len(raw) >= COMPRESS_MIN_SIZE:
+        return _COMPRESSED + zlib.compress(raw)
+    return _PLAIN + raw
+
+
+def load_data(blob: Optional[bytes]) -> Dict[str, Any]:
+    """Обратное преобразование dump_data()"""
+    if not blob:
+        return {}
+    blob = bytes(blob)
+    raw = zlib.decompress(blob[1:]) if blob[:1] == _COMPRESSED else blob[1:]
+    return json.loads(raw.decode('utf-8'), object_hook=_decode_value)
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    Хранилище FSM в restaurant.db вместо MemoryStorage.
+
+    Состояние и данные пользователя хранятся одной строкой таблицы
+    fsm_storage, поэтому незаконченные заказы и бронирования переживают
+    перезапуск бота. Запись идет сразу в БД, чтение - из LRU-кэша последних
+    FSM_CACHE_SIZE пользователей (промах читает БД один раз). Сессия живет
+    FSM_STATE_TTL секунд после последнего изменения, брошенные сессии
+    периодически удаляются. Кортежи и множества в данных после перезапуска
+    возвращаются списками (см. _encode_value).
+    """
+
+    def __init__(self, ttl: float = config.FSM_STATE_TTL, cache_size: int = config.FSM_CACHE_SIZE):
+        self.ttl = ttl
+        self.cache_size = cache_size
+        # ключ -> [state, data, expires_at]
+        self._cache: "OrderedDict[str, List[Any]]" = OrderedDict()
+        self._writes = 0
+        self.stats = {'hits': 0, 'misses': 0, 'writes': 0}
+        self.cleanup()
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        parts = (key.bot_id, key.chat_id, key.user_id, key.thread_id or '',
+                 getattr(key, 'business_connection_id', None) or '', key.destiny)
+        return ':'.join(str(part) for part in parts)
+
+    def _remember(self, storage_key: str, record: List[Any]):
+        self._cache[storage_key] = record
+        self._cache.move_to_end(storage_key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _load(self, storage_key: str) -> List[Any]:
+        """
+        Запись из кэша или из БД (нет записи - пустая, тоже кэшируется)
+
+        Ошибка чтения БД пробрасывается и ничего не кэширует, чтобы следующая
+        запись не затерла сохраненную сессию пустой.
+        """
+        now = time.time()
+        record = self._cache.get(storage_key)
+        if record is not None and record[2] > now:
+            self._cache.move_to_end(storage_key)
+            self.stats['hits'] += 1
+            return record
+
+        self.stats['misses'] += 1
+        row = database.get_fsm_record(storage_key)
+        record = None
+        if row:
+            try:
+                record = [row['state'], load_data(row['data']), row['expires_at']]
+            except (ValueError, zlib.error) as e:
+                logger.error(f"❌ Поврежденные данные FSM {storage_key}, сессия сброшена: {e}")
+        if record is None:
+            record = [None, {}, now + self.ttl]
+        self._remember(storage_key, record)
+        return record
+
+    def _save(self, storage_key: str, state: Optional[str], data: Dict[str, Any]):
+        """Обновить кэш и записать в БД (пустая сессия удаляется)"""
+        record = [state, data, time.time() + self.ttl]
+        self._remember(storage_key, record)
+
+        if state is None and not data:
+            database.delete_fsm_record(storage_key)
+        else:
+            try:
+                blob = dump_data(data)
+            except (TypeError, ValueError) as e:
+                # Сессия остается только в памяти - как было с MemoryStorage; прежняя
+                # запись удаляется, чтобы после перезапуска не вернулось устаревшее состояние
+                logger.error(f"❌ Данные FSM {storage_key} не сохранены в БД: {e}")
+                database.delete_fsm_record(storage_key)
+                return
+            database.save_fsm_record(storage_key, state, blob, record[2])
+
+        self.stats['writes'] += 1
+        self._writes += 1
+        if self._writes % CLEANUP_EVERY_WRITES == 0:
+            self.cleanup()
+
+    def cleanup(self) -> int:
+        """Удалить брошенные сессии из БД"""
+        removed = database.cleanup_fsm_records()
+        if removed:
+            logger.info(f"🧹 Удалено брошенных сессий FSM: {removed}")
+        return removed
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        storage_key = self._key(key)
+        record = self._load(storage_key)
+        self._save(storage_key, state.state if isinstance(state, State) else state, record[1])
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return self._load(self._key(key))[0]
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        storage_key = self._key(key)
+        record = self._load(storage_key)
+        self._save(storage_key, record[0], dict(data))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return self._load(self._key(key))[1].copy()
+
+    async def close(self) -> None:
+        self._cache.clear()
@@ -0,0 +1,131 @@
+"""
+geocode_cache.py
+Кэш геокодирования и подсказок адресов в SQLite: нормализованные ключи, TTL, кэш промахов
+"""
+
+import json
+import logging
+import re
+import time
+from typing import Dict, Any, Optional, Callable, Awaitable, Tuple
+
+import database
+from async_db import adb
+
+logger = logging.getLogger(__name__)
+
+# Сроки хранения (сек)
+GEOCODE_TTL = 30 * 24 * 3600      # адрес → координаты
+REVERSE_TTL = 30 * 24 * 3600      # координаты → адрес
+SUGGEST_TTL = 7 * 24 * 3600       # подсказки адресов Presto
+NEGATIVE_TTL = 24 * 3600          # "не найдено"
+
+# Координаты обратного геокодирования округляются до 4 знаков (~10 м)
+COORDS_PRECISION = 4
+
+# Сохраненные адреса клиентов перечитываются не чаще раза в SAVED_ADDRESSES_TTL секунд
+SAVED_ADDRESSES_TTL = 300
+
+# Просроченные записи удаляются после стольких записей в кэш
+CLEANUP_EVERY_WRITES = 500
+
+# Центр Москвы - запасные координаты при ошибках, в кэш как результат не попадают
+DEFAULT_COORDINATES = (55.7558, 37.6176)
+
+_PUNCTUATION_RE = re.compile(r'[,.;:"«»()\-]+')
+_SPACES_RE = re.compile(r'\s+')
+_CITY_PREFIX_RE = re.compile(r'^(россия\s+)?(г\s+|город\s+)?(москва|мск)\s+')
+
+
+def normalize_address(address: str) -> str:
+    """Ключ адреса: регистр, ё→е, без пунктуации, лишних пробелов и префикса города"""
+    text = address.lower().replace('ё', 'е')
+    text = _PUNCTUATION_RE.sub(' ', text)
+    text = _SPACES_RE.sub(' ', text).strip()
+    return _CITY_PREFIX_RE.sub('', text)
+
+
+def coords_key(latitude: float, longitude: float) -> str:
+    """Ключ координат, округленных до ~10 м"""
+    return f"{round(latitude, COORDS_PRECISION):.{COORDS_PRECISION}f},{round(longitude, COORDS_PRECISION):.{COORDS_PRECISION}f}"
+
+
+class GeocodeCache:
+    """
+    Кэш ответов геокодеров.
+
+    Результаты (и промахи - на меньший срок) хранятся в таблице geocode_cache,
+    поэтому переживают перезапуск бота. Ошибки сети и сервиса не кэшируются.
+    Адреса, которые клиенты уже сохраняли в user_addresses, получают
+    координаты без внешних запросов. Запросы к SQLite идут через adb,
+    чтобы не блокировать цикл событий.
+    """
+
+    def __init__(self):
+        self._saved_addresses: Dict[str, Tuple[float, float]] = {}
+        self._saved_loaded_at = 0.0
+        self._writes = 0
+        self.stats = {'hits': 0, 'negative_hits': 0, 'misses': 0, 'saved_address_hits': 0}
+
+    async def get_or_fetch(self, kind: str, key: str,
+                           fetch: Callable[[], Awaitable[Any]],
+                           ttl: float, negative_ttl: float = NEGATIVE_TTL) -> Any:
+        """
+        Результат из кэша или от fetch() с сохранением
+
+        Пустой результат fetch() (None, [], '') кэшируется как промах на negative_ttl,
+        исключение пробрасывается и не кэшируется.
+        """
+        record = await adb.read(database.get_geocode_cache, kind, key)
+        if record is not None:
+            if record['result'] is None:
+                self.stats['negative_hits'] += 1
+                return None
+            self.stats['hits'] += 1
+            return json.loads(record['result'])
+
+        self.stats['misses'] += 1
+        result = await fetch()
+        if result:
+            await adb.write(database.save_geocode_cache, kind, key, json.dumps(result, ensure_ascii=False), ttl)
+        else:
+            await adb.write(database.save_geocode_cache, kind, key, None, negative_ttl)
+        await self._after_write()
+        return result or None
+
+    async def _after_write(self):
+        """Периодическая очистка просроченных записей"""
+        self._writes += 1
+        if self._writes % CLEANUP_EVERY_WRITES == 0:
+            removed = await adb.write(database.cleanup_geocode_cache)
+            if removed:
+                logger.info(f"🧹 Удалено просроченных записей геокодирования: {removed}")
+
+    async def saved_address_coordinates(self, address: str) -> Optional[Dict[str, float]]:
+        """Координаты адреса, который уже сохранял кто-то из клиентов"""
+        if time.monotonic() - self._saved_loaded_at > SAVED_ADDRESSES_TTL:
+            saved = {}
+            for saved_address, latitude, longitude in await adb.read(database.get_saved_address_coordinates):
+                if (latitude, longitude) == DEFAULT_COORDINATES:
+                    continue
+                saved.setdefault(normalize_address(saved_address), (latitude, longitude))
+            self._saved_addresses = saved
+            self._saved_loaded_at = time.monotonic()
+
+        coordinates = self._saved_addresses.get(normalize_address(address))
+        if coordinates is None:
+            return None
+        self.stats['saved_address_hits'] += 1
+        return {'lat': coordinates[0], 'lon': coordinates[1]}
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Счетчики попаданий/промахов и размер кэша по типам"""
+        lookups = self.stats['hits'] + self.stats['negative_hits'] + self.stats['misses']
+        stats = dict(self.stats)
+        stats['hit_rate'] = (lookups - self.stats['misses']) / lookups if lookups else 0.0
+        stats['entries'] = database.get_geocode_cache_counts()
+        return stats
+
+
+# Глобальный экземпляр кэша геокодирования
+geocode_cache = GeocodeCache()
@@ -0,0 +1,315 @@
+"""
+hall_schema.py
+Схема зала для бронирования: отрисовка вне event loop и кэш готовых картинок
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import lru_cache
+from io import BytesIO
+from typing import Dict, List, Optional, Any, Tuple
+
+try:
+    from PIL import Image, ImageDraw, ImageFont
+    PIL_AVAILABLE = True
+except ImportError:
+    PIL_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+BASE_SCHEMA_PATH = os.path.join("files", "tables.png")
+TEMP_DIR = "temp"
+
+# Кэш отрисованных схем в памяти (PNG ~ сотни КБ)
+SCHEMA_CACHE_SIZE = 32
+RENDER_WORKERS = 2
+
+# Старые файлы схем в temp/ (hall_<user>_<ts>.png и т.п.) удаляются по возрасту
+SCHEMA_FILE_PREFIXES = ("hall_", "direct_booking_")
+SCHEMA_FILE_TTL = 3600
+CLEANUP_INTERVAL = 600
+
+# Какие номера столов показываются для количества гостей
+ALLOWED_TABLES_BY_GUESTS = {
+    1: {3, 4, 5, 7, 8, 10, 12, 14, 15, 16},
+    2: {3, 4, 5, 7, 8, 10, 12, 14, 15, 16},
+    3: {1, 2, 6, 11, 17, 18},
+    4: {1, 2, 6, 11, 17, 18},
+}
+
+
+@lru_cache(maxsize=8)
+def _load_font(size: int):
+    """Шрифт загружается один раз на размер"""
+    try:
+        return ImageFont.truetype("arial.ttf", size)
+    except Exception:
+        return ImageFont.load_default()
+
+
+def _text_size(font, text: str) -> Tuple[int, int]:
+    """Размер текста (getbbox в новых Pillow, getsize - в старых)"""
+    try:
+        left, top, right, bottom = font.getbbox(text)
+        return right - left, bottom - top
+    except Exception:
+        return font.getsize(text)
+
+
+def render_hall_schema(base_image, hall_data: dict, guests: int,
+                       selected_date: str, selected_time: str) -> Tuple[bytes, List[Any]]:
+    """
+    Отрисовка схемы зала поверх базовой картинки
+
+    Returns:
+        (PNG в байтах, ID свободных столов)
+    """
+    hall = hall_data["halls"][0]
+    items = hall.get("items", [])
+
+    img = base_image.copy()
+    width, height = img.size
+    overlay = Image.new('RGBA', (width, height), (255, 255, 255, 0))
+    draw = ImageDraw.Draw(overlay)
+
+    rel = hall.get("relation", {})
+    api_left = rel.get("left", 0)
+    api_top = rel.get("top", 0)
+    api_right = rel.get("right", 1000)
+    api_bottom = rel.get("bottom", 800)
+    api_width = api_right - api_left
+    api_height = api_bottom - api_top
+    scale_x = width / api_width if api_width > 0 else 1
+    scale_y = height / api_height if api_height > 0 else 1
+
+    free_table_ids = []
+    allowed_table_numbers = ALLOWED_TABLES_BY_GUESTS.get(guests, set())
+    font = _load_font(14)
+
+    for item in items:
+        if item.get("kind") != "table" or not item.get("visible", True):
+            continue
+
+        name = str(item.get("name", "?"))
+        try:
+            table_num = int(name)
+        except (ValueError, TypeError):
+            table_num = -1
+
+        # ✅ ПРОПУСКАЕМ стол, если он НЕ в списке разрешённых для этого количества гостей
+        if table_num not in allowed_table_numbers:
+            continue
+
+        x = (item.get("x", 0) - api_left) * scale_x
+        y = (item.get("y", 0) - api_top) * scale_y
+
+        if item.get("isBookingLocked", False):
+            color = (0, 0, 0, 200)
+        elif item.get("busy", True):
+            color = (255, 0, 0, 200)
+        else:
+            color = (0, 255, 0, 200)
+            free_table_ids.append(item["id"])
+
+        radius = 20
+        draw.ellipse(
+            [x - radius, y - radius, x + radius, y + radius],
+            fill=color,
+            outline=(255, 255, 255, 255),
+            width=3
+        )
+
+        text_width, text_height = _text_size(font, name)
+        draw.text(
+            (x - text_width / 2, y - text_height / 2),
+            name,
+            fill=(255, 255, 255, 255),
+            font=font,
+            stroke_width=1,
+            stroke_fill=(0, 0, 0, 200)
+        )
+
+    img = Image.alpha_composite(img, overlay)
+
+    # --- Текст с датой, временем, гостями ---
+    font_large = _load_font(20)
+    font_small = _load_font(16)
+
+    try:
+        display_date = datetime.strptime(selected_date, "%d.%m.%Y").strftime("%d.%m.%Y")
+    except Exception:
+        display_date = selected_date
+
+    date_text = f"Дата: {display_date}"
+    time_text = f"Время: {selected_time}"
+    guests_text = f"Гостей: {guests}"
+
+    text_overlay = Image.new('RGBA', (width, height), (255, 255, 255, 0))
+    text_draw = ImageDraw.Draw(text_overlay)
+
+    try:
+        max_width = max(_text_size(font_large, date_text)[0],
+                        _text_size(font_small, time_text)[0],
+                        _text_size(font_small, guests_text)[0])
+    except Exception:
+        max_width = 200
+
+    text_x = width - max_width - 20
+    text_y = 20
+
+    text_draw.rectangle(
+        [text_x - 10, text_y - 10, text_x + max_width + 10, text_y + 80],
+        fill=(0, 0, 0, 180),
+        outline=(255, 255, 255, 200),
+        width=2
+    )
+    text_draw.text((text_x, text_y), date_text, fill=(255, 255, 255, 255), font=font_large)
+    text_draw.text((text_x, text_y + 30), time_text, fill=(255, 255, 255, 255), font=font_small)
+    text_draw.text((text_x, text_y + 55), guests_text, fill=(255, 255, 255, 255), font=font_small)
+
+    img = Image.alpha_composite(img, text_overlay)
+
+    buffer = BytesIO()
+    img.save(buffer, "PNG")
+    return buffer.getvalue(), free_table_ids
+
+
+def schema_key(hall_data: dict, guests: int, selected_date: str, selected_time: str) -> str:
+    """Хэш всего, что влияет на картинку: состояние столов, гости, слот"""
+    hall = hall_data["halls"][0]
+    tables = sorted(
+        (str(item.get("id")), str(item.get("name", "?")), item.get("x", 0), item.get("y", 0),
+         bool(item.get("busy", True)), bool(item.get("isBookingLocked", False)))
+        for item in hall.get("items", [])
+        if item.get("kind") == "table" and item.get("visible", True)
+    )
+    payload = json.dumps([tables, hall.get("relation", {}), guests, selected_date, selected_time],
+                         sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+class HallSchemaCache:
+    """
+    Кэш схем зала.
+
+    Базовая картинка декодируется один раз (и перечитывается при смене файла),
+    отрисовка идет в пуле потоков, готовые PNG и file_id Telegram хранятся по
+    хэшу схемы - одинаковые схемы не перерисовываются и не загружаются заново.
+    """
+
+    def __init__(self, max_size: int = SCHEMA_CACHE_SIZE):
+        self.max_size = max_size
+        self._schemas: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._base_image = None
+        self._base_mtime: Optional[float] = None
+        self._base_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=RENDER_WORKERS, thread_name_prefix="hall_schema")
+        self._last_cleanup = 0.0
+        self.stats = {'hits': 0, 'renders': 0}
+
+    def _get_base_image(self):
+        """Базовая схема в RGBA (декодируется только при изменении файла)"""
+        mtime = os.path.getmtime(BASE_SCHEMA_PATH)
+        with self._base_lock:
+            if self._base_image is None or mtime != self._base_mtime:
+                with Image.open(BASE_SCHEMA_PATH) as source:
+                    self._base_image = source.convert("RGBA")
+                self._base_mtime = mtime
+                logger.info(f"🖼️ Базовая схема зала загружена: {self._base_image.size}")
+            return self._base_image
+
+    def _render(self, hall_data: dict, guests: int, selected_date: str, selected_time: str):
+        """Отрисовка в рабочем потоке"""
+        return render_hall_schema(self._get_base_image(), hall_data, guests, selected_date, selected_time)
+
+    async def render(self, hall_data: dict, guests: int,
+                     selected_date: str, selected_time: str) -> Optional[Dict[str, Any]]:
+        """
+        Готовая схема зала
+
+        Returns:
+            {'key', 'png', 'file_id', 'free_table_ids'} или None, если схему построить нельзя
+        """
+        if not PIL_AVAILABLE:
+            print("⚠️ Pillow не установлен, пропускаем генерацию схемы зала")
+            return None
+        if not os.path.exists(BASE_SCHEMA_PATH):
+            return None
+
+        loop = asyncio.get_running_loop()
+        self._maybe_cleanup(loop)
+
+        try:
+            key = schema_key(hall_data, guests, selected_date, selected_time)
+            schema = self._schemas.get(key)
+            if schema is not None:
+                self._schemas.move_to_end(key)
+                self.stats['hits'] += 1
+                return schema
+
+            png, free_table_ids = await loop.run_in_executor(
+                self._executor, self._render, hall_data, guests, selected_date, selected_time
+            )
+            self.stats['renders'] += 1
+
+            schema = {'key': key, 'png': png, 'file_id': None, 'free_table_ids': free_table_ids}
+            self._schemas[key] = schema
+            while len(self._schemas) > self.max_size:
+                self._schemas.popitem(last=False)
+            return schema
+        except Exception as e:
+            logger.error(f"❌ Ошибка генерации схемы зала: {e}")
+            return None
+
+    def remember_file_id(self, key: str, file_id: str):
+        """Запомнить file_id отправленной схемы - повторно ее можно слать без загрузки"""
+        schema = self._schemas.get(key)
+        if schema is not None:
+            schema['file_id'] = file_id
+
+    def _maybe_cleanup(self, loop):
+        """Не чаще раза в CLEANUP_INTERVAL чистим старые файлы схем (в пуле, без блокировки loop)"""
+        now = time.time()
+        if now - self._last_cleanup < CLEANUP_INTERVAL:
+            return
+        self._last_cleanup = now
+        loop.run_in_executor(self._executor, cleanup_schema_files)
+
+    def shutdown(self):
+        """Остановка пула отрисовки"""
+        self._executor.shutdown(wait=False)
+
+
+def cleanup_schema_files(max_age: int = SCHEMA_FILE_TTL) -> int:
+    """Удаление файлов схем из temp/ старше max_age секунд"""
+    removed = 0
+    if not os.path.isdir(TEMP_DIR):
+        return removed
+
+    cutoff = time.time() - max_age
+    for filename in os.listdir(TEMP_DIR):
+        if not filename.startswith(SCHEMA_FILE_PREFIXES) or not filename.endswith(".png"):
+            continue
+        path = os.path.join(TEMP_DIR, filename)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+                removed += 1
+        except OSError:
+            continue
+
+    if removed:
+        logger.info(f"🧹 Удалено старых схем зала: {removed}")
+    return removed
+
+
+# Глобальный экземпляр кэша схем зала
+hall_schema_cache = HallSchemaCache()
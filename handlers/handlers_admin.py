@@ -21,10 +21,16 @@ from keyboards import (
     dish_selection_keyboard       # ← И эту функцию
 )
 import database
+from async_db import adb
+from action_log import action_log
+from retention import retention_manager
 import services
 import config
 import asyncio
 import cache_manager
+from cart_manager import cart_manager
+from media_registry import media_registry
+from newsletter_engine import newsletter_engine
 import logging
 import os
 import shutil
@@ -34,6 +40,7 @@ import aiohttp
 from aiogram.exceptions import TelegramNetworkError
 import re
 import json
+import html
 # Импортируем утилиты и состояния
 from .utils import (
     safe_send_message,
@@ -59,6 +66,9 @@ FILES_DIR = "files/menu"
 PDF_MENU_PATH = os.path.join(FILES_DIR, "Menu.pdf")
 BANQUET_MENU_PATH = os.path.join(FILES_DIR, "MenuBanket.xlsx")
 
+# Периоды статистики (дней) в админке
+STATS_RANGES = (7, 30, 90)
+
 # Создаем директорию, если её нет
 os.makedirs(FILES_DIR, exist_ok=True)
 
@@ -277,7 +287,7 @@ async def handle_table_photo_upload(message: Message, state: FSMContext):
         await state.clear()
 
         # Логируем действие
-        database.log_action(message.from_user.id, "replace_table_photo",
+        action_log.log(message.from_user.id, "replace_table_photo",
                           f"filename:{filename}, size:{file_size_kb}KB")
 
     except Exception as e:
@@ -412,15 +422,15 @@ async def download_pdf_callback(callback: types.CallbackQuery):
         return
     
     try:
-        with open(PDF_MENU_PATH, 'rb') as file:
-            await callback.bot.send_document(
-                chat_id=callback.from_user.id,
-                document=types.BufferedInputFile(
-                    file.read(),
-                    filename=os.path.basename(PDF_MENU_PATH)
-                ),
-                caption=f"📄 {os.path.basename(PDF_MENU_PATH)}"
-            )
+        await media_registry.send_document(
+            callback.bot,
+            chat_id=callback.from_user.id,
+            document=types.FSInputFile(
+                PDF_MENU_PATH,
+                filename=os.path.basename(PDF_MENU_PATH)
+            ),
+            caption=f"📄 {os.path.basename(PDF_MENU_PATH)}"
+        )
         
         await callback.answer("✅ Файл отправлен!", show_alert=False)
     except Exception as e:
@@ -440,15 +450,15 @@ async def download_banquet_callback(callback: types.CallbackQuery):
         return
     
     try:
-        with open(BANQUET_MENU_PATH, 'rb') as file:
-            await callback.bot.send_document(
-                chat_id=callback.from_user.id,
-                document=types.BufferedInputFile(
-                    file.read(),
-                    filename=os.path.basename(BANQUET_MENU_PATH)
-                ),
-                caption=f"📊 {os.path.basename(BANQUET_MENU_PATH)}"
-            )
+        await media_registry.send_document(
+            callback.bot,
+            chat_id=callback.from_user.id,
+            document=types.FSInputFile(
+                BANQUET_MENU_PATH,
+                filename=os.path.basename(BANQUET_MENU_PATH)
+            ),
+            caption=f"📊 {os.path.basename(BANQUET_MENU_PATH)}"
+        )
         
         await callback.answer("✅ Файл отправлен!", show_alert=False)
     except Exception as e:
@@ -544,7 +554,7 @@ async def handle_pdf_menu_upload(message: Message, state: FSMContext):
         await state.clear()
         
         # Логируем действие
-        database.log_action(message.from_user.id, "upload_menu_pdf", 
+        action_log.log(message.from_user.id, "upload_menu_pdf", 
                           f"filename:{document.file_name}, size:{file_size_kb}KB")
         
     except Exception as e:
@@ -670,7 +680,7 @@ async def handle_banquet_menu_upload(message: Message, state: FSMContext):
         await state.clear()
         
         # Логируем действие
-        database.log_action(message.from_user.id, "upload_menu_banquet", 
+        action_log.log(message.from_user.id, "upload_menu_banquet", 
                           f"filename:{document.file_name}, size:{file_size_kb}KB")
         
     except Exception as e:
@@ -706,7 +716,7 @@ async def handle_banquet_menu_upload(message: Message, state: FSMContext):
 
 async def show_admin_panel(user_id: int, bot, message_id: int = None):
     """Показать админ-панель с подтверждением доступа"""
-    stats = database.get_stats()
+    stats = await action_log.get_stats()
 
     text = f"""✅ <b>Доступ к админке получен!</b>
 
@@ -837,7 +847,7 @@ async def check_admin_password(message: types.Message, state: FSMContext):
             pass
 
         # Отправляем новое сообщение с меню админки
-        stats = database.get_stats()
+        stats = await action_log.get_stats()
         text = f"""✅ <b>Доступ к админке получен!</b>
 
 🛠️ <b>Админ-панель ресторана</b>
@@ -886,16 +896,31 @@ async def admin_stats_callback(callback: types.CallbackQuery):
         await callback.answer("❌ Нет доступа!", show_alert=True)
         return
     
-    stats = database.get_stats()
+    stats = await action_log.get_stats()
+    cart_stats = cart_manager.get_write_stats()
+    action_stats = stats['action_log']
     
     text = f"""📊 <b>Статистика</b>
 
 👥 Всего пользователей: {stats['total_users']}
 🔥 Активных сегодня: {stats['active_today']}
 📅 Броней сегодня: {stats['bookings_today']}
-🍽️ Заказов сегодня: {stats['orders_today']}"""
+🍽️ Заказов сегодня: {stats['orders_today']}
+
+🛒 Изменений корзин: {cart_stats['mutations']}
+💾 Записей в БД: {cart_stats['writes']} (схлопнуто: {cart_stats['coalesced']})
+
+📈 Событий аналитики: {action_stats['logged']} (в буфере: {action_stats['buffered']}, потеряно: {action_stats['dropped'] + action_stats['failed']}, перегрузок: {action_stats['backpressure']})"""
+    
+    retention_report = retention_manager.last_report
+    if retention_report:
+        archived = sum(retention_report['archived'].values())
+        text += (f"\n🗄️ Обслуживание БД {retention_report['finished_at'][:16].replace('T', ' ')}: "
+                 f"в архив {archived} строк, освобождено {retention_report['reclaimed_bytes'] / 1024 / 1024:.1f} МБ")
     
     keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
+        [types.InlineKeyboardButton(text=f"📆 {days} дн.", callback_data=f"admin_stats_range_{days}")
+         for days in STATS_RANGES],
         [types.InlineKeyboardButton(text="⬅️ Назад в админку", callback_data="admin_back")]
     ])
     
@@ -904,6 +929,48 @@ async def admin_stats_callback(callback: types.CallbackQuery):
                         parse_mode="HTML",
                         bot=callback.bot)
 
+@router.callback_query(F.data.startswith("admin_stats_range_"))
+async def admin_stats_range_callback(callback: types.CallbackQuery):
+    """Статистика за период по сводным таблицам"""
+    await callback.answer()
+    
+    if not is_admin_fast(callback.from_user.id):
+        await callback.answer("❌ Нет доступа!", show_alert=True)
+        return
+    
+    try:
+        days = int(callback.data.replace("admin_stats_range_", ""))
+    except ValueError:
+        return
+    if days not in STATS_RANGES:
+        return
+    
+    stats = await adb.get_stats_range(days)
+    
+    text = f"""📊 <b>Статистика за {days} дн.</b>
+
+👥 Новых пользователей: {stats['new_users']}
+🔥 Активных (польз.-дней): {stats['active_users']}
+📅 Броней: {stats['bookings']}
+🍽️ Заказов: {stats['orders']}"""
+    
+    if stats['popular_actions']:
+        text += "\n\n<b>Популярные действия:</b>"
+        for action, count in stats['popular_actions']:
+            text += f"\n• {action}: {count}"
+    
+    keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
+        [types.InlineKeyboardButton(text=f"{'✅ ' if period == days else ''}📆 {period} дн.",
+                                    callback_data=f"admin_stats_range_{period}")
+         for period in STATS_RANGES],
+        [types.InlineKeyboardButton(text="⬅️ К статистике", callback_data="admin_stats")]
+    ])
+    
+    await update_message(callback.from_user.id, text,
+                        reply_markup=keyboard,
+                        parse_mode="HTML",
+                        bot=callback.bot)
+
 @router.callback_query(F.data == "admin_orders")
 async def admin_orders_callback(callback: types.CallbackQuery):
     """Быстрый просмотр заказов"""
@@ -1403,7 +1470,7 @@ async def handle_newsletter_schedule(callback: types.CallbackQuery, state: FSMCo
     await state.clear()
 
 async def send_newsletter_task_safe(newsletter_id: int, admin_id: int, bot):
-    """Безопасная задача рассылки с поддержкой переменных"""
+    """Безопасная задача рассылки с поддержкой переменных (продолжает прерванную рассылку)"""
     try:
         newsletter_info = database.get_newsletter_by_id(newsletter_id)
         
@@ -1416,129 +1483,73 @@ async def send_newsletter_task_safe(newsletter_id: int, admin_id: int, bot):
             )
             return
         
-        message_text = newsletter_info['message_text']
-        message_type = newsletter_info['message_type']
-        photo_id = newsletter_info.get('photo_id')
-        
-        all_users = database.get_all_users(limit=500)
-        sent_count = 0
-        failed_count = 0
+        if newsletter_engine.is_running(newsletter_id):
+            await update_message(
+                admin_id,
+                f"⏳ <b>Рассылка #{newsletter_id} уже отправляется</b>",
+                parse_mode="HTML",
+                bot=bot
+            )
+            return
         
-        batch_size = config.NEWSLETTER_BATCH_SIZE
+        recipients = database.count_newsletter_recipients(newsletter_id)
         
-        admin_data = database.get_user_data(admin_id)
+        admin_data = await adb.get_user_data(admin_id)
         admin_name = admin_data.get('full_name', 'Админ') if admin_data else 'Админ'
         
+        start_text = (f"📤 <b>Начинаем рассылку #{newsletter_id}</b>\n\n"
+                      f"Отправляем сообщение {recipients['total'] - recipients['done']} пользователям...\n")
+        if recipients['done']:
+            start_text += f"♻️ Уже доставлено ранее: {recipients['done']}\n"
+        start_text += f"Базовая рассылка запущена {admin_name}"
+        
         await update_message(
             admin_id,
-            f"📤 <b>Начинаем рассылку #{newsletter_id}</b>\n\n"
-            f"Отправляем сообщение {len(all_users)} пользователям...\n"
-            f"Базовая рассылка запущена {admin_name}",
+            start_text,
             parse_mode="HTML",
             bot=bot
         )
         
-        for i in range(0, len(all_users), batch_size):
-            batch = all_users[i:i+batch_size]
-            
-            for user in batch:
-                user_id = user[0]
-                user_full_name = user[1] or f"Пользователь {user_id}"
-                
-                # Подготавливаем персонализированный текст
-                personalized_text = message_text
-                
-                # Заменяем переменные
-                personalized_text = personalized_text.replace(
-                    '{Имя пользователя}', 
-                    user_full_name
-                ).replace(
-                    '{Имя}', 
-                    user_full_name.split()[0] if user_full_name and ' ' in user_full_name else user_full_name
-                ).replace(
-                    '{Дата}', 
-                    datetime.now().strftime('%d.%m.%Y')
-                )
-                
-                try:
-                    if message_type == 'photo' and photo_id:
-                        await bot.send_photo(
-                            chat_id=user_id,
-                            photo=photo_id,
-                            caption=personalized_text,
-                            parse_mode="HTML"
-                        )
-                    else:
-                        await bot.send_message(
-                            chat_id=user_id,
-                            text=personalized_text,
-                            parse_mode="HTML"
-                        )
-                    
-                    sent_count += 1
-                    
-                    if sent_count % 50 == 0:
-                        progress_text = f"📤 <b>Прогресс рассылки #{newsletter_id}</b>\n\n"
-                        progress_text += f"✅ Успешно отправлено: {sent_count}\n"
-                        progress_text += f"❌ Не удалось отправить: {failed_count}\n"
-                        progress_text += f"👥 Всего пользователей: {len(all_users)}\n"
-                        progress_text += f"📈 Прогресс: {sent_count/len(all_users)*100:.1f}%"
-                        
-                        await update_message(
-                            admin_id,
-                            progress_text,
-                            parse_mode="HTML",
-                            bot=bot
-                        )
-                    
-                except Exception as e:
-                    error_str = str(e)
-                    if "bot was blocked" in error_str or "user is deactivated" in error_str:
-                        failed_count += 1
-                    elif "Too Many Requests" in error_str:
-                        try:
-                            retry_after = int(error_str.split('retry after ')[1].split(')')[0])
-                            await asyncio.sleep(retry_after)
-                            try:
-                                if message_type == 'photo' and photo_id:
-                                    await bot.send_photo(
-                                        chat_id=user_id,
-                                        photo=photo_id,
-                                        caption=personalized_text,
-                                        parse_mode="HTML"
-                                    )
-                                else:
-                                    await bot.send_message(
-                                        chat_id=user_id,
-                                        text=personalized_text,
-                                        parse_mode="HTML"
-                                    )
-                                sent_count += 1
-                            except:
-                                failed_count += 1
-                        except:
-                            failed_count += 1
-                    else:
-                        failed_count += 1
+        async def show_progress(stats: dict):
+            processed = stats['already_done'] + stats['sent'] + stats['blocked'] + stats['failed']
+            progress_text = f"📤 <b>Прогресс рассылки #{newsletter_id}</b>\n\n"
+            progress_text += f"✅ Успешно отправлено: {stats['already_done'] + stats['sent']}\n"
+            progress_text += f"🚫 Заблокировали бота: {stats['blocked']}\n"
+            progress_text += f"❌ Не удалось отправить: {stats['failed']}\n"
+            progress_text += f"👥 Всего пользователей: {stats['total']}\n"
+            progress_text += f"⚡ Скорость: {stats['rate']:.1f} сообщ/сек\n"
+            progress_text += f"📈 Прогресс: {processed / max(stats['total'], 1) * 100:.1f}%"
             
-            if i + batch_size < len(all_users):
-                await asyncio.sleep(config.NEWSLETTER_DELAY)
+            await update_message(
+                admin_id,
+                progress_text,
+                parse_mode="HTML",
+                bot=bot
+            )
         
-        database.update_newsletter_status(newsletter_id, 'sent', sent_count)
+        stats = await newsletter_engine.send(newsletter_id, bot, on_progress=show_progress)
+        
+        sent_count = stats['already_done'] + stats['sent']
+        failed_count = stats['blocked'] + stats['failed']
+        total = max(stats['total'], 1)
         
         text = f"""✅ <b>Рассылка #{newsletter_id} завершена!</b>
 
 📊 Результаты:
 ✅ Успешно отправлено: {sent_count}
 ❌ Не удалось отправить: {failed_count}
-👥 Всего пользователей: {len(all_users)}
-📈 Эффективность: {sent_count/len(all_users)*100:.1f}%"""
-        
-        keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
-            [types.InlineKeyboardButton(text="📊 Статистика рассылки", callback_data=f"newsletter_stats_{newsletter_id}")],
+👥 Всего пользователей: {stats['total']}
+📈 Эффективность: {sent_count/total*100:.1f}%
+⚡ Скорость: {stats['rate']:.1f} сообщ/сек за {stats['elapsed']:.0f} сек"""
+        
+        buttons = [[types.InlineKeyboardButton(text="📊 Статистика рассылки", callback_data=f"newsletter_stats_{newsletter_id}")]]
+        if stats['failed']:
+            buttons.append([types.InlineKeyboardButton(text="🔄 Дослать недоставленные", callback_data=f"retry_newsletter_{newsletter_id}")])
+        buttons += [
             [types.InlineKeyboardButton(text="🔄 Создать новую рассылку", callback_data="admin_create_newsletter")],
             [types.InlineKeyboardButton(text="⬅️ Назад к рассылкам", callback_data="admin_newsletter")]
-        ])
+        ]
+        keyboard = types.InlineKeyboardMarkup(inline_keyboard=buttons)
         
         await update_message(
             admin_id,
@@ -1548,7 +1559,7 @@ async def send_newsletter_task_safe(newsletter_id: int, admin_id: int, bot):
             bot=bot
         )
         
-        database.log_action(admin_id, "newsletter_completed", 
+        action_log.log(admin_id, "newsletter_completed", 
                           f"id:{newsletter_id}, sent:{sent_count}, failed:{failed_count}")
         
     except Exception as e:
@@ -1571,6 +1582,50 @@ async def send_newsletter_task_safe(newsletter_id: int, admin_id: int, bot):
             bot=bot
         )
 
+@router.callback_query(F.data.startswith("retry_newsletter_"))
+async def retry_newsletter_callback(callback: types.CallbackQuery):
+    """Повторный запуск рассылки: продолжает с тех, кому еще не доставлено"""
+    await callback.answer()
+    
+    if not is_admin_fast(callback.from_user.id):
+        return
+    
+    newsletter_id = int(callback.data.replace("retry_newsletter_", ""))
+    asyncio.create_task(send_newsletter_task_safe(newsletter_id, callback.from_user.id, callback.bot))
+
+@router.callback_query(F.data.startswith("newsletter_stats_"))
+async def newsletter_stats_callback(callback: types.CallbackQuery):
+    """Статистика доставки рассылки по статусам"""
+    await callback.answer()
+    
+    if not is_admin_fast(callback.from_user.id):
+        return
+    
+    newsletter_id = int(callback.data.replace("newsletter_stats_", ""))
+    delivery_stats = database.get_newsletter_delivery_stats(newsletter_id)
+    recipients = database.count_newsletter_recipients(newsletter_id)
+    
+    text = f"""📊 <b>Статистика рассылки #{newsletter_id}</b>
+
+✅ Доставлено: {delivery_stats.get('sent', 0)}
+🚫 Заблокировали бота: {delivery_stats.get('blocked', 0)}
+❌ Ошибки доставки: {delivery_stats.get('failed', 0)}
+❔ Отправка прервана сбоем (не повторяется): {delivery_stats.get('sending', 0)}
+⏳ Еще не отправлено: {max(recipients['total'] - recipients['done'] - delivery_stats.get('failed', 0) - delivery_stats.get('sending', 0), 0)}"""
+    
+    keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
+        [types.InlineKeyboardButton(text="🔄 Дослать недоставленные", callback_data=f"retry_newsletter_{newsletter_id}")],
+        [types.InlineKeyboardButton(text="⬅️ Назад к рассылкам", callback_data="admin_newsletter")]
+    ])
+    
+    await update_message(
+        callback.from_user.id,
+        text,
+        reply_markup=keyboard,
+        parse_mode="HTML",
+        bot=callback.bot
+    )
+
 # ===== УПРАВЛЕНИЕ ОТЗЫВАМИ =====
 
 @router.callback_query(F.data == "parse_reviews")
@@ -1657,7 +1712,7 @@ async def admin_view_reviews_callback(callback: types.CallbackQuery):
     if not is_admin_fast(callback.from_user.id):
         return
     
-    reviews = database.get_all_reviews()
+    reviews = await adb.get_all_reviews()
     
     if not reviews:
         text = "⭐ <b>Все отзывы</b>\n\n❌ Отзывов пока нет в базе данных."
@@ -1714,7 +1769,7 @@ async def admin_reviews_callback(callback: types.CallbackQuery):
     if not is_admin_fast(callback.from_user.id):
         return
     
-    reviews = database.get_all_reviews()
+    reviews = await adb.get_all_reviews()
     
     text = "⭐ <b>Управление отзывами</b>\n\n"
     
@@ -1752,7 +1807,7 @@ async def admin_delete_review_start_callback(callback: types.CallbackQuery, stat
     if not is_admin_fast(callback.from_user.id):
         return
     
-    reviews = database.get_all_reviews()
+    reviews = await adb.get_all_reviews()
     
     if not reviews:
         text = "🗑️ <b>Удаление отзыва</b>\n\n❌ Нет отзывов для удаления."
@@ -1910,7 +1965,7 @@ async def admin_faq_callback(callback: types.CallbackQuery):
     if not is_admin_fast(callback.from_user.id):
         return
     
-    faq = database.get_faq()
+    faq = await adb.get_faq()
     
     text = "❓ <b>Управление FAQ</b>\n\n"
     
@@ -2004,7 +2059,7 @@ async def admin_view_faq_callback(callback: types.CallbackQuery):
     if not is_admin_fast(callback.from_user.id):
         return
     
-    faq_list = database.get_faq()
+    faq_list = await adb.get_faq()
     
     if not faq_list:
         text = "❓ <b>Все вопросы FAQ</b>\n\nВопросов пока нет."
@@ -2430,6 +2485,33 @@ async def clear_cache_command(message: types.Message):
     
     await message.answer("✅ Все кэши очищены!")
 
+@router.message(Command("menu_changes"))
+async def menu_changes_command(message: types.Message):
+    """История изменений меню при обновлениях из Presto"""
+    if not is_admin_fast(message.from_user.id):
+        await message.answer("❌ У вас нет доступа к этой команде!")
+        return
+    
+    diffs = await adb.get_menu_diffs(10)
+    if not diffs:
+        await message.answer("📜 Изменений меню пока не было")
+        return
+    
+    text = "📜 <b>Изменения меню</b>\n"
+    for diff in diffs:
+        text += f"\n<b>{diff['created_at'][:16].replace('T', ' ')}</b> - {diff['summary']}"
+        
+        details = json.loads(diff['details'] or '{}')
+        for menu_id, dish_id, name, old_price, new_price in details.get('price_changed', [])[:3]:
+            text += f"\n   • {html.escape(name)}: {old_price}₽ → {new_price}₽"
+        for menu_id, dish_id, name in details.get('added', [])[:3]:
+            text += f"\n   ➕ {html.escape(name)}"
+        for menu_id, dish_id, name in details.get('removed', [])[:3]:
+            text += f"\n   ➖ {html.escape(name)}"
+        text += "\n"
+    
+    await message.answer(text, parse_mode="HTML")
+
 @router.callback_query(F.data == "admin_back_to_promocodes")
 async def admin_back_to_promocodes_callback(callback: types.CallbackQuery):
     """Возврат в меню промокодов из админки"""
@@ -3322,7 +3404,7 @@ async def finalize_promocode(user_id: int, bot, state: FSMContext, description:
                             bot=bot)
         
         # Логируем создание промокода
-        database.log_action(user_id, "promocode_created", f"code:{code}, type:{promocode_type}")
+        action_log.log(user_id, "promocode_created", f"code:{code}, type:{promocode_type}")
     else:
         text = "❌ <b>Ошибка при создании промокода!</b>\n\nПопробуйте еще раз."
         
@@ -4301,7 +4383,7 @@ async def admin_manage_admins_callback(callback: types.CallbackQuery):
 <b>Список администраторов:</b>\n"""
     
     for admin_id in admins:
-        user_data = database.get_user_data(admin_id)
+        user_data = await adb.get_user_data(admin_id)
         if user_data:
             name = user_data.get('full_name', f'Пользователь {admin_id}')
             username = user_data.get('username', '')
@@ -4488,7 +4570,7 @@ async def admin_chat_management_callback(callback: types.CallbackQuery):
         return
 
     # Получаем все чаты из базы данных
-    chats = database.get_all_chats_for_admin()
+    chats = await adb.get_all_chats_for_admin()
 
     text = f"""💬 <b>Управление чатами пользователей</b>
 
@@ -5345,7 +5427,7 @@ async def handle_web_app_data(message: types.Message):
 
             # Получаем информацию о чате
             logger.info(f"Получаем информацию о чате {chat_id}")
-            chat_info = database.get_chat_by_id(chat_id)
+            chat_info = await adb.get_chat_by_id(chat_id)
             if not chat_info:
                 logger.error(f"Чат {chat_id} не найден в базе данных")
                 await safe_send_message(message.bot, user_id, f"❌ Чат не найден (ID: {chat_id})")
@@ -5369,7 +5451,7 @@ async def handle_web_app_data(message: types.Message):
 
                 # Сохраняем сообщение админа в базу данных
                 logger.info(f"Сохраняем сообщение в базу данных")
-                database.save_chat_message(chat_id, 'admin', admin_message)
+                await adb.save_chat_message(chat_id, 'admin', admin_message)
 
                 await safe_send_message(message.bot, user_id,
                                        f"✅ Сообщение отправлено пользователю {user_name}")
@@ -3,9 +3,10 @@
 from aiogram import Router, F, types
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
-from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton, FSInputFile
+from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton, BufferedInputFile
 import keyboards
 import database
+from async_db import adb
 import config
 
 import re
@@ -13,6 +14,7 @@ from aiogram.types import ReplyKeyboardRemove
 from typing import Dict, List
 from menu_cache import menu_cache
 from cart_manager import cart_manager
+from hall_schema import hall_schema_cache, PIL_AVAILABLE
 import asyncio
 import cache_manager
 import logging
@@ -25,6 +27,7 @@ import calendar
 try:
     from presto_api_booking import get_booking_calendar, get_hall_tables, create_booking, get_available_tables
     from presto_api_booking import get_booking_info, update_booking, cancel_booking, get_booking_state, BOOKING_STATUSES
+    from presto_api_booking import get_slots_availability
     print("✅ Presto API загружен успешно")
 except ImportError as e:
     print(f"⚠️ Ошибка импорта Presto API: {e}")
@@ -34,35 +37,39 @@ try:
 except ImportError:
     def clean_phone_for_link(phone):
         return ''.join(c for c in phone if c.isdigit() or c == '+')
-    def get_booking_calendar(*args, **kwargs):
+    async def get_booking_calendar(*args, **kwargs):
         print("⚠️ Presto API не доступен: get_booking_calendar")
         return None
     
-    def get_hall_tables(*args, **kwargs):
+    async def get_hall_tables(*args, **kwargs):
         print("⚠️ Presto API не доступен: get_hall_tables")
         return None
     
-    def get_available_tables(*args, **kwargs):
+    async def get_available_tables(*args, **kwargs):
         print("⚠️ Presto API не доступен: get_available_tables")
         return []
     
-    def create_booking(*args, **kwargs):
+    async def get_slots_availability(*args, **kwargs):
+        print("⚠️ Presto API не доступен: get_slots_availability")
+        return {}
+    
+    async def create_booking(*args, **kwargs):
         print("⚠️ Presto API не доступен: create_booking")
         return None
     
-    def get_booking_info(*args, **kwargs):
+    async def get_booking_info(*args, **kwargs):
         print("⚠️ Presto API не доступен: get_booking_info")
         return None
     
-    def update_booking(*args, **kwargs):
+    async def update_booking(*args, **kwargs):
         print("⚠️ Presto API не доступен: update_booking")
         return None
     
-    def cancel_booking(*args, **kwargs):
+    async def cancel_booking(*args, **kwargs):
         print("⚠️ Presto API не доступен: cancel_booking")
         return None
     
-    def get_booking_state(*args, **kwargs):
+    async def get_booking_state(*args, **kwargs):
         print("⚠️ Presto API не доступен: get_booking_state")
         return None
     
@@ -104,14 +111,6 @@ async def show_booking_options(callback_or_user_id, bot=None):
                            reply_markup=kb,
                            parse_mode="HTML")
 
-try:
-    from PIL import Image, ImageDraw, ImageFont, ImageFilter
-    from io import BytesIO
-    PIL_AVAILABLE = True
-except ImportError:
-    PIL_AVAILABLE = False
-    print("⚠️ Pillow не установлен.")
-
 try:
     import requests
     REQUESTS_AVAILABLE = True
@@ -159,12 +158,19 @@ category_names = {
     "evening": "🌙 Вечер (16:00–21:00)"
 }
 
+# Время, по которому проверяется доступность категории
+time_category_probes = {
+    "morning": "08:00",
+    "lunch": "12:00",
+    "evening": "18:00"
+}
+
 # Глобальная переменная для ID сообщения со схемой
 _schema_message_id = None
 
 async def get_user_bookings(user_id: int):
     """Получить бронирования пользователя"""
-    user_data = database.get_user_data(user_id)
+    user_data = await adb.get_user_data(user_id)
     if not user_data or not user_data.get('phone'):
         return []
     
@@ -359,7 +365,7 @@ async def booking_details_callback(callback: types.CallbackQuery, state: FSMCont
             pass
     
     # Получаем информацию о брони
-    booking_info = get_booking_info(external_id)
+    booking_info = await get_booking_info(external_id)
     
     if not booking_info:
         # Если API не работает, покажем локальную информацию
@@ -408,7 +414,7 @@ async def booking_details_callback(callback: types.CallbackQuery, state: FSMCont
         return
     
     # Получаем статус
-    state_info = get_booking_state(external_id)
+    state_info = await get_booking_state(external_id)
     status_code = state_info.get('state', 0) if state_info else 0
     status_text = BOOKING_STATUSES.get(status_code, f"Статус: {status_code}")
     
@@ -541,7 +547,7 @@ async def cancel_and_new_booking(callback: types.CallbackQuery, state: FSMContex
     external_id = callback.data.split(":", 1)[1]
     
     # Сначала отменяем бронь
-    result = cancel_booking(external_id)
+    result = await cancel_booking(external_id)
     
     if result:
         # Обновляем статус в локальном хранилище
@@ -589,7 +595,7 @@ async def cancel_booking_callback(callback: types.CallbackQuery, state: FSMConte
             pass
     
     # Получаем информацию о брони для подтверждения
-    booking_info = get_booking_info(external_id)
+    booking_info = await get_booking_info(external_id)
     if not booking_info:
         # Если API не работает, пробуем найти в локальном хранилище
         user_id = callback.from_user.id
@@ -681,7 +687,7 @@ async def confirm_cancel_booking(callback: types.CallbackQuery, state: FSMContex
             pass
     
     # Отменяем бронирование
-    result = cancel_booking(external_id)
+    result = await cancel_booking(external_id)
     
     if result:
         text = (
@@ -719,8 +725,8 @@ async def refresh_booking_callback(callback: types.CallbackQuery, state: FSMCont
     external_id = callback.data.split(":", 1)[1]
     
     # Обновляем информацию о брони
-    booking_info = get_booking_info(external_id)
-    state_info = get_booking_state(external_id)
+    booking_info = await get_booking_info(external_id)
+    state_info = await get_booking_state(external_id)
     
     if booking_info and state_info:
         status_code = state_info.get('state', 0)
@@ -817,7 +823,7 @@ async def select_guests(callback: types.CallbackQuery, state: FSMContext):
 
     print(f"📅 [Presto] Запрос календаря: {{'pointId': 3596, 'fromDate': '{from_date}', 'toDate': '{to_date}'}}")
 
-    calendar_data = get_booking_calendar(from_date, to_date)
+    calendar_data = await get_booking_calendar(from_date, to_date)
     if not calendar_data or not calendar_data.get("dates"):
         await update_message(
             callback.from_user.id,
@@ -991,29 +997,13 @@ async def show_time_categories(user_id: int, bot, state: FSMContext):
         dt_obj = datetime.strptime(selected_date, "%d.%m.%Y")
         api_date = dt_obj.strftime("%Y-%m-%d")
         
-        # Проверяем доступность для всех трех категорий времени
-        time_categories = []
-        
-        # Проверяем утро (08:00)
-        test_tables = get_available_tables(f"{api_date} 08:00:00", guests)
-        if test_tables:
-            filtered = filter_tables_by_guests(test_tables, guests)
-            if filtered:
-                time_categories.append("morning")
-        
-        # Проверяем обед (12:00)
-        test_tables = get_available_tables(f"{api_date} 12:00:00", guests)
-        if test_tables:
-            filtered = filter_tables_by_guests(test_tables, guests)
-            if filtered:
-                time_categories.append("lunch")
+        # Проверяем доступность для всех трех категорий времени одним пакетом
+        availability = await get_slots_availability(api_date, guests, list(time_category_probes.values()))
         
-        # Проверяем вечер (18:00)
-        test_tables = get_available_tables(f"{api_date} 18:00:00", guests)
-        if test_tables:
-            filtered = filter_tables_by_guests(test_tables, guests)
-            if filtered:
-                time_categories.append("evening")
+        time_categories = []
+        for category, probe_slot in time_category_probes.items():
+            if filter_tables_by_guests(availability.get(probe_slot, []), guests):
+                time_categories.append(category)
         
         if not time_categories:
             await update_message(user_id,
@@ -1109,7 +1099,7 @@ async def select_time(callback: types.CallbackQuery, state: FSMContext):
             datetime_api = f"{api_date} {time_slot}:00"
             
             # ПРОВЕРЯЕМ доступность столов только после выбора времени
-            available_tables = get_available_tables(datetime_api, guests)
+            available_tables = await get_available_tables(datetime_api, guests)
             filtered_tables = filter_tables_by_guests(available_tables, guests)
         
         if not filtered_tables:
@@ -1126,20 +1116,18 @@ async def select_time(callback: types.CallbackQuery, state: FSMContext):
         schema_text = "🪑 <b>Схема зала и выбор столика</b>\n\n"
         
         if PIL_AVAILABLE:
-            hall_data = get_hall_tables(datetime_api)
+            hall_data = await get_hall_tables(datetime_api)
             if hall_data and hall_data.get("halls"):
-                schema_id = f"hall_{callback.from_user.id}_{int(datetime.now().timestamp())}"
-                image_path, free_table_ids = generate_hall_schema(
+                schema = await hall_schema_cache.render(
                     hall_data, 
                     guests, 
-                    schema_id,
                     selected_date,
                     time_slot
                 )
                 
-                if image_path and os.path.exists(image_path):
+                if schema:
                     try:
-                        photo = FSInputFile(image_path)
+                        photo = hall_schema_photo(schema)
                         
                         # Создаем кнопки выбора столиков по 4 в ряд
                         kb = []
@@ -1182,6 +1170,8 @@ async def select_time(callback: types.CallbackQuery, state: FSMContext):
                             reply_markup=InlineKeyboardMarkup(inline_keyboard=kb)
                         )
                         _schema_message_id = sent_message.message_id
+                        if sent_message.photo:
+                            hall_schema_cache.remember_file_id(schema['key'], sent_message.photo[-1].file_id)
                         
                         await state.set_state(BookingStates.waiting_for_table)
                         return
@@ -1376,7 +1366,7 @@ async def select_random_table(callback: types.CallbackQuery, state: FSMContext):
     
     await state.update_data(selected_table=table_id, selected_table_name=random_table['name'])
     
-    user_data = database.get_user_data(callback.from_user.id)
+    user_data = await adb.get_user_data(callback.from_user.id)
     
     try:
         dt_obj = datetime.strptime(data['selected_date'], "%d.%m.%Y")
@@ -1455,7 +1445,7 @@ async def select_table(callback: types.CallbackQuery, state: FSMContext):
     
     await state.update_data(selected_table=table_id, selected_table_name=selected_table['name'])
     
-    user_data = database.get_user_data(callback.from_user.id)
+    user_data = await adb.get_user_data(callback.from_user.id)
     
     try:
         dt_obj = datetime.strptime(data['selected_date'], "%d.%m.%Y")
@@ -1518,7 +1508,7 @@ async def confirm_booking(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer("Обрабатываем бронирование...", show_alert=False)
     
     data = await state.get_data()
-    user_data = database.get_user_data(callback.from_user.id)
+    user_data = await adb.get_user_data(callback.from_user.id)
     
     if not user_data or not user_data.get('phone'):
         try:
@@ -1538,7 +1528,7 @@ async def confirm_booking(callback: types.CallbackQuery, state: FSMContext):
     
     try:
         async with typing_indicator(callback.bot, callback.from_user.id):
-            result = create_booking(
+            result = await create_booking(
                 phone=user_data["phone"],
                 name=user_data.get("full_name", "Гость"),
                 datetime_str=data['booking_datetime'],
@@ -1712,158 +1702,9 @@ async def back_main(callback: types.CallbackQuery):
     from .handlers_main import show_main_menu
     await show_main_menu(callback.from_user.id, callback.bot)
 
-def generate_hall_schema(hall_data: dict, guests: int, schema_id: str, selected_date: str, selected_time: str) -> tuple[str, list]:
-    try:
-        if not PIL_AVAILABLE:
-            print("⚠️ Pillow не установлен, пропускаем генерацию схемы зала")
-            return None, []
-
-        hall = hall_data["halls"][0]
-        items = hall.get("items", [])
-        base_schema_path = os.path.join("files", "tables.png")
-        if not os.path.exists(base_schema_path):
-            return None, []
-
-        img = Image.open(base_schema_path).convert("RGBA")
-        width, height = img.size
-        overlay = Image.new('RGBA', (width, height), (255, 255, 255, 0))
-        draw = ImageDraw.Draw(overlay)
-
-        rel = hall.get("relation", {})
-        api_left = rel.get("left", 0)
-        api_top = rel.get("top", 0)
-        api_right = rel.get("right", 1000)
-        api_bottom = rel.get("bottom", 800)
-        api_width = api_right - api_left
-        api_height = api_bottom - api_top
-        scale_x = width / api_width if api_width > 0 else 1
-        scale_y = height / api_height if api_height > 0 else 1
-
-        free_table_ids = []
-
-        # ✅ Определяем, какие номера столов разрешены
-        allowed_table_numbers = set()
-        if guests in (1, 2):
-            allowed_table_numbers = {3, 4, 5, 7, 8, 10, 12, 14, 15, 16}
-        elif guests in (3, 4):
-            allowed_table_numbers = {1, 2, 6, 11, 17, 18}
-
-        for item in items:
-            if item.get("kind") != "table" or not item.get("visible", True):
-                continue
-
-            name = str(item.get("name", "?"))
-            try:
-                table_num = int(name)
-            except (ValueError, TypeError):
-                table_num = -1
-
-            # ✅ ПРОПУСКАЕМ стол, если он НЕ в списке разрешённых для этого количества гостей
-            if table_num not in allowed_table_numbers:
-                continue
-
-            api_x = item.get("x", 0)
-            api_y = item.get("y", 0)
-            x = (api_x - api_left) * scale_x
-            y = (api_y - api_top) * scale_y
-            capacity = item.get("capacity", 0)
-            busy = item.get("busy", True)
-            locked = item.get("isBookingLocked", False)
-
-            if locked:
-                color = (0, 0, 0, 200)
-            elif busy:
-                color = (255, 0, 0, 200)
-            else:
-                color = (0, 255, 0, 200)
-                free_table_ids.append(item["id"])
-
-            radius = 20
-            draw.ellipse(
-                [x - radius, y - radius, x + radius, y + radius],
-                fill=color,
-                outline=(255, 255, 255, 255),
-                width=3
-            )
-
-            try:
-                font = ImageFont.truetype("arial.ttf", 14)
-            except:
-                font = ImageFont.load_default()
-
-            try:
-                left, top, right, bottom = font.getbbox(name)
-                text_width = right - left
-                text_height = bottom - top
-            except:
-                text_width, text_height = font.getsize(name)
-
-            draw.text(
-                (x - text_width / 2, y - text_height / 2),
-                name,
-                fill=(255, 255, 255, 255),
-                font=font,
-                stroke_width=1,
-                stroke_fill=(0, 0, 0, 200)
-            )
-
-        # --- Наложение фона схемы ---
-        img = Image.alpha_composite(img, overlay)
-
-        # --- Текст с датой, временем, гостями ---
-        try:
-            font_large = ImageFont.truetype("arial.ttf", 20)
-            font_small = ImageFont.truetype("arial.ttf", 16)
-        except:
-            font_large = ImageFont.load_default()
-            font_small = ImageFont.load_default()
-
-        try:
-            dt_obj = datetime.strptime(selected_date, "%d.%m.%Y")
-            display_date = dt_obj.strftime("%d.%m.%Y")
-        except:
-            display_date = selected_date
-
-        date_text = f"Дата: {display_date}"
-        time_text = f"Время: {selected_time}"
-        guests_text = f"Гостей: {guests}"
-
-        text_overlay = Image.new('RGBA', (width, height), (255, 255, 255, 0))
-        text_draw = ImageDraw.Draw(text_overlay)
-
-        try:
-            left, top, right, bottom = font_large.getbbox(date_text)
-            date_width = right - left
-            left, top, right, bottom = font_small.getbbox(time_text)
-            time_width = right - left
-            left, top, right, bottom = font_small.getbbox(guests_text)
-            guests_width = right - left
-            max_width = max(date_width, time_width, guests_width)
-        except:
-            max_width = 200
-
-        text_x = width - max_width - 20
-        text_y = 20
-
-        text_draw.rectangle(
-            [text_x - 10, text_y - 10, text_x + max_width + 10, text_y + 80],
-            fill=(0, 0, 0, 180),
-            outline=(255, 255, 255, 200),
-            width=2
-        )
-        text_draw.text((text_x, text_y), date_text, fill=(255, 255, 255, 255), font=font_large)
-        text_draw.text((text_x, text_y + 30), time_text, fill=(255, 255, 255, 255), font=font_small)
-        text_draw.text((text_x, text_y + 55), guests_text, fill=(255, 255, 255, 255), font=font_small)
-
-        img = Image.alpha_composite(img, text_overlay)
-
-        filepath = os.path.join(TEMP_DIR, f"{schema_id}.png")
-        img.save(filepath, "PNG")
-        return filepath, free_table_ids
-
-    except Exception as e:
-        print(f"Ошибка в generate_hall_schema: {e}")
-        return None, []
+def hall_schema_photo(schema: dict):
+    """Фото схемы для send_photo: file_id, если такая схема уже отправлялась, иначе PNG из кэша"""
+    return schema['file_id'] or BufferedInputFile(schema['png'], filename="hall_schema.png")
 
 @router.callback_query(F.data == "call_admin")
 async def call_admin(callback: types.CallbackQuery):
@@ -1,9 +1,11 @@
 ﻿from aiogram import Router, F, types
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
-from aiogram.types import FSInputFile, BufferedInputFile, InputMediaPhoto
+from aiogram.types import FSInputFile, InputMediaPhoto
 import keyboards
 import database
+from async_db import adb
+from action_log import action_log
 import config
 import asyncio
 import logging
@@ -13,12 +15,15 @@ from typing import Dict, List, Optional, Tuple
 from datetime import datetime, time, timedelta
 import pytz
 import json
-import aiohttp
 from .utils import update_message, check_user_registration_fast
 from .handlers_registration import RegistrationStates, ask_for_registration_phone
 from presto_api import PrestoAPI
 from menu_cache import menu_cache
 from cart_manager import cart_manager
+from media_registry import media_registry
+from delivery_zones import delivery_zones, KM_PER_DEGREE
+from payment_watcher import payment_watcher, is_order_paid
+from rate_limiter import telegram_limiter
 from presto_api import PrestoAPI
 
 logger = logging.getLogger(__name__)
@@ -34,10 +39,10 @@ MOSCOW_TZ = pytz.timezone('Europe/Moscow')
 user_main_message = {}
 user_message_history = {}
 user_photo_messages = {}
+# user_id -> (message_id, menu_id, category_id, page) кнопок выбора под альбомом категории
+user_category_selectors = {}
 user_document_history = {}
 
-pending_payments = {}
-
 temp_messages = {}
 
 async def add_temp_message(user_id: int, message_id: int):
@@ -71,149 +76,20 @@ async def get_district_for_address(address_text: str, latitude: float, longitude
         logger.info(f"📍 Получение района для адреса: {address_text}")
         logger.info(f"📍 Координаты для проверки: lat={latitude:.6f}, lon={longitude:.6f}")
         
-        # Получаем районы доставки
-        districts = await presto_api.get_delivery_districts(with_coordinates=True)
-        
-        if not districts:
+        # Районы доставки (кэш с индексом, Presto запрашивается не чаще раза в TTL)
+        if not await delivery_zones.load():
             logger.warning("⚠️ Нет районов доставки, используем дефолтный")
             return create_default_district(latitude, longitude)
         
-        # ВЫВОДИМ ВСЕ РАЙОНЫ ДЛЯ ДИАГНОСТИКИ
-        logger.info(f"📍 Получено {len(districts)} районов доставки:")
-        for i, district in enumerate(districts):
-            name = district.get('name', 'Без названия')
-            district_id = district.get('districtId', district.get('id', 'N/A'))
-            cost = district.get('cost', '?')
-            min_order = district.get('minOrderSum', '1000')
-            logger.info(f"   {i+1}. {name} (ID: {district_id}, Стоимость: {cost}₽, Мин. сумма: {min_order}₽)")
-        
-        selected_district = None
-        found_in_district = False
-        
-        # Проверяем каждый район
-        for district in districts:
-            coordinates = district.get('coordinates', [])
-            district_name = district.get('name', '')
-            district_id = district.get('districtId')
-            
-            logger.info(f"📍 Проверяем район '{district_name}' (ID: {district_id})")
-            
-            # Проверяем координаты
-            if not coordinates or not isinstance(coordinates, list):
-                logger.info(f"   ❌ Нет координат для района '{district_name}'")
-                continue
-            
-            polygon_points = []
-            
-            # Анализируем структуру координат
-            for coord_group in coordinates:
-                if not isinstance(coord_group, list):
-                    continue
-                    
-                for point in coord_group:
-                    if isinstance(point, list) and len(point) >= 2:
-                        try:
-                            val1 = float(point[0])
-                            val2 = float(point[1])
-                            
-                            # Определяем порядок координат по диапазонам
-                            # Москва: lat ≈ 55-56, lon ≈ 37-38
-                            
-                            if 30 <= val1 <= 40 and 50 <= val2 <= 60:
-                                # Вероятно [lon, lat] - переворачиваем
-                                lon = val1
-                                lat = val2
-                                logger.debug(f"   ↻ Обнаружен порядок [lon,lat]: {lon:.6f}, {lat:.6f} → {lat:.6f}, {lon:.6f}")
-                                polygon_points.append([lat, lon])
-                            elif 50 <= val1 <= 60 and 30 <= val2 <= 40:
-                                # Стандартный порядок [lat, lon]
-                                lat = val1
-                                lon = val2
-                                polygon_points.append([lat, lon])
-                            else:
-                                # Непонятный порядок
-                                logger.warning(f"   ⚠️ Непонятные координаты: {val1}, {val2}")
-                                polygon_points.append([val1, val2])
-                                
-                        except (ValueError, TypeError) as e:
-                            logger.error(f"   ❌ Ошибка парсинга координат {point}: {e}")
-                            continue
-            
-            if not polygon_points:
-                logger.info(f"   ❌ Нет валидных точек полигона для района '{district_name}'")
-                continue
-            
-            # Показываем информацию о полигоне
-            logger.info(f"   📍 Полигон '{district_name}' имеет {len(polygon_points)} точек")
-            
-            # Проверяем диапазон координат полигона
-            if polygon_points:
-                lats = [p[0] for p in polygon_points]
-                lons = [p[1] for p in polygon_points]
-                min_lat = min(lats)
-                max_lat = max(lats)
-                min_lon = min(lons)
-                max_lon = max(lons)
-                logger.info(f"   📍 Диапазон полигона: lat[{min_lat:.6f}-{max_lat:.6f}], lon[{min_lon:.6f}-{max_lon:.6f}]")
-                logger.info(f"   📍 Наша точка: lat={latitude:.6f}, lon={longitude:.6f}")
-            
-            # Проверяем точку в полигоне
-            if polygon_points and point_in_polygon((latitude, longitude), polygon_points):
-                logger.info(f"   ✅ Точка {latitude:.6f}, {longitude:.6f} внутри района '{district_name}'")
-                selected_district = district
-                found_in_district = True
-                break
-            else:
-                logger.info(f"   ❌ Точка {latitude:.6f}, {longitude:.6f} ВНЕ района '{district_name}'")
+        zone = delivery_zones.locate(latitude, longitude)
         
         # ВАЖНОЕ ИЗМЕНЕНИЕ: Если точка НЕ входит ни в один полигон
-        if not found_in_district:
+        if zone is None:
             logger.error(f"❌ Адрес ВНЕ зоны доставки! Координаты: {latitude:.6f}, {longitude:.6f}")
             
             # Находим ближайший район для информационного сообщения
-            closest_district = None
-            min_distance = float('inf')
-            closest_polygon_center = None
-            
-            for district in districts:
-                coordinates = district.get('coordinates', [])
-                district_name = district.get('name', '')
-                
-                if not coordinates:
-                    continue
-                
-                # Находим центр полигона (среднее арифметическое)
-                polygon_points = []
-                for coord_group in coordinates:
-                    if isinstance(coord_group, list):
-                        for point in coord_group:
-                            if isinstance(point, list) and len(point) >= 2:
-                                try:
-                                    val1 = float(point[0])
-                                    val2 = float(point[1])
-                                    
-                                    # Анализируем порядок координат
-                                    if 30 <= val1 <= 40 and 50 <= val2 <= 60:
-                                        # [lon, lat]
-                                        polygon_points.append([val2, val1])  # Переворачиваем
-                                    elif 50 <= val1 <= 60 and 30 <= val2 <= 40:
-                                        # [lat, lon]
-                                        polygon_points.append([val1, val2])
-                                except:
-                                    continue
-                
-                if polygon_points:
-                    # Вычисляем центр полигона
-                    center_lat = sum(p[0] for p in polygon_points) / len(polygon_points)
-                    center_lon = sum(p[1] for p in polygon_points) / len(polygon_points)
-                    
-                    # Расстояние в градусах (упрощенно)
-                    distance = ((latitude - center_lat) ** 2 + (longitude - center_lon) ** 2) ** 0.5
-                    
-                    if distance < min_distance:
-                        min_distance = distance
-                        closest_district = district
-                        closest_polygon_center = (center_lat, center_lon)
+            closest_zone, min_distance = delivery_zones.nearest(latitude, longitude)
+            closest_district = closest_zone.district if closest_zone else None
             
             # Возвращаем специальный объект с флагом недоступности
             unavailable_district = {
@@ -224,14 +100,17 @@ async def get_district_for_address(address_text: str, latitude: float, longitude
                 'closest_district': closest_district,
                 'closest_district_name': closest_district.get('name') if closest_district else 'Не определено',
                 'distance_degrees': min_distance,
-                'distance_km': min_distance * 111,  # 1 градус ≈ 111 км
-                'closest_center': closest_polygon_center,
+                'distance_km': min_distance * KM_PER_DEGREE,
+                'closest_center': closest_zone.centroid if closest_zone else None,
                 'message': f'Адрес находится вне зоны доставки. Ближайший район: {closest_district.get("name") if closest_district else "не определен"}'
             }
             
-            logger.warning(f"⚠️ Возвращаем объект с флагом недоступности: {unavailable_district}")
+            logger.warning(f"⚠️ Адрес вне зоны доставки, ближайший район: {unavailable_district['closest_district_name']}")
             return unavailable_district
         
+        # Копия: районы в индексе общие для всех запросов
+        selected_district = dict(zone.district)
+        
         # Если точка в зоне доставки, продолжаем обычную обработку
         logger.info(f"✅ Окончательный выбор: район '{selected_district.get('name')}'")
         
@@ -294,35 +173,6 @@ async def get_district_for_address(address_text: str, latitude: float, longitude
         logger.error(f"❌ Ошибка получения района: {e}", exc_info=True)
         return create_default_district(latitude, longitude)
 
-def point_in_polygon(point: Tuple[float, float], polygon: List[List[float]]) -> bool:
-    """Улучшенная проверка точки в полигоне с диагностикой"""
-    if not polygon or len(polygon) < 3:
-        logger.debug(f"❌ Невалидный полигон: {len(polygon)} точек")
-        return False
-    
-    x, y = point  # x = latitude, y = longitude
-    n = len(polygon)
-    inside = False
-    
-    # Проверяем, что координаты в разумных пределах
-    if not (40 <= x <= 60 and 30 <= y <= 40):  # Примерно Москва и область
-        logger.warning(f"⚠️ Подозрительные координаты точки: ({x:.6f}, {y:.6f})")
-    
-    # Алгоритм ray casting
-    p1x, p1y = polygon[0]
-    
-    for i in range(1, n + 1):
-        p2x, p2y = polygon[i % n]
-        
-        # Проверяем пересечение горизонтального луча с ребром полигона
-        if ((p1y > y) != (p2y > y)):
-            xinters = (y - p1y) * (p2x - p1x) / (p2y - p1y) + p1x
-            if x < xinters:
-                inside = not inside
-        
-        p1x, p1y = p2x, p2y
-    
-    return inside
 def create_default_district(latitude: float, longitude: float) -> Dict:
     return {
         'districtId': 20646,
@@ -432,6 +282,7 @@ async def update_main_message(user_id: int, text: str, reply_markup=None,
         return False
 
 async def cleanup_photo_messages(user_id: int, bot):
+    user_category_selectors.pop(user_id, None)
     if user_id in user_photo_messages:
         for msg_id in user_photo_messages[user_id]:
             try:
@@ -610,65 +461,204 @@ async def format_full_dish_description(dish: Dict) -> str:
     
     return text
 
-async def send_dish_photo(user_id: int, dish: Dict, menu_id: int, category_id: int, bot):
+def cart_quantities(user_id: int) -> Dict[int, int]:
+    """Количество каждого блюда в корзине пользователя (один проход по корзине)"""
+    cart_summary = cart_manager.get_cart_summary(user_id)
+    return {item['dish_id']: item['quantity'] for item in cart_summary['items']}
+
+def dish_caption(dish: Dict) -> str:
+    """Подпись к фото блюда"""
+    caption = f"<b>{dish['name']}</b>\n"
+    
+    if dish.get('price', 0) > 0:
+        caption += f"💰 <b>Цена:</b> {dish['price']}₽\n"
+    
+    if dish.get('weight'):
+        caption += f"⚖️ <b>Вес:</b> {dish['weight']}\n"
+    
+    if dish.get('unit') and dish['unit'] != 'шт':
+        caption += f"📏 <b>Единица:</b> {dish['unit']}"
+    
+    return caption
+
+def dish_card_keyboard(menu_id: int, category_id: int, dish_id: int, in_cart_count: int) -> types.InlineKeyboardMarkup:
+    """Кнопки под фото блюда"""
+    cart_button_text = "Добавить в корзину 🛒"
+    if in_cart_count > 0:
+        cart_button_text = f"Добавлено ({in_cart_count}) ✅"
+    
+    return types.InlineKeyboardMarkup(inline_keyboard=[
+        [
+            types.InlineKeyboardButton(text=cart_button_text, callback_data=f"add_to_cart_{menu_id}_{dish_id}"),
+            types.InlineKeyboardButton(text="📝 Полное описание", callback_data=f"view_full_desc_{menu_id}_{category_id}_{dish_id}")
+        ],
+        [types.InlineKeyboardButton(text="⬅️ Назад к категориям", callback_data=f"back_from_photos_{menu_id}")]
+    ])
+
+def dish_image_path(dish: Dict) -> Optional[str]:
+    """Путь к локальному фото блюда, если файл есть"""
+    image_path = dish.get('image_local_path')
+    if not image_path and dish.get('image_filename'):
+        image_path = os.path.join(config.MENU_IMAGES_DIR, dish['image_filename'])
+    
+    if image_path and os.path.exists(image_path):
+        return image_path
+    return None
+
+def build_dish_card(dish: Dict, menu_id: int, category_id: int, quantities: Dict[int, int]) -> Dict:
+    """Готовая карточка блюда: подпись, кнопки и фото"""
+    return {
+        'dish_id': dish['id'],
+        'caption': dish_caption(dish),
+        'keyboard': dish_card_keyboard(menu_id, category_id, dish['id'], quantities.get(dish['id'], 0)),
+        'image_path': dish_image_path(dish)
+    }
+
+async def send_dish_card(user_id: int, card: Dict, bot):
+    """Отправка карточки блюда под общим лимитом Telegram"""
+    if card['image_path']:
+        request = lambda: media_registry.send_photo(
+            bot,
+            chat_id=user_id,
+            photo=FSInputFile(card['image_path'], filename="dish.jpg"),
+            caption=card['caption'],
+            parse_mode="HTML",
+            reply_markup=card['keyboard']
+        )
+    else:
+        request = lambda: bot.send_message(
+            chat_id=user_id,
+            text=card['caption'],
+            parse_mode="HTML",
+            reply_markup=card['keyboard']
+        )
+    
+    return await telegram_limiter.call(user_id, request)
+
+async def send_dish_photo(user_id: int, dish: Dict, menu_id: int, category_id: int, bot,
+                          quantities: Optional[Dict[int, int]] = None):
     try:
-        caption = f"<b>{dish['name']}</b>\n"
-        
-        if dish.get('price', 0) > 0:
-            caption += f"💰 <b>Цена:</b> {dish['price']}₽\n"
-        
-        if dish.get('weight'):
-            caption += f"⚖️ <b>Вес:</b> {dish['weight']}\n"
-        
-        if dish.get('unit') and dish['unit'] != 'шт':
-            caption += f"📏 <b>Единица:</b> {dish['unit']}"
-        
-        cart_summary = cart_manager.get_cart_summary(user_id)
-        in_cart_count = 0
-        for item in cart_summary['items']:
-            if item['dish_id'] == dish['id']:
-                in_cart_count = item['quantity']
-                break
+        if quantities is None:
+            quantities = cart_quantities(user_id)
         
-        cart_button_text = "Добавить в корзину 🛒"
-        if in_cart_count > 0:
-            cart_button_text = f"Добавлено ({in_cart_count}) ✅"
+        message = await send_dish_card(user_id, build_dish_card(dish, menu_id, category_id, quantities), bot)
+        user_photo_messages.setdefault(user_id, []).append(message.message_id)
         
-        keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
-            [
-                types.InlineKeyboardButton(text=cart_button_text, callback_data=f"add_to_cart_{menu_id}_{dish['id']}"),
-                types.InlineKeyboardButton(text="📝 Полное описание", callback_data=f"view_full_desc_{menu_id}_{category_id}_{dish['id']}")
-            ],
-            [types.InlineKeyboardButton(text="⬅️ Назад к категориям", callback_data=f"back_from_photos_{menu_id}")]
+    except Exception as e:
+        logger.error(f"Ошибка отправки фото блюда {dish['id']}: {e}")
+
+async def send_dish_cards(user_id: int, cards: List[Dict], bot):
+    """
+    Отправка карточек категории строго по порядку.
+    
+    Параллельно идет только подготовка: file_id фото (проверка файла и
+    реестра) ищутся заранее в потоках, до CATEGORY_SEND_CONCURRENCY
+    одновременно, поэтому отправки идут одна за другой без ожидания диска и БД.
+    """
+    semaphore = asyncio.Semaphore(config.CATEGORY_SEND_CONCURRENCY)
+    
+    async def prepare(card: Dict):
+        if card['image_path']:
+            async with semaphore:
+                await asyncio.to_thread(media_registry.get_file_id, card['image_path'], 'photo')
+    
+    prepared = [asyncio.create_task(prepare(card)) for card in cards]
+    try:
+        for card, preparation in zip(cards, prepared):
+            try:
+                await preparation
+                message = await send_dish_card(user_id, card, bot)
+                user_photo_messages.setdefault(user_id, []).append(message.message_id)
+            except Exception as e:
+                logger.error(f"Ошибка отправки фото блюда {card['dish_id']}: {e}")
+    finally:
+        for preparation in prepared:
+            preparation.cancel()
+
+def _album_page(dishes: List[Dict], page: int) -> Tuple[int, int, int, List[Dict]]:
+    """(страница, всего страниц, номер первого блюда, блюда страницы)"""
+    page_size = config.CATEGORY_ALBUM_PAGE_SIZE
+    pages = max(1, (len(dishes) + page_size - 1) // page_size)
+    page = max(0, min(page, pages - 1))
+    start = page * page_size
+    return page, pages, start + 1, dishes[start:start + page_size]
+
+def category_selector(menu_id: int, category_id: int, dishes: List[Dict], page: int,
+                      quantities: Dict[int, int]) -> Tuple[str, types.InlineKeyboardMarkup]:
+    """Текст и компактные кнопки выбора блюд под альбомом категории"""
+    page, pages, first_number, page_dishes = _album_page(dishes, page)
+    
+    text = f"📋 <b>Блюда {first_number}-{first_number + len(page_dishes) - 1} из {len(dishes)}</b>\n\n"
+    rows = []
+    for number, dish in enumerate(page_dishes, first_number):
+        in_cart_count = quantities.get(dish['id'], 0)
+        price = f" - {dish['price']}₽" if dish.get('price', 0) > 0 else ""
+        text += f"{number}. {dish['name']}{price}\n"
+        
+        cart_mark = f"✅ {in_cart_count}" if in_cart_count > 0 else "🛒"
+        rows.append([
+            types.InlineKeyboardButton(text=f"{cart_mark} {number}. {dish['name'][:28]}",
+                                       callback_data=f"add_to_cart_{menu_id}_{dish['id']}"),
+            types.InlineKeyboardButton(text="📝", callback_data=f"dish_card_{menu_id}_{category_id}_{dish['id']}")
         ])
-        
-        image_path = dish.get('image_local_path')
-        if not image_path and dish.get('image_filename'):
-            image_path = os.path.join(config.MENU_IMAGES_DIR, dish['image_filename'])
-        
-        if image_path and os.path.exists(image_path):
-            with open(image_path, 'rb') as photo_file:
-                message = await bot.send_photo(
-                    chat_id=user_id,
-                    photo=BufferedInputFile(photo_file.read(), filename="dish.jpg"),
-                    caption=caption,
-                    parse_mode="HTML",
-                    reply_markup=keyboard
-                )
-        else:
-            message = await bot.send_message(
-                chat_id=user_id,
-                text=caption,
-                parse_mode="HTML",
-                reply_markup=keyboard
+    
+    if pages > 1:
+        nav_row = []
+        if page > 0:
+            nav_row.append(types.InlineKeyboardButton(text="◀️", callback_data=f"category_page_{menu_id}_{category_id}_{page - 1}"))
+        nav_row.append(types.InlineKeyboardButton(text=f"{page + 1}/{pages}", callback_data="ignore"))
+        if page < pages - 1:
+            nav_row.append(types.InlineKeyboardButton(text="▶️", callback_data=f"category_page_{menu_id}_{category_id}_{page + 1}"))
+        rows.append(nav_row)
+    
+    rows.append([types.InlineKeyboardButton(text="⬅️ Назад к категориям", callback_data=f"back_from_photos_{menu_id}")])
+    return text, types.InlineKeyboardMarkup(inline_keyboard=rows)
+
+async def send_category_album_page(user_id: int, menu_id: int, category_id: int, dishes: List[Dict],
+                                   page: int, bot, quantities: Optional[Dict[int, int]] = None):
+    """Страница категории одним альбомом (sendMediaGroup) и сообщением с кнопками выбора"""
+    if quantities is None:
+        quantities = cart_quantities(user_id)
+    
+    page, _, first_number, page_dishes = _album_page(dishes, page)
+    
+    media = []
+    for number, dish in enumerate(page_dishes, first_number):
+        image_path = dish_image_path(dish)
+        if image_path:
+            media.append(InputMediaPhoto(
+                media=FSInputFile(image_path, filename="dish.jpg"),
+                caption=f"{number}. {dish_caption(dish)}",
+                parse_mode="HTML"
+            ))
+    
+    try:
+        if len(media) > 1:
+            messages = await telegram_limiter.call(
+                user_id, lambda: media_registry.send_media_group(bot, chat_id=user_id, media=media)
             )
-        
-        if user_id not in user_photo_messages:
-            user_photo_messages[user_id] = []
-        user_photo_messages[user_id].append(message.message_id)
-        
+            user_photo_messages.setdefault(user_id, []).extend(message.message_id for message in messages)
+        elif media:
+            message = await telegram_limiter.call(user_id, lambda: media_registry.send_photo(
+                bot,
+                chat_id=user_id,
+                photo=media[0].media,
+                caption=media[0].caption,
+                parse_mode="HTML"
+            ))
+            user_photo_messages.setdefault(user_id, []).append(message.message_id)
     except Exception as e:
-        logger.error(f"Ошибка отправки фото блюда {dish['id']}: {e}")
+        logger.error(f"Ошибка отправки альбома категории {category_id}: {e}")
+    
+    text, keyboard = category_selector(menu_id, category_id, dishes, page, quantities)
+    selector = await telegram_limiter.call(user_id, lambda: bot.send_message(
+        chat_id=user_id,
+        text=text,
+        parse_mode="HTML",
+        reply_markup=keyboard
+    ))
+    user_photo_messages.setdefault(user_id, []).append(selector.message_id)
+    user_category_selectors[user_id] = (selector.message_id, menu_id, category_id, page)
 
 async def show_category_photos(user_id: int, menu_id: int, category_id: int, bot, state: FSMContext):
     dishes = menu_cache.get_category_items(menu_id, category_id)
@@ -707,7 +697,17 @@ async def show_category_photos(user_id: int, menu_id: int, category_id: int, bot
     
     await cleanup_photo_messages(user_id, bot)
     
-    text = f"""📸 <b>{display_name}</b>
+    album_mode = bool(config.CATEGORY_ALBUM_THRESHOLD) and len(dishes) > config.CATEGORY_ALBUM_THRESHOLD
+    if album_mode:
+        text = f"""📸 <b>{display_name}</b>
+
+<i>Все блюда категории:</i>
+👇 Под альбомом есть кнопки с номерами блюд:
+🛒 - добавить в корзину
+📝 - фото и полное описание
+"""
+    else:
+        text = f"""📸 <b>{display_name}</b>
 
 <i>Все блюда категории:</i>
 👆 Под каждой фотографией есть кнопки:
@@ -726,11 +726,62 @@ async def show_category_photos(user_id: int, menu_id: int, category_id: int, bot
                         parse_mode="HTML",
                         bot=bot)
     
-    for dish in dishes:
-        await send_dish_photo(user_id, dish, menu_id, category_id, bot)
+    # Корзина читается один раз на всю категорию
+    quantities = cart_quantities(user_id)
+    if album_mode:
+        await send_category_album_page(user_id, menu_id, category_id, dishes, 0, bot, quantities)
+    else:
+        cards = [build_dish_card(dish, menu_id, category_id, quantities) for dish in dishes]
+        await send_dish_cards(user_id, cards, bot)
     
     await state.set_state(MenuDeliveryStates.viewing_category)
 
+@router.callback_query(F.data.startswith("category_page_"))
+async def category_page_handler(callback: types.CallbackQuery, state: FSMContext):
+    await callback.answer()
+    
+    try:
+        parts = callback.data.replace("category_page_", "").split("_")
+        if len(parts) != 3:
+            return
+        
+        menu_id = int(parts[0])
+        category_id = int(parts[1])
+        page = int(parts[2])
+        
+        dishes = menu_cache.get_category_items(menu_id, category_id)
+        if not dishes:
+            return
+        
+        await cleanup_photo_messages(callback.from_user.id, callback.bot)
+        await send_category_album_page(callback.from_user.id, menu_id, category_id, dishes, page, callback.bot)
+        
+    except Exception as e:
+        logger.error(f"Ошибка переключения страницы категории: {e}")
+
+@router.callback_query(F.data.startswith("dish_card_"))
+async def dish_card_handler(callback: types.CallbackQuery, state: FSMContext):
+    await callback.answer()
+    
+    try:
+        parts = callback.data.replace("dish_card_", "").split("_")
+        if len(parts) != 3:
+            return
+        
+        menu_id = int(parts[0])
+        category_id = int(parts[1])
+        dish_id = int(parts[2])
+        
+        dish = menu_cache.get_dish_by_id(menu_id, dish_id)
+        if not dish:
+            await callback.answer("❌ Блюдо не найдено", show_alert=True)
+            return
+        
+        await send_dish_photo(callback.from_user.id, dish, menu_id, category_id, callback.bot)
+        
+    except Exception as e:
+        logger.error(f"Ошибка показа карточки блюда: {e}")
+
 @router.callback_query(F.data.startswith("select_menu_"))
 async def select_menu_handler(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
@@ -892,17 +943,17 @@ async def view_full_desc_handler(callback: types.CallbackQuery, state: FSMContex
         
         if image_path and os.path.exists(image_path):
             try:
-                with open(image_path, 'rb') as photo_file:
-                    await callback.bot.edit_message_media(
-                        chat_id=callback.from_user.id,
-                        message_id=callback.message.message_id,
-                        media=InputMediaPhoto(
-                            media=BufferedInputFile(photo_file.read(), filename="dish.jpg"),
-                            caption=text,
-                            parse_mode="HTML"
-                        ),
-                        reply_markup=keyboard
-                    )
+                await media_registry.edit_message_media(
+                    callback.bot,
+                    chat_id=callback.from_user.id,
+                    message_id=callback.message.message_id,
+                    media=InputMediaPhoto(
+                        media=FSInputFile(image_path, filename="dish.jpg"),
+                        caption=text,
+                        parse_mode="HTML"
+                    ),
+                    reply_markup=keyboard
+                )
             except Exception as e:
                 logger.debug(f"Не удалось обновить фото на описание: {e}")
                 await callback.bot.edit_message_caption(
@@ -950,51 +1001,24 @@ async def back_to_photo_handler(callback: types.CallbackQuery, state: FSMContext
             await callback.answer("❌ Блюдо не найдено", show_alert=True)
             return
         
-        caption = f"<b>{dish['name']}</b>\n"
+        caption = dish_caption(dish)
+        quantities = cart_quantities(callback.from_user.id)
+        keyboard = dish_card_keyboard(menu_id, category_id, dish_id, quantities.get(dish_id, 0))
         
-        if dish.get('price', 0) > 0:
-            caption += f"💰 <b>Цена:</b> {dish['price']}₽\n"
-        
-        if dish.get('weight'):
-            caption += f"⚖️ <b>Вес:</b> {dish['weight']}\n"
-        
-        if dish.get('unit') and dish['unit'] != 'шт':
-            caption += f"📏 <b>Единица:</b> {dish['unit']}"
-        
-        cart_summary = cart_manager.get_cart_summary(callback.from_user.id)
-        in_cart_count = 0
-        for item in cart_summary['items']:
-            if item['dish_id'] == dish_id:
-                in_cart_count = item['quantity']
-                break
-        
-        cart_button_text = f"Добавлено ({in_cart_count}) ✅" if in_cart_count > 0 else "Добавить в корзину 🛒"
-        
-        keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
-            [
-                types.InlineKeyboardButton(text=cart_button_text, callback_data=f"add_to_cart_{menu_id}_{dish_id}"),
-                types.InlineKeyboardButton(text="📝 Полное описание", callback_data=f"view_full_desc_{menu_id}_{category_id}_{dish_id}")
-            ],
-            [types.InlineKeyboardButton(text="⬅️ Назад к категориям", callback_data=f"back_from_photos_{menu_id}")]
-        ])
-        
-        image_path = dish.get('image_local_path')
-        if not image_path and dish.get('image_filename'):
-            image_path = os.path.join(config.MENU_IMAGES_DIR, dish['image_filename'])
-        
-        if image_path and os.path.exists(image_path):
+        image_path = dish_image_path(dish)
+        if image_path:
             try:
-                with open(image_path, 'rb') as photo_file:
-                    await callback.bot.edit_message_media(
-                        chat_id=callback.from_user.id,
-                        message_id=callback.message.message_id,
-                        media=InputMediaPhoto(
-                            media=BufferedInputFile(photo_file.read(), filename="dish.jpg"),
-                            caption=caption,
-                            parse_mode="HTML"
-                        ),
-                        reply_markup=keyboard
-                    )
+                await media_registry.edit_message_media(
+                    callback.bot,
+                    chat_id=callback.from_user.id,
+                    message_id=callback.message.message_id,
+                    media=InputMediaPhoto(
+                        media=FSInputFile(image_path, filename="dish.jpg"),
+                        caption=caption,
+                        parse_mode="HTML"
+                    ),
+                    reply_markup=keyboard
+                )
             except Exception as e:
                 logger.debug(f"Не удалось вернуть фото: {e}")
                 await callback.bot.edit_message_caption(
@@ -1082,22 +1106,25 @@ async def add_to_cart_handler(callback: types.CallbackQuery, state: FSMContext):
         )
         
         if success:
-            cart_summary = cart_manager.get_cart_summary(user_id)
-            new_count = 0
-            for item in cart_summary['items']:
-                if item['dish_id'] == dish_id:
-                    new_count = item['quantity']
-                    break
+            quantities = cart_quantities(user_id)
+            new_count = quantities.get(dish_id, 0)
             
             try:
-                cart_button_text = f"Добавлено ({new_count}) ✅"
-                keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
-                    [
-                        types.InlineKeyboardButton(text=cart_button_text, callback_data=f"add_to_cart_{menu_id}_{dish_id}"),
-                        types.InlineKeyboardButton(text="📝 Полное описание", callback_data=f"view_full_desc_{menu_id}_{0}_{dish_id}")
-                    ],
-                    [types.InlineKeyboardButton(text="⬅️ Назад к категориям", callback_data=f"back_from_photos_{menu_id}")]
-                ])
+                selector = user_category_selectors.get(user_id)
+                if selector and selector[0] == callback.message.message_id:
+                    # Кнопки выбора под альбомом: обновляем отметку у всей страницы
+                    _, selector_menu_id, selector_category_id, page = selector
+                    dishes = menu_cache.get_category_items(selector_menu_id, selector_category_id)
+                    _, keyboard = category_selector(selector_menu_id, selector_category_id, dishes, page, quantities)
+                else:
+                    cart_button_text = f"Добавлено ({new_count}) ✅"
+                    keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
+                        [
+                            types.InlineKeyboardButton(text=cart_button_text, callback_data=f"add_to_cart_{menu_id}_{dish_id}"),
+                            types.InlineKeyboardButton(text="📝 Полное описание", callback_data=f"view_full_desc_{menu_id}_{0}_{dish_id}")
+                        ],
+                        [types.InlineKeyboardButton(text="⬅️ Назад к категориям", callback_data=f"back_from_photos_{menu_id}")]
+                    ])
                 
                 await callback.bot.edit_message_reply_markup(
                     chat_id=user_id,
@@ -1401,7 +1428,7 @@ async def ask_for_address_from_cart(user_id: int, bot, state: FSMContext):
     await state.set_state(DeliveryOrderStates.entering_address)
 
 async def show_address_selection_from_cart(user_id: int, bot, state: FSMContext):
-    user_addresses = database.get_user_addresses(user_id)
+    user_addresses = await adb.get_user_addresses(user_id)
     
     text = """📍 <b>Выберите адрес доставки</b>
 
@@ -1463,7 +1490,7 @@ async def use_saved_address_from_cart_handler(callback: types.CallbackQuery, sta
     user_id = callback.from_user.id
     address_id = int(callback.data.replace("use_saved_address_", "").replace("_from_cart", ""))
     
-    user_addresses = database.get_user_addresses(user_id)
+    user_addresses = await adb.get_user_addresses(user_id)
     selected_address = None
     
     for address in user_addresses:
@@ -1475,7 +1502,7 @@ async def use_saved_address_from_cart_handler(callback: types.CallbackQuery, sta
         await callback.answer("❌ Адрес не найден", show_alert=True)
         return
     
-    database.update_address_last_used(address_id)
+    await adb.update_address_last_used(address_id)
     
     await state.update_data({
         'address_text': selected_address['address'],
@@ -2027,14 +2054,14 @@ async def process_search_query(message: types.Message, state: FSMContext):
         await message.answer("⚠️ Введите хотя бы 2 символа для поиска")
         return
     
-    database.log_action(message.from_user.id, "menu_search", search_text)
+    action_log.log(message.from_user.id, "menu_search", search_text)
     
     state_data = await state.get_data()
     menu_id = state_data.get('search_menu_id')
     
-    results = menu_cache.search_dishes(search_text, menu_id)
+    search_result = menu_cache.search(search_text, menu_id, limit=10)
     
-    if not results:
+    if not search_result['total']:
         if menu_id:
             menu_name = ""
             available_menus = menu_cache.get_available_menus()
@@ -2058,40 +2085,26 @@ async def process_search_query(message: types.Message, state: FSMContext):
                 [types.InlineKeyboardButton(text="🍽️ Все меню", callback_data="menu_delivery")]
             ])
     else:
-        results_by_menu = {}
-        for dish in results:
-            m_id = dish.get('menu_id')
-            if m_id not in results_by_menu:
-                results_by_menu[m_id] = []
-            results_by_menu[m_id].append(dish)
+        # Результаты уже отсортированы по релевантности, берем только первые 10
+        top_results = search_result['results']
+        total_results = search_result['total']
         
         text = f"🔍 <b>Результаты поиска:</b> {search_text}\n\n"
         
         if menu_id:
-            menu_results = results_by_menu.get(menu_id, [])
-            text += f"Найдено блюд: {len(menu_results)}\n\nВыберите блюдо:"
+            text += f"Найдено блюд: {total_results}\n\nВыберите блюдо:"
         else:
-            total_results = sum(len(r) for r in results_by_menu.values())
             text += f"Найдено блюд: {total_results}\n\n"
             
-            for m_id, menu_dishes in results_by_menu.items():
-                menu_name = menu_dishes[0].get('menu_name', f'Меню {m_id}')
-                text += f"<b>{menu_name}:</b> {len(menu_dishes)} блюд\n"
+            for m_id, menu_count in search_result['by_menu'].items():
+                menu_name = menu_cache.all_menus_cache.get(m_id, {}).get('name') or f'Меню {m_id}'
+                text += f"<b>{menu_name}:</b> {menu_count} блюд\n"
             
             text += "\nВыберите блюдо:"
         
         keyboard = types.InlineKeyboardMarkup(inline_keyboard=[])
         
-        all_results = []
-        if menu_id:
-            all_results = results_by_menu.get(menu_id, [])
-        else:
-            for menu_dishes in results_by_menu.values():
-                all_results.extend(menu_dishes)
-        
-        all_results.sort(key=lambda x: x.get('name', ''))
-        
-        for dish in all_results[:10]:
+        for dish in top_results:
             menu_prefix = ""
             if not menu_id:
                 menu_name_short = dish.get('menu_name', '?')[:3]
@@ -2108,10 +2121,10 @@ async def process_search_query(message: types.Message, state: FSMContext):
                 )
             ])
         
-        if len(all_results) > 10:
+        if total_results > 10:
             keyboard.inline_keyboard.append([
                 types.InlineKeyboardButton(
-                    text=f"📄 Показать ещё ({len(all_results) - 10})",
+                    text=f"📄 Показать ещё ({total_results - 10})",
                     callback_data=f"show_more_search_{search_text}_{menu_id if menu_id else 'all'}"
                 )
             ])
@@ -2237,23 +2250,23 @@ async def menu_pdf_callback(callback: types.CallbackQuery, state: FSMContext):
     
     try:
         if os.path.exists(PDF_MENU_PATH):
-            with open(PDF_MENU_PATH, 'rb') as file:
-                message = await callback.bot.send_document(
-                    chat_id=callback.from_user.id,
-                    document=BufferedInputFile(
-                        file.read(),
-                        filename="Menu_Mashkov_Rest.pdf"
-                    ),
-                    caption="📋 <b>Полное меню ресторана с барной картой</b>\n\nЗдесь вы найдете все блюда и напитки нашего ресторана.",
-                    parse_mode="HTML"
-                )
+            message = await media_registry.send_document(
+                callback.bot,
+                chat_id=callback.from_user.id,
+                document=FSInputFile(
+                    PDF_MENU_PATH,
+                    filename="Menu_Mashkov_Rest.pdf"
+                ),
+                caption="📋 <b>Полное меню ресторана с барной картой</b>\n\nЗдесь вы найдете все блюда и напитки нашего ресторана.",
+                parse_mode="HTML"
+            )
             
             user_id = callback.from_user.id
             if user_id not in user_document_history:
                 user_document_history[user_id] = []
             user_document_history[user_id].append(message.message_id)
             
-            database.log_action(callback.from_user.id, "menu_pdf_downloaded")
+            action_log.log(callback.from_user.id, "menu_pdf_downloaded")
             
             await asyncio.sleep(1)
             await menu_food_handler(callback.from_user.id, callback.bot)
@@ -2298,23 +2311,23 @@ async def menu_banquet_callback(callback: types.CallbackQuery, state: FSMContext
     
     try:
         if os.path.exists(BANQUET_MENU_PATH):
-            with open(BANQUET_MENU_PATH, 'rb') as file:
-                message = await callback.bot.send_document(
-                    chat_id=callback.from_user.id,
-                    document=BufferedInputFile(
-                        file.read(),
-                        filename="Menu_Banket_Mashkov_Rest.xlsx"
-                    ),
-                    caption="🎉 <b>Банкетное меню</b>\n\nСпециальное предложение для мероприятий и праздников.",
-                    parse_mode="HTML"
-                )
+            message = await media_registry.send_document(
+                callback.bot,
+                chat_id=callback.from_user.id,
+                document=FSInputFile(
+                    BANQUET_MENU_PATH,
+                    filename="Menu_Banket_Mashkov_Rest.xlsx"
+                ),
+                caption="🎉 <b>Банкетное меню</b>\n\nСпециальное предложение для мероприятий и праздников.",
+                parse_mode="HTML"
+            )
             
             user_id = callback.from_user.id
             if user_id not in user_document_history:
                 user_document_history[user_id] = []
             user_document_history[user_id].append(message.message_id)
             
-            database.log_action(callback.from_user.id, "menu_banquet_downloaded")
+            action_log.log(callback.from_user.id, "menu_banquet_downloaded")
             
             await asyncio.sleep(1)
             await menu_food_handler(callback.from_user.id, callback.bot)
@@ -2394,7 +2407,7 @@ async def show_static_menu(user_id: int, bot):
                             bot=bot)
 
 async def menu_food_handler(user_id: int, bot):
-    database.log_action(user_id, "view_menu")
+    action_log.log(user_id, "view_menu")
     
     text = """🍽️ <b>Меню ресторана</b>
 
@@ -2508,7 +2521,7 @@ async def order_delivery_handler(callback: types.CallbackQuery, state: FSMContex
     user_id = callback.from_user.id
     await state.update_data(order_type='delivery')
     
-    user_addresses = database.get_user_addresses(user_id)
+    user_addresses = await adb.get_user_addresses(user_id)
     
     if user_addresses:
         await show_address_selection(user_id, callback.bot, state)
@@ -2536,7 +2549,7 @@ async def ask_for_address(user_id: int, bot, state: FSMContext):
     await state.set_state(DeliveryOrderStates.entering_address)
 
 async def show_address_selection(user_id: int, bot, state: FSMContext):
-    user_addresses = database.get_user_addresses(user_id)
+    user_addresses = await adb.get_user_addresses(user_id)
     
     text = """📍 <b>Выберите адрес доставки</b>
 
@@ -2581,7 +2594,7 @@ async def use_saved_address_handler(callback: types.CallbackQuery, state: FSMCon
     user_id = callback.from_user.id
     address_id = int(callback.data.replace("use_saved_address_", ""))
     
-    user_addresses = database.get_user_addresses(user_id)
+    user_addresses = await adb.get_user_addresses(user_id)
     selected_address = None
     
     for address in user_addresses:
@@ -2593,7 +2606,7 @@ async def use_saved_address_handler(callback: types.CallbackQuery, state: FSMCon
         await callback.answer("❌ Адрес не найден", show_alert=True)
         return
     
-    database.update_address_last_used(address_id)
+    await adb.update_address_last_used(address_id)
     
     await state.update_data({
         'address_text': selected_address['address'],
@@ -2637,42 +2650,13 @@ async def share_location_handler(callback: types.CallbackQuery, state: FSMContex
     await callback.answer("📍 Ожидаем ваше местоположение")
 
 async def reverse_geocode_dadata(latitude: float, longitude: float) -> Optional[str]:
-    """Преобразование координат в адрес через DaData"""
+    """Преобразование координат в адрес через DaData (с кэшем)"""
     try:
-        DADATA_API_KEY = config.DADATA_API_KEY
-        DADATA_SECRET_KEY = config.DADATA_SECRET_KEY
-        
-        if not DADATA_API_KEY or not DADATA_SECRET_KEY:
+        if not config.DADATA_API_KEY or not config.DADATA_SECRET_KEY:
             logger.warning("⚠️ Нет ключей DaData для обратного геокодирования")
             return None
         
-        url = "https://suggestions.dadata.ru/suggestions/api/4_1/rs/geolocate/address"
-        
-        headers = {
-            "Content-Type": "application/json",
-            "Accept": "application/json",
-            "Authorization": f"Token {DADATA_API_KEY}",
-            "X-Secret": DADATA_SECRET_KEY
-        }
-        
-        data = {
-            "lat": latitude,
-            "lon": longitude,
-            "count": 1,
-            "radius_meters": 50  # Более точный поиск
-        }
-        
-        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=5)) as session:
-            async with session.post(url, headers=headers, json=data) as response:
-                if response.status == 200:
-                    result = await response.json()
-                    
-                    if result.get('suggestions') and len(result['suggestions']) > 0:
-                        address = result['suggestions'][0].get('value', '')
-                        logger.info(f"📍 DaData обратное геокодирование: {latitude}, {longitude} → {address}")
-                        return address
-        
-        return None
+        return await presto_api.reverse_geocode_address(latitude, longitude, radius_meters=50)
         
     except Exception as e:
         logger.error(f"❌ Ошибка обратного геокодирования DaData: {e}")
@@ -2998,7 +2982,7 @@ async def proceed_to_comment_handler(callback: types.CallbackQuery, state: FSMCo
     door_code = state_data.get('door_code', '')
     
     if address_text:
-        database.save_user_address(
+        await adb.save_user_address(
             user_id=user_id,
             address=address_text,
             latitude=latitude,
@@ -3076,7 +3060,7 @@ async def show_order_summary(user_id: int, bot, state: FSMContext, message_id: i
     applied_promocode = state_data.get('applied_promocode')
     
     # Получаем данные пользователя
-    user_data = database.get_user_data(user_id)
+    user_data = await adb.get_user_data(user_id)
     
     if not user_data:
         logger.error(f"❌ Нет данных пользователя {user_id}")
@@ -3345,7 +3329,7 @@ async def process_promocode_input(message: types.Message, state: FSMContext):
     original_cart_total = cart_summary.get('original_total', cart_summary.get('total', 0))
     
     # Проверяем промокод на основе ИСХОДНОЙ суммы
-    validation_result = database.validate_promocode_for_user(promocode_text, user_id, original_cart_total)
+    validation_result = await adb.validate_promocode_for_user(promocode_text, user_id, original_cart_total)
     
     if validation_result.get('valid'):
         # Рассчитываем новую сумму с учетом скидки
@@ -3470,7 +3454,7 @@ async def apply_promocode_successfully(user_id: int, state: FSMContext, cart_sum
 <b>Сумма скидки:</b> {discount_amount:.0f}₽
 <b>Сумма заказа:</b> {original_total}₽ → {new_cart_total}₽"""
     
-    database.mark_promocode_used(promocode_text)
+    await adb.mark_promocode_used(promocode_text)
     
     await update_main_message(user_id, text,
                             parse_mode="HTML",
@@ -3573,7 +3557,7 @@ async def apply_promo_with_min_handler(callback: types.CallbackQuery, state: FSM
         # Применяем скидку к корзине (ограниченную версию)
         cart_manager.apply_promocode_to_cart(callback.from_user.id, effective_discount, 'amount')
         
-        database.mark_promocode_used(promocode_text)
+        await adb.mark_promocode_used(promocode_text)
         
         text = f"""✅ <b>Промокод применен с ограничением!</b>
 
@@ -3661,7 +3645,7 @@ async def process_payment_handler(callback: types.CallbackQuery, state: FSMConte
     delivery_cost = state_data.get('delivery_cost', 0)
     district_info = state_data.get('district_info', {})
     
-    user_data = database.get_user_data(user_id)
+    user_data = await adb.get_user_data(user_id)
     
     if not user_data or not user_data.get('phone'):
         await callback.answer("❌ Необходимо указать телефон", show_alert=True)
@@ -3831,17 +3815,8 @@ async def process_payment_handler(callback: types.CallbackQuery, state: FSMConte
                             bot=callback.bot)
         return
     
-    # Запускаем задачу проверки статуса оплаты
-    task = asyncio.create_task(
-        check_payment_status(sale_key, user_id, callback.bot, state)
-    )
-    
-    pending_payments[user_id] = {
-        'sale_key': sale_key,
-        'task': task,
-        'timestamp': datetime.now(),
-        'order_number': order_number
-    }
+    # Ставим заказ на отслеживание оплаты (общий планировщик, переживает перезапуск)
+    payment_watcher.watch(sale_key, user_id, order_number)
     
     # Сохраняем информацию о заказе для восстановления корзины
     await state.update_data({
@@ -3867,7 +3842,7 @@ async def process_payment_handler(callback: types.CallbackQuery, state: FSMConte
         order_items_text += f"\nКомментарий: {comment}"
     
     # Сохраняем заказ в базу (но не очищаем корзину сразу!)
-    database.save_order(
+    await adb.save_order(
         user_id=user_id,
         items=order_items_text,
         total_amount=final_total,
@@ -3880,7 +3855,7 @@ async def process_payment_handler(callback: types.CallbackQuery, state: FSMConte
     
     # Сохраняем использованный промокод если есть
     if promocode_used:
-        database.save_user_promocode(user_id, promocode_used, discount_amount=discount_amount)
+        await adb.save_user_promocode(user_id, promocode_used, discount_amount=discount_amount)
     
     text = f"""✅ <b>Заказ №{order_number} создан!</b>
 
@@ -4164,73 +4139,44 @@ async def show_address_details_again(user_id: int, bot, state: FSMContext):
     await state.set_state(DeliveryOrderStates.entering_address_details)
 
 async def cancel_pending_payment(user_id: int):
-    if user_id in pending_payments:
-        payment_data = pending_payments[user_id]
-        sale_key = payment_data.get('sale_key')
+    for payment in payment_watcher.get_user_payments(user_id):
+        sale_key = payment['sale_key']
+        payment_watcher.finish(sale_key, 'cancelled')
         
-        if sale_key:
-            try:
-                await presto_api.cancel_order(sale_key)
-            except:
-                pass
-        
-        task = payment_data.get('task')
-        if task and not task.done():
-            task.cancel()
-        
-        del pending_payments[user_id]
+        try:
+            await presto_api.cancel_order(sale_key)
+        except:
+            pass
 
-async def check_payment_status(sale_key: str, user_id: int, bot, state: FSMContext):
+@payment_watcher.on_paid
+async def on_payment_paid(payment: Dict, status_result: Dict):
+    user_id = payment['user_id']
+    await complete_order_after_payment(user_id, payment_watcher.bot, payment_watcher.state_for(user_id), payment['sale_key'])
+
+@payment_watcher.on_expired
+async def on_payment_expired(payment: Dict, status_result: Dict):
     try:
-        for i in range(42):  # 42 * 10 секунд = 7 минут
-            await asyncio.sleep(10)
-            
-            status_result = await presto_api.get_order_status(sale_key)
-            
-            if 'error' in status_result:
-                continue
-            
-            payments = status_result.get('payments', [])
-            is_paid = False
-            
-            for payment in payments:
-                if payment.get('isClosed', False) and payment.get('paymentType') == 'online':
-                    is_paid = True
-                    break
-            
-            if is_paid:
-                if user_id in pending_payments:
-                    del pending_payments[user_id]
-                
-                await complete_order_after_payment(user_id, bot, state, sale_key)
-                return
-        
-        # Если не оплачено за 7 минут
-        await cancel_pending_payment(user_id)
-        
-        text = """❌ <b>Время оплаты истекло</b>
+        await presto_api.cancel_order(payment['sale_key'])
+    except:
+        pass
+    
+    text = """❌ <b>Время оплаты истекло</b>
 
 Вы не оплатили заказ в течение 7 минут.
 
 Заказ был автоматически отменен.
 
 Вы можете создать новый заказ."""
-        
-        keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
-            [types.InlineKeyboardButton(text="🍽️ Создать новый заказ", callback_data="menu_delivery")],
-            [types.InlineKeyboardButton(text="🏠 В главное меню", callback_data="back_main")]
-        ])
-        
-        await update_message(user_id, text,
-                            reply_markup=keyboard,
-                            parse_mode="HTML",
-                            bot=bot)
-        
-    except asyncio.CancelledError:
-        pass
-    except Exception as e:
-        logger.error(f"❌ Ошибка проверки статуса оплаты: {e}")
-        await cancel_pending_payment(user_id)
+    
+    keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
+        [types.InlineKeyboardButton(text="🍽️ Создать новый заказ", callback_data="menu_delivery")],
+        [types.InlineKeyboardButton(text="🏠 В главное меню", callback_data="back_main")]
+    ])
+    
+    await update_message(payment['user_id'], text,
+                        reply_markup=keyboard,
+                        parse_mode="HTML",
+                        bot=payment_watcher.bot)
 
 async def complete_order_after_payment(user_id: int, bot, state: FSMContext, sale_key: str):
     state_data = await state.get_data()
@@ -4247,7 +4193,7 @@ async def complete_order_after_payment(user_id: int, bot, state: FSMContext, sal
     cart_manager.clear_cart(user_id)
     
     order_text = "\n".join([f"{item['name']} - {item['quantity']}шт." 
-                          for item in cart_summary['items']])
+                          for item in cart_summary.get('items', [])])
     
     discount_percent = applied_promocode.get('discount_percent', 0) if applied_promocode else 0
     
@@ -4320,16 +4266,34 @@ async def check_payment_status_handler(callback: types.CallbackQuery, state: FSM
 
 <b>ID заказа:</b> {sale_key}"""
     else:
-        payments = status_result.get('payments', [])
-        is_paid = False
-        
-        for payment in payments:
-            if payment.get('isClosed', False) and payment.get('paymentType') == 'online':
-                is_paid = True
-                break
-        
-        if is_paid:
-            await complete_order_after_payment(user_id, callback.bot, state, sale_key)
+        if is_order_paid(status_result):
+            # Заказ оформляет только тот, кто завершил ожидание (кнопка или планировщик)
+            finished = payment_watcher.finish(sale_key, 'paid')
+            if finished:
+                await complete_order_after_payment(user_id, callback.bot, state, sale_key)
+                return
+            if finished is None:
+                # Ошибка БД: заказ не оформлен, планировщик попробует еще раз
+                text = f"""✅ <b>Оплата получена</b>
+
+Не удалось сразу оформить заказ. Мы повторим автоматически, или нажмите «Проверить еще раз» через минуту.
+
+<b>ID заказа:</b> {sale_key}"""
+                keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
+                    [types.InlineKeyboardButton(text="🔄 Проверить еще раз", callback_data=f"check_payment_{sale_key}")],
+                    [types.InlineKeyboardButton(text="📞 Связаться", callback_data="contact_us")]
+                ])
+                await update_message(user_id, text, reply_markup=keyboard, parse_mode="HTML", bot=callback.bot)
+                return
+            text = f"""✅ <b>Оплата уже получена</b>
+
+Заказ оформлен, подтверждение отправлено выше.
+
+<b>ID заказа:</b> {sale_key}"""
+            keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
+                [types.InlineKeyboardButton(text="🏠 В главное меню", callback_data="back_main")]
+            ])
+            await update_message(user_id, text, reply_markup=keyboard, parse_mode="HTML", bot=callback.bot)
             return
         else:
             text = f"""⏳ <b>Оплата еще не поступила</b>
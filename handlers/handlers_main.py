@@ -6,12 +6,15 @@ from aiogram import types
 from aiogram.fsm.state import State, StatesGroup
 import os
 import json
-from aiogram.types import BufferedInputFile
+from aiogram.types import BufferedInputFile, FSInputFile
 from aiogram import Router, F, types
 from aiogram.filters import CommandStart, Command, StateFilter
 from aiogram.fsm.context import FSMContext
 import keyboards
 import database
+from async_db import adb
+from action_log import action_log
+from media_registry import media_registry
 import config
 import asyncio
 import cache_manager
@@ -36,7 +39,8 @@ from .utils import (
     set_operator_notifications,
     is_operator_chat,
     clear_operator_chat,
-    typing_indicator
+    typing_indicator,
+    StreamingReply
 )
 from difflib import SequenceMatcher
 
@@ -356,7 +360,7 @@ async def process_supplier_submission(source, state: FSMContext, file_id=None, f
                                parse_mode="HTML",
                                bot=source.bot)
             
-            database.log_action(user_id, "supplier_form_submitted", 
+            action_log.log(user_id, "supplier_form_submitted", 
                               f"company:{data.get('company_name', '')}")
             
         except Exception as e:
@@ -520,7 +524,7 @@ async def start_handler(message: types.Message, state: FSMContext):
     logger.info(f"Получен /start от {user.id} ({user.username or 'нет username'})")
     
     database.add_user(user.id, user.username, user.full_name)
-    database.log_action(user.id, "start")
+    action_log.log(user.id, "start")
     
     await state.clear()
     
@@ -751,10 +755,13 @@ async def cmd_restart_menu(message: types.Message, state: FSMContext):
                 for cat_id, cat_data in menu_data.get('categories', {}).items():
                     total_items += len(cat_data.get('items', []))
 
+            changes = menu_cache.last_diff.summary() if menu_cache.last_diff else "первая загрузка"
+
             await safe_send_message(message.bot, user_id,
                                    f"✅ <b>Меню успешно обновлено!</b>\n\n"
                                    f"📊 Загружено {len(menus)} меню\n"
-                                   f"🍽️ Всего позиций: {total_items}\n\n"
+                                   f"🍽️ Всего позиций: {total_items}\n"
+                                   f"🔍 Изменения: {changes}\n\n"
                                    f"🕐 Обновлено: {datetime.now().strftime('%H:%M:%S')}",
                                    parse_mode="HTML")
         else:
@@ -1133,7 +1140,7 @@ async def menu_delivery_callback(callback: types.CallbackQuery):
 async def about_us_callback(callback: types.CallbackQuery):
     """Быстрая информация о нас с фото"""
     await callback.answer()
-    database.log_action(callback.from_user.id, "view_about")
+    action_log.log(callback.from_user.id, "view_about")
     
     restaurant_address = database.get_setting('restaurant_address', config.RESTAURANT_ADDRESS)
     restaurant_phone = database.get_setting('restaurant_phone', config.RESTAURANT_PHONE)
@@ -1160,46 +1167,46 @@ async def about_us_callback(callback: types.CallbackQuery):
     try:
         photo_path = "files/REST_PHOTO.webp"
         if os.path.exists(photo_path):
-            with open(photo_path, 'rb') as photo_file:
+            try:
+                await media_registry.edit_message_media(
+                    callback.bot,
+                    chat_id=callback.from_user.id,
+                    message_id=callback.message.message_id,
+                    media=types.InputMediaPhoto(
+                        media=FSInputFile(photo_path, filename="restaurant.jpg"),
+                        caption=caption,
+                        parse_mode="HTML"
+                    ),
+                    reply_markup=keyboard
+                )
+                
+                last_message_ids[callback.from_user.id] = callback.message.message_id
+                
+                user_id = callback.from_user.id
+                if user_id not in user_message_history:
+                    user_message_history[user_id] = []
+                user_message_history[user_id].append(callback.message.message_id)
+                
+                logger.info(f"Сообщение с фото отредактировано для пользователя {callback.from_user.id}")
+                
+            except Exception as e:
+                logger.error(f"Ошибка редактирования с фото: {e}")
                 try:
-                    await callback.bot.edit_message_media(
+                    await callback.bot.edit_message_text(
                         chat_id=callback.from_user.id,
                         message_id=callback.message.message_id,
-                        media=types.InputMediaPhoto(
-                            media=BufferedInputFile(photo_file.read(), filename="restaurant.jpg"),
-                            caption=caption,
-                            parse_mode="HTML"
-                        ),
-                        reply_markup=keyboard
+                        text=caption,
+                        reply_markup=keyboard,
+                        parse_mode="HTML",
+                        disable_web_page_preview=True
                     )
-                    
-                    last_message_ids[callback.from_user.id] = callback.message.message_id
-                    
-                    user_id = callback.from_user.id
-                    if user_id not in user_message_history:
-                        user_message_history[user_id] = []
-                    user_message_history[user_id].append(callback.message.message_id)
-                    
-                    logger.info(f"Сообщение с фото отредактировано для пользователя {callback.from_user.id}")
-                    
-                except Exception as e:
-                    logger.error(f"Ошибка редактирования с фото: {e}")
-                    try:
-                        await callback.bot.edit_message_text(
-                            chat_id=callback.from_user.id,
-                            message_id=callback.message.message_id,
-                            text=caption,
-                            reply_markup=keyboard,
-                            parse_mode="HTML",
-                            disable_web_page_preview=True
-                        )
-                        logger.info(f"Сообщение без фото отредактировано для пользователя {callback.from_user.id}")
-                    except Exception as e2:
-                        logger.error(f"Ошибка редактирования текста: {e2}")
-                        await update_message(callback.from_user.id, caption,
-                                            reply_markup=keyboard,
-                                            parse_mode="HTML",
-                                            bot=callback.bot)
+                    logger.info(f"Сообщение без фото отредактировано для пользователя {callback.from_user.id}")
+                except Exception as e2:
+                    logger.error(f"Ошибка редактирования текста: {e2}")
+                    await update_message(callback.from_user.id, caption,
+                                        reply_markup=keyboard,
+                                        parse_mode="HTML",
+                                        bot=callback.bot)
         else:
             await callback.bot.edit_message_text(
                 chat_id=callback.from_user.id,
@@ -1231,7 +1238,7 @@ async def about_us_callback(callback: types.CallbackQuery):
 async def faq_callback(callback: types.CallbackQuery):
     """Быстрые FAQ"""
     await callback.answer()
-    database.log_action(callback.from_user.id, "view_faq")
+    action_log.log(callback.from_user.id, "view_faq")
 
     user_id = callback.from_user.id
     log_user_action(user_id, "Открыл FAQ")
@@ -1240,7 +1247,7 @@ async def faq_callback(callback: types.CallbackQuery):
     faq_list = cache_manager.cache.get(cache_key)
     
     if faq_list is None:
-        faq_list = database.get_faq()
+        faq_list = await adb.get_faq()
         cache_manager.cache.set(cache_key, faq_list, ttl=600)
     
     if not faq_list:
@@ -1270,7 +1277,7 @@ async def faq_answer_callback(callback: types.CallbackQuery):
         faq_list = cache_manager.cache.get(cache_key)
         
         if faq_list is None:
-            faq_list = database.get_faq()
+            faq_list = await adb.get_faq()
             cache_manager.cache.set(cache_key, faq_list, ttl=600)
         
         answer_text = "Пожалуйста, задайте этот вопрос оператору."
@@ -1305,7 +1312,7 @@ async def reviews_callback(callback: types.CallbackQuery):
 
 async def show_reviews_handler(user_id: int, bot):
     """Показ отзывов - САМЫЕ СВЕЖИЕ ПЕРВЫМИ"""
-    database.log_action(user_id, "view_reviews")
+    action_log.log(user_id, "view_reviews")
     
     cache_key = f"reviews_{user_id}"
     cached_text = cache_manager.cache.get(cache_key)
@@ -1424,7 +1431,7 @@ async def send_private_event_application_to_admin(user_id: int, bot, event_type:
     """Отправка СРОЧНОЙ заявки на частное мероприятие администратору"""
     try:
         # Получаем данные пользователя
-        user_data = database.get_user_complete_data(user_id)
+        user_data = await adb.get_user_complete_data(user_id)
         name = user_data.get('name', 'Не указано') if user_data else 'Не указано'
         phone = user_data.get('phone', 'Не указано') if user_data else 'Не указано'
         
@@ -1486,13 +1493,13 @@ async def show_main_menu_after_private_event_callback(callback: types.CallbackQu
         # Отправляем основное меню (PDF)
         menu_path = "files/menu/Menu.pdf"
         if os.path.exists(menu_path):
-            with open(menu_path, 'rb') as menu_file:
-                await callback.bot.send_document(
-                    callback.from_user.id,
-                    BufferedInputFile(menu_file.read(), filename="Основное_меню.pdf"),
-                    caption="📋 <b>Основное меню ресторана Mashkov</b>\n\nВот наше полное меню с актуальными ценами!",
-                    parse_mode="HTML"
-                )
+            await media_registry.send_document(
+                callback.bot,
+                callback.from_user.id,
+                FSInputFile(menu_path, filename="Основное_меню.pdf"),
+                caption="📋 <b>Основное меню ресторана Mashkov</b>\n\nВот наше полное меню с актуальными ценами!",
+                parse_mode="HTML"
+            )
         else:
             await callback.bot.send_message(
                 callback.from_user.id,
@@ -1521,13 +1528,13 @@ async def show_banquet_menu_after_private_event_callback(callback: types.Callbac
         # Отправляем банкетное меню (Excel)
         banquet_menu_path = "files/menu/MenuBanket.xlsx"
         if os.path.exists(banquet_menu_path):
-            with open(banquet_menu_path, 'rb') as banquet_file:
-                await callback.bot.send_document(
-                    callback.from_user.id,
-                    BufferedInputFile(banquet_file.read(), filename="Банкетное_меню.xlsx"),
-                    caption="🍾 <b>Банкетное меню ресторана Mashkov</b>\n\nСпециальные предложения для торжественных мероприятий!",
-                    parse_mode="HTML"
-                )
+            await media_registry.send_document(
+                callback.bot,
+                callback.from_user.id,
+                FSInputFile(banquet_menu_path, filename="Банкетное_меню.xlsx"),
+                caption="🍾 <b>Банкетное меню ресторана Mashkov</b>\n\nСпециальные предложения для торжественных мероприятий!",
+                parse_mode="HTML"
+            )
         else:
             await callback.bot.send_message(
                 callback.from_user.id,
@@ -1556,24 +1563,24 @@ async def show_both_menus_after_private_event_callback(callback: types.CallbackQ
         # Отправляем основное меню (PDF)
         menu_path = "files/menu/Menu.pdf"
         if os.path.exists(menu_path):
-            with open(menu_path, 'rb') as menu_file:
-                await callback.bot.send_document(
-                    callback.from_user.id,
-                    BufferedInputFile(menu_file.read(), filename="Основное_меню.pdf"),
-                    caption="📋 <b>Основное меню ресторана Mashkov</b>",
-                    parse_mode="HTML"
-                )
+            await media_registry.send_document(
+                callback.bot,
+                callback.from_user.id,
+                FSInputFile(menu_path, filename="Основное_меню.pdf"),
+                caption="📋 <b>Основное меню ресторана Mashkov</b>",
+                parse_mode="HTML"
+            )
         
         # Отправляем банкетное меню (Excel)
         banquet_menu_path = "files/menu/MenuBanket.xlsx"
         if os.path.exists(banquet_menu_path):
-            with open(banquet_menu_path, 'rb') as banquet_file:
-                await callback.bot.send_document(
-                    callback.from_user.id,
-                    BufferedInputFile(banquet_file.read(), filename="Банкетное_меню.xlsx"),
-                    caption="🍾 <b>Банкетное меню ресторана Mashkov</b>\n\nСпециальные предложения для торжественных мероприятий!",
-                    parse_mode="HTML"
-                )
+            await media_registry.send_document(
+                callback.bot,
+                callback.from_user.id,
+                FSInputFile(banquet_menu_path, filename="Банкетное_меню.xlsx"),
+                caption="🍾 <b>Банкетное меню ресторана Mashkov</b>\n\nСпециальные предложения для торжественных мероприятий!",
+                parse_mode="HTML"
+            )
         
         # Редактируем исходное сообщение
         await callback.message.edit_text(
@@ -1868,7 +1875,7 @@ async def send_event_application_to_admin(user_id: int, bot):
     """Отправка заявки на мероприятие администратору для зарегистрированного пользователя"""
     try:
         # Получаем данные пользователя
-        user_data = database.get_user_complete_data(user_id)
+        user_data = await adb.get_user_complete_data(user_id)
         name = user_data.get('name', 'Не указано') if user_data else 'Не указано'
         phone = user_data.get('phone', 'Не указано') if user_data else 'Не указано'
         
@@ -2121,37 +2128,37 @@ async def show_hall_photos(user_id: int, bot):
                     if file_size > 10 * 1024 * 1024:  # 10MB limit
                         logger.warning(f"Файл {photo_path} слишком большой ({file_size / (1024*1024):.1f}MB), отправляем как документ")
                         # Отправляем как документ
-                        with open(photo_path, 'rb') as photo:
-                            await bot.send_document(
+                        await media_registry.send_document(
+                            bot,
+                            user_id,
+                            FSInputFile(photo_path, filename=f"hall_{i+1}.jpg"),
+                            caption=f"🏛️ <b>Наш уютный зал</b> ({i+1}/{len(hall_photos)})" if i == 0 else f"🏛️ <b>Фото зала</b> ({i+1}/{len(hall_photos)})",
+                            parse_mode="HTML"
+                        )
+                        photos_sent += 1
+                    else:
+                        try:
+                            caption = f"🏛️ <b>Наш уютный зал</b> ({i+1}/{len(hall_photos)})" if i == 0 else None
+                            await media_registry.send_photo(
+                                bot,
                                 user_id,
-                                BufferedInputFile(photo.read(), filename=f"hall_{i+1}.jpg"),
-                                caption=f"🏛️ <b>Наш уютный зал</b> ({i+1}/{len(hall_photos)})" if i == 0 else f"🏛️ <b>Фото зала</b> ({i+1}/{len(hall_photos)})",
+                                FSInputFile(photo_path, filename=f"hall_{i+1}.jpg"),
+                                caption=caption,
                                 parse_mode="HTML"
                             )
                             photos_sent += 1
-                    else:
-                        try:
-                            with open(photo_path, 'rb') as photo:
-                                caption = f"🏛️ <b>Наш уютный зал</b> ({i+1}/{len(hall_photos)})" if i == 0 else None
-                                await bot.send_photo(
-                                    user_id,
-                                    BufferedInputFile(photo.read(), filename=f"hall_{i+1}.jpg"),
-                                    caption=caption,
-                                    parse_mode="HTML"
-                                )
-                                photos_sent += 1
                         except Exception as photo_send_error:
                             # Если не удалось отправить как фото (например, PHOTO_INVALID_DIMENSIONS), отправляем как документ
                             logger.warning(f"Не удалось отправить {photo_path} как фото ({photo_send_error}), отправляем как документ")
                             try:
-                                with open(photo_path, 'rb') as photo:
-                                    await bot.send_document(
-                                        user_id,
-                                        BufferedInputFile(photo.read(), filename=f"hall_{i+1}.jpg"),
-                                        caption=f"🏛️ <b>Наш уютный зал</b> ({i+1}/{len(hall_photos)})" if i == 0 else f"🏛️ <b>Фото зала</b> ({i+1}/{len(hall_photos)})",
-                                        parse_mode="HTML"
-                                    )
-                                    photos_sent += 1
+                                await media_registry.send_document(
+                                    bot,
+                                    user_id,
+                                    FSInputFile(photo_path, filename=f"hall_{i+1}.jpg"),
+                                    caption=f"🏛️ <b>Наш уютный зал</b> ({i+1}/{len(hall_photos)})" if i == 0 else f"🏛️ <b>Фото зала</b> ({i+1}/{len(hall_photos)})",
+                                    parse_mode="HTML"
+                                )
+                                photos_sent += 1
                             except Exception as doc_error:
                                 logger.error(f"Не удалось отправить {photo_path} даже как документ: {doc_error}")
                     
@@ -2198,14 +2205,14 @@ async def show_bar_photos(user_id: int, bot):
         
         for i, photo_path in enumerate(bar_photos):
             if os.path.exists(photo_path):
-                with open(photo_path, 'rb') as photo:
-                    caption = f"🍸 <b>Наш стильный бар</b> ({i+1}/{len(bar_photos)})" if i == 0 else None
-                    await bot.send_photo(
-                        user_id,
-                        BufferedInputFile(photo.read(), filename=f"bar_{i+1}.jpg"),
-                        caption=caption,
-                        parse_mode="HTML"
-                    )
+                caption = f"🍸 <b>Наш стильный бар</b> ({i+1}/{len(bar_photos)})" if i == 0 else None
+                await media_registry.send_photo(
+                    bot,
+                    user_id,
+                    FSInputFile(photo_path, filename=f"bar_{i+1}.jpg"),
+                    caption=caption,
+                    parse_mode="HTML"
+                )
         
         # Отправляем сообщение с кнопкой назад
         text = "🍸 Вот наш стильный бар! Здесь вы можете насладиться широким выбором напитков и коктейлей."
@@ -2243,36 +2250,36 @@ async def show_kassa_photos(user_id: int, bot):
                     
                     if file_size > 10 * 1024 * 1024:  # 10MB limit
                         logger.warning(f"Файл {photo_path} слишком большой ({file_size / (1024*1024):.1f}MB), отправляем как документ")
-                        with open(photo_path, 'rb') as photo:
-                            await bot.send_document(
+                        await media_registry.send_document(
+                            bot,
+                            user_id,
+                            FSInputFile(photo_path, filename=f"kassa_{i+1}.jpg"),
+                            caption=f"💳 <b>Наша касса</b> ({i+1}/{len(kassa_photos)})" if i == 0 else f"💳 <b>Фото кассы</b> ({i+1}/{len(kassa_photos)})",
+                            parse_mode="HTML"
+                        )
+                        photos_sent += 1
+                    else:
+                        try:
+                            caption = f"💳 <b>Наша касса</b> ({i+1}/{len(kassa_photos)})" if i == 0 else None
+                            await media_registry.send_photo(
+                                bot,
                                 user_id,
-                                BufferedInputFile(photo.read(), filename=f"kassa_{i+1}.jpg"),
-                                caption=f"💳 <b>Наша касса</b> ({i+1}/{len(kassa_photos)})" if i == 0 else f"💳 <b>Фото кассы</b> ({i+1}/{len(kassa_photos)})",
+                                FSInputFile(photo_path, filename=f"kassa_{i+1}.jpg"),
+                                caption=caption,
                                 parse_mode="HTML"
                             )
                             photos_sent += 1
-                    else:
-                        try:
-                            with open(photo_path, 'rb') as photo:
-                                caption = f"💳 <b>Наша касса</b> ({i+1}/{len(kassa_photos)})" if i == 0 else None
-                                await bot.send_photo(
+                        except Exception as photo_send_error:
+                            logger.warning(f"Не удалось отправить {photo_path} как фото ({photo_send_error}), отправляем как документ")
+                            try:
+                                await media_registry.send_document(
+                                    bot,
                                     user_id,
-                                    BufferedInputFile(photo.read(), filename=f"kassa_{i+1}.jpg"),
-                                    caption=caption,
+                                    FSInputFile(photo_path, filename=f"kassa_{i+1}.jpg"),
+                                    caption=f"💳 <b>Наша касса</b> ({i+1}/{len(kassa_photos)})" if i == 0 else f"💳 <b>Фото кассы</b> ({i+1}/{len(kassa_photos)})",
                                     parse_mode="HTML"
                                 )
                                 photos_sent += 1
-                        except Exception as photo_send_error:
-                            logger.warning(f"Не удалось отправить {photo_path} как фото ({photo_send_error}), отправляем как документ")
-                            try:
-                                with open(photo_path, 'rb') as photo:
-                                    await bot.send_document(
-                                        user_id,
-                                        BufferedInputFile(photo.read(), filename=f"kassa_{i+1}.jpg"),
-                                        caption=f"💳 <b>Наша касса</b> ({i+1}/{len(kassa_photos)})" if i == 0 else f"💳 <b>Фото кассы</b> ({i+1}/{len(kassa_photos)})",
-                                        parse_mode="HTML"
-                                    )
-                                    photos_sent += 1
                             except Exception as doc_error:
                                 logger.error(f"Не удалось отправить {photo_path} даже как документ: {doc_error}")
                     
@@ -2327,36 +2334,36 @@ async def show_wc_photos(user_id: int, bot):
                     
                     if file_size > 10 * 1024 * 1024:  # 10MB limit
                         logger.warning(f"Файл {photo_path} слишком большой ({file_size / (1024*1024):.1f}MB), отправляем как документ")
-                        with open(photo_path, 'rb') as photo:
-                            await bot.send_document(
+                        await media_registry.send_document(
+                            bot,
+                            user_id,
+                            FSInputFile(photo_path, filename=f"wc_{i+1}.jpg"),
+                            caption=f"🚻 <b>Наш туалет</b> ({i+1}/{len(wc_photos)})" if i == 0 else f"🚻 <b>Фото туалета</b> ({i+1}/{len(wc_photos)})",
+                            parse_mode="HTML"
+                        )
+                        photos_sent += 1
+                    else:
+                        try:
+                            caption = f"🚻 <b>Наш туалет</b> ({i+1}/{len(wc_photos)})" if i == 0 else None
+                            await media_registry.send_photo(
+                                bot,
                                 user_id,
-                                BufferedInputFile(photo.read(), filename=f"wc_{i+1}.jpg"),
-                                caption=f"🚻 <b>Наш туалет</b> ({i+1}/{len(wc_photos)})" if i == 0 else f"🚻 <b>Фото туалета</b> ({i+1}/{len(wc_photos)})",
+                                FSInputFile(photo_path, filename=f"wc_{i+1}.jpg"),
+                                caption=caption,
                                 parse_mode="HTML"
                             )
                             photos_sent += 1
-                    else:
-                        try:
-                            with open(photo_path, 'rb') as photo:
-                                caption = f"🚻 <b>Наш туалет</b> ({i+1}/{len(wc_photos)})" if i == 0 else None
-                                await bot.send_photo(
+                        except Exception as photo_send_error:
+                            logger.warning(f"Не удалось отправить {photo_path} как фото ({photo_send_error}), отправляем как документ")
+                            try:
+                                await media_registry.send_document(
+                                    bot,
                                     user_id,
-                                    BufferedInputFile(photo.read(), filename=f"wc_{i+1}.jpg"),
-                                    caption=caption,
+                                    FSInputFile(photo_path, filename=f"wc_{i+1}.jpg"),
+                                    caption=f"🚻 <b>Наш туалет</b> ({i+1}/{len(wc_photos)})" if i == 0 else f"🚻 <b>Фото туалета</b> ({i+1}/{len(wc_photos)})",
                                     parse_mode="HTML"
                                 )
                                 photos_sent += 1
-                        except Exception as photo_send_error:
-                            logger.warning(f"Не удалось отправить {photo_path} как фото ({photo_send_error}), отправляем как документ")
-                            try:
-                                with open(photo_path, 'rb') as photo:
-                                    await bot.send_document(
-                                        user_id,
-                                        BufferedInputFile(photo.read(), filename=f"wc_{i+1}.jpg"),
-                                        caption=f"🚻 <b>Наш туалет</b> ({i+1}/{len(wc_photos)})" if i == 0 else f"🚻 <b>Фото туалета</b> ({i+1}/{len(wc_photos)})",
-                                        parse_mode="HTML"
-                                    )
-                                    photos_sent += 1
                             except Exception as doc_error:
                                 logger.error(f"Не удалось отправить {photo_path} даже как документ: {doc_error}")
                     
@@ -2491,6 +2498,13 @@ async def our_app_callback(callback: types.CallbackQuery):
 
 # ===== ТЕКСТОВЫЙ ОБРАБОТЧИК =====
 
+# Ответы AI, после которых показывается не текст модели, а меню, фото и т.п.
+AI_NON_TEXT_RESULTS = (
+    'show_category', 'show_reviews', 'show_apps', 'show_hall_photos', 'show_bar_photos',
+    'show_kassa_photos', 'show_wc_photos', 'show_booking_options',
+    'show_private_event_registration', 'show_event_registration'
+)
+
 @router.message(F.text, StateFilter(None))
 async def handle_text_messages(message: types.Message, state: FSMContext):
     """Общий обработчик текстовых сообщений — ТОЛЬКО если нет активного состояния"""
@@ -2508,11 +2522,11 @@ async def handle_text_messages(message: types.Message, state: FSMContext):
 
     # Проверяем статус чата - если на паузе, сохраняем сообщение в миниапп и игнорируем
     try:
-        chat_id = database.get_or_create_chat(user.id, user.full_name or f'User {user.id}')
-        chat_info = database.get_chat_by_id(chat_id)
+        chat_id = await adb.get_or_create_chat(user.id, user.full_name or f'User {user.id}')
+        chat_info = await adb.get_chat_by_id(chat_id)
         if chat_info and chat_info.get('chat_status') == 'paused':
             # Сохраняем сообщение в миниапп
-            database.save_chat_message(chat_id, 'user', message.text)
+            await adb.save_chat_message(chat_id, 'user', message.text)
             logger.info(f"Сообщение пользователя {user.id} сохранено в миниапп (чат на паузе): {message.text[:50]}...")
 
             # Отправляем уведомление пользователю, что диалог на паузе
@@ -2629,9 +2643,9 @@ async def handle_text_messages(message: types.Message, state: FSMContext):
 
         # Сохраняем в чат для миниаппа
         try:
-            chat_id = database.get_or_create_chat(user.id, user.full_name or f'User {user.id}')
-            database.save_chat_message(chat_id, 'user', message.text)
-            database.save_chat_message(chat_id, 'bot', f'Распознал бронирование: {booking_details["guests"]} чел., {booking_details["date_str"]}, {booking_details["time_str"]}')
+            chat_id = await adb.get_or_create_chat(user.id, user.full_name or f'User {user.id}')
+            await adb.save_chat_message(chat_id, 'user', message.text)
+            await adb.save_chat_message(chat_id, 'bot', f'Распознал бронирование: {booking_details["guests"]} чел., {booking_details["date_str"]}, {booking_details["time_str"]}')
         except Exception as e:
             logger.error(f"Ошибка сохранения в миниапп: {e}")
 
@@ -2643,9 +2657,9 @@ async def handle_text_messages(message: types.Message, state: FSMContext):
 
         # Сохраняем в чат для миниаппа
         try:
-            chat_id = database.get_or_create_chat(user.id, user.full_name or f'User {user.id}')
-            database.save_chat_message(chat_id, 'user', message.text)
-            database.save_chat_message(chat_id, 'bot', 'Показал меню бронирования')
+            chat_id = await adb.get_or_create_chat(user.id, user.full_name or f'User {user.id}')
+            await adb.save_chat_message(chat_id, 'user', message.text)
+            await adb.save_chat_message(chat_id, 'bot', 'Показал меню бронирования')
         except Exception as e:
             logger.error(f"Ошибка сохранения в миниапп: {e}")
 
@@ -2675,9 +2689,9 @@ async def handle_text_messages(message: types.Message, state: FSMContext):
 
         # Сохраняем в чат
         try:
-            chat_id = database.get_or_create_chat(user.id, user.full_name or f'User {user.id}')
-            database.save_chat_message(chat_id, 'user', message.text)
-            database.save_chat_message(chat_id, 'bot', 'Показал диалог подтверждения возраста')
+            chat_id = await adb.get_or_create_chat(user.id, user.full_name or f'User {user.id}')
+            await adb.save_chat_message(chat_id, 'user', message.text)
+            await adb.save_chat_message(chat_id, 'bot', 'Показал диалог подтверждения возраста')
         except Exception as e:
             logger.error(f"Ошибка сохранения в миниапп: {e}")
 
@@ -2686,10 +2700,10 @@ async def handle_text_messages(message: types.Message, state: FSMContext):
     # Всегда сохраняем сообщения пользователей в базу данных для миниаппа
     try:
         # Создаем/получаем чат для пользователя
-        chat_id = database.get_or_create_chat(user.id, user.full_name or f'User {user.id}')
+        chat_id = await adb.get_or_create_chat(user.id, user.full_name or f'User {user.id}')
 
         # Сохраняем сообщение пользователя
-        database.save_chat_message(chat_id, 'user', message.text)
+        await adb.save_chat_message(chat_id, 'user', message.text)
 
         logger.info(f"Сообщение пользователя {user.id} сохранено в миниапп: {message.text[:50]}...")
 
@@ -2741,11 +2755,16 @@ async def handle_text_messages(message: types.Message, state: FSMContext):
     except Exception as e:
         logger.debug(f"Ошибка в обработчике операторского чата: {e}")
 
-    # Если ничего не найдено - используем AI
+    # Если ничего не найдено - используем AI (ответ показывается по мере генерации)
+    draft = StreamingReply(message.bot, user.id)
     try:
         async with typing_indicator(message.bot, user.id):
             from ai_assistant import get_ai_response
-            result = await get_ai_response(message.text, user.id)
+            result = await get_ai_response(message.text, user.id, on_partial=draft.update)
+
+        # Черновик остается, только если ответом будет текст модели
+        if result['type'] != 'text' or any(result.get(key) for key in AI_NON_TEXT_RESULTS):
+            await draft.discard()
 
         # Проверяем на показ категории
         if result.get('show_category'):
@@ -2756,8 +2775,8 @@ async def handle_text_messages(message: types.Message, state: FSMContext):
 
             # Сохраняем в чат
             try:
-                chat_id = database.get_or_create_chat(user.id, user.full_name or f'User {user.id}')
-                database.save_chat_message(chat_id, 'bot', f'Показал категорию: {category_name}')
+                chat_id = await adb.get_or_create_chat(user.id, user.full_name or f'User {user.id}')
+                await adb.save_chat_message(chat_id, 'bot', f'Показал категорию: {category_name}')
             except Exception as e:
                 logger.error(f"Ошибка сохранения в миниапп: {e}")
 
@@ -2798,11 +2817,11 @@ async def handle_text_messages(message: types.Message, state: FSMContext):
         if result.get('show_restaurant_menu'):
             logger.info(f"Обрабатываем show_restaurant_menu для пользователя {user_id}")
             # Сначала отправляем ответ AI
-            await safe_send_message(message.bot, user_id, result['text'])
+            await draft.finish(result['text'])
             # Сохраняем ответ бота
             try:
-                chat_id = database.get_or_create_chat(user.id, user.full_name or f'User {user.id}')
-                database.save_chat_message(chat_id, 'bot', result['text'])
+                chat_id = await adb.get_or_create_chat(user.id, user.full_name or f'User {user.id}')
+                await adb.save_chat_message(chat_id, 'bot', result['text'])
             except Exception as e:
                 logger.error(f"Ошибка сохранения ответа бота: {e}")
             # Затем показываем меню ресторана
@@ -2811,11 +2830,11 @@ async def handle_text_messages(message: types.Message, state: FSMContext):
 
         # Проверяем на парсинг бронирования
         if result.get('parse_booking'):
-            await safe_send_message(message.bot, user_id, result['text'])
+            await draft.finish(result['text'])
             # Сохраняем ответ бота
             try:
-                chat_id = database.get_or_create_chat(user.id, user.full_name or f'User {user.id}')
-                database.save_chat_message(chat_id, 'bot', result['text'])
+                chat_id = await adb.get_or_create_chat(user.id, user.full_name or f'User {user.id}')
+                await adb.save_chat_message(chat_id, 'bot', result['text'])
             except Exception as e:
                 logger.error(f"Ошибка сохранения ответа бота: {e}")
             
@@ -2853,19 +2872,19 @@ async def handle_text_messages(message: types.Message, state: FSMContext):
                     [types.InlineKeyboardButton(text="🤖 Google Play", url=config.APP_ANDROID)],
                     [types.InlineKeyboardButton(text="🟦 RuStore", url=config.APP_RUSTORE)]
                 ])
-                await safe_send_message(message.bot, user.id, result['text'], reply_markup=keyboard, parse_mode="HTML")
+                await draft.finish(result['text'], reply_markup=keyboard, parse_mode="HTML")
             elif result.get('show_delivery_button', False):
                 keyboard = types.InlineKeyboardMarkup(inline_keyboard=[
                     [types.InlineKeyboardButton(text="🚚 Заказать доставку", web_app=types.WebAppInfo(url="https://strdr1.github.io/mashkov-telegram-app/"))]
                 ])
-                await safe_send_message(message.bot, user.id, result['text'], reply_markup=keyboard, parse_mode="HTML")
+                await draft.finish(result['text'], reply_markup=keyboard, parse_mode="HTML")
             else:
-                await safe_send_message(message.bot, user.id, result['text'])
+                await draft.finish(result['text'])
 
             # Сохраняем ответ бота
             try:
-                chat_id = database.get_or_create_chat(user.id, user.full_name or f'User {user.id}')
-                database.save_chat_message(chat_id, 'bot', result['text'])
+                chat_id = await adb.get_or_create_chat(user.id, user.full_name or f'User {user.id}')
+                await adb.save_chat_message(chat_id, 'bot', result['text'])
             except Exception as e:
                 logger.error(f"Ошибка сохранения ответа бота: {e}")
 
@@ -2889,13 +2908,14 @@ async def handle_text_messages(message: types.Message, state: FSMContext):
 
             # Сохраняем ответ бота
             try:
-                chat_id = database.get_or_create_chat(user.id, user.full_name or f'User {user.id}')
-                database.save_chat_message(chat_id, 'bot', result['text'])
+                chat_id = await adb.get_or_create_chat(user.id, user.full_name or f'User {user.id}')
+                await adb.save_chat_message(chat_id, 'bot', result['text'])
             except Exception as e:
                 logger.error(f"Ошибка сохранения ответа бота: {e}")
 
     except Exception as e:
         logger.error(f"Ошибка AI: {e}")
+        await draft.discard()
         text_response = """🤖 <b>Я не понял ваш запрос</b>
 
 Используйте кнопки меню ниже или задайте вопрос оператору."""
@@ -2905,8 +2925,8 @@ async def handle_text_messages(message: types.Message, state: FSMContext):
 
         # Сохраняем ошибочный ответ бота
         try:
-            chat_id = database.get_or_create_chat(user.id, user.full_name or f'User {user.id}')
-            database.save_chat_message(chat_id, 'bot', text_response)
+            chat_id = await adb.get_or_create_chat(user.id, user.full_name or f'User {user.id}')
+            await adb.save_chat_message(chat_id, 'bot', text_response)
         except Exception as e:
             logger.error(f"Ошибка сохранения ошибочного ответа бота: {e}")
 
@@ -3161,7 +3181,7 @@ async def process_direct_booking_request(user_id: int, bot, booking_details: dic
         from_date = dt_obj.replace(day=1).strftime("%d.%m.%Y")
         to_date = (dt_obj.replace(day=1) + timedelta(days=62)).replace(day=1).strftime("%d.%m.%Y")
 
-        calendar_data = get_booking_calendar(from_date, to_date)
+        calendar_data = await get_booking_calendar(from_date, to_date)
         if calendar_data and calendar_data.get("dates"):
             await state.update_data(presto_calendar=calendar_data)
         else:
@@ -3186,7 +3206,7 @@ async def process_direct_booking_request(user_id: int, bot, booking_details: dic
         from presto_api_booking import get_available_tables, get_hall_tables
 
         datetime_api = f"{api_date} {booking_details['time']}:00"
-        available_tables = get_available_tables(datetime_api, booking_details['guests'])
+        available_tables = await get_available_tables(datetime_api, booking_details['guests'])
 
         from .handlers_booking import filter_tables_by_guests
         filtered_tables = filter_tables_by_guests(available_tables, booking_details['guests'])
@@ -3204,7 +3224,7 @@ async def process_direct_booking_request(user_id: int, bot, booking_details: dic
         )
 
         # Получаем информацию о зале для генерации схемы
-        hall_data = get_hall_tables(datetime_api)
+        hall_data = await get_hall_tables(datetime_api)
         if hall_data and isinstance(hall_data, dict) and hall_data.get("halls"):
             # hall_data["halls"] может быть списком или словарём
             halls = hall_data["halls"]
@@ -3221,22 +3241,19 @@ async def process_direct_booking_request(user_id: int, bot, booking_details: dic
             await state.update_data(hall_id=int(hall_id))
 
             # Генерируем схему зала
-            from .handlers_booking import generate_hall_schema, _schema_message_id
+            from .handlers_booking import hall_schema_photo, _schema_message_id
+            from hall_schema import hall_schema_cache
 
-            schema_id = f"direct_booking_{user_id}_{int(datetime.now().timestamp())}"
-            image_path, free_table_ids = generate_hall_schema(
+            schema = await hall_schema_cache.render(
                 hall_data,
                 booking_details['guests'],
-                schema_id,
                 booking_details['date_str'],
                 booking_details['time_str']
             )
 
-            if image_path and os.path.exists(image_path):
+            if schema:
                 try:
-                    from aiogram.types import FSInputFile
-
-                    photo = FSInputFile(image_path)
+                    photo = hall_schema_photo(schema)
 
                     # Создаем кнопки выбора столиков
                     from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
@@ -3281,6 +3298,8 @@ async def process_direct_booking_request(user_id: int, bot, booking_details: dic
                     )
 
                     _schema_message_id = sent_message.message_id
+                    if sent_message.photo:
+                        hall_schema_cache.remember_file_id(schema['key'], sent_message.photo[-1].file_id)
                     await state.set_state(BookingStates.waiting_for_table)
 
                     logger.info(f"Показал схему столов для прямой брони: {user_id}")
@@ -6,6 +6,7 @@ from aiogram import Router, F, types
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
 import database
+from async_db import adb
 import keyboards
 import re
 import asyncio
@@ -77,7 +78,7 @@ async def personal_cabinet_handler(callback: types.CallbackQuery, state: FSMCont
         await register_or_login_handler(callback, state)
         return
     
-    user_data = database.get_user_complete_data(user_id)
+    user_data = await adb.get_user_complete_data(user_id)
     
     if not user_data:
         await callback.answer("❌ Ошибка загрузки данных", show_alert=True)
@@ -135,7 +136,7 @@ async def change_phone_handler(callback: types.CallbackQuery, state: FSMContext)
     await callback.answer()
     
     user_id = callback.from_user.id
-    user_data = database.get_user_data(user_id)
+    user_data = await adb.get_user_data(user_id)
     
     text = f"""📱 <b>Изменение телефона</b>
 
@@ -179,7 +180,7 @@ async def process_new_phone(message: types.Message, state: FSMContext):
     elif not clean_phone.startswith('+'):
         clean_phone = '+7' + clean_phone
     
-    success = database.update_user_phone(user_id, clean_phone)
+    success = await adb.update_user_phone(user_id, clean_phone)
     
     if success:
         # Получаем новый UUID
@@ -204,7 +205,7 @@ async def change_name_handler(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
     
     user_id = callback.from_user.id
-    user_data = database.get_user_data(user_id)
+    user_data = await adb.get_user_data(user_id)
     
     text = f"""👤 <b>Изменение имени</b>
 
@@ -239,7 +240,7 @@ async def process_new_name(message: types.Message, state: FSMContext):
         await message.answer("❌ Имя слишком короткое.")
         return
     
-    success = database.update_user_name(user_id, new_name)
+    success = await adb.update_user_name(user_id, new_name)
     
     if success:
         text = f"""✅ <b>Имя успешно обновлено!</b>
@@ -5,6 +5,8 @@ from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardRemove, BufferedInputFile
 import database
+from async_db import adb
+from action_log import action_log
 import re
 import asyncio
 import logging
@@ -106,7 +108,7 @@ async def ask_for_registration_phone(user_id: int, bot, context: str = "general"
         _add_registration_message(user_id, msg.message_id)
     
     # Логируем начало регистрации
-    database.log_action(user_id, "registration_started", context)
+    action_log.log(user_id, "registration_started", context)
 
 @router.message(F.contact)
 async def handle_contact(message: types.Message, state: FSMContext):
@@ -288,10 +290,10 @@ async def handle_name_input(message: types.Message, state: FSMContext):
     context = data.get('context', 'general')
     
     # ВАЖНО: Сначала создаем/обновляем пользователя в БД
-    database.add_or_update_user(user.id, user.username, user.full_name)
+    await adb.add_or_update_user(user.id, user.username, user.full_name)
     
-    database.update_user_phone(user.id, phone)
-    database.update_user_name(user.id, text, accept_agreement=agreement_accepted)
+    await adb.update_user_phone(user.id, phone)
+    await adb.update_user_name(user.id, text, accept_agreement=agreement_accepted)
     clear_user_cache(user.id)
 
     # Отправляем сообщение о завершении регистрации
@@ -341,10 +343,10 @@ async def confirm_name_callback(callback: types.CallbackQuery, state: FSMContext
     context = data.get('context', 'general')
     
     # ВАЖНО: Сначала создаем/обновляем пользователя в БД
-    database.add_or_update_user(callback.from_user.id, callback.from_user.username, callback.from_user.full_name)
+    await adb.add_or_update_user(callback.from_user.id, callback.from_user.username, callback.from_user.full_name)
     
-    database.update_user_phone(callback.from_user.id, phone)
-    database.update_user_name(callback.from_user.id, user_name, accept_agreement=agreement_accepted)
+    await adb.update_user_phone(callback.from_user.id, phone)
+    await adb.update_user_name(callback.from_user.id, user_name, accept_agreement=agreement_accepted)
     clear_user_cache(callback.from_user.id)
 
     # Отправляем сообщение о завершении регистрации
@@ -726,7 +728,7 @@ async def send_event_application_to_admin(user_id: int, bot, name: str = None, p
     try:
         # Получаем данные пользователя если не переданы
         if not name or not phone:
-            user_data = database.get_user_complete_data(user_id)
+            user_data = await adb.get_user_complete_data(user_id)
             if user_data:
                 name = name or user_data.get('name', 'Не указано')
                 phone = phone or user_data.get('phone', 'Не указано')
@@ -8,10 +8,13 @@ from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter, Telegra
 import asyncio
 import aiohttp
 import logging
+import time
 from typing import Optional
 import database
+from async_db import adb
 import config
 import cache_manager
+from rate_limiter import telegram_limiter
 from datetime import datetime
 from functools import wraps
 from aiogram import BaseMiddleware
@@ -74,9 +77,10 @@ class TimeoutMiddleware(BaseMiddleware):
 # ===== УТИЛИТЫ С ЗАЩИТОЙ ОТ ТАЙМАУТОВ =====
 
 async def safe_send_message(bot, chat_id: int, text: str, **kwargs) -> Optional[types.Message]:
-    """Безопасная отправка сообщения с повторными попытками"""
+    """Безопасная отправка сообщения с повторными попытками (под общим лимитом Telegram)"""
     for attempt in range(config.MAX_RETRIES):
         try:
+            await telegram_limiter.acquire(chat_id)
             async with asyncio.timeout(config.MESSAGE_TIMEOUT):
                 return await bot.send_message(chat_id=chat_id, text=text, **kwargs)
         except asyncio.TimeoutError:
@@ -85,7 +89,8 @@ async def safe_send_message(bot, chat_id: int, text: str, **kwargs) -> Optional[
                 return None
             await asyncio.sleep(config.RETRY_DELAY)
         except TelegramRetryAfter as e:
-            await asyncio.sleep(e.retry_after)
+            # Следующий acquire дождется конца паузы, как и остальные отправки в этот чат
+            telegram_limiter.pause(e.retry_after, chat_id)
             continue
         except (TelegramNetworkError, aiohttp.ClientError, aiohttp.ClientOSError, OSError) as e:
             if attempt == config.MAX_RETRIES - 1:
@@ -101,9 +106,10 @@ async def safe_send_message(bot, chat_id: int, text: str, **kwargs) -> Optional[
     return None
 
 async def safe_edit_message(bot, chat_id: int, message_id: int, text: str, **kwargs) -> bool:
-    """Безопасное редактирование сообщения"""
+    """Безопасное редактирование сообщения (под общим лимитом Telegram)"""
     for attempt in range(config.MAX_RETRIES):
         try:
+            await telegram_limiter.acquire(chat_id)
             async with asyncio.timeout(config.MESSAGE_TIMEOUT):
                 await bot.edit_message_text(
                     chat_id=chat_id,
@@ -118,7 +124,8 @@ async def safe_edit_message(bot, chat_id: int, message_id: int, text: str, **kwa
                 return False
             await asyncio.sleep(config.RETRY_DELAY)
         except TelegramRetryAfter as e:
-            await asyncio.sleep(e.retry_after)
+            # Следующий acquire дождется конца паузы, как и остальные отправки в этот чат
+            telegram_limiter.pause(e.retry_after, chat_id)
             continue
         except TelegramBadRequest as e:
             error_str = str(e)
@@ -146,6 +153,7 @@ async def safe_edit_message(bot, chat_id: int, message_id: int, text: str, **kwa
 async def safe_delete_message(bot, chat_id: int, message_id: int) -> bool:
     """Безопасное удаление сообщения"""
     try:
+        await telegram_limiter.acquire(chat_id)
         async with asyncio.timeout(5):
             await bot.delete_message(chat_id, message_id)
             return True
@@ -293,7 +301,7 @@ async def send_order_notification(user_id: int, order_text: str, bot):
             user_display = f"Пользователь ID: {user_id}"
         
         # Получаем данные пользователя из БД
-        user_data = database.get_user_data(user_id)
+        user_data = await adb.get_user_data(user_id)
         user_phone = user_data.get('phone', 'Не указан') if user_data else 'Не указан'
         
         # Получаем всех админов
@@ -403,4 +411,101 @@ async def typing_indicator(bot, chat_id: int):
             try:
                 await typing_task
             except asyncio.CancelledError:
-                pass
\ No newline at end of file
+                pass
+
+# ===== ПОТОКОВЫЙ ОТВЕТ AI =====
+
+# Черновик показывается, когда модель написала хотя бы столько символов
+STREAM_MIN_CHARS = 20
+
+class StreamingReply:
+    """
+    Ответ AI, который показывается по мере генерации.
+
+    Первый фрагмент отправляется новым сообщением, дальше оно редактируется
+    не чаще раза в AI_STREAM_EDIT_INTERVAL секунд (черновик - без разметки,
+    HTML может быть недописан). finish() заменяет черновик окончательным
+    ответом, discard() удаляет его, если ответ будет показан иначе.
+    """
+
+    def __init__(self, bot, chat_id: int, interval: float = config.AI_STREAM_EDIT_INTERVAL):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.interval = interval
+        self.message_id: Optional[int] = None
+        self._text = ''
+        self._shown = ''
+        self._last_update = 0.0
+        self._task: Optional[asyncio.Task] = None
+        self._in_flight = False
+        self._closed = False
+
+    async def update(self, text: str):
+        """Новый текст черновика (отправка идет в фоне, поток ответа не ждет Telegram)"""
+        if self._closed or len(text) < STREAM_MIN_CHARS:
+            return
+        self._text = text
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush())
+
+    async def _flush(self):
+        delay = self.interval - (time.monotonic() - self._last_update)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        text = self._text[:4096]
+        if self._closed or text == self._shown:
+            return
+        try:
+            await telegram_limiter.acquire(self.chat_id)
+            self._in_flight = True
+            if self.message_id is None:
+                message = await self.bot.send_message(chat_id=self.chat_id, text=text, parse_mode=None)
+                self.message_id = message.message_id
+            else:
+                await self.bot.edit_message_text(text=text, chat_id=self.chat_id,
+                                                 message_id=self.message_id, parse_mode=None)
+            self._shown = text
+        except Exception as e:
+            logger.debug(f"Не удалось обновить черновик ответа для {self.chat_id}: {e}")
+        finally:
+            self._in_flight = False
+        self._last_update = time.monotonic()
+
+    async def _stop(self):
+        self._closed = True
+        if self._task and not self._task.done():
+            if self._in_flight:
+                # Запрос уже ушел в Telegram - дожидаемся message_id, иначе finish() пришлет ответ второй раз
+                await asyncio.shield(self._task)
+                return
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+    async def finish(self, text: str, **kwargs) -> Optional[types.Message]:
+        """Показать окончательный ответ: в черновике, если он есть, иначе новым сообщением"""
+        await self._stop()
+        if self.message_id is not None:
+            try:
+                return await self.bot.edit_message_text(text=text, chat_id=self.chat_id,
+                                                        message_id=self.message_id, **kwargs)
+            except TelegramBadRequest as e:
+                if 'not modified' in str(e):
+                    if kwargs.get('reply_markup'):
+                        await self.bot.edit_message_reply_markup(chat_id=self.chat_id, message_id=self.message_id,
+                                                                 reply_markup=kwargs['reply_markup'])
+                    return None
+                logger.warning(f"⚠️ Не удалось заменить черновик ответа для {self.chat_id}: {e}")
+            except Exception as e:
+                logger.warning(f"⚠️ Не удалось заменить черновик ответа для {self.chat_id}: {e}")
+            await self.discard()
+        return await safe_send_message(self.bot, self.chat_id, text, **kwargs)
+
+    async def discard(self):
+        """Удалить черновик"""
+        await self._stop()
+        if self.message_id is not None:
+            await safe_delete_message(self.bot, self.chat_id, self.message_id)
+            self.message_id = None
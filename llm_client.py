@@ -0,0 +1,156 @@
+"""
+llm_client.py
+Асинхронный клиент Polza AI: общая сессия с keep-alive, ограничение параллельных запросов, потоковые ответы (SSE)
+"""
+
+import asyncio
+import json
+import logging
+import time
+from typing import Dict, Any, Optional, Callable, Awaitable, AsyncIterator
+
+import aiohttp
+
+import config
+
+logger = logging.getLogger(__name__)
+
+TextCallback = Callable[[str], Awaitable[None]]
+
+# Сколько держать простаивающее соединение открытым (сек)
+KEEPALIVE_TIMEOUT = 60
+
+
+def _delta_text(event: Dict[str, Any]) -> str:
+    """Фрагмент текста из события потока (OpenAI-совместимый формат)"""
+    choices = event.get('choices') or []
+    if not choices:
+        return ''
+    return (choices[0].get('delta') or {}).get('content') or ''
+
+
+def _message_text(response_data: Dict[str, Any]) -> str:
+    """Текст из обычного (не потокового) ответа"""
+    choices = response_data.get('choices') or []
+    if not choices:
+        logger.error(f"❌ Polza AI не вернул 'choices'. Доступные ключи: {list(response_data.keys())}")
+        return ''
+    return (choices[0].get('message') or {}).get('content') or ''
+
+
+class LLMClient:
+    """
+    Клиент чат-модели Polza AI.
+
+    Одна aiohttp-сессия на весь бот - соединение с API переиспользуется
+    между сообщениями пользователей. Одновременных запросов не больше
+    AI_MAX_CONCURRENCY, остальные ждут очереди. Ответ запрашивается потоком
+    (stream=True): обработчик on_text получает накопленный текст с первым же
+    фрагментом, не дожидаясь конца генерации.
+    """
+
+    def __init__(self, url: str = config.AI_API_URL,
+                 concurrency: int = config.AI_MAX_CONCURRENCY,
+                 timeout: float = config.AI_REQUEST_TIMEOUT):
+        self.url = url
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.session: Optional[aiohttp.ClientSession] = None
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self.stats = {'requests': 0, 'errors': 0}
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """Общая сессия (соединения переиспользуются между запросами)"""
+        if not self.session or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.concurrency, keepalive_timeout=KEEPALIVE_TIMEOUT),
+                timeout=aiohttp.ClientTimeout(total=self.timeout, sock_read=config.AI_STREAM_READ_TIMEOUT),
+                headers={
+                    "Content-Type": "application/json",
+                    "Accept": "text/event-stream"
+                }
+            )
+        return self.session
+
+    async def close_session(self):
+        """Закрытие сессии"""
+        if self.session:
+            await self.session.close()
+            self.session = None
+
+    @staticmethod
+    async def _events(response: aiohttp.ClientResponse) -> AsyncIterator[Dict[str, Any]]:
+        """События SSE из тела ответа (до data: [DONE])"""
+        async for raw_line in response.content:
+            line = raw_line.decode('utf-8').strip()
+            if not line.startswith('data:'):
+                continue
+            payload = line[5:].strip()
+            if payload == '[DONE]':
+                return
+            try:
+                yield json.loads(payload)
+            except ValueError:
+                logger.warning(f"⚠️ Непонятное событие потока Polza AI: {payload[:200]}")
+
+    async def chat(self, token: str, payload: Dict[str, Any],
+                   on_text: Optional[TextCallback] = None) -> Optional[str]:
+        """
+        Ответ модели целиком; None - ошибка запроса или пустой ответ
+
+        Args:
+            token: токен Polza AI
+            payload: тело запроса chat/completions (stream включается здесь)
+            on_text: вызывается с накопленным текстом по мере прихода фрагментов
+        """
+        body = dict(payload, stream=True)
+        headers = {"Authorization": f"Bearer {token}"}
+        started = time.monotonic()
+        first_text_at = None
+        parts = []
+
+        async with self._semaphore:
+            self.stats['requests'] += 1
+            session = await self._get_session()
+            try:
+                async with session.post(self.url, json=body, headers=headers) as response:
+                    if response.status not in (200, 201):
+                        error_text = await response.text()
+                        logger.error(f"❌ Polza AI API error: {response.status} - {error_text[:500]}")
+                        self.stats['errors'] += 1
+                        return None
+
+                    if response.content_type != 'text/event-stream':
+                        # Сервис ответил без потока
+                        text = _message_text(await response.json(content_type=None))
+                    else:
+                        async for event in self._events(response):
+                            if event.get('error'):
+                                logger.error(f"❌ Ошибка в потоке Polza AI: {event['error']}")
+                                self.stats['errors'] += 1
+                                return None
+                            delta = _delta_text(event)
+                            if not delta:
+                                continue
+                            if first_text_at is None:
+                                first_text_at = time.monotonic()
+                            parts.append(delta)
+                            if on_text:
+                                try:
+                                    await on_text(''.join(parts))
+                                except Exception as e:
+                                    logger.debug(f"Ошибка обработчика потока Polza AI: {e}")
+                        text = ''.join(parts)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.error(f"❌ Ошибка запроса к Polza AI: {e!r}")
+                self.stats['errors'] += 1
+                return None
+
+        total = time.monotonic() - started
+        first = f"{first_text_at - started:.1f} с" if first_text_at else "-"
+        logger.info(f"🤖 Polza AI: первый фрагмент через {first}, ответ {len(text)} симв. за {total:.1f} с")
+        return text or None
+
+
+# Глобальный клиент Polza AI
+llm_client = LLMClient()
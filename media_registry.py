@@ -0,0 +1,204 @@
+"""
+media_registry.py
+Реестр file_id Telegram для локальных файлов: повторная отправка без загрузки
+"""
+
+import hashlib
+import logging
+import os
+from typing import Dict, Any, Optional, List
+
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import FSInputFile
+
+import database
+
+logger = logging.getLogger(__name__)
+
+# Поля сообщения, из которых берется file_id отправленного файла
+_MESSAGE_MEDIA_FIELDS = ('document', 'video', 'animation', 'audio')
+
+
+def content_hash(path: str) -> str:
+    """SHA-1 содержимого файла (читается блоками)"""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _extract_file_id(message) -> Optional[tuple]:
+    """(file_id, тип) из ответа Telegram на отправку файла"""
+    if getattr(message, 'photo', None):
+        return message.photo[-1].file_id, 'photo'
+    for field in _MESSAGE_MEDIA_FIELDS:
+        media = getattr(message, field, None)
+        if media is not None:
+            return media.file_id, field
+    return None
+
+
+class MediaRegistry:
+    """
+    Соответствие "локальный файл + хэш содержимого → file_id" в SQLite.
+
+    Первый успешный send заполняет реестр из ответа Telegram, дальше файл
+    отправляется по file_id без загрузки. Изменение файла на диске
+    (другой размер/mtime и другой хэш) автоматически сбрасывает запись.
+    """
+
+    def __init__(self):
+        # path -> запись из БД (None - записи нет, чтобы не ходить в БД повторно)
+        self._records: Dict[str, Optional[Dict[str, Any]]] = {}
+        self.stats = {'hits': 0, 'uploads': 0}
+
+    @staticmethod
+    def _key(path: str) -> str:
+        return os.path.normpath(path)
+
+    def get_file_id(self, path: str, file_type: Optional[str] = None) -> Optional[str]:
+        """file_id для файла, если он уже отправлялся (как file_type) и с тех пор не менялся"""
+        key = self._key(path)
+        try:
+            stat = os.stat(key)
+        except OSError:
+            return None
+
+        if key not in self._records:
+            self._records[key] = database.get_media_file(key)
+        record = self._records[key]
+        if not record or (file_type and record['file_type'] != file_type):
+            return None
+
+        if record['size'] == stat.st_size and record['mtime'] == stat.st_mtime:
+            return record['file_id']
+
+        # Файл трогали - сверяем содержимое, прежде чем доверять file_id
+        if record['size'] == stat.st_size and content_hash(key) == record['content_hash']:
+            record['mtime'] = stat.st_mtime
+            database.save_media_file(key, record['content_hash'], record['file_id'],
+                                     record['file_type'], stat.st_size, stat.st_mtime)
+            return record['file_id']
+
+        self.invalidate(key)
+        return None
+
+    def remember(self, path: str, file_id: str, file_type: str):
+        """Запомнить file_id для текущего содержимого файла"""
+        key = self._key(path)
+        try:
+            stat = os.stat(key)
+            record = {
+                'path': key,
+                'content_hash': content_hash(key),
+                'file_id': file_id,
+                'file_type': file_type,
+                'size': stat.st_size,
+                'mtime': stat.st_mtime
+            }
+        except OSError as e:
+            logger.error(f"❌ Не удалось запомнить file_id для {key}: {e}")
+            return
+
+        self._records[key] = record
+        database.save_media_file(key, record['content_hash'], file_id, file_type, stat.st_size, stat.st_mtime)
+
+    def invalidate(self, path: str):
+        """Забыть file_id файла (файл заменен)"""
+        key = self._key(path)
+        self._records[key] = None
+        database.delete_media_file(key)
+
+    def _remember_message(self, path: str, message):
+        """Запомнить file_id из ответа на отправку"""
+        extracted = _extract_file_id(message)
+        if extracted:
+            self.remember(path, *extracted)
+
+    async def _send(self, method, field: str, chat_id, media, kwargs: Dict[str, Any]):
+        """Отправка по file_id, если он известен, иначе загрузка файла с запоминанием file_id"""
+        path = media.path if isinstance(media, FSInputFile) else None
+
+        if path:
+            file_id = self.get_file_id(path, field)
+            if file_id:
+                try:
+                    message = await method(chat_id=chat_id, **{field: file_id}, **kwargs)
+                    self.stats['hits'] += 1
+                    return message
+                except TelegramBadRequest as e:
+                    logger.warning(f"⚠️ Telegram не принял file_id для {path} ({e}), загружаем файл заново")
+                    self.invalidate(path)
+
+        message = await method(chat_id=chat_id, **{field: media}, **kwargs)
+        if path:
+            self.stats['uploads'] += 1
+            self._remember_message(path, message)
+        return message
+
+    async def send_photo(self, bot, chat_id, photo, **kwargs):
+        """bot.send_photo с повторным использованием file_id для FSInputFile"""
+        return await self._send(bot.send_photo, 'photo', chat_id, photo, kwargs)
+
+    async def send_document(self, bot, chat_id, document, **kwargs):
+        """bot.send_document с повторным использованием file_id для FSInputFile"""
+        return await self._send(bot.send_document, 'document', chat_id, document, kwargs)
+
+    async def send_media_group(self, bot, chat_id, media: List[Any], **kwargs):
+        """bot.send_media_group с повторным использованием file_id для FSInputFile в альбоме"""
+        paths = [item.media.path if isinstance(item.media, FSInputFile) else None for item in media]
+        file_ids = [self.get_file_id(path, item.type) if path else None for path, item in zip(paths, media)]
+
+        if any(file_ids):
+            cached = [item.model_copy(update={'media': file_id}) if file_id else item
+                      for item, file_id in zip(media, file_ids)]
+            try:
+                messages = await bot.send_media_group(chat_id=chat_id, media=cached, **kwargs)
+                self.stats['hits'] += sum(1 for file_id in file_ids if file_id)
+                self._remember_group(paths, file_ids, messages)
+                return messages
+            except TelegramBadRequest as e:
+                logger.warning(f"⚠️ Telegram не принял file_id в альбоме ({e}), загружаем файлы заново")
+                for path, file_id in zip(paths, file_ids):
+                    if file_id:
+                        self.invalidate(path)
+                file_ids = [None] * len(media)
+
+        messages = await bot.send_media_group(chat_id=chat_id, media=media, **kwargs)
+        self._remember_group(paths, file_ids, messages)
+        return messages
+
+    def _remember_group(self, paths: List[Optional[str]], file_ids: List[Optional[str]], messages):
+        """Запомнить file_id загруженных файлов альбома (сообщения идут в порядке media)"""
+        for path, file_id, message in zip(paths, file_ids, messages):
+            if path and not file_id:
+                self.stats['uploads'] += 1
+                self._remember_message(path, message)
+
+    async def edit_message_media(self, bot, media, **kwargs):
+        """bot.edit_message_media с повторным использованием file_id для FSInputFile"""
+        path = media.media.path if isinstance(media.media, FSInputFile) else None
+
+        if path:
+            file_id = self.get_file_id(path, media.type)
+            if file_id:
+                try:
+                    result = await bot.edit_message_media(media=media.model_copy(update={'media': file_id}), **kwargs)
+                    self.stats['hits'] += 1
+                    return result
+                except TelegramBadRequest as e:
+                    if 'not modified' in str(e):
+                        raise
+                    logger.warning(f"⚠️ Telegram не принял file_id для {path} ({e}), загружаем файл заново")
+                    self.invalidate(path)
+
+        result = await bot.edit_message_media(media=media, **kwargs)
+        if path:
+            self.stats['uploads'] += 1
+            self._remember_message(path, result)
+        return result
+
+
+# Глобальный экземпляр реестра медиа
+media_registry = MediaRegistry()
@@ -6,7 +6,8 @@ menu_cache.py - ОБНОВЛЕННЫЙ
 import json
 import os
 import logging
-from typing import Dict, List, Optional
+from types import MappingProxyType
+from typing import Dict, List, Optional, Mapping
 from datetime import datetime, timedelta
 import asyncio
 import pytz
@@ -14,6 +15,9 @@ import pytz
 import config
 import database
 from presto_api import presto_api
+from menu_compiler import menu_compiler, normalize_menus
+from menu_search import MenuSearchIndex, make_dish_view
+from menu_diff import diff_menus, dish_entries, MenuDiff, VALUE_FIELDS
 
 logger = logging.getLogger(__name__)
 
@@ -29,6 +33,13 @@ class MenuCache:
         self.last_update = None
         self.cache_ttl = 3600  # 1 час
         self.moscow_tz = pytz.timezone('Europe/Moscow')
+        self.search_index = MenuSearchIndex({})
+        # Вторичные индексы для O(1) поиска по ID
+        self._dishes_by_id = {}       # (menu_id, dish_id) → (category_id, блюдо)
+        self._categories_by_id = {}   # (menu_id, category_id) → метаданные категории
+        self._menus_by_dish = {}      # dish_id → [menu_id, ...]
+        # Изменения при последнем обновлении из API
+        self.last_diff: Optional[MenuDiff] = None
 
         # Создаем директории
         os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
@@ -41,6 +52,42 @@ class MenuCache:
         self._load_delivery_cache()
         self._load_all_menus_cache()
     
+    def _on_menus_updated(self):
+        """Пересборка производных структур после замены all_menus_cache"""
+        self._build_lookup_tables()
+        self.search_index = MenuSearchIndex(self.all_menus_cache)
+        menu_compiler.publish(self.all_menus_cache)
+    
+    def _build_lookup_tables(self):
+        """Построение индексов dish_id/category_id по текущему кэшу меню"""
+        dishes_by_id = {}
+        categories_by_id = {}
+        menus_by_dish = {}
+        
+        for menu_id, menu_data in self.all_menus_cache.items():
+            for cat_id, cat_data in menu_data.get('categories', {}).items():
+                name = cat_data.get('name', '')
+                categories_by_id[(menu_id, cat_id)] = MappingProxyType({
+                    'id': cat_id,
+                    'name': name,
+                    'display_name': cat_data.get('display_name', name),
+                    'item_count': len(cat_data.get('items', [])),
+                    'image_url': cat_data.get('image_url'),
+                    'menu_id': menu_id,
+                    'menu_name': menu_data.get('name', '')
+                })
+                
+                for dish in cat_data.get('items', []):
+                    dish_id = dish.get('id')
+                    # Как и при переборе, побеждает первое вхождение блюда в меню
+                    if (menu_id, dish_id) not in dishes_by_id:
+                        dishes_by_id[(menu_id, dish_id)] = (cat_id, dish)
+                        menus_by_dish.setdefault(dish_id, []).append(menu_id)
+        
+        self._dishes_by_id = dishes_by_id
+        self._categories_by_id = categories_by_id
+        self._menus_by_dish = menus_by_dish
+    
     def _load_point_id_from_db(self):
         """Загрузка ID точки продаж из базы данных"""
         point_id_str = database.get_setting('presto_point_id')
@@ -65,7 +112,7 @@ class MenuCache:
 
                     # Проверяем не устарел ли кэш
                     if (datetime.now() - cache_time).total_seconds() < self.cache_ttl:
-                        self.delivery_menus_cache = cache_data.get('all_menus', {})
+                        self.delivery_menus_cache = normalize_menus(cache_data.get('all_menus', {}))
                         self.last_update = cache_time
 
                         # Также загружаем point_id из кэша если есть
@@ -100,7 +147,8 @@ class MenuCache:
 
                     # Проверяем не устарел ли кэш
                     if (datetime.now() - cache_time).total_seconds() < self.cache_ttl:
-                        self.all_menus_cache = cache_data.get('all_menus', {})
+                        self.all_menus_cache = normalize_menus(cache_data.get('all_menus', {}))
+                        self._on_menus_updated()
                         logger.info(f"✅ Все меню загружены из кэша ({len(self.all_menus_cache)} меню)")
                         return True
                     else:
@@ -177,11 +225,8 @@ class MenuCache:
                 menus = await presto_api.get_all_menus()
 
                 if menus:
-                    self.all_menus_cache = menus
                     self.last_update = datetime.now()
-                    # Сохраняем оба кэша
-                    self._save_delivery_cache()
-                    self._save_all_menus_cache()
+                    self._apply_menus(menus)
 
                     logger.info(f"✅ Загружено {len(menus)} меню:")
                     for menu_id, menu_data in menus.items():
@@ -189,7 +234,7 @@ class MenuCache:
                         total_items = sum(len(cat['items']) for cat in menu_data.get('categories', {}).values())
                         logger.info(f"   • {menu_data['name']}: {categories_count} категорий, {total_items} товаров")
 
-                    return menus
+                    return self.all_menus_cache
                 else:
                     logger.warning("⚠️ Не удалось загрузить меню из API")
                     # Возвращаем старый кэш если есть
@@ -204,6 +249,65 @@ class MenuCache:
 
         return self.all_menus_cache
     
+    def _apply_menus(self, menus: Dict):
+        """
+        Применение свежего снимка меню по разнице с текущим
+        
+        Без изменений кэш и индексы не трогаются (в файлах кэша обновляется
+        только время проверки); если изменились только цены/остатки - они
+        обновляются в текущих блюдах на месте, во всех вхождениях блюда
+        (поисковый индекс и таблицы id остаются), иначе меню заменяется целиком.
+        """
+        if not self.all_menus_cache:
+            self.all_menus_cache = menus
+            self.last_diff = None
+            self._on_menus_updated()
+            self._save_delivery_cache()
+            self._save_all_menus_cache()
+            return
+
+        diff = diff_menus(self.all_menus_cache, menus)
+        self.last_diff = diff
+        logger.info(f"🔍 Изменения меню: {diff.summary()}")
+
+        if diff.is_empty():
+            # Иначе после рестарта кэш старше cache_ttl и меню снова грузится целиком
+            self._save_delivery_cache()
+            self._save_all_menus_cache()
+            return
+
+        new_entries = dish_entries(menus)
+        if diff.values_only():
+            # Структура совпадает, поэтому блюда идут в том же порядке: так обновляются
+            # и повторные вхождения блюда в других категориях, которых нет в индексах
+            for menu_id, menu_data in self.all_menus_cache.items():
+                new_categories = menus[menu_id].get('categories', {})
+                for cat_id, cat_data in menu_data.get('categories', {}).items():
+                    for dish, new_dish in zip(cat_data.get('items', []), new_categories[cat_id].get('items', [])):
+                        for field in VALUE_FIELDS:
+                            dish[field] = new_dish.get(field)
+            # Цены есть в контексте AI - его пересобираем
+            menu_compiler.publish(self.all_menus_cache)
+        else:
+            self.all_menus_cache = menus
+            self._on_menus_updated()
+
+        self._save_delivery_cache()
+        self._save_all_menus_cache()
+
+        # Фото блюд с новой картинкой перекачиваем (новые блюда уже в очереди загрузки)
+        changed_images = {}
+        for key in diff.image_changed:
+            _, dish = new_entries[key]
+            if dish.get('image_filename'):
+                save_path = os.path.join(self.images_dir, dish['image_filename'])
+                if os.path.exists(save_path):
+                    changed_images[save_path] = (dish['image_url'], dish['id'])
+        presto_api.schedule_images(changed_images)
+
+        database.save_menu_diff(diff.counts(), diff.summary(),
+                                json.dumps(diff.details(), ensure_ascii=False))
+
     def get_available_menus(self) -> List[Dict]:
         """Получает доступные меню для доставки с учетом времени"""
         current_time = datetime.now(self.moscow_tz).time()
@@ -293,82 +397,72 @@ class MenuCache:
         category_data = self.all_menus_cache[menu_id]['categories'][category_id]
         return category_data.get('items', [])
     
-    def get_dish_by_id(self, menu_id: int, dish_id: int) -> Optional[Dict]:
-        """Поиск блюда по ID в меню"""
-        if menu_id not in self.all_menus_cache:
+    def _dish_view(self, menu_id: int, category_id: int, dish: Dict) -> Mapping:
+        """Read-only блюдо с информацией о категории и меню (без копирования)"""
+        category = self._categories_by_id.get((menu_id, category_id), {})
+        return make_dish_view(
+            dish,
+            category_id=category_id,
+            category_name=category.get('name', ''),
+            menu_id=menu_id,
+            menu_name=category.get('menu_name', '')
+        )
+    
+    def get_dish_by_id(self, menu_id: int, dish_id: int) -> Optional[Mapping]:
+        """Поиск блюда по ID в меню (O(1), read-only)"""
+        found = self._dishes_by_id.get((menu_id, dish_id))
+        if not found:
             return None
         
-        for cat_id, cat_data in self.all_menus_cache[menu_id].get('categories', {}).items():
-            for dish in cat_data.get('items', []):
-                if dish.get('id') == dish_id:
-                    # Копируем и добавляем информацию о категории и меню
-                    dish_copy = dish.copy()
-                    dish_copy['category_id'] = cat_id
-                    dish_copy['category_name'] = cat_data.get('name', '')
-                    dish_copy['menu_id'] = menu_id
-                    dish_copy['menu_name'] = self.all_menus_cache[menu_id].get('name', '')
-                    return dish_copy
-        
-        return None
+        category_id, dish = found
+        return self._dish_view(menu_id, category_id, dish)
+    
+    def get_menus_for_dish(self, dish_id: int) -> List[int]:
+        """Все меню, в которых есть блюдо"""
+        return list(self._menus_by_dish.get(dish_id, []))
     
-    def get_dish_by_index(self, menu_id: int, category_id: int, dish_index: int) -> Optional[Dict]:
+    def find_dish(self, dish_id: int) -> Optional[Mapping]:
+        """Поиск блюда по ID во всех меню (первое меню, где оно встречается)"""
+        menu_ids = self._menus_by_dish.get(dish_id)
+        if not menu_ids:
+            return None
+        return self.get_dish_by_id(menu_ids[0], dish_id)
+    
+    def get_category_by_id(self, menu_id: int, category_id: int) -> Optional[Mapping]:
+        """Получает категорию по ID (O(1), read-only)"""
+        return self._categories_by_id.get((menu_id, category_id))
+    
+    def get_dish_by_index(self, menu_id: int, category_id: int, dish_index: int) -> Optional[Mapping]:
         """Получение блюда по индексу в категории"""
         items = self.get_category_items(menu_id, category_id)
         
         if 0 <= dish_index < len(items):
-            dish = items[dish_index].copy()
-            dish['category_id'] = category_id
-            dish['menu_id'] = menu_id
-            
-            # Добавляем информацию о категории и меню
-            if menu_id in self.all_menus_cache:
-                menu_data = self.all_menus_cache[menu_id]
-                dish['menu_name'] = menu_data.get('name', '')
-                
-                if category_id in menu_data.get('categories', {}):
-                    dish['category_name'] = menu_data['categories'][category_id].get('name', '')
-            
-            return dish
+            return self._dish_view(menu_id, category_id, items[dish_index])
         
         return None
     
-    def search_dishes(self, search_text: str, menu_id: Optional[int] = None) -> List[Dict]:
-        """Поиск блюд по названию"""
-        if not search_text:
-            return []
-        
-        search_lower = search_text.lower()
-        results = []
-        
-        # Если указано конкретное меню
-        menus_to_search = [menu_id] if menu_id else self.all_menus_cache.keys()
+    def search(self, search_text: str, menu_id: Optional[int] = None, limit: Optional[int] = 10) -> Dict:
+        """
+        Ранжированный поиск блюд по названию и описанию
         
-        for m_id in menus_to_search:
-            if m_id not in self.all_menus_cache:
-                continue
-            
-            for cat_id, cat_data in self.all_menus_cache[m_id].get('categories', {}).items():
-                for dish in cat_data.get('items', []):
-                    dish_name = dish.get('name', '').lower()
-                    dish_desc = dish.get('description', '').lower()
-                    
-                    if (search_lower in dish_name or 
-                        search_lower in dish_desc):
-                        
-                        dish_copy = dish.copy()
-                        dish_copy['category_id'] = cat_id
-                        dish_copy['category_name'] = cat_data.get('name', '')
-                        dish_copy['menu_id'] = m_id
-                        dish_copy['menu_name'] = self.all_menus_cache[m_id].get('name', '')
-                        results.append(dish_copy)
+        Returns:
+            {'results': лучшие limit блюд (read-only), 'total': всего найдено, 'by_menu': {menu_id: найдено}}
+        """
+        if not search_text:
+            return {'results': [], 'total': 0, 'by_menu': {}}
         
-        return results
+        return self.search_index.search(search_text, menu_id=menu_id or None, limit=limit)
+    
+    def search_dishes(self, search_text: str, menu_id: Optional[int] = None) -> List[Dict]:
+        """Поиск блюд по названию (все результаты по убыванию релевантности)"""
+        return self.search(search_text, menu_id, limit=None)['results']
     
     def clear_cache(self) -> bool:
         """Очистка кэша"""
         try:
             self.all_menus_cache = {}
             self.last_update = None
+            self._on_menus_updated()
             
             if os.path.exists(self.cache_file):
                 os.remove(self.cache_file)
@@ -383,31 +477,5 @@ class MenuCache:
             logger.error(f"❌ Ошибка очистки кэша: {e}")
             return False
 
-# В класс MenuCache в menu_cache.py добавьте этот метод:
-
-def get_category_by_id(self, menu_id: int, category_id: int) -> Optional[Dict]:
-    """Получает категорию по ID"""
-    if menu_id not in self.all_menus_cache:
-        return None
-    
-    menu_data = self.all_menus_cache[menu_id]
-    categories = menu_data.get('categories', {})
-    
-    if category_id not in categories:
-        return None
-    
-    cat_data = categories[category_id]
-    
-    # Проверяем есть ли display_name
-    name = cat_data.get('name', '')
-    display_name = cat_data.get('display_name', name)
-    
-    return {
-        'id': category_id,
-        'name': name,
-        'display_name': display_name,
-        'item_count': len(cat_data.get('items', [])),
-        'image_url': cat_data.get('image_url')
-    }
 # Глобальный экземпляр кэша меню
 menu_cache = MenuCache()
@@ -0,0 +1,164 @@
+"""
+menu_compiler.py
+Предкомпилированный контекст меню для AI помощника
+"""
+
+import json
+import os
+import re
+import logging
+from datetime import datetime
+from typing import Dict, Any, Optional
+
+from dish_index import DishIndex
+
+logger = logging.getLogger(__name__)
+
+# Меню доставки и бара (тот же состав, что показывается пользователю)
+DELIVERY_MENU_IDS = (90, 92, 141)
+BAR_MENU_IDS = (29, 91, 86, 32)
+ALCOHOL_MENU_ID = 32
+
+ALL_MENUS_CACHE_FILE = 'files/all_menus_cache.json'
+LEGACY_MENU_CACHE_FILE = 'files/menu_cache.json'
+
+# Грубая оценка количества токенов: слова и отдельные знаки препинания
+_TOKEN_RE = re.compile(r'\w+|[^\w\s]')
+
+
+def _int_keys(data: Dict) -> Dict:
+    """JSON превращает int-ключи в строки - возвращаем их обратно"""
+    return {int(k) if isinstance(k, str) and k.isdigit() else k: v for k, v in data.items()}
+
+
+def normalize_menus(menus: Dict) -> Dict:
+    """Приведение ID меню и категорий к int (как при загрузке из Presto API)"""
+    normalized = {}
+    for menu_id, menu in _int_keys(menus).items():
+        if isinstance(menu, dict) and isinstance(menu.get('categories'), dict):
+            menu = {**menu, 'categories': _int_keys(menu['categories'])}
+        normalized[menu_id] = menu
+    return normalized
+
+
+def estimate_tokens(text: str) -> int:
+    """Приблизительное число токенов в тексте промпта"""
+    return len(_TOKEN_RE.findall(text))
+
+
+def render_menu_context(menus: Dict) -> str:
+    """Сборка текстового фрагмента промпта со всем меню"""
+    parts = ["ПОЛНОЕ МЕНЮ РЕСТОРАНА (все позиции для перечисления):\n\n"]
+
+    def render_menu(menu: Dict, header: str):
+        parts.append(header)
+        for category in menu.get('categories', {}).values():
+            category_name = category.get('name', '').replace('🍕', '').replace('🥗', '').strip()
+            parts.append(f"\n{category_name}:\n")
+            for item in category.get('items', []):
+                parts.append(f"• {item['name']} - {item['price']}₽\n")
+            parts.append("\n")
+
+    # Добавляем меню доставки с ПОЛНЫМИ категориями
+    for menu_id in DELIVERY_MENU_IDS:
+        if menu_id in menus:
+            menu = menus[menu_id]
+            menu_name = menu.get('name', '').replace('🍳', '').replace('📋', '').strip()
+            render_menu(menu, f"=== {menu_name} (ДОСТАВКА) ===\n")
+
+    # Добавляем меню бара с ПОЛНЫМИ категориями
+    for menu_id in BAR_MENU_IDS:
+        if menu_id in menus:
+            menu = menus[menu_id]
+            menu_name = menu.get('name', '').replace('🍳', '').replace('📋', '').strip()
+            alcohol_note = " (АЛКОГОЛЬ)" if menu_id == ALCOHOL_MENU_ID else ""
+            render_menu(menu, f"=== {menu_name}{alcohol_note} (БАР) ===\n")
+
+    return ''.join(parts)
+
+
+class MenuContextCompiler:
+    """
+    Хранит меню и собранный из него контекст для AI в памяти.
+
+    Контекст пересобирается один раз на каждое обновление меню:
+    MenuCache вызывает publish() после загрузки, а без него (отдельные
+    скрипты) источником служит файл кэша, перечитываемый только при смене mtime.
+    """
+
+    def __init__(self):
+        self.version = 0
+        self._compiled: Optional[Dict[str, Any]] = None
+        self._published = False
+        self._file_mtime: Optional[float] = None
+
+    def _compile(self, menus: Dict) -> Dict[str, Any]:
+        """Сборка контекста и всех производных структур"""
+        self.version += 1
+        text = render_menu_context(menus)
+        compiled = {
+            'version': self.version,
+            'menu_data': menus,
+            'text': text,
+            'tokens': estimate_tokens(text),
+            'dish_index': DishIndex(menus),
+            'compiled_at': datetime.now().isoformat()
+        }
+        logger.info(f"✅ Контекст меню для AI собран: v{self.version}, "
+                    f"{len(text)} символов, ~{compiled['tokens']} токенов, "
+                    f"{len(compiled['dish_index'].entries)} блюд в индексе")
+        return compiled
+
+    def publish(self, menus: Dict):
+        """Публикация нового меню (вызывается MenuCache при каждом обновлении)"""
+        self._compiled = self._compile(normalize_menus(menus or {}))
+        self._published = True
+
+    def _load_from_file(self) -> Optional[Dict]:
+        """Чтение меню из файлового кэша, если он изменился с прошлого раза"""
+        cache_file = ALL_MENUS_CACHE_FILE
+        if not os.path.exists(cache_file):
+            # Fallback на старый файл menu_cache.json
+            cache_file = LEGACY_MENU_CACHE_FILE
+            if not os.path.exists(cache_file):
+                return None if self._compiled else {}
+
+        mtime = os.path.getmtime(cache_file)
+        if self._compiled is not None and mtime == self._file_mtime:
+            return None
+
+        with open(cache_file, 'r', encoding='utf-8') as f:
+            cache_data = json.load(f)
+        self._file_mtime = mtime
+        return cache_data.get('all_menus', {})
+
+    def get(self) -> Dict[str, Any]:
+        """
+        Текущий скомпилированный контекст
+
+        Returns:
+            {'version', 'menu_data', 'text', 'tokens', 'dish_index', 'compiled_at'}
+        """
+        if not self._published:
+            try:
+                menus = self._load_from_file()
+                if menus is not None:
+                    self._compiled = self._compile(normalize_menus(menus))
+            except Exception as e:
+                logger.error(f"Ошибка загрузки кэша меню для AI: {e}")
+
+        if self._compiled is None:
+            self._compiled = self._compile({})
+        return self._compiled
+
+    def get_menu_data(self) -> Dict:
+        """Меню в памяти (без чтения файла на каждый запрос)"""
+        return self.get()['menu_data']
+
+    def get_dish_index(self) -> DishIndex:
+        """Индекс названий блюд текущего меню"""
+        return self.get()['dish_index']
+
+
+# Глобальный экземпляр компилятора контекста меню
+menu_compiler = MenuContextCompiler()
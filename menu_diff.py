@@ -0,0 +1,144 @@
+"""
+menu_diff.py
+Сравнение снимков меню Presto по id блюд: добавленные, удаленные, изменения цен и остатков
+"""
+
+import logging
+from typing import Dict, List, Any, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Поля, изменение которых не меняет структуру меню - применяются к кэшу на месте
+VALUE_FIELDS = ('price', 'balance')
+
+# Локальные поля (пути к фото на диске) - в сравнении не участвуют
+LOCAL_FIELDS = ('image_local_path', 'image_downloaded')
+
+# Сколько изменений каждого вида хранить в истории
+HISTORY_DETAILS_LIMIT = 50
+
+DishKey = Tuple[Any, Any]  # (menu_id, dish_id)
+
+
+def dish_entries(menus: Dict) -> Dict[DishKey, Tuple[Any, Dict]]:
+    """Блюда меню по (menu_id, dish_id) → (category_id, блюдо); как и в индексах, побеждает первое вхождение"""
+    entries = {}
+    for menu_id, menu_data in menus.items():
+        for cat_id, cat_data in menu_data.get('categories', {}).items():
+            for dish in cat_data.get('items', []):
+                entries.setdefault((menu_id, dish.get('id')), (cat_id, dish))
+    return entries
+
+
+def menu_layout(menus: Dict) -> Dict:
+    """Структура меню без цен и остатков: названия меню и категорий, порядок блюд"""
+    return {
+        menu_id: (
+            menu_data.get('name', ''),
+            [(cat_id, cat_data.get('name', ''), [dish.get('id') for dish in cat_data.get('items', [])])
+             for cat_id, cat_data in menu_data.get('categories', {}).items()]
+        )
+        for menu_id, menu_data in menus.items()
+    }
+
+
+def _content(dish: Dict) -> Dict:
+    return {k: v for k, v in dish.items() if k not in VALUE_FIELDS and k not in LOCAL_FIELDS}
+
+
+class MenuDiff:
+    """Разница между двумя снимками меню"""
+
+    def __init__(self):
+        self.added: List[Tuple[DishKey, str]] = []
+        self.removed: List[Tuple[DishKey, str]] = []
+        self.price_changed: List[Tuple[DishKey, str, Any, Any]] = []
+        self.stock_changed: List[Tuple[DishKey, str, Any, Any]] = []
+        self.changed: List[Tuple[DishKey, str, List[str]]] = []
+        self.image_changed: List[DishKey] = []
+        self.layout_changed = False
+
+    def is_empty(self) -> bool:
+        return not (self.added or self.removed or self.price_changed
+                    or self.stock_changed or self.changed or self.layout_changed)
+
+    def values_only(self) -> bool:
+        """Изменились только цены/остатки - структуру и индексы можно не пересобирать"""
+        return not (self.added or self.removed or self.changed or self.layout_changed)
+
+    def counts(self) -> Dict[str, int]:
+        return {
+            'added': len(self.added),
+            'removed': len(self.removed),
+            'price_changed': len(self.price_changed),
+            'stock_changed': len(self.stock_changed),
+            'changed': len(self.changed),
+        }
+
+    def summary(self) -> str:
+        """Краткое описание для админов: "12 цен изменилось, +3 блюда" """
+        if self.is_empty():
+            return "без изменений"
+        labels = (
+            ('added', "➕ новых блюд"),
+            ('removed', "➖ убрано блюд"),
+            ('price_changed', "💰 цен изменилось"),
+            ('stock_changed', "📦 остатков изменилось"),
+            ('changed', "✏️ описаний изменилось"),
+        )
+        counts = self.counts()
+        parts = [f"{label}: {counts[name]}" for name, label in labels if counts[name]]
+        if not parts:
+            parts.append("изменился порядок категорий/блюд")
+        return ', '.join(parts)
+
+    def details(self, limit: int = HISTORY_DETAILS_LIMIT) -> Dict[str, List]:
+        """Изменения для истории (по limit каждого вида)"""
+        return {
+            'added': [[menu_id, dish_id, name] for (menu_id, dish_id), name in self.added[:limit]],
+            'removed': [[menu_id, dish_id, name] for (menu_id, dish_id), name in self.removed[:limit]],
+            'price_changed': [[menu_id, dish_id, name, old, new]
+                              for (menu_id, dish_id), name, old, new in self.price_changed[:limit]],
+            'stock_changed': [[menu_id, dish_id, name, old, new]
+                              for (menu_id, dish_id), name, old, new in self.stock_changed[:limit]],
+            'changed': [[menu_id, dish_id, name, fields]
+                        for (menu_id, dish_id), name, fields in self.changed[:limit]],
+        }
+
+
+def diff_menus(old_menus: Dict, new_menus: Dict) -> MenuDiff:
+    """Сравнение текущего и свежего снимка меню по id блюд"""
+    diff = MenuDiff()
+    old_entries = dish_entries(old_menus)
+    new_entries = dish_entries(new_menus)
+
+    for key, (cat_id, dish) in new_entries.items():
+        old = old_entries.get(key)
+        name = dish.get('name', '')
+        if old is None:
+            diff.added.append((key, name))
+            continue
+
+        old_cat_id, old_dish = old
+        if old_dish.get('price') != dish.get('price'):
+            diff.price_changed.append((key, name, old_dish.get('price'), dish.get('price')))
+        if old_dish.get('balance') != dish.get('balance'):
+            diff.stock_changed.append((key, name, old_dish.get('balance'), dish.get('balance')))
+
+        old_content = _content(old_dish)
+        new_content = _content(dish)
+        if old_cat_id != cat_id or old_content != new_content:
+            fields = sorted(field for field in set(old_content) | set(new_content)
+                            if old_content.get(field) != new_content.get(field))
+            if old_cat_id != cat_id:
+                fields.append('category_id')
+            diff.changed.append((key, name, fields))
+        if dish.get('image_url') and old_dish.get('image_url') != dish.get('image_url'):
+            diff.image_changed.append(key)
+
+    for key, (cat_id, dish) in old_entries.items():
+        if key not in new_entries:
+            diff.removed.append((key, dish.get('name', '')))
+
+    diff.layout_changed = menu_layout(old_menus) != menu_layout(new_menus)
+    return diff
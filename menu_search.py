@@ -0,0 +1,200 @@
+"""
+menu_search.py
+Полнотекстовый поиск по меню: нормализация, стемминг, опечатки, ранжирование
+"""
+
+import re
+import logging
+from bisect import bisect_left
+from collections import ChainMap
+from types import MappingProxyType
+from typing import Dict, List, Optional, Any, Tuple, Mapping
+
+logger = logging.getLogger(__name__)
+
+_WORD_RE = re.compile(r'\w+')
+
+# Окончания для упрощенного стемминга (от длинных к коротким)
+_ENDINGS = sorted([
+    'иями', 'ями', 'ами', 'ией', 'иях', 'ях', 'ах', 'ев', 'ов', 'ей', 'ий', 'ый', 'ой', 'ая', 'яя',
+    'ое', 'ее', 'ые', 'ие', 'ую', 'юю', 'ого', 'его', 'ому', 'ему', 'ым', 'им', 'ом', 'ем',
+    'ью', 'ия', 'ие', 'ии', 'а', 'я', 'о', 'е', 'ы', 'и', 'у', 'ю', 'ь', 'й'
+], key=len, reverse=True)
+_MIN_STEM = 3
+
+# Веса полей и типов совпадений
+NAME_WEIGHT = 3.0
+DESCRIPTION_WEIGHT = 1.0
+PREFIX_FACTOR = 0.7
+TYPO_FACTOR = 0.5
+
+
+def normalize_text(text: str) -> str:
+    """Регистр и ё→е"""
+    return text.lower().replace('ё', 'е')
+
+
+def stem(word: str) -> str:
+    """Упрощенный стемминг: отрезаем типичное окончание, оставляя основу от 3 букв"""
+    for ending in _ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= _MIN_STEM:
+            return word[:-len(ending)]
+    return word
+
+
+def tokenize(text: str) -> List[str]:
+    """Нормализованные основы слов текста"""
+    return [stem(word) for word in _WORD_RE.findall(normalize_text(text))]
+
+
+def _deletes(word: str) -> set:
+    """Все варианты слова с одной удаленной буквой"""
+    return {word[:i] + word[i + 1:] for i in range(len(word))}
+
+
+def make_dish_view(dish: Dict, **extra) -> Mapping:
+    """Read-only представление блюда с дополнительными полями без копирования словаря"""
+    return MappingProxyType(ChainMap(extra, dish))
+
+
+class MenuSearchIndex:
+    """
+    Инвертированный индекс по названиям и описаниям блюд.
+
+    Строится один раз при каждой загрузке меню. Запрос разбивается на
+    основы слов; каждая должна совпасть с основой блюда точно, по префиксу
+    (для недописанных слов) или с одной опечаткой.
+    """
+
+    def __init__(self, menus: Dict):
+        self.docs: List[Tuple[Any, Any, Dict, str]] = []   # (menu_id, category_id, блюдо, нормализованное название)
+        self._postings: Dict[str, Dict[int, float]] = {}    # основа → {документ: вес}
+        self._deletes: Dict[str, set] = {}                  # вариант с удаленной буквой → основы
+        self._menu_names: Dict[Any, str] = {}
+        self._category_names: Dict[Tuple[Any, Any], str] = {}
+
+        for menu_id, menu in menus.items():
+            self._menu_names[menu_id] = menu.get('name', '')
+            for cat_id, category in menu.get('categories', {}).items():
+                self._category_names[(menu_id, cat_id)] = category.get('name', '')
+                for dish in category.get('items', []):
+                    self._add(menu_id, cat_id, dish)
+
+        self._vocabulary = sorted(self._postings)
+        for term in self._vocabulary:
+            for variant in _deletes(term):
+                self._deletes.setdefault(variant, set()).add(term)
+
+        logger.info(f"✅ Поисковый индекс меню: {len(self.docs)} блюд, {len(self._vocabulary)} основ")
+
+    def _add(self, menu_id: Any, cat_id: Any, dish: Dict):
+        """Индексация одного блюда"""
+        doc_id = len(self.docs)
+        name = dish.get('name', '')
+        self.docs.append((menu_id, cat_id, dish, normalize_text(name)))
+
+        for weight, text in ((NAME_WEIGHT, name), (DESCRIPTION_WEIGHT, dish.get('description') or '')):
+            for term in tokenize(text):
+                postings = self._postings.setdefault(term, {})
+                if postings.get(doc_id, 0) < weight:
+                    postings[doc_id] = weight
+
+    def _prefix_terms(self, term: str) -> List[str]:
+        """Основы словаря, начинающиеся с term"""
+        start = bisect_left(self._vocabulary, term)
+        terms = []
+        for candidate in self._vocabulary[start:]:
+            if not candidate.startswith(term):
+                break
+            terms.append(candidate)
+        return terms
+
+    def _typo_terms(self, term: str) -> set:
+        """Основы на расстоянии одной правки (вставка, удаление, замена)"""
+        candidates = set(self._deletes.get(term, ()))        # в запросе пропущена буква
+        for variant in _deletes(term):
+            if variant in self._postings:                    # в запросе лишняя буква
+                candidates.add(variant)
+            candidates |= self._deletes.get(variant, set())   # замена одной буквы
+        candidates.discard(term)
+        return candidates
+
+    def _match_term(self, term: str, allow_typos: bool) -> Dict[int, float]:
+        """Документы, совпавшие с одной основой запроса, и их оценка"""
+        scores: Dict[int, float] = dict(self._postings.get(term, {}))
+
+        for candidate in self._prefix_terms(term):
+            if candidate == term:
+                continue
+            for doc_id, weight in self._postings[candidate].items():
+                scores[doc_id] = max(scores.get(doc_id, 0), weight * PREFIX_FACTOR)
+
+        if not scores and allow_typos and len(term) >= 4:
+            for candidate in self._typo_terms(term):
+                for doc_id, weight in self._postings[candidate].items():
+                    scores[doc_id] = max(scores.get(doc_id, 0), weight * TYPO_FACTOR)
+
+        return scores
+
+    def search(self, query: str, menu_id: Optional[Any] = None,
+               limit: Optional[int] = 10) -> Dict[str, Any]:
+        """
+        Поиск блюд
+
+        Args:
+            query: текст запроса
+            menu_id: искать только в этом меню
+            limit: сколько лучших результатов вернуть (None - все)
+
+        Returns:
+            {'results': [представления блюд], 'total': всего найдено, 'by_menu': {menu_id: найдено}}
+        """
+        terms = tokenize(query)
+        empty = {'results': [], 'total': 0, 'by_menu': {}}
+        if not terms:
+            return empty
+
+        # Все слова запроса должны совпасть (AND), оценки суммируются
+        scores: Optional[Dict[int, float]] = None
+        for term in dict.fromkeys(terms):
+            term_scores = self._match_term(term, allow_typos=True)
+            if scores is None:
+                scores = term_scores
+            else:
+                scores = {doc_id: score + term_scores[doc_id]
+                          for doc_id, score in scores.items() if doc_id in term_scores}
+            if not scores:
+                return empty
+
+        if menu_id is not None:
+            scores = {doc_id: score for doc_id, score in scores.items() if self.docs[doc_id][0] == menu_id}
+
+        # Бонус за совпадение фразы целиком в названии
+        phrase = ' '.join(_WORD_RE.findall(normalize_text(query)))
+        by_menu: Dict[Any, int] = {}
+        ranked = []
+        for doc_id, score in scores.items():
+            doc_menu_id, _, _, name = self.docs[doc_id]
+            if name.startswith(phrase):
+                score += 3
+            elif phrase in name:
+                score += 2
+            by_menu[doc_menu_id] = by_menu.get(doc_menu_id, 0) + 1
+            ranked.append((-score, name, doc_id))
+
+        ranked.sort()
+        if limit is not None:
+            ranked = ranked[:limit]
+
+        results = []
+        for _, _, doc_id in ranked:
+            doc_menu_id, cat_id, dish, _ = self.docs[doc_id]
+            results.append(make_dish_view(
+                dish,
+                category_id=cat_id,
+                category_name=self._category_names.get((doc_menu_id, cat_id), ''),
+                menu_id=doc_menu_id,
+                menu_name=self._menu_names.get(doc_menu_id, '')
+            ))
+
+        return {'results': results, 'total': len(scores), 'by_menu': by_menu}
@@ -0,0 +1,199 @@
+"""
+miniapp_bridge.py
+Доставка сообщений админа из миниаппа: уведомление бота через локальный TCP-порт, БД - надежный резерв
+"""
+
+import asyncio
+import logging
+import socket
+from collections import deque
+from typing import Dict, Any, Optional, Set, Deque
+
+import config
+import database
+
+logger = logging.getLogger(__name__)
+
+# Сколько неотправленных сообщений читать из БД за один запрос
+FETCH_BATCH = 100
+
+# Таймаут уведомления со стороны миниапп-сервера (сек) - запрос админа не должен ждать бота
+NOTIFY_TIMEOUT = 0.5
+
+# Сколько бот ждет строку уведомления от подключившегося клиента (сек)
+NOTIFY_READ_TIMEOUT = 5
+
+
+def notify_bot(host: str = config.MINIAPP_BRIDGE_HOST,
+               port: int = config.MINIAPP_BRIDGE_PORT,
+               timeout: float = NOTIFY_TIMEOUT) -> bool:
+    """
+    Разбудить бота после сохранения сообщения в БД (вызывается миниапп-сервером)
+
+    False - бот недоступен; сообщение все равно уйдет при следующей проверке БД
+    или при запуске бота.
+    """
+    try:
+        with socket.create_connection((host, port), timeout=timeout) as sock:
+            sock.sendall(b'new\n')
+            sock.recv(16)
+        return True
+    except OSError as e:
+        logger.warning(f"⚠️ Не удалось уведомить бота о новом сообщении ({host}:{port}): {e}")
+        return False
+
+
+class MiniappBridge:
+    """
+    Отправка пользователям сообщений, которые админ пишет в миниаппе.
+
+    Миниапп-сервер сохраняет сообщение в chat_messages (sent=0) и сразу
+    будит бота через notify_bot(), бот забирает новые сообщения из БД и
+    отправляет их. Без уведомлений БД проверяется раз в MINIAPP_SWEEP_INTERVAL
+    секунд и при запуске - так уходят сообщения, сохраненные, пока бот не
+    работал. У каждого чата своя очередь: разные чаты отправляются
+    параллельно, сообщения одного чата - строго по порядку.
+    """
+
+    def __init__(self, host: str = config.MINIAPP_BRIDGE_HOST,
+                 port: int = config.MINIAPP_BRIDGE_PORT,
+                 sweep_interval: float = config.MINIAPP_SWEEP_INTERVAL):
+        self.host = host
+        self.port = port
+        self.sweep_interval = sweep_interval
+        self.bot = None
+        self._send = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup = asyncio.Event()
+        self._queues: Dict[int, Deque[Dict[str, Any]]] = {}
+        self._workers: Dict[int, asyncio.Task] = {}
+        # id сообщений в очередях и в процессе отправки
+        self._queued: Set[int] = set()
+        self.stats = {'notifications': 0, 'sweeps': 0, 'sent': 0, 'failed': 0}
+
+    async def start(self, bot):
+        """Открыть порт уведомлений и запустить доставку (с отправкой накопившихся сообщений)"""
+        # Импорт здесь: миниапп-сервер использует notify_bot() без aiogram
+        from handlers.utils import safe_send_message
+
+        async def send(user_id: int, text: str):
+            # safe_send_message сам берет токен общего лимитера Telegram
+            return await safe_send_message(bot, user_id, text)
+
+        self.bot = bot
+        self._send = send
+        try:
+            self._server = await asyncio.start_server(self._handle_client, self.host, self.port)
+            logger.info(f"📨 Ожидаем уведомления миниаппа на {self.host}:{self.port}")
+        except OSError as e:
+            logger.error(f"❌ Не удалось открыть порт уведомлений {self.host}:{self.port}: {e}. "
+                         f"Сообщения будут отправляться по проверке БД раз в {self.sweep_interval} сек")
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Закрыть порт и остановить отправку (неотправленное остается в БД)"""
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+        tasks = list(self._workers.values())
+        if self._task and not self._task.done():
+            tasks.append(self._task)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = None
+        self._workers.clear()
+        self._queues.clear()
+        self._queued.clear()
+
+    def wakeup(self):
+        """Проверить БД на новые сообщения прямо сейчас"""
+        self._wakeup.set()
+
+    async def _handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Уведомление от миниапп-сервера: одна строка, в ответ ok"""
+        try:
+            await asyncio.wait_for(reader.readline(), timeout=NOTIFY_READ_TIMEOUT)
+            self.stats['notifications'] += 1
+            self.wakeup()
+            writer.write(b'ok\n')
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError) as e:
+            logger.debug(f"Обрыв уведомления миниаппа: {e}")
+        finally:
+            writer.close()
+
+    async def _run(self):
+        """Цикл доставки: забрать сообщения из БД, ждать уведомления или следующей проверки"""
+        while True:
+            try:
+                self._wakeup.clear()
+                self.collect()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.sweep_interval)
+                except asyncio.TimeoutError:
+                    self.stats['sweeps'] += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Ошибка доставки сообщений миниаппа: {e}")
+                await asyncio.sleep(5)
+
+    def collect(self) -> int:
+        """Разложить новые неотправленные сообщения из БД по очередям чатов"""
+        added = 0
+        after_id = 0
+        while True:
+            batch = database.get_unsent_admin_messages(after_id=after_id, limit=FETCH_BATCH)
+            for message in batch:
+                if message['id'] in self._queued:
+                    continue
+                user_id = message['user_id']
+                self._queued.add(message['id'])
+                self._queues.setdefault(user_id, deque()).append(message)
+                if user_id not in self._workers:
+                    self._workers[user_id] = asyncio.create_task(self._chat_worker(user_id))
+                added += 1
+            if len(batch) < FETCH_BATCH:
+                return added
+            after_id = batch[-1]['id']
+
+    async def _chat_worker(self, user_id: int):
+        """Последовательная отправка очереди одного чата"""
+        queue = self._queues[user_id]
+        try:
+            while queue:
+                message = queue[0]
+                result = await self._send(user_id, message['message_text'])
+                queue.popleft()
+
+                if result:
+                    database.mark_message_sent(message['id'])
+                    self._queued.discard(message['id'])
+                    self.stats['sent'] += 1
+                    logger.info(f"Сообщение {message['id']} из миниаппа отправлено пользователю {user_id}")
+                    continue
+
+                # Остаток очереди чата ждет следующей проверки БД, чтобы не нарушить порядок
+                self.stats['failed'] += 1
+                logger.error(f"❌ Не удалось отправить сообщение {message['id']} пользователю {user_id}")
+                self._queued.discard(message['id'])
+                for pending in queue:
+                    self._queued.discard(pending['id'])
+                queue.clear()
+        except Exception as e:
+            logger.error(f"❌ Ошибка отправки сообщений миниаппа пользователю {user_id}: {e}")
+            for pending in queue:
+                self._queued.discard(pending['id'])
+            queue.clear()
+        finally:
+            self._workers.pop(user_id, None)
+            self._queues.pop(user_id, None)
+
+
+# Глобальный экземпляр доставки сообщений миниаппа
+miniapp_bridge = MiniappBridge()
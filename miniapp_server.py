@@ -11,6 +11,7 @@ from flask import Flask, jsonify, request
 from flask_cors import CORS
 import database
 import logging
+from miniapp_bridge import notify_bot
 
 # Импортируем бота для отправки сообщений
 try:
@@ -73,8 +74,9 @@ def send_message(chat_id):
             logger.error(f"Failed to save message to database for chat {chat_id}")
             return jsonify({'error': 'Failed to save message'}), 500
 
-        # Сообщение будет отправлено ботом через очередь в базе данных
-        # Миниапп сервер просто сохраняет сообщение с sent=0, бот его подхватит
+        # Сообщение сохранено с sent=0 - будим бота, он отправит его сразу.
+        # Если бот недоступен, сообщение уйдет при его проверке БД
+        notify_bot()
         logger.info(f"Message saved to queue for user {user_chat_id}, bot will send it")
 
         return jsonify({'success': True})
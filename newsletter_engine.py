@@ -0,0 +1,224 @@
+"""
+newsletter_engine.py
+Рассылки: token bucket под лимит Telegram, пул отправителей, статусы доставки в БД
+"""
+
+import asyncio
+import logging
+import time
+from datetime import datetime
+from typing import Dict, Any, Optional, Callable, Awaitable
+
+from aiogram.exceptions import (
+    TelegramRetryAfter,
+    TelegramForbiddenError,
+    TelegramBadRequest,
+    TelegramNetworkError,
+)
+
+import config
+import database
+from async_db import adb
+from rate_limiter import TokenBucket, telegram_limiter
+
+logger = logging.getLogger(__name__)
+
+
+def personalize_newsletter_text(message_text: str, full_name: str) -> str:
+    """Подстановка переменных {Имя пользователя}, {Имя}, {Дата}"""
+    return message_text.replace(
+        '{Имя пользователя}',
+        full_name
+    ).replace(
+        '{Имя}',
+        full_name.split()[0] if full_name and ' ' in full_name else full_name
+    ).replace(
+        '{Дата}',
+        datetime.now().strftime('%d.%m.%Y')
+    )
+
+
+class NewsletterEngine:
+    """
+    Отправка рассылки всем активным пользователям.
+
+    Получатели читаются из SQLite страницами (keyset по user_id), отправку
+    ведут NEWSLETTER_WORKERS задач под token bucket рассылки и общим лимитом
+    бота (rate_limiter.telegram_limiter). Перед отправкой получатель
+    помечается в newsletter_deliveries как 'sending', после - получает
+    итоговый статус, поэтому повторный запуск той же рассылки продолжает
+    с места остановки и не шлет сообщение повторно ни тем, кому оно уже
+    доставлено, ни тем, на ком отправку прервал сбой (результат неизвестен).
+    """
+
+    def __init__(self, rate: float = config.NEWSLETTER_RATE_LIMIT,
+                 workers: int = config.NEWSLETTER_WORKERS,
+                 page_size: int = config.NEWSLETTER_PAGE_SIZE,
+                 max_retries: int = config.MAX_NEWSLETTER_RETRIES):
+        self.rate = rate
+        self.workers = workers
+        self.page_size = page_size
+        self.max_retries = max_retries
+        self._running: Dict[int, Dict[str, Any]] = {}
+
+    def is_running(self, newsletter_id: int) -> bool:
+        """Идет ли сейчас отправка этой рассылки"""
+        return newsletter_id in self._running
+
+    async def _send_one(self, bot, bucket: TokenBucket, user_id: int, text: str,
+                        message_type: str, photo_id: Optional[str],
+                        progress: Optional[Dict[str, bool]] = None) -> tuple:
+        """
+        Отправка одному получателю с повторами. Возвращает (статус, попыток, ошибка)
+
+        progress['requested'] - запрос в Telegram уже ушел (при отмене сообщение могло быть доставлено)
+        """
+        progress = progress if progress is not None else {}
+        attempts = 0
+        while True:
+            attempts += 1
+            progress['requested'] = False
+            # Своя корзина держит скорость рассылки, общая - оставляет запас остальному боту
+            await bucket.acquire()
+            await telegram_limiter.acquire()
+            progress['requested'] = True
+            try:
+                if message_type == 'photo' and photo_id:
+                    await bot.send_photo(chat_id=user_id, photo=photo_id, caption=text, parse_mode="HTML")
+                else:
+                    await bot.send_message(chat_id=user_id, text=text, parse_mode="HTML")
+                return 'sent', attempts, None
+            except TelegramRetryAfter as e:
+                # Флуд-контроль: притормаживаем всех и повторяем этому же получателю
+                logger.warning(f"⏳ Рассылка: Telegram просит подождать {e.retry_after} сек")
+                bucket.pause(e.retry_after)
+                telegram_limiter.pause(e.retry_after)
+                if attempts > self.max_retries:
+                    return 'failed', attempts, f"retry after {e.retry_after}"
+            except TelegramForbiddenError as e:
+                # Бот заблокирован или пользователь удален - повторять бессмысленно
+                return 'blocked', attempts, str(e)[:200]
+            except TelegramBadRequest as e:
+                return 'failed', attempts, str(e)[:200]
+            except TelegramNetworkError as e:
+                if attempts > self.max_retries:
+                    return 'failed', attempts, str(e)[:200]
+                await asyncio.sleep(config.RETRY_DELAY * attempts)
+            except Exception as e:
+                return 'failed', attempts, str(e)[:200]
+
+    async def send(self, newsletter_id: int, bot,
+                   on_progress: Optional[Callable[[Dict[str, Any]], Awaitable[None]]] = None) -> Dict[str, Any]:
+        """
+        Отправка (или продолжение) рассылки
+
+        Args:
+            newsletter_id: ID рассылки
+            bot: экземпляр бота
+            on_progress: корутина, которая получает статистику каждые NEWSLETTER_PROGRESS_INTERVAL секунд
+
+        Returns:
+            Статистика: sent, blocked, failed, total, already_done, elapsed, rate
+        """
+        if newsletter_id in self._running:
+            raise RuntimeError(f"Рассылка #{newsletter_id} уже отправляется")
+
+        newsletter = database.get_newsletter_by_id(newsletter_id)
+        if not newsletter:
+            raise ValueError(f"Рассылка #{newsletter_id} не найдена")
+
+        counts = database.count_newsletter_recipients(newsletter_id)
+        stats = {
+            'sent': 0, 'blocked': 0, 'failed': 0,
+            'total': counts['total'], 'already_done': counts['done'],
+            'elapsed': 0.0, 'rate': 0.0
+        }
+        self._running[newsletter_id] = stats
+        database.update_newsletter_status(newsletter_id, 'sending', counts['done'])
+
+        bucket = TokenBucket(self.rate)
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.workers * 4)
+        started = time.monotonic()
+
+        async def producer():
+            last_user_id = 0
+            while True:
+                page = database.get_newsletter_recipients_page(newsletter_id, last_user_id, self.page_size)
+                if not page:
+                    break
+                for user_id, full_name in page:
+                    await queue.put((user_id, full_name))
+                last_user_id = page[-1][0]
+            for _ in range(self.workers):
+                await queue.put(None)
+
+        async def worker():
+            while True:
+                recipient = await queue.get()
+                if recipient is None:
+                    return
+                user_id, full_name = recipient
+                progress = {'requested': False}
+                try:
+                    # Получателя уже отправляет другой запуск или он обработан - пропускаем
+                    if not await adb.write(database.claim_newsletter_recipient, newsletter_id, user_id):
+                        continue
+                    text = personalize_newsletter_text(
+                        newsletter['message_text'], full_name or f"Пользователь {user_id}"
+                    )
+                    status, attempts, error = await self._send_one(
+                        bot, bucket, user_id, text, newsletter['message_type'], newsletter.get('photo_id'),
+                        progress
+                    )
+                except asyncio.CancelledError:
+                    # Запрос в Telegram не уходил - снимаем пометку, иначе получатель пропадет из дорассылки
+                    if not progress['requested']:
+                        await asyncio.shield(adb.write(database.release_newsletter_recipient,
+                                                       newsletter_id, user_id))
+                    raise
+                stats[status] += 1
+                await adb.write(database.save_newsletter_deliveries, newsletter_id,
+                                [(user_id, status, attempts, error)])
+
+        async def reporter():
+            while True:
+                await asyncio.sleep(config.NEWSLETTER_PROGRESS_INTERVAL)
+                self._update_timing(stats, started)
+                try:
+                    await on_progress(dict(stats))
+                except Exception as e:
+                    logger.error(f"❌ Ошибка обновления прогресса рассылки #{newsletter_id}: {e}")
+
+        tasks = [asyncio.create_task(producer())]
+        tasks += [asyncio.create_task(worker()) for _ in range(self.workers)]
+        if on_progress:
+            tasks.append(asyncio.create_task(reporter()))
+        try:
+            await asyncio.gather(*tasks[:self.workers + 1])
+        finally:
+            # При ошибке одной задачи остальные не должны продолжать отправку
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self._update_timing(stats, started)
+            del self._running[newsletter_id]
+
+        delivered = stats['already_done'] + stats['sent'] + stats['blocked']
+        # partial - есть недоставленные, админу предлагается дослать
+        status = 'partial' if stats['failed'] else 'sent'
+        database.update_newsletter_status(newsletter_id, status, stats['already_done'] + stats['sent'])
+        logger.info(f"✅ Рассылка #{newsletter_id}: отправлено {stats['sent']}, заблокировали {stats['blocked']}, "
+                    f"ошибок {stats['failed']}, всего обработано {delivered}/{stats['total']} "
+                    f"за {stats['elapsed']:.1f} сек ({stats['rate']:.1f} сообщ/сек)")
+        return stats
+
+    @staticmethod
+    def _update_timing(stats: Dict[str, Any], started: float):
+        """Время и фактическая скорость отправки"""
+        stats['elapsed'] = time.monotonic() - started
+        processed = stats['sent'] + stats['blocked'] + stats['failed']
+        stats['rate'] = processed / stats['elapsed'] if stats['elapsed'] > 0 else 0.0
+
+
+# Глобальный экземпляр движка рассылок
+newsletter_engine = NewsletterEngine()
@@ -0,0 +1,208 @@
+"""
+payment_watcher.py
+Отслеживание онлайн-оплаты заказов: один планировщик на все заказы, состояние в SQLite
+"""
+
+import asyncio
+import logging
+import time
+from typing import Dict, Any, Optional, Callable, Awaitable, List
+
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import StorageKey
+
+import config
+import database
+from presto_api import presto_api
+
+logger = logging.getLogger(__name__)
+
+PaymentCallback = Callable[[Dict[str, Any], Dict[str, Any]], Awaitable[None]]
+
+# Планировщик просыпается не реже, чем раз в MAX_IDLE_SLEEP секунд
+MAX_IDLE_SLEEP = 60
+
+
+def is_order_paid(status_result: Dict[str, Any]) -> bool:
+    """Есть ли у заказа закрытая онлайн-оплата"""
+    for payment in status_result.get('payments', []):
+        if payment.get('isClosed', False) and payment.get('paymentType') == 'online':
+            return True
+    return False
+
+
+class PaymentWatcher:
+    """
+    Ожидание оплаты всех заказов одной задачей.
+
+    Заказы хранятся в таблице pending_payments. Проверка статуса идет по
+    расписанию PAYMENT_POLL_SCHEDULE: сначала часто (оплату обычно проводят
+    в первые минуты), потом реже. Все заказы, которым пора, проверяются за
+    один проход с ограничением одновременных запросов в Presto. По оплате или
+    истечении PAYMENT_TIMEOUT вызываются обработчики on_paid / on_expired.
+    После перезапуска бота отслеживание продолжается с сохраненного места.
+    """
+
+    def __init__(self, timeout: float = config.PAYMENT_TIMEOUT,
+                 schedule: Optional[List[float]] = None,
+                 concurrency: int = config.PAYMENT_STATUS_CONCURRENCY):
+        self.timeout = timeout
+        self.schedule = schedule or config.PAYMENT_POLL_SCHEDULE
+        self.concurrency = concurrency
+        self.bot = None
+        self.storage = None
+        self._payments: Dict[str, Dict[str, Any]] = {}
+        self._paid_callbacks: List[PaymentCallback] = []
+        self._expired_callbacks: List[PaymentCallback] = []
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {'checks': 0, 'paid': 0, 'expired': 0}
+
+    def on_paid(self, callback: PaymentCallback) -> PaymentCallback:
+        """Декоратор обработчика оплаты: callback(payment, status_result)"""
+        self._paid_callbacks.append(callback)
+        return callback
+
+    def on_expired(self, callback: PaymentCallback) -> PaymentCallback:
+        """Декоратор обработчика истечения времени оплаты: callback(payment, status_result)"""
+        self._expired_callbacks.append(callback)
+        return callback
+
+    def start(self, bot, storage=None):
+        """Загрузка ожидающих оплат из БД и запуск планировщика"""
+        self.bot = bot
+        self.storage = storage
+        for payment in database.get_pending_payments():
+            self._payments[payment['sale_key']] = payment
+        if self._payments:
+            logger.info(f"💳 Продолжаем ожидать оплату {len(self._payments)} заказов")
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Остановка планировщика (ожидающие оплаты остаются в БД)"""
+        if self._task and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+
+    def watch(self, sale_key: str, user_id: int, order_number: Optional[str] = None):
+        """Начать ожидание оплаты заказа"""
+        now = time.time()
+        payment = {
+            'sale_key': sale_key,
+            'user_id': user_id,
+            'order_number': order_number,
+            'attempts': 0,
+            'next_check_at': now + self.schedule[0],
+            'expires_at': now + self.timeout
+        }
+        database.add_pending_payment(sale_key, user_id, order_number,
+                                     payment['next_check_at'], payment['expires_at'])
+        self._payments[sale_key] = payment
+        self._wakeup.set()
+
+    def finish(self, sale_key: str, status: str = 'cancelled') -> Optional[bool]:
+        """
+        Прекратить ожидание (заказ отменен или оплата подтверждена вручную)
+        
+        True - только у того вызова, который завершил ожидание: заказ по нему
+        оформляет ровно один обработчик. False - ожидание уже завершено раньше.
+        None - ошибка БД: заказ остается под наблюдением и проверяется снова
+        по следующему шагу расписания, а не в каждом проходе планировщика.
+        """
+        finished = database.finish_pending_payment(sale_key, status)
+        if finished is None:
+            payment = self._payments.get(sale_key)
+            if payment is not None:
+                payment['next_check_at'] = time.time() + self._next_delay(payment['attempts'])
+            return None
+        self._payments.pop(sale_key, None)
+        return finished
+
+    def get_user_payments(self, user_id: int) -> List[Dict[str, Any]]:
+        """Ожидающие оплаты заказы пользователя"""
+        return [payment for payment in self._payments.values() if payment['user_id'] == user_id]
+
+    def state_for(self, user_id: int) -> Optional[FSMContext]:
+        """FSM-контекст пользователя для обработчиков (вне апдейта Telegram)"""
+        if self.storage is None or self.bot is None:
+            return None
+        key = StorageKey(bot_id=self.bot.id, chat_id=user_id, user_id=user_id)
+        return FSMContext(storage=self.storage, key=key)
+
+    def _next_delay(self, attempts: int) -> float:
+        return self.schedule[min(attempts, len(self.schedule) - 1)]
+
+    async def _run(self):
+        """Цикл планировщика: проверяет заказы, которым пора, и спит до следующего"""
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def check(payment):
+            async with semaphore:
+                await self._check(payment)
+
+        while True:
+            try:
+                self._wakeup.clear()
+                now = time.time()
+                due = [p for p in self._payments.values() if p['next_check_at'] <= now]
+                if due:
+                    await asyncio.gather(*(check(payment) for payment in due))
+
+                if self._payments:
+                    sleep_for = min(p['next_check_at'] for p in self._payments.values()) - time.time()
+                    sleep_for = min(max(sleep_for, 0), MAX_IDLE_SLEEP)
+                else:
+                    sleep_for = MAX_IDLE_SLEEP
+
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=sleep_for)
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Ошибка планировщика оплат: {e}")
+                await asyncio.sleep(5)
+
+    async def _check(self, payment: Dict[str, Any]):
+        """Одна проверка статуса оплаты заказа"""
+        sale_key = payment['sale_key']
+        status_result = await presto_api.get_order_status(sale_key)
+        self.stats['checks'] += 1
+
+        if sale_key not in self._payments:
+            # Пока шел запрос, ожидание отменили
+            return
+
+        if 'error' not in status_result and is_order_paid(status_result):
+            if self.finish(sale_key, 'paid'):
+                self.stats['paid'] += 1
+                await self._fire(self._paid_callbacks, payment, status_result)
+            return
+
+        now = time.time()
+        if now >= payment['expires_at']:
+            if self.finish(sale_key, 'expired'):
+                self.stats['expired'] += 1
+                await self._fire(self._expired_callbacks, payment, status_result)
+            return
+
+        payment['attempts'] += 1
+        payment['next_check_at'] = min(now + self._next_delay(payment['attempts']), payment['expires_at'])
+        database.update_pending_payment(sale_key, payment['attempts'], payment['next_check_at'])
+
+    async def _fire(self, callbacks: List[PaymentCallback], payment: Dict[str, Any], status_result: Dict[str, Any]):
+        for callback in callbacks:
+            try:
+                await callback(payment, status_result)
+            except Exception as e:
+                logger.error(f"❌ Ошибка обработчика оплаты заказа {payment['sale_key']}: {e}")
+
+
+# Глобальный экземпляр планировщика оплат
+payment_watcher = PaymentWatcher()
@@ -4,10 +4,16 @@ import asyncio
 import aiohttp
 import base64
 import os
+import time
 from datetime import datetime
 from typing import Dict, List, Optional, Any, Tuple
 import config
 import database
+from media_registry import media_registry
+from geocode_cache import (
+    geocode_cache, normalize_address, coords_key,
+    GEOCODE_TTL, REVERSE_TTL, SUGGEST_TTL
+)
 
 logger = logging.getLogger(__name__)
 
@@ -19,6 +25,7 @@ class PrestoAPI:
         self.point_id = 3596  # MASHKOV.REST
         self.base_url = "https://api.sbis.ru/retail"
         self.session = None
+        self.dadata_session = None
         
         # Меню для загрузки
         self.menus = {
@@ -30,6 +37,10 @@ class PrestoAPI:
         # Кэш промокодов (id: code)
         self.promocodes = {}
         
+        # Фоновая загрузка фото блюд после синхронизации меню
+        self._images_task: Optional[asyncio.Task] = None
+        self.last_sync_stats: Dict[str, Any] = {}
+        
         logger.info(f"🔌 Инициализация PrestoAPI")
         logger.info(f"   Точка ID: {self.point_id} (MASHKOV.REST)")
     
@@ -47,9 +58,18 @@ class PrestoAPI:
     
     async def close_session(self):
         """Закрытие сессии"""
+        if self._images_task and not self._images_task.done():
+            self._images_task.cancel()
+            try:
+                await self._images_task
+            except asyncio.CancelledError:
+                pass
         if self.session:
             await self.session.close()
             self.session = None
+        if self.dadata_session:
+            await self.dadata_session.close()
+            self.dadata_session = None
     
     # ===== ФУНКЦИИ ДЛЯ РАБОТЫ С АДРЕСАМИ И ДОСТАВКОЙ =====
     
@@ -60,57 +80,66 @@ class PrestoAPI:
                          door_code: str = '',
                          locality: str = 'Москва') -> List[Dict]:
         """
-        Корректировка адреса через API Presto
+        Корректировка адреса через API Presto (с кэшем)
         GET /delivery/suggested-address
         """
         try:
-            await self.init_session()
-        
-            url = f"{self.base_url}/delivery/suggested-address"
-        
             # Добавляем город к запросу для точного поиска
             if not any(city in address.lower() for city in ['москва', 'мск', 'moscow']):
                 search_address = f"Москва, {address}"
             else:
                 search_address = address
         
-            params = {
-                'address': search_address,
-                'aptNum': apartment,
-                'entrance': entrance,
-                'floor': floor,
-                'doorCode': door_code,
-                'pageSize': 10
-            }
-        
-            logger.info(f"📍 Корректировка адреса: {search_address}")
-        
-            async with self.session.get(url, params=params) as response:
-                response_text = await response.text()
-            
-                if response.status == 200:
-                    data = await response.json()
-                    addresses = data.get('addresses', [])
-                
-                    logger.info(f"✅ Найдено {len(addresses)} вариантов адреса")
-                
-                    # Фильтруем московские адреса
-                    moscow_addresses = []
-                    for addr in addresses:
-                        address_full = addr.get('addressFull', '').lower()
-                        if any(moscow_keyword in address_full 
-                               for moscow_keyword in ['москва', 'мск', 'moscow', 'moskva']):
-                            moscow_addresses.append(addr)
-                
-                    if not moscow_addresses and addresses:
-                        moscow_addresses = [addresses[0]]
-                
-                    return moscow_addresses
+            cache_key = '|'.join([normalize_address(search_address), apartment, entrance, floor, door_code])
+            addresses = await geocode_cache.get_or_fetch(
+                'suggest', cache_key,
+                lambda: self._fetch_suggested_addresses(search_address, apartment, entrance, floor, door_code),
+                ttl=SUGGEST_TTL
+            )
+            return addresses or []
                     
         except Exception as e:
             logger.error(f"❌ Ошибка корректировки адреса: {e}")
             return []
     
+    async def _fetch_suggested_addresses(self, search_address: str, apartment: str, entrance: str,
+                                         floor: str, door_code: str) -> List[Dict]:
+        """Запрос подсказок адреса в Presto (ошибка ответа - исключение, чтобы она не попала в кэш)"""
+        await self.init_session()
+        
+        url = f"{self.base_url}/delivery/suggested-address"
+        
+        params = {
+            'address': search_address,
+            'aptNum': apartment,
+            'entrance': entrance,
+            'floor': floor,
+            'doorCode': door_code,
+            'pageSize': 10
+        }
+        
+        logger.info(f"📍 Корректировка адреса: {search_address}")
+        
+        async with self.session.get(url, params=params) as response:
+            response.raise_for_status()
+            data = await response.json()
+            addresses = data.get('addresses', [])
+            
+            logger.info(f"✅ Найдено {len(addresses)} вариантов адреса")
+            
+            # Фильтруем московские адреса
+            moscow_addresses = []
+            for addr in addresses:
+                address_full = addr.get('addressFull', '').lower()
+                if any(moscow_keyword in address_full 
+                       for moscow_keyword in ['москва', 'мск', 'moscow', 'moskva']):
+                    moscow_addresses.append(addr)
+            
+            if not moscow_addresses and addresses:
+                moscow_addresses = [addresses[0]]
+            
+            return moscow_addresses
+    
     async def get_delivery_districts(self, with_coordinates: bool = True) -> List[Dict]:
         """
         Получение списка районов доставки
@@ -143,43 +172,67 @@ class PrestoAPI:
             logger.error(f"❌ Ошибка получения районов: {e}")
             return []
     
+    async def _get_dadata_session(self) -> aiohttp.ClientSession:
+        """Общая сессия DaData (соединения переиспользуются между запросами)"""
+        if not self.dadata_session or self.dadata_session.closed:
+            self.dadata_session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=10),
+                headers={
+                    "Content-Type": "application/json",
+                    "Accept": "application/json",
+                    "Authorization": f"Token {config.DADATA_API_KEY}",
+                    "X-Secret": config.DADATA_SECRET_KEY
+                }
+            )
+        return self.dadata_session
+    
+    async def reverse_geocode_address(self, latitude: float, longitude: float,
+                                      radius_meters: int = 100) -> Optional[str]:
+        """
+        Адрес по координатам через DaData (с кэшем по координатам, округленным до ~10 м, и радиусу поиска)
+        
+        Returns:
+            Адрес или None, если DaData его не нашел
+        """
+        return await geocode_cache.get_or_fetch(
+            'reverse', f"{coords_key(latitude, longitude)}:{radius_meters}",
+            lambda: self._dadata_reverse_geocode(latitude, longitude, radius_meters),
+            ttl=REVERSE_TTL
+        )
+    
+    async def _dadata_reverse_geocode(self, latitude: float, longitude: float,
+                                      radius_meters: int) -> Optional[str]:
+        """Запрос обратного геокодирования в DaData"""
+        url = "https://suggestions.dadata.ru/suggestions/api/4_1/rs/geolocate/address"
+        
+        data = {
+            "lat": latitude,
+            "lon": longitude,
+            "count": 1,
+            "radius_meters": radius_meters
+        }
+        
+        session = await self._get_dadata_session()
+        async with session.post(url, json=data) as response:
+            response.raise_for_status()
+            result = await response.json()
+            
+            if result.get('suggestions') and len(result['suggestions']) > 0:
+                address = result['suggestions'][0].get('value', '')
+                logger.info(f"📍 DaData обратное геокодирование: {latitude}, {longitude} → {address}")
+                return address
+        
+        return None
+    
     async def reverse_geocode(self, latitude: float, longitude: float) -> Optional[str]:
         """Обратное геокодирование через DaData"""
         try:
-            DADATA_API_KEY = config.DADATA_API_KEY
-            DADATA_SECRET_KEY = config.DADATA_SECRET_KEY
-        
-            if not DADATA_API_KEY or not DADATA_SECRET_KEY:
+            if not config.DADATA_API_KEY or not config.DADATA_SECRET_KEY:
                 logger.warning("⚠️ Нет ключей DaData для обратного геокодирования")
                 return f"{latitude:.6f}, {longitude:.6f}"
         
-            url = "https://suggestions.dadata.ru/suggestions/api/4_1/rs/geolocate/address"
-        
-            headers = {
-                "Content-Type": "application/json",
-                "Accept": "application/json",
-                "Authorization": f"Token {DADATA_API_KEY}",
-                "X-Secret": DADATA_SECRET_KEY
-            }
-        
-            data = {
-                "lat": latitude,
-                "lon": longitude,
-                "count": 1,
-                "radius_meters": 100
-            }
-        
-            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10)) as session:
-                async with session.post(url, headers=headers, json=data) as response:
-                    if response.status == 200:
-                        result = await response.json()
-                    
-                        if result.get('suggestions') and len(result['suggestions']) > 0:
-                            address = result['suggestions'][0].get('value', '')
-                            logger.info(f"📍 DaData обратное геокодирование: {latitude}, {longitude} → {address}")
-                            return address
-        
-            return f"{latitude:.6f}, {longitude:.6f}"
+            address = await self.reverse_geocode_address(latitude, longitude)
+            return address or f"{latitude:.6f}, {longitude:.6f}"
         
         except Exception as e:
             logger.error(f"❌ Ошибка обратного геокодирования: {e}")
@@ -187,66 +240,31 @@ class PrestoAPI:
 
     async def geocode_address(self, address: str) -> Optional[Dict[str, float]]:
         """
-        Геокодирование через DaData API с очисткой кэша
+        Геокодирование: сохраненные адреса клиентов, кэш, затем DaData API
         """
         try:
-            DADATA_API_KEY = config.DADATA_API_KEY
-            DADATA_SECRET_KEY = config.DADATA_SECRET_KEY
-        
             logger.info(f"📍 Геокодирование адреса: {address}")
         
-            url = "https://suggestions.dadata.ru/suggestions/api/4_1/rs/suggest/address"
-        
-            headers = {
-                "Content-Type": "application/json",
-                "Accept": "application/json",
-                "Authorization": f"Token {DADATA_API_KEY}",
-                "X-Secret": DADATA_SECRET_KEY
-            }
+            # Адрес уже сохраняли клиенты - координаты известны
+            saved = await geocode_cache.saved_address_coordinates(address)
+            if saved:
+                logger.info(f"✅ Координаты из сохраненных адресов: {saved['lat']:.6f}, {saved['lon']:.6f}")
+                return saved
         
-            # Добавляем параметр для отключения кэша
-            data = {
-                "query": address,
-                "count": 1,
-                "language": "ru",
-                "locations": [
-                    {"kladr_id": "7700000000000"},  # Москва
-                    {"kladr_id": "5000000000000"}   # Московская область
-                ],
-                "restrict_value": True,
-                "from_bound": {"value": "street"},  # Точнее геокодирование
-                "to_bound": {"value": "house"}      # До дома
-            }
-        
-            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10)) as session:
-                async with session.post(url, headers=headers, json=data) as response:
-                    if response.status == 200:
-                        result = await response.json()
-                    
-                        if result.get('suggestions') and len(result['suggestions']) > 0:
-                            suggestion = result['suggestions'][0]
-                            suggestion_data = suggestion.get('data', {})
-                        
-                            # Детальный логинг
-                            logger.info(f"📍 DaData результат для '{address}':")
-                            logger.info(f"   📍 Полный адрес: {suggestion.get('value')}")
-                            logger.info(f"   📍 Регион: {suggestion_data.get('region')}")
-                            logger.info(f"   📍 Город: {suggestion_data.get('city')}")
-                            logger.info(f"   📍 Улица: {suggestion_data.get('street')}")
-                            logger.info(f"   📍 Дом: {suggestion_data.get('house')}")
-                        
-                            geo_lat = suggestion_data.get('geo_lat')
-                            geo_lon = suggestion_data.get('geo_lon')
-                        
-                            if geo_lat and geo_lon:
-                                lat = float(geo_lat)
-                                lon = float(geo_lon)
-                                logger.info(f"✅ Координаты найдены: {lat:.6f}, {lon:.6f}")
-                                return {'lat': lat, 'lon': lon}
-                            else:
-                                logger.warning(f"⚠️ DaData не вернул координаты для '{address}'")
+            try:
+                coords = await geocode_cache.get_or_fetch(
+                    'geocode', normalize_address(address),
+                    lambda: self._dadata_geocode(address),
+                    ttl=GEOCODE_TTL
+                )
+            except Exception as e:
+                # Ошибка DaData (ключи, квота, 5xx, сеть) в кэш не попадает
+                logger.warning(f"⚠️ DaData недоступен для '{address}': {e}")
+                coords = None
+            if coords:
+                return coords
         
-            # Если DaData не нашел, используем упрощенное геокодирование как запасной вариант
+            # Если DaData не нашел или недоступен, используем упрощенное геокодирование как запасной вариант
             logger.info(f"📍 Используем упрощенное геокодирование для: {address}")
             return self._simple_geocode(address)
             
@@ -254,6 +272,53 @@ class PrestoAPI:
             logger.error(f"❌ Ошибка геокодирования: {e}")
             return {'lat': 55.7558, 'lon': 37.6176}
     
+    async def _dadata_geocode(self, address: str) -> Optional[Dict[str, float]]:
+        """Запрос координат адреса в DaData (None - адрес не найден)"""
+        url = "https://suggestions.dadata.ru/suggestions/api/4_1/rs/suggest/address"
+        
+        data = {
+            "query": address,
+            "count": 1,
+            "language": "ru",
+            "locations": [
+                {"kladr_id": "7700000000000"},  # Москва
+                {"kladr_id": "5000000000000"}   # Московская область
+            ],
+            "restrict_value": True,
+            "from_bound": {"value": "street"},  # Точнее геокодирование
+            "to_bound": {"value": "house"}      # До дома
+        }
+        
+        session = await self._get_dadata_session()
+        async with session.post(url, json=data) as response:
+            response.raise_for_status()
+            result = await response.json()
+            
+            if result.get('suggestions') and len(result['suggestions']) > 0:
+                suggestion = result['suggestions'][0]
+                suggestion_data = suggestion.get('data', {})
+                
+                # Детальный логинг
+                logger.info(f"📍 DaData результат для '{address}':")
+                logger.info(f"   📍 Полный адрес: {suggestion.get('value')}")
+                logger.info(f"   📍 Регион: {suggestion_data.get('region')}")
+                logger.info(f"   📍 Город: {suggestion_data.get('city')}")
+                logger.info(f"   📍 Улица: {suggestion_data.get('street')}")
+                logger.info(f"   📍 Дом: {suggestion_data.get('house')}")
+                
+                geo_lat = suggestion_data.get('geo_lat')
+                geo_lon = suggestion_data.get('geo_lon')
+                
+                if geo_lat and geo_lon:
+                    lat = float(geo_lat)
+                    lon = float(geo_lon)
+                    logger.info(f"✅ Координаты найдены: {lat:.6f}, {lon:.6f}")
+                    return {'lat': lat, 'lon': lon}
+                else:
+                    logger.warning(f"⚠️ DaData не вернул координаты для '{address}'")
+        
+        return None
+    
     def _simple_geocode(self, address: str) -> Dict[str, float]:
         """Упрощенное геокодирование"""
         address_lower = address.lower()
@@ -815,9 +880,12 @@ class PrestoAPI:
         else:
             return None
     
-    async def get_menu_by_id(self, menu_id: int) -> Dict:
+    async def get_menu_by_id(self, menu_id: int, download_images: bool = True) -> Dict:
         """
         Получение меню по ID
+        
+        download_images=False - только пути к фото, загрузку делает вызывающий
+        (get_all_menus загружает фото всех меню одним фоновым этапом)
         """
         try:
             await self.init_session()
@@ -850,7 +918,10 @@ class PrestoAPI:
                     logger.info(f"📂 Найдено категорий: {len(categories)}")
                     
                     structured_menu = self._structure_menu_by_categories(all_items, categories, menu_id)
-                    await self._download_menu_images(structured_menu)
+                    if download_images:
+                        await self._download_menu_images(structured_menu)
+                    else:
+                        self._prepare_menu_images(structured_menu)
                     
                     return structured_menu
                 else:
@@ -1066,14 +1137,11 @@ class PrestoAPI:
             logger.error(f"❌ Ошибка извлечения данных блюда: {e}")
             return None
     
-    async def _download_menu_images(self, structured_menu: Dict):
-        """Загружает изображения"""
+    def _prepare_menu_images(self, structured_menu: Dict) -> Dict[str, Tuple[str, int]]:
+        """Пути к фото блюд; возвращает фото, которых еще нет на диске: {путь: (url, id блюда)}"""
+        missing = {}
         if not structured_menu:
-            return
-        
-        os.makedirs(config.MENU_IMAGES_DIR, exist_ok=True)
-        
-        download_tasks = []
+            return missing
         
         for category_id, category_data in structured_menu.items():
             for dish in category_data['items']:
@@ -1083,20 +1151,39 @@ class PrestoAPI:
                     dish['image_local_path'] = save_path
                     
                     if not os.path.exists(save_path):
-                        download_tasks.append(
-                            self._download_single_image(image_url, save_path, dish['id'])
-                        )
+                        missing[save_path] = (image_url, dish['id'])
                     else:
                         dish['image_downloaded'] = True
+        return missing
+    
+    async def _download_menu_images(self, structured_menu: Dict):
+        """Загружает изображения"""
+        await self._download_images(self._prepare_menu_images(structured_menu))
+    
+    async def _download_images(self, missing: Dict[str, Tuple[str, int]]) -> int:
+        """Загрузка фото с ограничением одновременных запросов; возвращает число загруженных"""
+        if not missing:
+            return 0
         
-        if download_tasks:
-            logger.info(f"🖼️ Загружаем {len(download_tasks)} изображений...")
-            try:
-                results = await asyncio.gather(*download_tasks, return_exceptions=True)
-                successful = sum(1 for r in results if r is True)
-                logger.info(f"✅ Изображений загружено: {successful}/{len(download_tasks)}")
-            except Exception as e:
-                logger.error(f"❌ Ошибка при загрузке изображений: {e}")
+        os.makedirs(config.MENU_IMAGES_DIR, exist_ok=True)
+        semaphore = asyncio.Semaphore(config.MENU_IMAGE_CONCURRENCY)
+        
+        async def download(save_path, image_url, dish_id):
+            async with semaphore:
+                return await self._download_single_image(image_url, save_path, dish_id)
+        
+        logger.info(f"🖼️ Загружаем {len(missing)} изображений...")
+        try:
+            results = await asyncio.gather(
+                *(download(save_path, image_url, dish_id) for save_path, (image_url, dish_id) in missing.items()),
+                return_exceptions=True
+            )
+            successful = sum(1 for r in results if r is True)
+            logger.info(f"✅ Изображений загружено: {successful}/{len(missing)}")
+            return successful
+        except Exception as e:
+            logger.error(f"❌ Ошибка при загрузке изображений: {e}")
+            return 0
     
     async def _download_single_image(self, image_url: str, save_path: str, dish_id: int) -> bool:
         """Загрузка одного изображения"""
@@ -1110,6 +1197,8 @@ class PrestoAPI:
                     with open(save_path, 'wb') as f:
                         f.write(image_data)
                     
+                    # Файл заменен - прежний file_id Telegram больше не соответствует картинке
+                    media_registry.invalidate(save_path)
                     return True
                 else:
                     return False
@@ -1163,25 +1252,42 @@ class PrestoAPI:
             logger.error(f"❌ Ошибка при получении списка прайс-листов: {e}")
             return []
 
-    async def get_all_menus(self) -> Dict[int, Dict]:
-        """Получает все доступные меню через API прайс-листов"""
+    async def get_all_menus(self, wait_for_images: bool = False) -> Dict[int, Dict]:
+        """
+        Получает все доступные меню через API прайс-листов
+        
+        Прайс-листы загружаются параллельно (не больше MENU_SYNC_CONCURRENCY
+        одновременно), фото блюд всех меню докачиваются одним фоновым этапом
+        после возврата меню - если не передан wait_for_images=True.
+        """
         all_menus = {}
+        started = time.monotonic()
 
         # Сначала получаем список всех доступных прайс-листов
         price_lists = await self.get_price_lists()
+        price_lists_time = time.monotonic() - started
 
         if not price_lists:
             logger.warning("⚠️ Не удалось получить список прайс-листов, используем известные меню")
             # Fallback на известные меню
             price_lists = [{'id': menu_id, 'name': menu_name} for menu_id, menu_name in self.menus.items()]
 
-        # Загружаем меню для каждого прайс-листа
-        for price_list in price_lists:
+        semaphore = asyncio.Semaphore(config.MENU_SYNC_CONCURRENCY)
+
+        async def load_menu(price_list):
             menu_id = int(price_list['id'])
-            menu_name = price_list['name']
+            async with semaphore:
+                logger.info(f"📥 Загружаем меню '{price_list['name']}' (ID: {menu_id})")
+                return menu_id, await self.get_menu_by_id(menu_id, download_images=False)
+
+        menus_started = time.monotonic()
+        results = await asyncio.gather(*(load_menu(price_list) for price_list in price_lists))
+        menus_time = time.monotonic() - menus_started
 
-            logger.info(f"📥 Загружаем меню '{menu_name}' (ID: {menu_id})")
-            menu_data = await self.get_menu_by_id(menu_id)
+        # Порядок меню - как в списке прайс-листов
+        missing_images = {}
+        for price_list, (menu_id, menu_data) in zip(price_lists, results):
+            menu_name = price_list['name']
 
             if menu_data:
                 all_menus[menu_id] = {
@@ -1189,6 +1295,8 @@ class PrestoAPI:
                     'name': menu_name,
                     'categories': menu_data
                 }
+                # Одно блюдо в нескольких меню - одна загрузка фото
+                missing_images.update(self._prepare_menu_images(menu_data))
 
                 categories_count = len(menu_data)
                 total_items = sum(len(cat['items']) for cat in menu_data.values())
@@ -1196,8 +1304,48 @@ class PrestoAPI:
             else:
                 logger.warning(f"⚠️ Меню '{menu_name}' (ID: {menu_id}) не загружено")
 
-        logger.info(f"📊 Всего загружено меню: {len(all_menus)}")
+        self.last_sync_stats = {
+            'price_lists': len(price_lists),
+            'menus': len(all_menus),
+            'price_lists_time': price_lists_time,
+            'menus_time': menus_time,
+            'images_pending': len(missing_images),
+            'images_downloaded': 0,
+            'images_time': 0.0,
+        }
+        logger.info(f"📊 Всего загружено меню: {len(all_menus)} "
+                    f"(прайс-листы {price_lists_time:.2f} сек, меню {menus_time:.2f} сек, "
+                    f"фото к загрузке: {len(missing_images)})")
+
+        if missing_images:
+            self.schedule_images(missing_images)
+            if wait_for_images:
+                await self.wait_for_images()
         return all_menus
 
+    def schedule_images(self, images: Dict[str, Tuple[str, int]]):
+        """Фоновая загрузка фото {путь: (url, id блюда)} - после уже запущенной, файлы перезаписываются"""
+        if images:
+            self._images_task = asyncio.create_task(self._sync_images(images, self._images_task))
+
+    async def _sync_images(self, missing_images: Dict[str, Tuple[str, int]], previous: Optional[asyncio.Task] = None):
+        """Фоновый этап синхронизации меню - загрузка фото блюд"""
+        if previous and not previous.done():
+            # Загрузки идут по очереди, чтобы не превышать MENU_IMAGE_CONCURRENCY
+            await previous
+        started = time.monotonic()
+        downloaded = await self._download_images(missing_images)
+        images_time = time.monotonic() - started
+        self.last_sync_stats.update({'images_downloaded': downloaded, 'images_time': images_time})
+        logger.info(f"🖼️ Фото меню загружены: {downloaded}/{len(missing_images)} за {images_time:.2f} сек")
+
+    async def wait_for_images(self):
+        """Дождаться фоновой загрузки фото меню (для скриптов, которые завершаются сразу после синхронизации)"""
+        if self._images_task and not self._images_task.done():
+            try:
+                await self._images_task
+            except asyncio.CancelledError:
+                pass
+
 # Глобальный экземпляр API
 presto_api = PrestoAPI()
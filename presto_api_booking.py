@@ -1,8 +1,10 @@
-﻿import requests
+﻿import aiohttp
+import asyncio
 import logging
 import os
 import json
 import datetime
+import time
 from typing import Optional, Dict, Any, List
 from config import PRESTO_ACCESS_TOKEN
 
@@ -14,9 +16,72 @@ HEADERS = {
     "Content-Type": "application/json"
 }
 
+# Пул соединений с Presto: держим keep-alive, чтобы не открывать TLS на каждый запрос
+CONNECTION_LIMIT = 20
+DEFAULT_TIMEOUT = 10
+
+# Пакетная проверка слотов: не больше стольких запросов схемы зала одновременно
+SLOT_PROBE_CONCURRENCY = 6
+DAY_FIRST_SLOT = "08:00"
+DAY_LAST_SLOT = "20:30"
+
+# Схема зала: ответы живут несколько секунд, одинаковые запросы объединяются в один
+HALL_CACHE_TTL = 5
+HALL_CACHE_MAX_SIZE = 512
+
 EXAMPLES_DIR = "examples"
 os.makedirs(EXAMPLES_DIR, exist_ok=True)
 
+_session: Optional[aiohttp.ClientSession] = None
+
+# (point_id, hall_id, date_time) -> (время получения, ответ) и запросы, которые сейчас в полете
+_hall_cache: Dict[tuple, tuple] = {}
+_hall_inflight: Dict[tuple, asyncio.Future] = {}
+
+
+async def init_session() -> aiohttp.ClientSession:
+    """Инициализация общей сессии (как PrestoAPI.init_session, но с токеном SBIS)"""
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            headers=HEADERS,
+            timeout=aiohttp.ClientTimeout(total=DEFAULT_TIMEOUT),
+            connector=aiohttp.TCPConnector(limit=CONNECTION_LIMIT, ttl_dns_cache=300)
+        )
+    return _session
+
+
+async def close_session():
+    """Закрытие сессии"""
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
+
+
+async def _request(method: str, url: str, error_message: str, timeout: int = DEFAULT_TIMEOUT,
+                   log_status: bool = False, **kwargs) -> Optional[Dict[str, Any]]:
+    """
+    Запрос к Presto через общую сессию
+
+    Возвращает JSON ответа или None при ошибке (текст ошибки и тело ответа печатаются)
+    """
+    try:
+        session = await init_session()
+        async with session.request(method, url, timeout=aiohttp.ClientTimeout(total=timeout), **kwargs) as response:
+            if log_status:
+                print(f"📊 [Presto] Статус ответа: {response.status}")
+            if response.status >= 400:
+                body = await response.text()
+                print(f"❌ [Presto] {error_message}: HTTP {response.status} {response.reason}")
+                print(f"📩 Тело ошибки: {body[:500]}")
+                return None
+            return await response.json(content_type=None)
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        print(f"❌ [Presto] {error_message}: {e!r}")
+        return None
+
+
 def save_example(data: dict, filename: str):
     """Сохранить пример ответа API в файл"""
     try:
@@ -27,7 +92,7 @@ def save_example(data: dict, filename: str):
     except Exception as e:
         print(f"⚠️ Ошибка сохранения: {e}")
 
-def get_booking_calendar(from_date: str, to_date: str, point_id: int = 3596) -> Optional[Dict[str, Any]]:
+async def get_booking_calendar(from_date: str, to_date: str, point_id: int = 3596) -> Optional[Dict[str, Any]]:
     """
     Получить доступные интервалы бронирования — https://saby.ru/help/integration/api/app_presto/Presto_reserv/time
     
@@ -41,22 +106,66 @@ def get_booking_calendar(from_date: str, to_date: str, point_id: int = 3596) ->
         "fromDate": from_date,
         "toDate": to_date
     }
-    try:
-        print(f"📅 [Presto] Запрос календаря: {params}")
-        response = requests.get(url, params=params, headers=HEADERS, timeout=10)
-        response.raise_for_status()
-        data = response.json()
-        safe_name = f"calendar_{from_date}_to_{to_date}.json".replace(".", "-")
-        save_example(data, safe_name)
-        print(f"✅ [Presto] Календарь получен, записей: {len(data.get('dates', []))}")
-        return data
-    except requests.exceptions.RequestException as e:
-        print(f"❌ [Presto] Ошибка календаря: {e}")
-        if hasattr(e, 'response') and e.response:
-            print(f"📩 Тело ошибки: {e.response.text}")
+    print(f"📅 [Presto] Запрос календаря: {params}")
+    data = await _request("GET", url, "Ошибка календаря", params=params)
+    if data is None:
         return None
 
-def get_hall_tables(date_time: str, hall_id: Optional[int] = None, point_id: int = 3596) -> Optional[Dict[str, Any]]:
+    safe_name = f"calendar_{from_date}_to_{to_date}.json".replace(".", "-")
+    save_example(data, safe_name)
+    print(f"✅ [Presto] Календарь получен, записей: {len(data.get('dates', []))}")
+    return data
+
+def invalidate_hall_cache(date_time: Optional[str] = None, point_id: Optional[int] = None):
+    """
+    Сбросить кэш схемы зала
+
+    Без аргументов сбрасывается весь кэш, иначе - только записи указанного слота/точки (по всем залам).
+    Запросы в полете забываются, чтобы следующий вызов получил свежую схему.
+    """
+    for storage in (_hall_cache, _hall_inflight):
+        for key in [key for key in storage
+                    if (point_id is None or key[0] == point_id) and (date_time is None or key[2] == date_time)]:
+            del storage[key]
+
+def _store_hall_tables(key: tuple, task: asyncio.Future):
+    """Сохранение результата завершившегося запроса схемы зала"""
+    if _hall_inflight.get(key) is not task:
+        return  # кэш сбросили, пока запрос был в полете - результат мог устареть
+    del _hall_inflight[key]
+    if task.cancelled() or task.exception() is not None or task.result() is None:
+        return
+
+    now = time.monotonic()
+    if len(_hall_cache) >= HALL_CACHE_MAX_SIZE:
+        for stale_key in [k for k, (fetched_at, _) in _hall_cache.items() if now - fetched_at >= HALL_CACHE_TTL]:
+            del _hall_cache[stale_key]
+        if len(_hall_cache) >= HALL_CACHE_MAX_SIZE:
+            _hall_cache.pop(next(iter(_hall_cache)))
+    _hall_cache[key] = (now, task.result())
+
+async def get_hall_tables(date_time: str, hall_id: Optional[int] = None, point_id: int = 3596) -> Optional[Dict[str, Any]]:
+    """
+    Получить схему зала на конкретное время (с кэшем на HALL_CACHE_TTL секунд).
+
+    Одновременные запросы одного слота ждут один общий запрос к Presto.
+    Возвращаемый словарь общий для всех вызывающих - не изменяйте его.
+    """
+    key = (point_id, hall_id, date_time)
+    cached = _hall_cache.get(key)
+    if cached and time.monotonic() - cached[0] < HALL_CACHE_TTL:
+        return cached[1]
+
+    task = _hall_inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_fetch_hall_tables(date_time, hall_id, point_id))
+        _hall_inflight[key] = task
+        task.add_done_callback(lambda done: _store_hall_tables(key, done))
+
+    # shield: отмена одного ожидающего не должна отменять общий запрос
+    return await asyncio.shield(task)
+
+async def _fetch_hall_tables(date_time: str, hall_id: Optional[int] = None, point_id: int = 3596) -> Optional[Dict[str, Any]]:
     """
     Получить схему зала на конкретное время.
     
@@ -88,45 +197,45 @@ def get_hall_tables(date_time: str, hall_id: Optional[int] = None, point_id: int
 
     print(f"📊 [Presto] Запрос схемы зала: {params}")
     
-    try:
-        response = requests.get(url, params=params, headers=HEADERS, timeout=10)
-        response.raise_for_status()
-        data = response.json()
-        
-        # Генерируем имя файла
-        safe_date = date_time.replace(":", "_").replace(" ", "_")
-        safe_name = f"hall_{point_id}_{safe_date}.json"
-        if hall_id:
-            safe_name = f"hall_{point_id}_{hall_id}_{safe_date}.json"
-        
-        save_example(data, safe_name)
-        
-        # Логируем результат
-        halls_count = len(data.get('halls', []))
-        items_total = 0
-        for hall in data.get('halls', []):
-            items_total += len(hall.get('items', []))
-        
-        print(f"✅ [Presto] Схема зала получена")
-        print(f"   📍 Залы: {halls_count}")
-        print(f"   🪑 Всего элементов: {items_total}")
-        
-        return data
-    except requests.exceptions.RequestException as e:
-        print(f"❌ [Presto] Ошибка схемы зала: {e}")
-        if hasattr(e, 'response') and e.response:
-            print(f"📩 Тело ошибки: {e.response.text[:500]}")
+    data = await _request("GET", url, "Ошибка схемы зала", params=params)
+    if data is None:
         return None
 
-def get_available_tables(date_time: str, guests: int, hall_id: Optional[int] = None, point_id: int = 3596) -> List[Dict[str, Any]]:
+    # Генерируем имя файла
+    safe_date = date_time.replace(":", "_").replace(" ", "_")
+    safe_name = f"hall_{point_id}_{safe_date}.json"
+    if hall_id:
+        safe_name = f"hall_{point_id}_{hall_id}_{safe_date}.json"
+
+    save_example(data, safe_name)
+
+    # Логируем результат
+    halls_count = len(data.get('halls', []))
+    items_total = 0
+    for hall in data.get('halls', []):
+        items_total += len(hall.get('items', []))
+
+    print(f"✅ [Presto] Схема зала получена")
+    print(f"   📍 Залы: {halls_count}")
+    print(f"   🪑 Всего элементов: {items_total}")
+
+    return data
+
+async def get_available_tables(date_time: str, guests: int, hall_id: Optional[int] = None, point_id: int = 3596) -> List[Dict[str, Any]]:
     """
     Получить список доступных столов для бронирования
     Возвращает список словарей с информацией о столах
     """
-    hall_data = get_hall_tables(date_time, hall_id, point_id)
+    hall_data = await get_hall_tables(date_time, hall_id, point_id)
     if not hall_data:
         return []
-    
+
+    available_tables = extract_available_tables(hall_data, guests)
+    print(f"✅ [Presto] Найдено доступных столов: {len(available_tables)}")
+    return available_tables
+
+def extract_available_tables(hall_data: Dict[str, Any], guests: int) -> List[Dict[str, Any]]:
+    """Свободные для брони столы из ответа схемы зала"""
     available_tables = []
     
     for hall in hall_data.get('halls', []):
@@ -167,11 +276,67 @@ def get_available_tables(date_time: str, guests: int, hall_id: Optional[int] = N
             }
             
             available_tables.append(table_info)
-    
-    print(f"✅ [Presto] Найдено доступных столов: {len(available_tables)}")
+
     return available_tables
 
-def create_booking(
+def day_time_slots(step_minutes: int = 30, first_slot: str = DAY_FIRST_SLOT, last_slot: str = DAY_LAST_SLOT) -> List[str]:
+    """Все слоты дня с заданным шагом: ["08:00", "08:30", ..., "20:30"]"""
+    first = datetime.datetime.strptime(first_slot, "%H:%M")
+    last = datetime.datetime.strptime(last_slot, "%H:%M")
+    slots = []
+    while first <= last:
+        slots.append(first.strftime("%H:%M"))
+        first += datetime.timedelta(minutes=step_minutes)
+    return slots
+
+async def get_slots_availability(
+    date: str,
+    guests: int,
+    slots: Optional[List[str]] = None,
+    hall_id: Optional[int] = None,
+    point_id: int = 3596,
+    concurrency: int = SLOT_PROBE_CONCURRENCY
+) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Свободные столы сразу для нескольких слотов одного дня
+
+    Схемы зала запрашиваются параллельно (не больше concurrency одновременно),
+    поэтому проверка нескольких слотов занимает примерно одно время ответа Presto.
+
+    Args:
+        date: дата "2026-01-07"
+        guests: количество гостей
+        slots: время слотов ["08:00", "12:00", ...]; по умолчанию - весь день с шагом 30 минут
+
+    Returns:
+        {слот: список свободных столов} в порядке slots; при ошибке запроса - пустой список
+    """
+    if slots is None:
+        slots = day_time_slots()
+
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def probe(slot: str) -> List[Dict[str, Any]]:
+        async with semaphore:
+            hall_data = await get_hall_tables(f"{date} {slot}:00", hall_id, point_id)
+        if not hall_data:
+            return []
+        return extract_available_tables(hall_data, guests)
+
+    results = await asyncio.gather(*(probe(slot) for slot in slots), return_exceptions=True)
+
+    availability = {}
+    for slot, tables in zip(slots, results):
+        if isinstance(tables, Exception):
+            print(f"❌ [Presto] Ошибка проверки слота {date} {slot}: {tables!r}")
+            tables = []
+        availability[slot] = tables
+
+    free_slots = sum(1 for tables in availability.values() if tables)
+    print(f"✅ [Presto] Проверено слотов: {len(slots)}, со свободными столами: {free_slots}")
+    return availability
+
+async def create_booking(
     phone: str,
     name: str,
     datetime_str: str,
@@ -208,64 +373,57 @@ def create_booking(
     print(f"📝 [Presto] Создание брони...")
     print(f"📝 [Presto] Payload: {json.dumps(payload, indent=2, ensure_ascii=False)}")
     
-    try:
-        response = requests.post(url, json=payload, headers=HEADERS, timeout=15)
-        print(f"📝 [Presto] Статус ответа: {response.status_code}")
-        
-        response.raise_for_status()
-        data = response.json()
-        
-        # СОХРАНИТЕ ПОЛНЫЙ ОТВЕТ ДЛЯ АНАЛИЗА
-        save_example(data, f"booking_full_response_{datetime_str.replace(':', '_').replace(' ', '_')}.json")
-        
-        print(f"✅ [Presto] Бронь создана успешно!")
-        
-        # РАСПЕЧАТАЙТЕ ВСЮ СТРУКТУРУ ОТВЕТА
-        print("📋 [Presto] Полная структура ответа:")
-        print(json.dumps(data, indent=2, ensure_ascii=False))
-        
-        # ИЩИТЕ ID В РАЗНЫХ МЕСТАХ
-        external_id = None
-        search_paths = [
-            ('id',),
-            ('order', 'id'),
-            ('externalId',),
-            ('booking_id',),
-            ('bookingId',),
-            ('reservationId',),
-            ('data', 'id'),
-            ('result', 'id'),
-            ('response', 'id')
-        ]
-        
-        for path in search_paths:
-            try:
-                value = data
-                for key in path:
-                    value = value[key]
-                if value:
-                    external_id = str(value)
-                    print(f"🎯 [Presto] Найден ID по пути {path}: {external_id}")
-                    break
-            except (KeyError, TypeError):
-                continue
-        
-        if external_id:
-            data['_extracted_id'] = external_id
-            print(f"🎉 [Presto] ID брони извлечен: {external_id}")
-        else:
-            print(f"⚠️ [Presto] ID брони не найден в ответе!")
-            print(f"⚠️ [Presto] Ключи в ответе: {list(data.keys())}")
-        
-        return data
-        
-    except requests.exceptions.RequestException as e:
-        print(f"❌ [Presto] Ошибка создания брони: {e}")
-        if hasattr(e, 'response') and e.response:
-            print(f"📩 Тело ошибки: {e.response.text[:500]}")
+    data = await _request("POST", url, "Ошибка создания брони", timeout=15, log_status=True, json=payload)
+    # Даже при ошибке бронь могла создаться - занятость слота надо перечитать
+    invalidate_hall_cache(datetime_str, point_id)
+    if data is None:
         return None
 
-def get_booking_info(external_id: str) -> Optional[Dict[str, Any]]:
+    # СОХРАНИТЕ ПОЛНЫЙ ОТВЕТ ДЛЯ АНАЛИЗА
+    save_example(data, f"booking_full_response_{datetime_str.replace(':', '_').replace(' ', '_')}.json")
+
+    print(f"✅ [Presto] Бронь создана успешно!")
+
+    # РАСПЕЧАТАЙТЕ ВСЮ СТРУКТУРУ ОТВЕТА
+    print("📋 [Presto] Полная структура ответа:")
+    print(json.dumps(data, indent=2, ensure_ascii=False))
+
+    # ИЩИТЕ ID В РАЗНЫХ МЕСТАХ
+    external_id = None
+    search_paths = [
+        ('id',),
+        ('order', 'id'),
+        ('externalId',),
+        ('booking_id',),
+        ('bookingId',),
+        ('reservationId',),
+        ('data', 'id'),
+        ('result', 'id'),
+        ('response', 'id')
+    ]
+
+    for path in search_paths:
+        try:
+            value = data
+            for key in path:
+                value = value[key]
+            if value:
+                external_id = str(value)
+                print(f"🎯 [Presto] Найден ID по пути {path}: {external_id}")
+                break
+        except (KeyError, TypeError):
+            continue
+
+    if external_id:
+        data['_extracted_id'] = external_id
+        print(f"🎉 [Presto] ID брони извлечен: {external_id}")
+    else:
+        print(f"⚠️ [Presto] ID брони не найден в ответе!")
+        print(f"⚠️ [Presto] Ключи в ответе: {list(data.keys())}")
+
+    return data
+
+async def get_booking_info(external_id: str) -> Optional[Dict[str, Any]]:
     """
     Получить информацию о бронировании по ID
     Метод: GET
@@ -277,27 +435,16 @@ def get_booking_info(external_id: str) -> Optional[Dict[str, Any]]:
     print(f"🔍 [Presto] Формирую URL: {url}")
     print(f"🔍 [Presto] External ID: '{external_id}' (длина: {len(external_id)})")
     
-    try:
-        print(f"📋 [Presto] Запрос информации о бронировании: {external_id}")
-        response = requests.get(url, headers=HEADERS, timeout=10)
-        
-        # Логируем статус
-        print(f"📊 [Presto] Статус ответа: {response.status_code}")
-        
-        response.raise_for_status()
-        data = response.json()
-        
-        save_example(data, f"booking_info_{external_id}.json")
-        print(f"✅ [Presto] Информация о брони получена")
-        return data
-        
-    except requests.exceptions.RequestException as e:
-        print(f"❌ [Presto] Ошибка получения информации о брони: {e}")
-        if hasattr(e, 'response') and e.response:
-            print(f"📩 Тело ошибки: {e.response.text[:500]}")
+    print(f"📋 [Presto] Запрос информации о бронировании: {external_id}")
+    data = await _request("GET", url, "Ошибка получения информации о брони", log_status=True)
+    if data is None:
         return None
 
-def update_booking(external_id: str, booking_data: dict) -> Optional[Dict[str, Any]]:
+    save_example(data, f"booking_info_{external_id}.json")
+    print(f"✅ [Presto] Информация о брони получена")
+    return data
+
+async def update_booking(external_id: str, booking_data: dict) -> Optional[Dict[str, Any]]:
     """
     Изменить бронирование
     Метод: PUT
@@ -305,22 +452,18 @@ def update_booking(external_id: str, booking_data: dict) -> Optional[Dict[str, A
     """
     url = f"{BASE_URL}/retail/order/{external_id}/update"
     
-    try:
-        print(f"✏️ [Presto] Обновление бронирования: {external_id}")
-        response = requests.put(url, json=booking_data, headers=HEADERS, timeout=10)
-        response.raise_for_status()
-        data = response.json()
-        
-        save_example(data, f"booking_update_{external_id}.json")
-        print(f"✅ [Presto] Бронирование обновлено")
-        return data
-    except requests.exceptions.RequestException as e:
-        print(f"❌ [Presto] Ошибка обновления брони: {e}")
-        if hasattr(e, 'response') and e.response:
-            print(f"📩 Тело ошибки: {e.response.text[:500]}")
+    print(f"✏️ [Presto] Обновление бронирования: {external_id}")
+    data = await _request("PUT", url, "Ошибка обновления брони", json=booking_data)
+    # Прежний слот брони здесь неизвестен - сбрасываем кэш схем целиком
+    invalidate_hall_cache()
+    if data is None:
         return None
 
-def cancel_booking(external_id: str) -> Optional[Dict[str, Any]]:
+    save_example(data, f"booking_update_{external_id}.json")
+    print(f"✅ [Presto] Бронирование обновлено")
+    return data
+
+async def cancel_booking(external_id: str) -> Optional[Dict[str, Any]]:
     """
     Отменить бронирование
     Метод: PUT
@@ -328,22 +471,18 @@ def cancel_booking(external_id: str) -> Optional[Dict[str, Any]]:
     """
     url = f"{BASE_URL}/retail/order/{external_id}/cancel"
     
-    try:
-        print(f"❌ [Presto] Отмена бронирования: {external_id}")
-        response = requests.put(url, headers=HEADERS, timeout=10)
-        response.raise_for_status()
-        data = response.json()
-        
-        save_example(data, f"booking_cancel_{external_id}.json")
-        print(f"✅ [Presto] Бронирование отменено")
-        return data
-    except requests.exceptions.RequestException as e:
-        print(f"❌ [Presto] Ошибка отмены брони: {e}")
-        if hasattr(e, 'response') and e.response:
-            print(f"📩 Тело ошибки: {e.response.text[:500]}")
+    print(f"❌ [Presto] Отмена бронирования: {external_id}")
+    data = await _request("PUT", url, "Ошибка отмены брони")
+    # Слот отмененной брони здесь неизвестен - сбрасываем кэш схем целиком
+    invalidate_hall_cache()
+    if data is None:
         return None
 
-def get_booking_state(external_id: str) -> Optional[Dict[str, Any]]:
+    save_example(data, f"booking_cancel_{external_id}.json")
+    print(f"✅ [Presto] Бронирование отменено")
+    return data
+
+async def get_booking_state(external_id: str) -> Optional[Dict[str, Any]]:
     """
     Получить статус бронирования
     Метод: GET
@@ -351,20 +490,14 @@ def get_booking_state(external_id: str) -> Optional[Dict[str, Any]]:
     """
     url = f"{BASE_URL}/retail/order/{external_id}/state"
     
-    try:
-        print(f"📊 [Presto] Запрос статуса бронирования: {external_id}")
-        response = requests.get(url, headers=HEADERS, timeout=10)
-        response.raise_for_status()
-        data = response.json()
-        
-        save_example(data, f"booking_state_{external_id}.json")
-        print(f"✅ [Presto] Статус брони получен")
-        return data
-    except requests.exceptions.RequestException as e:
-        print(f"❌ [Presto] Ошибка получения статуса брони: {e}")
-        if hasattr(e, 'response') and e.response:
-            print(f"📩 Тело ошибки: {e.response.text[:500]}")
+    print(f"📊 [Presto] Запрос статуса бронирования: {external_id}")
+    data = await _request("GET", url, "Ошибка получения статуса брони")
+    if data is None:
         return None
+        
+    save_example(data, f"booking_state_{external_id}.json")
+    print(f"✅ [Presto] Статус брони получен")
+    return data
 
 # Добавим статусы для удобства
 BOOKING_STATUSES = {
@@ -381,35 +514,38 @@ BOOKING_STATUSES = {
 }
 # ===== ТЕСТОВЫЕ ФУНКЦИИ =====
 
-def test_presto_api():
+async def test_presto_api():
     """Тестирование всех функций API Presto"""
     print("🚀 Запуск теста API Presto...")
     
-    # 1. Тест календаря
-    print("\n1. 📅 Тест календаря бронирования:")
-    from_date = datetime.datetime.now().strftime("%d.%m.%Y")
-    to_date = (datetime.datetime.now() + datetime.timedelta(days=7)).strftime("%d.%m.%Y")
-    calendar = get_booking_calendar(from_date, to_date)
+    try:
+        # 1. Тест календаря
+        print("\n1. 📅 Тест календаря бронирования:")
+        from_date = datetime.datetime.now().strftime("%d.%m.%Y")
+        to_date = (datetime.datetime.now() + datetime.timedelta(days=7)).strftime("%d.%m.%Y")
+        calendar = await get_booking_calendar(from_date, to_date)
     
-    if calendar:
-        print(f"   ✅ Календарь получен")
-        print(f"   📅 Дней доступно: {len(calendar.get('dates', []))}")
+        if calendar:
+            print(f"   ✅ Календарь получен")
+            print(f"   📅 Дней доступно: {len(calendar.get('dates', []))}")
     
-    # 2. Тест схемы зала
-    print("\n2. 🏛️ Тест схемы зала:")
-    test_date = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    hall_data = get_hall_tables(test_date)
+        # 2. Тест схемы зала
+        print("\n2. 🏛️ Тест схемы зала:")
+        test_date = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        hall_data = await get_hall_tables(test_date)
     
-    if hall_data:
-        print(f"   ✅ Схема зала получена")
+        if hall_data:
+            print(f"   ✅ Схема зала получена")
     
-    # 3. Тест доступных столов
-    print("\n3. 🪑 Тест доступных столов:")
-    tables = get_available_tables(test_date, guests=2)
-    print(f"   ✅ Доступных столов: {len(tables)}")
+        # 3. Тест доступных столов
+        print("\n3. 🪑 Тест доступных столов:")
+        tables = await get_available_tables(test_date, guests=2)
+        print(f"   ✅ Доступных столов: {len(tables)}")
+    finally:
+        await close_session()
     
     print("\n✅ Тест API Presto завершен!")
 
 if __name__ == "__main__":
     # Запуск теста при прямом выполнении файла
-    test_presto_api()
+    asyncio.run(test_presto_api())
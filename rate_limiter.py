@@ -0,0 +1,138 @@
+"""
+rate_limiter.py
+Общий ограничитель скорости запросов к Telegram: лимит на бота и на отдельный чат
+"""
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Optional, Callable, Awaitable, Any
+
+from aiogram.exceptions import TelegramRetryAfter
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# Сколько корзин отдельных чатов держать в памяти
+MAX_CHAT_BUCKETS = 1000
+
+
+class TokenBucket:
+    """
+    Ограничитель скорости: rate токенов в секунду, запас не больше capacity.
+
+    pause() останавливает выдачу для всех отправителей - Telegram при
+    флуд-контроле (RetryAfter) ограничивает бота целиком, а не один чат.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds: float):
+        """Не выдавать токены ближайшие seconds секунд"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+    def is_idle(self) -> bool:
+        """Запас восстановлен полностью и никто не ждет токен"""
+        if self._lock.locked() or time.monotonic() < self._paused_until:
+            return False
+        return self._tokens + (time.monotonic() - self._updated) * self.rate >= self.capacity
+
+    async def acquire(self):
+        """Дождаться токена"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    self._updated = time.monotonic()
+                    continue
+
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class TelegramRateLimiter:
+    """
+    Лимит запросов к Telegram, общий для всех частей бота.
+
+    Глобальная корзина держит бота ниже лимита Telegram на все чаты
+    (рассылки и обычные ответы делят ее между собой), корзина чата
+    разрешает короткий всплеск сообщений одному пользователю (категория
+    меню) и затем ограничивает скорость, чтобы не получить RetryAfter.
+    """
+
+    def __init__(self, rate: float = config.TELEGRAM_RATE_LIMIT,
+                 chat_rate: float = config.TELEGRAM_CHAT_RATE_LIMIT,
+                 chat_burst: float = config.TELEGRAM_CHAT_BURST):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._global = TokenBucket(rate)
+        self._chats: "OrderedDict[int, TokenBucket]" = OrderedDict()
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        """Корзина чата (неиспользуемые вытесняются, когда их много)"""
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self._chats[chat_id] = bucket
+            if len(self._chats) > MAX_CHAT_BUCKETS:
+                for old_chat_id in [cid for cid, b in self._chats.items() if b.is_idle()]:
+                    del self._chats[old_chat_id]
+        else:
+            self._chats.move_to_end(chat_id)
+        return bucket
+
+    async def acquire(self, chat_id: Optional[int] = None):
+        """Дождаться разрешения на запрос (в чат chat_id или без привязки к чату)"""
+        if chat_id is not None:
+            await self._chat_bucket(chat_id).acquire()
+        await self._global.acquire()
+
+    def pause(self, seconds: float, chat_id: Optional[int] = None):
+        """Притормозить отправку в чат или всего бота после RetryAfter"""
+        if chat_id is not None:
+            self._chat_bucket(chat_id).pause(seconds)
+        else:
+            self._global.pause(seconds)
+
+    async def call(self, chat_id: Optional[int], request: Callable[[], Awaitable[Any]],
+                   max_retries: int = 2, acquired: bool = False) -> Any:
+        """
+        Выполнить запрос request() под лимитом, повторяя его после RetryAfter
+
+        Args:
+            chat_id: чат, в который идет запрос
+            request: фабрика корутины запроса (вызывается на каждую попытку)
+            max_retries: сколько раз повторять после RetryAfter
+            acquired: разрешение на первую попытку уже получено через acquire()
+        """
+        attempts = 0
+        while True:
+            if not acquired:
+                await self.acquire(chat_id)
+            acquired = False
+            try:
+                return await request()
+            except TelegramRetryAfter as e:
+                attempts += 1
+                logger.warning(f"⏳ Telegram просит подождать {e.retry_after} сек (чат {chat_id})")
+                self.pause(e.retry_after, chat_id)
+                if attempts > max_retries:
+                    raise
+
+
+# Глобальный ограничитель запросов к Telegram
+telegram_limiter = TelegramRateLimiter()
@@ -0,0 +1,129 @@
+"""
+retention.py
+Хранение истории: перенос старых событий и сообщений в архивную БД и сжатие основной БД ночью
+"""
+
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Any, Optional, Tuple
+
+import config
+import database
+from async_db import adb
+
+logger = logging.getLogger(__name__)
+
+# Как часто планировщик проверяет, не началось ли окно обслуживания (сек)
+CHECK_INTERVAL = 600
+
+
+class RetentionManager:
+    """
+    Обслуживание БД раз в сутки в окне RETENTION_WINDOW.
+
+    Строки stats и chat_messages старше заданного срока переносятся пачками
+    в архивную БД (ARCHIVE_DB_PATH) - каждая пачка отдельной транзакцией
+    через поток записи, так что обычные запросы бота не ждут весь перенос.
+    Сводная статистика (stats_daily/stats_hourly) не трогается и хранит
+    историю за все время. После переноса свободные страницы возвращаются
+    системе (incremental_vacuum), а WAL усекается.
+    """
+
+    def __init__(self, window: Tuple[int, int] = config.RETENTION_WINDOW,
+                 batch_size: int = config.RETENTION_BATCH_SIZE):
+        self.window = window
+        self.batch_size = batch_size
+        self.retention_days = {
+            'stats': config.RETENTION_STATS_DAYS,
+            'chat_messages': config.RETENTION_CHAT_DAYS,
+        }
+        self._task: Optional[asyncio.Task] = None
+        self._last_run_day = None
+        self.last_report: Optional[Dict[str, Any]] = None
+
+    def start(self):
+        """Запуск планировщика обслуживания"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Остановка планировщика (прерванный перенос продолжится в следующий раз)"""
+        if self._task and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+
+    def in_window(self, now: Optional[datetime] = None) -> bool:
+        """Идет ли сейчас окно обслуживания"""
+        start_hour, end_hour = self.window
+        hour = (now or datetime.now()).hour
+        if start_hour <= end_hour:
+            return start_hour <= hour < end_hour
+        # Окно через полночь, например (23, 2)
+        return hour >= start_hour or hour < end_hour
+
+    async def _run(self):
+        """Цикл планировщика: один проход обслуживания за сутки"""
+        while True:
+            try:
+                now = datetime.now()
+                if self.in_window(now) and self._last_run_day != now.date():
+                    await self.run_once()
+                    self._last_run_day = now.date()
+                await asyncio.sleep(CHECK_INTERVAL)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Ошибка обслуживания БД: {e}")
+                await asyncio.sleep(CHECK_INTERVAL)
+
+    async def archive_table(self, table: str, days: int) -> int:
+        """Перенос строк таблицы старше days дней в архив"""
+        cutoff = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d')
+        moved = 0
+        while True:
+            batch = await adb.write(database.archive_old_rows, table, cutoff,
+                                    config.ARCHIVE_DB_PATH, self.batch_size)
+            moved += batch
+            if batch < self.batch_size:
+                return moved
+            # Между пачками в поток записи успевают запросы бота
+            await asyncio.sleep(0)
+
+    async def run_once(self) -> Dict[str, Any]:
+        """Перенос старых строк, сжатие БД и отчет об освобожденном месте"""
+        started = time.monotonic()
+        before = await adb.read(database.get_db_space_info)
+
+        archived = {}
+        for table, days in self.retention_days.items():
+            archived[table] = await self.archive_table(table, days)
+
+        compacted = await adb.write(database.compact_database)
+        after = await adb.read(database.get_db_space_info)
+
+        report = {
+            'finished_at': datetime.now().isoformat(),
+            'archived': archived,
+            'compacted': compacted,
+            'db_bytes': after['db_bytes'],
+            'wal_bytes': after['wal_bytes'],
+            'reclaimed_bytes': (before['db_bytes'] + before['wal_bytes']) - (after['db_bytes'] + after['wal_bytes']),
+            'duration': time.monotonic() - started,
+        }
+        self.last_report = report
+
+        moved = ', '.join(f"{table}: {count}" for table, count in archived.items())
+        logger.info(f"🗄️ Обслуживание БД: в архив перенесено {moved}; "
+                    f"освобождено {report['reclaimed_bytes'] / 1024 / 1024:.1f} МБ "
+                    f"(БД {report['db_bytes'] / 1024 / 1024:.1f} МБ) за {report['duration']:.1f} сек")
+        return report
+
+
+# Глобальный экземпляр обслуживания БД
+retention_manager = RetentionManager()
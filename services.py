@@ -5,6 +5,7 @@ services.py
 
 import database
 import config
+from action_log import action_log
 from datetime import datetime
 import asyncio
 import logging
@@ -423,6 +424,6 @@ def init_database():
     """Инициализация базы данных"""
     database.init_database()
 
-def get_bot_stats():
+async def get_bot_stats():
     """Получение статистики бота"""
-    return database.get_stats()
+    return await action_log.get_stats()